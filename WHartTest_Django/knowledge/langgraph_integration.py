@@ -2,19 +2,93 @@
 LangGraph与知识库集成模块
 提供RAG功能的LangGraph节点和状态管理
 """
+import asyncio
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, TypedDict, Annotated
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
 from langchain_core.documents import Document as LangChainDocument
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END, START
 from langgraph.graph.message import add_messages
+from langgraph_integration.response_cache import build_context_fingerprint, get_llm_cache_key, get_semantic_cache
 from .models import KnowledgeBase
-from .services import KnowledgeBaseService
+from .services import VectorStoreManager
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 向量检索（嵌入计算 + Chroma查询）是同步阻塞调用，异步路径统一放入有界线程池执行，
+# 避免一次慢速嵌入请求阻塞整个事件循环上的其他对话流
+_retrieval_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'KNOWLEDGE_RETRIEVAL_MAX_WORKERS', 4),
+    thread_name_prefix='rag-retrieval'
+)
+
+
+# 向量存储管理器按知识库复用：知识库ID -> (知识库更新时间, 管理器)，知识库配置更新后重建
+_vector_managers: Dict[Any, Any] = {}
+_vector_managers_lock = threading.Lock()
+
+
+def get_vector_manager(knowledge_base_id: str) -> VectorStoreManager:
+    """获取知识库的向量存储管理器，避免每次检索重新构建服务与嵌入客户端"""
+    knowledge_base = KnowledgeBase.objects.get(id=knowledge_base_id)
+    with _vector_managers_lock:
+        cached = _vector_managers.get(knowledge_base.pk)
+    if cached and cached[0] == knowledge_base.updated_at:
+        return cached[1]
+
+    vector_manager = VectorStoreManager(knowledge_base)
+    with _vector_managers_lock:
+        _vector_managers[knowledge_base.pk] = (knowledge_base.updated_at, vector_manager)
+    logger.info(f"Created vector manager for knowledge base: {knowledge_base.pk}")
+    return vector_manager
+
+
+def search_knowledge_base(knowledge_base_id: str, query: str, top_k: int = 5,
+                          similarity_threshold: float = 0.7) -> List[Dict[str, Any]]:
+    """在指定知识库中执行相似度检索（同步）"""
+    return get_vector_manager(knowledge_base_id).similarity_search(
+        query, k=top_k, score_threshold=similarity_threshold
+    )
+
+
+def _with_fresh_connections(func, *args):
+    """
+    在线程池中执行任务，前后清理数据库连接
+    线程池的工作线程长期存活，不经过请求结束时的连接清理，需手动关闭失效或超过CONN_MAX_AGE的连接
+    """
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_retrieval_executor(func, *args):
+    """在检索线程池中执行同步调用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_retrieval_executor, _with_fresh_connections, func, *args)
+
+
+async def asearch_knowledge_base(knowledge_base_id: str, query: str, top_k: int = 5,
+                                 similarity_threshold: float = 0.7) -> List[Dict[str, Any]]:
+    """在指定知识库中执行相似度检索（异步，使用有界线程池）"""
+    return await run_in_retrieval_executor(
+        search_knowledge_base, knowledge_base_id, query, top_k, similarity_threshold
+    )
+
+
+def embed_knowledge_base_query(knowledge_base_id: str, text: str) -> List[float]:
+    """使用知识库配置的嵌入模型计算文本向量（同步）"""
+    return get_vector_manager(knowledge_base_id).embeddings.embed_query(text)
+
 
 class RAGState(TypedDict):
     """RAG状态定义"""
@@ -46,9 +120,9 @@ class KnowledgeRAGService:
         """构建RAG图"""
         graph_builder = StateGraph(RAGState)
 
-        # 添加节点
-        graph_builder.add_node("retrieve", self._retrieve_node)
-        graph_builder.add_node("generate", self._generate_node)
+        # 添加节点（同时提供同步与异步实现，invoke/ainvoke各走各的路径）
+        graph_builder.add_node("retrieve", RunnableLambda(self._retrieve_node, afunc=self._aretrieve_node))
+        graph_builder.add_node("generate", RunnableLambda(self._generate_node, afunc=self._agenerate_node))
 
         # 设置边
         graph_builder.add_edge(START, "retrieve")
@@ -57,38 +131,32 @@ class KnowledgeRAGService:
 
         return graph_builder.compile()
 
+    def _should_retrieve(self, state: RAGState) -> bool:
+        """检查是否需要使用知识库"""
+        if not state.get("use_knowledge_base", True):
+            logger.info("跳过知识库检索")
+            return False
+        if not state.get("knowledge_base_id"):
+            logger.warning("未提供知识库ID")
+            return False
+        return True
+
     def _retrieve_node(self, state: RAGState) -> Dict[str, Any]:
         """检索节点"""
         start_time = time.time()
 
         try:
-            # 检查是否需要使用知识库
-            if not state.get("use_knowledge_base", True):
-                logger.info("跳过知识库检索")
-                return {
-                    "context": [],
-                    "retrieval_time": time.time() - start_time
-                }
-
-            # 获取知识库
-            knowledge_base_id = state.get("knowledge_base_id")
-            if not knowledge_base_id:
-                logger.warning("未提供知识库ID")
+            if not self._should_retrieve(state):
                 return {
                     "context": [],
                     "retrieval_time": time.time() - start_time
                 }
 
-            knowledge_base = KnowledgeBase.objects.get(id=knowledge_base_id)
-            service = KnowledgeBaseService(knowledge_base)
-
-            # 获取检索参数
-            top_k = state.get("top_k", 5)
-            similarity_threshold = state.get("similarity_threshold", 0.7)
-
             # 执行检索
-            search_results = service.vector_manager.similarity_search(
-                state["question"], k=top_k, score_threshold=similarity_threshold
+            search_results = search_knowledge_base(
+                state["knowledge_base_id"], state["question"],
+                top_k=state.get("top_k", 5),
+                similarity_threshold=state.get("similarity_threshold", 0.7)
             )
 
             retrieval_time = time.time() - start_time
@@ -107,31 +175,60 @@ class KnowledgeRAGService:
                 "retrieval_time": time.time() - start_time
             }
 
-    def _generate_node(self, state: RAGState) -> Dict[str, Any]:
-        """生成节点"""
+    async def _aretrieve_node(self, state: RAGState) -> Dict[str, Any]:
+        """检索节点（异步）"""
         start_time = time.time()
 
         try:
-            # 构建上下文
-            context_sources = state.get("context", [])
-            context_text = ""
+            if not self._should_retrieve(state):
+                return {
+                    "context": [],
+                    "retrieval_time": time.time() - start_time
+                }
+
+            search_results = await asearch_knowledge_base(
+                state["knowledge_base_id"], state["question"],
+                top_k=state.get("top_k", 5),
+                similarity_threshold=state.get("similarity_threshold", 0.7)
+            )
+
+            retrieval_time = time.time() - start_time
+            logger.info(f"检索完成: 找到 {len(search_results)} 个相关片段，耗时 {retrieval_time:.3f}s")
+
+            return {
+                "context": search_results,
+                "retrieval_time": retrieval_time
+            }
+
+        except Exception as e:
+            logger.error(f"检索失败: {e}")
+            return {
+                "context": [],
+                "retrieval_time": time.time() - start_time
+            }
 
-            if context_sources:
-                # 构建详细的上下文信息
-                context_parts = []
-                for i, result in enumerate(context_sources[:3], 1):
-                    content = result.get("content", "")
-                    score = result.get("similarity_score", 0.0)
-                    metadata = result.get("metadata", {})
-                    source = metadata.get("source", "未知来源")
+    def _build_generate_messages(self, state: RAGState) -> List:
+        """构建生成节点的提示消息"""
+        # 构建上下文
+        context_sources = state.get("context", [])
+        context_text = ""
+
+        if context_sources:
+            # 构建详细的上下文信息
+            context_parts = []
+            for i, result in enumerate(context_sources[:3], 1):
+                content = result.get("content", "")
+                score = result.get("similarity_score", 0.0)
+                metadata = result.get("metadata", {})
+                source = metadata.get("source", "未知来源")
 
-                    context_parts.append(f"[来源{i}: {source} (相似度: {score:.2f})]\n{content}")
+                context_parts.append(f"[来源{i}: {source} (相似度: {score:.2f})]\n{content}")
 
-                context_text = "\n\n".join(context_parts)
+            context_text = "\n\n".join(context_parts)
 
-            # 构建提示
-            if context_text:
-                system_prompt = """你是一个智能助手，请基于提供的上下文信息回答用户的问题。
+        # 构建提示
+        if context_text:
+            system_prompt = """你是一个智能助手，请基于提供的上下文信息回答用户的问题。
 
 请遵循以下原则：
 1. 优先使用上下文信息中的内容回答问题
@@ -143,28 +240,90 @@ class KnowledgeRAGService:
 上下文信息：
 {context}"""
 
-                messages = [
-                    SystemMessage(content=system_prompt.format(context=context_text)),
-                    HumanMessage(content=state["question"])
-                ]
+            messages = [
+                SystemMessage(content=system_prompt.format(context=context_text)),
+                HumanMessage(content=state["question"])
+            ]
 
-                logger.info(f"使用知识库上下文生成回答，上下文长度: {len(context_text)}")
-            else:
-                system_prompt = """你是一个智能助手，请回答用户的问题。
+            logger.info(f"使用知识库上下文生成回答，上下文长度: {len(context_text)}")
+        else:
+            system_prompt = """你是一个智能助手，请回答用户的问题。
 由于没有找到相关的知识库信息，请基于你的一般知识回答，并明确说明这不是基于特定文档的回答。"""
 
-                messages = [
-                    SystemMessage(content=system_prompt),
-                    HumanMessage(content=state["question"])
-                ]
+            messages = [
+                SystemMessage(content=system_prompt),
+                HumanMessage(content=state["question"])
+            ]
+
+            logger.info("未找到相关上下文，使用一般知识回答")
+
+        return messages
+
+    def _lookup_semantic_answer(self, state: RAGState):
+        """
+        查询语义缓存，返回 (命中的回答, 问题向量)
+        只有启用语义缓存且本次检索到上下文时才查询；作用域为 知识库 + 上下文指纹，模型参数需一致
+        """
+        cache = get_semantic_cache()
+        if cache is None or not state.get("knowledge_base_id") or not state.get("context"):
+            return None, None
+
+        try:
+            question_embedding = embed_knowledge_base_query(state["knowledge_base_id"], state["question"])
+            scope = f"{state['knowledge_base_id']}:{build_context_fingerprint(state['context'])}"
+            hit = cache.semantic_lookup(
+                scope, get_llm_cache_key(self.llm), question_embedding,
+                getattr(settings, 'LLM_SEMANTIC_CACHE_THRESHOLD', 0.95)
+            )
+        except Exception as e:
+            logger.warning(f"语义缓存查询失败，直接生成回答: {e}")
+            return None, None
+
+        if hit:
+            logger.info(f"语义缓存命中: '{state['question'][:50]}' ≈ '{hit['matched_question'][:50]}' "
+                        f"(相似度: {hit['similarity']:.4f})")
+            return hit["answer"], question_embedding
+        return None, question_embedding
+
+    def _store_semantic_answer(self, state: RAGState, question_embedding, response):
+        """将生成的回答写入语义缓存"""
+        cache = get_semantic_cache()
+        if cache is None or question_embedding is None:
+            return
+        try:
+            usage_metadata = getattr(response, "usage_metadata", None) or {}
+            cache.semantic_update(
+                f"{state['knowledge_base_id']}:{build_context_fingerprint(state['context'])}",
+                get_llm_cache_key(self.llm), state["question"], question_embedding,
+                response.content, usage_metadata.get("total_tokens", 0) or 0
+            )
+        except Exception as e:
+            logger.warning(f"写入语义缓存失败: {e}")
+
+    def _cached_answer_result(self, answer: str, start_time: float) -> Dict[str, Any]:
+        return {
+            "answer": answer,
+            "generation_time": time.time() - start_time,
+            "messages": [AIMessage(content=answer)]
+        }
+
+    def _generate_node(self, state: RAGState) -> Dict[str, Any]:
+        """生成节点"""
+        start_time = time.time()
+
+        try:
+            cached_answer, question_embedding = self._lookup_semantic_answer(state)
+            if cached_answer is not None:
+                return self._cached_answer_result(cached_answer, start_time)
 
-                logger.info("未找到相关上下文，使用一般知识回答")
+            messages = self._build_generate_messages(state)
 
             # 生成回答
             response = self.llm.invoke(messages)
             generation_time = time.time() - start_time
 
             logger.info(f"回答生成完成，耗时 {generation_time:.3f}s")
+            self._store_semantic_answer(state, question_embedding, response)
 
             return {
                 "answer": response.content,
@@ -181,14 +340,51 @@ class KnowledgeRAGService:
                 "messages": [AIMessage(content=error_message)]
             }
 
-    def query(self, question: str, knowledge_base_id: str = None, user=None,
-              project_id: str = None, thread_id: str = None,
-              use_knowledge_base: bool = True, similarity_threshold: float = 0.7,
-              top_k: int = 5) -> Dict[str, Any]:
-        """执行RAG查询"""
+    async def _agenerate_node(self, state: RAGState) -> Dict[str, Any]:
+        """生成节点（异步）"""
         start_time = time.time()
 
-        initial_state = {
+        try:
+            # 语义缓存需要计算问题向量，与检索一样放入线程池执行
+            cached_answer, question_embedding = await run_in_retrieval_executor(
+                self._lookup_semantic_answer, state
+            )
+            if cached_answer is not None:
+                return self._cached_answer_result(cached_answer, start_time)
+
+            messages = self._build_generate_messages(state)
+
+            # 生成回答
+            response = await self.llm.ainvoke(messages)
+            generation_time = time.time() - start_time
+
+            logger.info(f"回答生成完成，耗时 {generation_time:.3f}s")
+            if question_embedding is not None:
+                await run_in_retrieval_executor(
+                    self._store_semantic_answer, state, question_embedding, response
+                )
+
+            return {
+                "answer": response.content,
+                "generation_time": generation_time,
+                "messages": [AIMessage(content=response.content)]
+            }
+
+        except Exception as e:
+            logger.error(f"生成回答失败: {e}")
+            error_message = "抱歉，生成回答时出现错误。请稍后重试。"
+            return {
+                "answer": error_message,
+                "generation_time": time.time() - start_time,
+                "messages": [AIMessage(content=error_message)]
+            }
+
+    def _build_initial_state(self, question: str, knowledge_base_id: str = None, user=None,
+                             project_id: str = None, thread_id: str = None,
+                             use_knowledge_base: bool = True, similarity_threshold: float = 0.7,
+                             top_k: int = 5) -> Dict[str, Any]:
+        """构建RAG图的初始状态"""
+        return {
             "messages": [HumanMessage(content=question)],
             "question": question,
             "knowledge_base_id": knowledge_base_id or "",
@@ -206,6 +402,18 @@ class KnowledgeRAGService:
             "top_k": top_k
         }
 
+    def query(self, question: str, knowledge_base_id: str = None, user=None,
+              project_id: str = None, thread_id: str = None,
+              use_knowledge_base: bool = True, similarity_threshold: float = 0.7,
+              top_k: int = 5) -> Dict[str, Any]:
+        """执行RAG查询"""
+        start_time = time.time()
+
+        initial_state = self._build_initial_state(
+            question, knowledge_base_id, user, project_id, thread_id,
+            use_knowledge_base, similarity_threshold, top_k
+        )
+
         try:
             logger.info(f"开始RAG查询: {question[:50]}...")
             logger.info(f"知识库ID: {knowledge_base_id}, 使用知识库: {use_knowledge_base}")
@@ -237,6 +445,48 @@ class KnowledgeRAGService:
             }
             return error_response
 
+    async def aquery(self, question: str, knowledge_base_id: str = None, user=None,
+                     project_id: str = None, thread_id: str = None,
+                     use_knowledge_base: bool = True, similarity_threshold: float = 0.7,
+                     top_k: int = 5) -> Dict[str, Any]:
+        """执行RAG查询（异步版本，检索走有界线程池，生成使用ainvoke）"""
+        start_time = time.time()
+
+        initial_state = self._build_initial_state(
+            question, knowledge_base_id, user, project_id, thread_id,
+            use_knowledge_base, similarity_threshold, top_k
+        )
+
+        try:
+            logger.info(f"开始RAG查询: {question[:50]}...")
+            logger.info(f"知识库ID: {knowledge_base_id}, 使用知识库: {use_knowledge_base}")
+
+            # 执行图
+            final_state = await self.graph.ainvoke(initial_state)
+
+            # 计算总时间
+            total_time = time.time() - start_time
+            final_state["total_time"] = total_time
+
+            logger.info(f"RAG查询完成，总耗时: {total_time:.3f}s")
+
+            # 记录查询日志
+            if user and knowledge_base_id:
+                await sync_to_async(self._log_query)(final_state, user)
+
+            return final_state
+
+        except Exception as e:
+            logger.error(f"RAG查询失败: {e}")
+            return {
+                "question": question,
+                "answer": "抱歉，查询过程中出现错误。",
+                "context": [],
+                "retrieval_time": 0.0,
+                "generation_time": 0.0,
+                "total_time": time.time() - start_time
+            }
+
     def _log_query(self, state: RAGState, user):
         """记录查询日志"""
         try:
@@ -408,10 +658,12 @@ class ConversationalRAGService(KnowledgeRAGService):
         """构建对话式RAG图"""
         graph_builder = StateGraph(RAGState)
 
-        # 添加节点
+        # 添加节点（同时提供同步与异步实现）
         graph_builder.add_node("analyze_query", self._analyze_query_node)
-        graph_builder.add_node("retrieve", self._retrieve_node)
-        graph_builder.add_node("generate", self._conversational_generate_node)
+        graph_builder.add_node("retrieve", RunnableLambda(self._retrieve_node, afunc=self._aretrieve_node))
+        graph_builder.add_node("generate", RunnableLambda(
+            self._conversational_generate_node, afunc=self._aconversational_generate_node
+        ))
 
         # 设置边
         graph_builder.add_edge(START, "analyze_query")
@@ -435,41 +687,73 @@ class ConversationalRAGService(KnowledgeRAGService):
             logger.error(f"查询分析失败: {e}")
             return {"question": state.get("question", "")}
 
+    def _build_conversational_messages(self, state: RAGState) -> List:
+        """构建对话式生成的提示消息"""
+        # 构建上下文
+        context_text = "\n\n".join([
+            result["content"] for result in state["context"][:3]
+        ])
+
+        # 构建对话历史
+        conversation_history = []
+        for msg in state["messages"][:-1]:  # 排除最新的用户消息
+            if isinstance(msg, (HumanMessage, AIMessage)):
+                conversation_history.append(msg)
+
+        # 构建提示
+        if context_text:
+            system_prompt = """你是一个智能助手，请基于提供的上下文信息和对话历史回答用户的问题。
+请保持回答准确、简洁且有帮助。如果上下文中没有相关信息，请明确说明。
+
+上下文信息：
+{context}"""
+
+            messages = [SystemMessage(content=system_prompt.format(context=context_text))]
+            messages.extend(conversation_history)
+            messages.append(HumanMessage(content=state["question"]))
+        else:
+            system_prompt = "你是一个智能助手，请基于对话历史回答用户的问题。如果没有足够的信息，请说明。"
+            messages = [SystemMessage(content=system_prompt)]
+            messages.extend(conversation_history)
+            messages.append(HumanMessage(content=state["question"]))
+
+        return messages
+
     def _conversational_generate_node(self, state: RAGState) -> Dict[str, Any]:
         """对话式生成节点，考虑对话历史"""
         start_time = time.time()
 
         try:
-            # 构建上下文
-            context_text = "\n\n".join([
-                result["content"] for result in state["context"][:3]
-            ])
-
-            # 构建对话历史
-            conversation_history = []
-            for msg in state["messages"][:-1]:  # 排除最新的用户消息
-                if isinstance(msg, (HumanMessage, AIMessage)):
-                    conversation_history.append(msg)
-
-            # 构建提示
-            if context_text:
-                system_prompt = """你是一个智能助手，请基于提供的上下文信息和对话历史回答用户的问题。
-请保持回答准确、简洁且有帮助。如果上下文中没有相关信息，请明确说明。
+            messages = self._build_conversational_messages(state)
 
-上下文信息：
-{context}"""
+            # 生成回答
+            response = self.llm.invoke(messages)
+            generation_time = time.time() - start_time
 
-                messages = [SystemMessage(content=system_prompt.format(context=context_text))]
-                messages.extend(conversation_history)
-                messages.append(HumanMessage(content=state["question"]))
-            else:
-                system_prompt = "你是一个智能助手，请基于对话历史回答用户的问题。如果没有足够的信息，请说明。"
-                messages = [SystemMessage(content=system_prompt)]
-                messages.extend(conversation_history)
-                messages.append(HumanMessage(content=state["question"]))
+            return {
+                "answer": response.content,
+                "generation_time": generation_time,
+                "messages": state["messages"] + [AIMessage(content=response.content)]
+            }
+
+        except Exception as e:
+            logger.error(f"对话式生成回答失败: {e}")
+            error_message = "抱歉，生成回答时出现错误。"
+            return {
+                "answer": error_message,
+                "generation_time": time.time() - start_time,
+                "messages": state["messages"] + [AIMessage(content=error_message)]
+            }
+
+    async def _aconversational_generate_node(self, state: RAGState) -> Dict[str, Any]:
+        """对话式生成节点（异步）"""
+        start_time = time.time()
+
+        try:
+            messages = self._build_conversational_messages(state)
 
             # 生成回答
-            response = self.llm.invoke(messages)
+            response = await self.llm.ainvoke(messages)
             generation_time = time.time() - start_time
 
             return {
@@ -506,13 +790,9 @@ def create_knowledge_tool(knowledge_base_id: str, user, similarity_threshold: fl
         try:
             logger.info(f"知识库工具被调用: {query[:50]}...")
 
-            # 获取知识库
-            knowledge_base = KnowledgeBase.objects.get(id=knowledge_base_id)
-            service = KnowledgeBaseService(knowledge_base)
-
             # 执行检索
-            search_results = service.vector_manager.similarity_search(
-                query, k=top_k, score_threshold=similarity_threshold
+            search_results = search_knowledge_base(
+                knowledge_base_id, query, top_k=top_k, similarity_threshold=similarity_threshold
             )
 
             if not search_results:
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class LanggraphIntegrationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'langgraph_integration'
+
+    def ready(self):
+        """
+        当应用准备好时导入信号处理器（配置缓存失效）
+        """
+        import langgraph_integration.signals
@@ -0,0 +1,215 @@
+"""
+对话检查点存储后端
+根据 CHAT_CHECKPOINTER_BACKEND 选择对话历史（LangGraph checkpoint）的存储位置：
+- sqlite（默认）：BASE_DIR 下的 chat_history.sqlite 文件，适合单机部署
+- postgres：与Django共用的PostgreSQL数据库（或单独指定的连接串），使用连接池，支持多进程/多主机部署
+PostgreSQL后端依赖 langgraph-checkpoint-postgres 和 psycopg[pool]，仅在启用时导入
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import asynccontextmanager, closing, contextmanager
+from functools import lru_cache
+from typing import List
+
+from django.conf import settings
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+logger = logging.getLogger(__name__)
+
+BACKEND_SQLITE = 'sqlite'
+BACKEND_POSTGRES = 'postgres'
+
+
+def get_checkpointer_backend() -> str:
+    backend = getattr(settings, 'CHAT_CHECKPOINTER_BACKEND', BACKEND_SQLITE) or BACKEND_SQLITE
+    if backend not in (BACKEND_SQLITE, BACKEND_POSTGRES):
+        raise ValueError(f"Unsupported CHAT_CHECKPOINTER_BACKEND: {backend}")
+    return backend
+
+
+def get_sqlite_path() -> str:
+    return getattr(settings, 'CHAT_HISTORY_SQLITE_PATH', None) \
+        or os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
+
+
+def get_postgres_conninfo() -> str:
+    """PostgreSQL连接串：优先使用单独配置，否则复用Django默认数据库"""
+    conninfo = getattr(settings, 'CHAT_CHECKPOINTER_POSTGRES_URL', '')
+    if conninfo:
+        return conninfo
+
+    database = settings.DATABASES['default']
+    if 'postgresql' not in database.get('ENGINE', ''):
+        raise ValueError("CHAT_CHECKPOINTER_BACKEND=postgres requires CHAT_CHECKPOINTER_POSTGRES_URL "
+                         "or a PostgreSQL default database")
+    parts = {
+        'dbname': database.get('NAME'),
+        'user': database.get('USER'),
+        'password': database.get('PASSWORD'),
+        'host': database.get('HOST'),
+        'port': database.get('PORT'),
+    }
+    return " ".join(f"{key}={value}" for key, value in parts.items() if value)
+
+
+class ThreadedAsyncSaverMixin:
+    """
+    在线程中执行同步检查点方法，为只实现同步接口的存储提供异步接口
+    连接池不绑定事件循环，任意事件循环（ASGI常驻循环或WSGI下每个请求新建的循环）都可共用
+    """
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoints = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=''):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+@lru_cache(maxsize=None)
+def _threaded_postgres_saver_class():
+    from langgraph.checkpoint.postgres import PostgresSaver
+
+    class ThreadedPostgresSaver(ThreadedAsyncSaverMixin, PostgresSaver):
+        """同时支持同步与异步接口的PostgreSQL检查点存储"""
+
+    return ThreadedPostgresSaver
+
+
+class PostgresCheckpointerPools:
+    """
+    PostgreSQL检查点连接池
+    进程内只有一个同步连接池，异步路径通过线程复用同一连接池，
+    不按事件循环创建异步连接池：WSGI下每个请求都会新建事件循环，循环结束后其异步连接池无法再关闭
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_pool = None
+        self._setup_done = False
+
+    @staticmethod
+    def _pool_kwargs() -> dict:
+        from psycopg.rows import dict_row
+        # PostgresSaver要求autocommit和dict_row；连接池复用连接时禁用预编译语句
+        return {
+            'conninfo': get_postgres_conninfo(),
+            'min_size': getattr(settings, 'CHAT_CHECKPOINTER_POOL_MIN_SIZE', 1),
+            'max_size': getattr(settings, 'CHAT_CHECKPOINTER_POOL_MAX_SIZE', 10),
+            'kwargs': {'autocommit': True, 'prepare_threshold': 0, 'row_factory': dict_row},
+        }
+
+    def sync_pool(self):
+        with self._lock:
+            if self._sync_pool is None:
+                from psycopg_pool import ConnectionPool
+                self._sync_pool = ConnectionPool(open=True, **self._pool_kwargs())
+                logger.info("PostgresCheckpointerPools: Opened sync connection pool")
+            return self._sync_pool
+
+    def sync_saver(self):
+        saver = _threaded_postgres_saver_class()(self.sync_pool())
+        with self._lock:
+            if not self._setup_done:
+                saver.setup()
+                self._setup_done = True
+        return saver
+
+    async def async_saver(self):
+        # 建表和打开连接池是阻塞操作，放入线程执行
+        return await asyncio.to_thread(self.sync_saver)
+
+    def close(self):
+        with self._lock:
+            if self._sync_pool is not None:
+                self._sync_pool.close()
+                self._sync_pool = None
+
+
+postgres_pools = PostgresCheckpointerPools()
+
+
+@contextmanager
+def sync_checkpointer():
+    """同步检查点存储（用于同步视图和管理命令）"""
+    if get_checkpointer_backend() == BACKEND_POSTGRES:
+        yield postgres_pools.sync_saver()
+    else:
+        with SqliteSaver.from_conn_string(get_sqlite_path()) as saver:
+            yield saver
+
+
+@asynccontextmanager
+async def async_checkpointer():
+    """异步检查点存储（用于异步对话视图）"""
+    if get_checkpointer_backend() == BACKEND_POSTGRES:
+        yield await postgres_pools.async_saver()
+    else:
+        async with AsyncSqliteSaver.from_conn_string(get_sqlite_path()) as saver:
+            yield saver
+
+
+def _execute_postgres(query: str, params: tuple) -> List[dict]:
+    with postgres_pools.sync_pool().connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def count_thread_checkpoints(thread_id: str) -> int:
+    """统计会话的检查点数量"""
+    if get_checkpointer_backend() == BACKEND_POSTGRES:
+        rows = _execute_postgres("SELECT COUNT(*) AS count FROM checkpoints WHERE thread_id = %s", (thread_id,))
+        return rows[0]['count']
+
+    db_path = get_sqlite_path()
+    if not os.path.exists(db_path):
+        return 0
+    with closing(sqlite3.connect(db_path)) as conn:
+        try:
+            return conn.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = ?", (thread_id,)).fetchone()[0]
+        except sqlite3.OperationalError:
+            # 数据库文件存在但尚未建表
+            return 0
+
+
+def list_thread_ids(prefix: str) -> List[str]:
+    """列出以指定前缀开头的会话ID（thread_id）"""
+    if get_checkpointer_backend() == BACKEND_POSTGRES:
+        rows = _execute_postgres("SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id LIKE %s",
+                                 (prefix + '%',))
+        return [row['thread_id'] for row in rows]
+
+    db_path = get_sqlite_path()
+    if not os.path.exists(db_path):
+        return []
+    with closing(sqlite3.connect(db_path)) as conn:
+        try:
+            rows = conn.execute("SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id LIKE ?",
+                                (prefix + '%',)).fetchall()
+        except sqlite3.OperationalError:
+            return []
+    return [row[0] for row in rows]
+
+
+def delete_thread(thread_id: str) -> int:
+    """删除会话的全部检查点和写入记录，返回删除的检查点数量"""
+    deleted_count = count_thread_checkpoints(thread_id)
+    if deleted_count:
+        with sync_checkpointer() as saver:
+            saver.delete_thread(thread_id)
+    return deleted_count
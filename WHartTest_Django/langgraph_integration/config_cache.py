@@ -0,0 +1,164 @@
+"""
+对话配置缓存
+缓存当前激活的LLMConfig、用户提示词以及会话的"系统提示词已写入"标记，
+使对话热路径在缓存命中时不再访问数据库。缓存由模型信号失效（见signals.py），
+并带有TTL兜底，保证多进程部署下其他进程的修改最终可见。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from prompts.models import UserPrompt
+from .models import ChatSession, LLMConfig
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ChatConfigCache:
+    """进程内的对话配置缓存"""
+
+    def __init__(self, max_sessions: int = 10000):
+        self._lock = threading.Lock()
+        self._active_config: Tuple[float, Any] = (0.0, _MISSING)
+        self._prompts: Dict[Tuple[int, Any], Tuple[float, Optional[str]]] = {}  # (user_id, prompt_id|None) -> content
+        self._session_flags: "OrderedDict[str, float]" = OrderedDict()  # 已写入系统提示词的会话 -> 缓存时间
+        self._max_sessions = max_sessions
+
+    @property
+    def ttl(self) -> float:
+        return getattr(settings, 'CHAT_CONFIG_CACHE_TTL', 300)
+
+    def _fresh(self, cached_at: float) -> bool:
+        return time.monotonic() - cached_at < self.ttl
+
+    # --- LLM配置 ---
+    def get_active_llm_config(self) -> LLMConfig:
+        """
+        获取当前激活的LLM配置
+        与 LLMConfig.objects.get(is_active=True) 行为一致：不存在或存在多个时抛出对应异常（异常不缓存）
+        """
+        with self._lock:
+            cached_at, config = self._active_config
+        if config is not _MISSING and self._fresh(cached_at):
+            return config
+
+        config = LLMConfig.objects.get(is_active=True)
+        with self._lock:
+            self._active_config = (time.monotonic(), config)
+        return config
+
+    async def aget_active_llm_config(self) -> LLMConfig:
+        with self._lock:
+            cached_at, config = self._active_config
+        if config is not _MISSING and self._fresh(cached_at):
+            return config
+        return await sync_to_async(self.get_active_llm_config)()
+
+    def invalidate_llm_config(self):
+        with self._lock:
+            self._active_config = (0.0, _MISSING)
+        logger.debug("ChatConfigCache: Active LLM config invalidated")
+
+    # --- 用户提示词 ---
+    def _load_prompt(self, user, prompt_id=None) -> Optional[str]:
+        if prompt_id:
+            prompt = UserPrompt.objects.filter(id=prompt_id, user=user, is_active=True).first()
+        else:
+            prompt = UserPrompt.get_user_default_prompt(user)
+        return prompt.content if prompt else None
+
+    def get_user_prompt(self, user, prompt_id=None) -> Optional[str]:
+        """获取用户指定的提示词（prompt_id）或默认提示词的内容，不存在时返回None"""
+        key = (user.id, prompt_id or None)
+        with self._lock:
+            cached = self._prompts.get(key)
+        if cached and self._fresh(cached[0]):
+            return cached[1]
+
+        content = self._load_prompt(user, prompt_id)
+        with self._lock:
+            self._prompts[key] = (time.monotonic(), content)
+        return content
+
+    async def aget_user_prompt(self, user, prompt_id=None) -> Optional[str]:
+        key = (user.id, prompt_id or None)
+        with self._lock:
+            cached = self._prompts.get(key)
+        if cached and self._fresh(cached[0]):
+            return cached[1]
+        return await sync_to_async(self.get_user_prompt)(user, prompt_id)
+
+    def invalidate_user_prompts(self, user_id):
+        with self._lock:
+            for key in [k for k in self._prompts if k[0] == user_id]:
+                del self._prompts[key]
+        logger.debug(f"ChatConfigCache: Prompts invalidated for user {user_id}")
+
+    # --- 会话元数据 ---
+    async def ais_system_prompt_added(self, user, session_id: str) -> bool:
+        """
+        会话元数据中是否已记录写入系统提示词
+        只缓存True：False可能表示旧会话或上一轮失败，调用方需要回退检查checkpoint；
+        缓存带TTL，其他进程清空会话历史（重置标记）后，本进程的缓存最多在TTL内有效
+        """
+        if self._session_flag_cached(session_id):
+            return True
+
+        added = await ChatSession.objects.filter(
+            user=user, session_id=session_id, system_prompt_added=True
+        ).aexists()
+        if added:
+            self._remember_session(session_id)
+        return added
+
+    async def amark_system_prompt_added(self, user, session_id: str):
+        """在会话元数据中记录已写入系统提示词"""
+        if self._session_flag_cached(session_id):
+            return
+        updated = await ChatSession.objects.filter(user=user, session_id=session_id).aupdate(system_prompt_added=True)
+        if updated:
+            self._remember_session(session_id)
+
+    def _session_flag_cached(self, session_id: str) -> bool:
+        with self._lock:
+            cached_at = self._session_flags.get(session_id)
+            if cached_at is None:
+                return False
+            if not self._fresh(cached_at):
+                del self._session_flags[session_id]
+                return False
+            self._session_flags.move_to_end(session_id)
+            return True
+
+    def _remember_session(self, session_id: str):
+        with self._lock:
+            self._session_flags[session_id] = time.monotonic()
+            self._session_flags.move_to_end(session_id)
+            while len(self._session_flags) > self._max_sessions:
+                self._session_flags.popitem(last=False)
+
+    def invalidate_session(self, session_id: str):
+        with self._lock:
+            self._session_flags.pop(session_id, None)
+
+    def reset_system_prompt_added(self, user, session_id: str):
+        """会话历史被清空后重置标记，下一轮重新写入系统提示词"""
+        ChatSession.objects.filter(user=user, session_id=session_id).update(system_prompt_added=False)
+        self.invalidate_session(session_id)
+
+    def clear(self):
+        with self._lock:
+            self._active_config = (0.0, _MISSING)
+            self._prompts.clear()
+            self._session_flags.clear()
+
+
+# 全局对话配置缓存实例
+chat_config_cache = ChatConfigCache()
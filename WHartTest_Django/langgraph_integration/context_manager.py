@@ -0,0 +1,189 @@
+"""
+对话上下文管理
+按token统计对话历史，超过阈值时将较早的轮次压缩为滚动摘要（保存在checkpoint中），
+发送给LLM的提示词只包含系统提示词、摘要和最近K轮原文，使每轮提示词大小保持稳定
+"""
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+from django.conf import settings
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langgraph.prebuilt.chat_agent_executor import AgentState as ReactAgentState
+
+from requirements.context_limits import context_checker
+
+logger = logging.getLogger(__name__)
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """你是对话摘要助手。请将下面的对话内容压缩为一份简洁的摘要，供后续对话继续使用。
+要求：
+1. 保留用户的目标、已确认的需求和约束、关键结论和决定
+2. 保留已生成或修改的关键数据（如测试用例编号、模块名称、项目信息等）
+3. 保留尚未完成的事项
+4. 省略寒暄和重复内容，使用与对话相同的语言输出"""
+
+SUMMARY_PREFIX = "以下是此前对话的摘要，请结合摘要继续对话：\n"
+
+
+class ChatAgentState(ReactAgentState):
+    """带滚动摘要的Agent状态（用于create_react_agent）"""
+    context_summary: str
+    summary_until_id: str
+
+
+class ConversationContextManager:
+    """
+    对话上下文管理器
+    - 使用ContextLimitChecker逐条统计消息token数（按消息ID缓存）
+    - 超过阈值时把最近K轮之前的消息合并进滚动摘要
+    - aprepare可直接作为create_react_agent的pre_model_hook使用
+    """
+
+    _token_cache: "OrderedDict[tuple, int]" = OrderedDict()
+    _token_cache_size = 10000
+
+    def __init__(self, llm, model_name: str, max_context_tokens: Optional[int] = None,
+                 trigger_ratio: Optional[float] = None, keep_last_turns: Optional[int] = None,
+                 tool_output_chars: int = 2000):
+        self.llm = llm
+        self.model_name = model_name or 'default'
+        self.trigger_ratio = trigger_ratio if trigger_ratio is not None else getattr(
+            settings, 'CHAT_CONTEXT_TRIGGER_RATIO', 0.75)
+        self.keep_last_turns = max(1, keep_last_turns if keep_last_turns is not None else getattr(
+            settings, 'CHAT_CONTEXT_KEEP_LAST_TURNS', 4))
+        self.max_context_tokens = max_context_tokens or getattr(settings, 'CHAT_CONTEXT_MAX_TOKENS', 0) \
+            or context_checker.get_context_limit(self.model_name)
+        self.tool_output_chars = tool_output_chars
+
+    @property
+    def token_threshold(self) -> int:
+        """触发摘要的token阈值"""
+        return int(self.max_context_tokens * self.trigger_ratio)
+
+    def count_message_tokens(self, message: BaseMessage) -> int:
+        """统计单条消息的token数，有ID的消息结果会被缓存"""
+        cache_key = (self.model_name, message.id) if message.id else None
+        if cache_key and cache_key in self._token_cache:
+            self._token_cache.move_to_end(cache_key)
+            return self._token_cache[cache_key]
+
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        tokens = int(context_checker.count_tokens(content, self.model_name)) + MESSAGE_OVERHEAD_TOKENS
+        if isinstance(message, AIMessage) and message.tool_calls:
+            tokens += int(context_checker.count_tokens(str(message.tool_calls), self.model_name))
+
+        if cache_key:
+            self._token_cache[cache_key] = tokens
+            if len(self._token_cache) > self._token_cache_size:
+                self._token_cache.popitem(last=False)
+        return tokens
+
+    def count_tokens(self, messages: Sequence[BaseMessage]) -> int:
+        return sum(self.count_message_tokens(message) for message in messages)
+
+    def _split_messages(self, state: Dict[str, Any]):
+        """拆分为 (系统提示词列表, 摘要未覆盖的消息列表)"""
+        messages = list(state.get('messages') or [])
+        system_messages = []
+        while messages and isinstance(messages[0], SystemMessage):
+            system_messages.append(messages.pop(0))
+
+        summary_until_id = state.get('summary_until_id')
+        if summary_until_id:
+            for index, message in enumerate(messages):
+                if message.id == summary_until_id:
+                    messages = messages[index + 1:]
+                    break
+        return system_messages, messages
+
+    def _build_llm_input(self, system_messages: List[BaseMessage], summary: str,
+                         messages: List[BaseMessage]) -> List[BaseMessage]:
+        """组装发送给LLM的消息；摘要合并进系统消息，兼容只允许单条系统消息的供应商"""
+        if not summary:
+            return system_messages + messages
+
+        summary_block = f"{SUMMARY_PREFIX}{summary}"
+        if system_messages:
+            merged = SystemMessage(content=f"{system_messages[0].content}\n\n{summary_block}")
+            return [merged] + system_messages[1:] + messages
+        return [SystemMessage(content=summary_block)] + messages
+
+    def _find_recent_turns_start(self, messages: List[BaseMessage]) -> int:
+        """定位最近K轮的起始位置（以用户消息为轮次边界，保证工具调用与结果不被拆开）"""
+        human_indexes = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        if len(human_indexes) <= self.keep_last_turns:
+            return 0
+        return human_indexes[-self.keep_last_turns]
+
+    def _render_transcript(self, messages: List[BaseMessage]) -> str:
+        lines = []
+        for message in messages:
+            content = message.content if isinstance(message.content, str) else str(message.content)
+            if isinstance(message, HumanMessage):
+                lines.append(f"用户: {content}")
+            elif isinstance(message, AIMessage):
+                if content.strip():
+                    lines.append(f"助手: {content}")
+                for tool_call in message.tool_calls or []:
+                    lines.append(f"助手调用工具 {tool_call.get('name')}: {tool_call.get('args')}")
+            elif isinstance(message, ToolMessage):
+                if len(content) > self.tool_output_chars:
+                    content = content[:self.tool_output_chars] + "...(已截断)"
+                lines.append(f"工具结果({message.name or 'tool'}): {content}")
+        return "\n".join(lines)
+
+    async def _asummarize(self, previous_summary: str, messages: List[BaseMessage]) -> str:
+        transcript = self._render_transcript(messages)
+        content = f"已有摘要：\n{previous_summary}\n\n需要并入摘要的新对话：\n{transcript}" \
+            if previous_summary else f"对话内容：\n{transcript}"
+        # nostream标签：摘要调用的输出不推送到SSE消息流
+        response = await self.llm.ainvoke(
+            [SystemMessage(content=SUMMARY_PROMPT), HumanMessage(content=content)],
+            config={"tags": ["nostream"]}
+        )
+        return response.content if isinstance(response.content, str) else str(response.content)
+
+    async def aprepare(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        计算本次LLM调用的输入消息
+        返回 {'llm_input_messages': [...]}，触发摘要时额外返回新的 context_summary / summary_until_id
+        """
+        summary = state.get('context_summary') or ''
+        system_messages, messages = self._split_messages(state)
+        llm_input = self._build_llm_input(system_messages, summary, messages)
+
+        total_tokens = self.count_tokens(llm_input)
+        if total_tokens <= self.token_threshold:
+            return {'llm_input_messages': llm_input}
+
+        recent_start = self._find_recent_turns_start(messages)
+        older, recent = messages[:recent_start], messages[recent_start:]
+        if not older:
+            logger.info(f"ConversationContextManager: {total_tokens} tokens exceed threshold "
+                        f"{self.token_threshold}, but no older turns to summarize")
+            return {'llm_input_messages': llm_input}
+
+        try:
+            new_summary = await self._asummarize(summary, older)
+        except Exception as e:
+            logger.error(f"ConversationContextManager: Failed to summarize conversation: {e}", exc_info=True)
+            return {'llm_input_messages': llm_input}
+
+        llm_input = self._build_llm_input(system_messages, new_summary, recent)
+        logger.info(f"ConversationContextManager: Summarized {len(older)} messages, prompt tokens "
+                    f"{total_tokens} -> {self.count_tokens(llm_input)}")
+        return {
+            'llm_input_messages': llm_input,
+            'context_summary': new_summary,
+            'summary_until_id': older[-1].id,
+        }
+
+
+def create_context_manager(llm, model_name: str) -> Optional[ConversationContextManager]:
+    """按配置创建上下文管理器，未启用时返回None"""
+    if not getattr(settings, 'CHAT_CONTEXT_SUMMARY_ENABLED', True):
+        return None
+    return ConversationContextManager(llm, model_name)
@@ -0,0 +1,455 @@
+"""
+LLM调用网关
+按LLM配置限制并发请求数和每分钟token数，所有通过 create_llm_instance 创建的模型共享同一组限流队列：
+- 排队按优先级调度（交互式对话优先于批量需求评审），同优先级内优先调度在途请求较少的用户
+- 同时支持同步调用（需求评审线程）和异步调用（ASGI对话流）
+- 记录队列深度、等待时间等统计信息
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+# 优先级：数值越小越优先
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+PRIORITY_LABELS = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BATCH: 'batch',
+}
+
+TPM_WINDOW_SECONDS = 60
+# 等待超过该时长时记录警告日志
+SLOW_WAIT_LOG_SECONDS = 1.0
+
+# 当前调用链是否已持有许可（部分供应商的_generate内部会转调_stream，避免同一请求重复排队）
+_lease_held = contextvars.ContextVar('llm_gateway_lease_held', default=False)
+
+
+class LLMGatewayTimeout(Exception):
+    """排队等待超时"""
+
+
+def estimate_message_tokens(messages) -> int:
+    """粗略估算提示词token数（中英文混合按每2个字符1个token计），用于限流预占"""
+    total_chars = 0
+    for message in messages or []:
+        content = getattr(message, 'content', message)
+        total_chars += len(content if isinstance(content, str) else str(content))
+        tool_calls = getattr(message, 'tool_calls', None)
+        if tool_calls:
+            total_chars += len(str(tool_calls))
+    return total_chars // 2 + 4 * len(messages or [])
+
+
+def _result_total_tokens(result) -> Optional[int]:
+    """从ChatResult中提取实际token用量，无用量信息时返回None"""
+    total = 0
+    found = False
+    for generation in getattr(result, 'generations', None) or []:
+        usage_metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+        if usage_metadata:
+            found = True
+            total += usage_metadata.get('total_tokens', 0) or 0
+    if found:
+        return total
+
+    llm_output = getattr(result, 'llm_output', None) or {}
+    token_usage = llm_output.get('token_usage') or llm_output.get('usage') or {}
+    if token_usage.get('total_tokens'):
+        return token_usage['total_tokens']
+    prompt_tokens = token_usage.get('prompt_tokens') or token_usage.get('input_tokens') or 0
+    completion_tokens = token_usage.get('completion_tokens') or token_usage.get('output_tokens') or 0
+    return (prompt_tokens + completion_tokens) or None
+
+
+class _Waiter:
+    """排队中的请求"""
+    __slots__ = ('priority', 'user_key', 'seq', 'tokens', 'enqueued_at', 'granted_at',
+                 'event', 'loop', 'future', 'window_entry')
+
+    def __init__(self, priority: int, user_key, seq: int, tokens: int):
+        self.priority = priority
+        self.user_key = user_key
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.event: Optional[threading.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+        self.window_entry: Optional[List] = None
+
+    @property
+    def granted(self) -> bool:
+        return self.granted_at is not None
+
+
+class LLMLease:
+    """已获得的调用许可，调用结束后必须释放"""
+
+    def __init__(self, limiter: "ProviderLimiter", waiter: _Waiter):
+        self._limiter = limiter
+        self._waiter = waiter
+        self._released = False
+
+    @property
+    def wait_seconds(self) -> float:
+        return self._waiter.granted_at - self._waiter.enqueued_at
+
+    def record_tokens(self, total_tokens: Optional[int]):
+        """用实际token用量修正预占的估算值"""
+        if total_tokens is not None:
+            self._limiter._record_tokens(self._waiter, total_tokens)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter._release(self._waiter)
+
+
+class ProviderLimiter:
+    """单个LLM配置的并发与TPM限流器"""
+
+    def __init__(self, key, name: str, max_concurrency: int, tokens_per_minute: int = 0):
+        self.key = key
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.tokens_per_minute = max(0, tokens_per_minute or 0)
+
+        self._lock = threading.Lock()
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._active_by_user: Counter = Counter()
+        self._window: deque = deque()  # [granted_at, tokens]
+        self._timer: Optional[threading.Timer] = None
+
+        self._total_requests = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+
+    def update_limits(self, max_concurrency: int, tokens_per_minute: int = 0):
+        with self._lock:
+            self.max_concurrency = max(1, max_concurrency)
+            self.tokens_per_minute = max(0, tokens_per_minute or 0)
+            self._dispatch_locked()
+
+    # --- 获取许可 ---
+    def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE, user_key=None,
+                timeout: Optional[float] = None) -> LLMLease:
+        """同步获取许可（阻塞当前线程）"""
+        waiter = _Waiter(priority, user_key, next(self._seq), tokens)
+        waiter.event = threading.Event()
+        with self._lock:
+            self._waiters.append(waiter)
+            self._dispatch_locked()
+
+        if not waiter.event.wait(timeout):
+            with self._lock:
+                if not waiter.granted:
+                    self._abandon_locked(waiter)
+                    raise LLMGatewayTimeout(
+                        f"LLM request queue timeout after {timeout}s for config '{self.name}'")
+        return self._granted_lease(waiter)
+
+    async def aacquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE, user_key=None,
+                       timeout: Optional[float] = None) -> LLMLease:
+        """异步获取许可（不阻塞事件循环）"""
+        waiter = _Waiter(priority, user_key, next(self._seq), tokens)
+        waiter.loop = asyncio.get_running_loop()
+        waiter.future = waiter.loop.create_future()
+        with self._lock:
+            self._waiters.append(waiter)
+            self._dispatch_locked()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not waiter.granted:
+                    self._abandon_locked(waiter)
+                    raise LLMGatewayTimeout(
+                        f"LLM request queue timeout after {timeout}s for config '{self.name}'")
+        except asyncio.CancelledError:
+            # 排队期间被取消（如客户端断开），已分配的许可需要归还
+            with self._lock:
+                if waiter.granted:
+                    self._release_locked(waiter)
+                else:
+                    self._waiters.remove(waiter)
+            raise
+        return self._granted_lease(waiter)
+
+    def _granted_lease(self, waiter: _Waiter) -> LLMLease:
+        wait_seconds = waiter.granted_at - waiter.enqueued_at
+        if wait_seconds >= SLOW_WAIT_LOG_SECONDS:
+            logger.warning(f"LLMGateway: Request for '{self.name}' waited {wait_seconds:.2f}s in queue "
+                           f"(priority={PRIORITY_LABELS.get(waiter.priority, waiter.priority)}, "
+                           f"queue_depth={len(self._waiters)}, active={self._active})")
+        return LLMLease(self, waiter)
+
+    def _abandon_locked(self, waiter: _Waiter):
+        self._waiters.remove(waiter)
+        self._timeouts += 1
+        logger.warning(f"LLMGateway: Request for '{self.name}' timed out in queue")
+
+    # --- 调度 ---
+    def _window_used_locked(self, now: float) -> int:
+        while self._window and now - self._window[0][0] >= TPM_WINDOW_SECONDS:
+            self._window.popleft()
+        return max(0, sum(entry[1] for entry in self._window))
+
+    def _dispatch_locked(self):
+        now = time.monotonic()
+        while self._waiters and self._active < self.max_concurrency:
+            # 优先级最高者优先；同优先级内在途请求少的用户优先，再按排队顺序
+            waiter = min(self._waiters,
+                         key=lambda w: (w.priority, self._active_by_user[w.user_key], w.seq))
+            if self.tokens_per_minute:
+                used = self._window_used_locked(now)
+                # 窗口为空时总是放行，避免单个超大请求永远无法执行
+                if used and used + waiter.tokens > self.tokens_per_minute:
+                    self._schedule_retry_locked(self._window[0][0] + TPM_WINDOW_SECONDS - now)
+                    break
+            self._waiters.remove(waiter)
+            self._grant_locked(waiter, now)
+
+    def _grant_locked(self, waiter: _Waiter, now: float):
+        waiter.granted_at = now
+        waiter.window_entry = [now, waiter.tokens]
+        self._window.append(waiter.window_entry)
+        self._active += 1
+        self._active_by_user[waiter.user_key] += 1
+
+        wait = now - waiter.enqueued_at
+        self._total_requests += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+
+        if waiter.event is not None:
+            waiter.event.set()
+        elif waiter.future is not None and not waiter.loop.is_closed():
+            waiter.loop.call_soon_threadsafe(self._resolve_future, waiter.future)
+
+    @staticmethod
+    def _resolve_future(future: asyncio.Future):
+        if not future.done():
+            future.set_result(True)
+
+    def _schedule_retry_locked(self, delay: float):
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(max(delay, 0.01), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch_locked()
+
+    # --- 释放 ---
+    def _record_tokens(self, waiter: _Waiter, total_tokens: int):
+        with self._lock:
+            if waiter.window_entry is not None:
+                waiter.window_entry[1] = total_tokens
+
+    def _release(self, waiter: _Waiter):
+        with self._lock:
+            self._release_locked(waiter)
+
+    def _release_locked(self, waiter: _Waiter):
+        self._active -= 1
+        self._active_by_user[waiter.user_key] -= 1
+        if self._active_by_user[waiter.user_key] <= 0:
+            del self._active_by_user[waiter.user_key]
+        self._dispatch_locked()
+
+    # --- 统计 ---
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            queued_by_priority = Counter(
+                PRIORITY_LABELS.get(w.priority, str(w.priority)) for w in self._waiters)
+            oldest_wait = max((now - w.enqueued_at for w in self._waiters), default=0.0)
+            return {
+                'config_id': self.key,
+                'config_name': self.name,
+                'max_concurrency': self.max_concurrency,
+                'tokens_per_minute': self.tokens_per_minute or None,
+                'active': self._active,
+                'queue_depth': len(self._waiters),
+                'queued_by_priority': dict(queued_by_priority),
+                'oldest_queued_ms': int(oldest_wait * 1000),
+                'tokens_last_minute': self._window_used_locked(now),
+                'total_requests': self._total_requests,
+                'avg_wait_ms': int(self._total_wait / self._total_requests * 1000) if self._total_requests else 0,
+                'max_wait_ms': int(self._max_wait * 1000),
+                'timeouts': self._timeouts,
+            }
+
+
+class LLMGateway:
+    """全局LLM网关：按LLM配置维护限流器，并为模型类生成带限流的子类"""
+
+    def __init__(self):
+        self._limiters: Dict[Any, ProviderLimiter] = {}
+        self._model_classes: Dict[type, type] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return getattr(settings, 'LLM_GATEWAY_ENABLED', True)
+
+    @property
+    def queue_timeout(self) -> Optional[float]:
+        timeout = getattr(settings, 'LLM_GATEWAY_QUEUE_TIMEOUT', 300)
+        return timeout or None
+
+    def get_limiter(self, active_config) -> ProviderLimiter:
+        """获取（必要时创建）LLM配置对应的限流器，并同步配置中的限额"""
+        key = active_config.pk or f"{active_config.provider}:{active_config.api_url}:{active_config.name}"
+        max_concurrency = getattr(active_config, 'max_concurrent_requests', None) \
+            or getattr(settings, 'LLM_GATEWAY_DEFAULT_MAX_CONCURRENCY', 8)
+        tokens_per_minute = getattr(active_config, 'tokens_per_minute', None) \
+            or getattr(settings, 'LLM_GATEWAY_DEFAULT_TOKENS_PER_MINUTE', 0)
+        name = getattr(active_config, 'config_name', None) or active_config.name
+
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = ProviderLimiter(key, name, max_concurrency, tokens_per_minute)
+                self._limiters[key] = limiter
+                return limiter
+
+        if (limiter.max_concurrency, limiter.tokens_per_minute) != (max_concurrency, tokens_per_minute):
+            logger.info(f"LLMGateway: Updating limits for '{name}': "
+                        f"max_concurrency={max_concurrency}, tokens_per_minute={tokens_per_minute}")
+            limiter.update_limits(max_concurrency, tokens_per_minute)
+        return limiter
+
+    def gated_model_class(self, model_class: type) -> type:
+        """生成（并缓存）带限流的模型子类"""
+        with self._lock:
+            gated_class = self._model_classes.get(model_class)
+            if gated_class is None:
+                namespace = {
+                    '__module__': __name__,
+                    '_gateway_limiter': PrivateAttr(default=None),
+                    '_gateway_priority': PrivateAttr(default=PRIORITY_INTERACTIVE),
+                    '_gateway_user_key': PrivateAttr(default=None),
+                }
+                # 只包装供应商原生实现的方法：默认实现会在线程中转调同步方法，重复包装会导致同一请求占用两个许可
+                for method in ('_agenerate', '_stream', '_astream'):
+                    if getattr(model_class, method) is getattr(BaseChatModel, method):
+                        namespace[method] = getattr(model_class, method)
+                gated_class = type(f"Gated{model_class.__name__}", (GatedChatModelMixin, model_class), namespace)
+                self._model_classes[model_class] = gated_class
+            return gated_class
+
+    def create_llm(self, model_class: type, active_config, priority: int = PRIORITY_INTERACTIVE,
+                   user=None, **model_kwargs) -> BaseChatModel:
+        """创建经过网关限流的LLM实例；网关关闭时返回原始模型"""
+        if not self.enabled:
+            return model_class(**model_kwargs)
+
+        llm = self.gated_model_class(model_class)(**model_kwargs)
+        llm._gateway_limiter = self.get_limiter(active_config)
+        llm._gateway_priority = priority
+        llm._gateway_user_key = getattr(user, 'pk', user)
+        return llm
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return [limiter.stats() for limiter in limiters]
+
+
+class GatedChatModelMixin:
+    """在模型的生成/流式方法外层获取和释放网关许可"""
+
+    def _gateway_acquire(self, messages) -> LLMLease:
+        return self._gateway_limiter.acquire(
+            estimate_message_tokens(messages), self._gateway_priority, self._gateway_user_key,
+            timeout=llm_gateway.queue_timeout)
+
+    async def _gateway_aacquire(self, messages) -> LLMLease:
+        return await self._gateway_limiter.aacquire(
+            estimate_message_tokens(messages), self._gateway_priority, self._gateway_user_key,
+            timeout=llm_gateway.queue_timeout)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if _lease_held.get():
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        lease = self._gateway_acquire(messages)
+        token = _lease_held.set(True)
+        try:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            lease.record_tokens(_result_total_tokens(result))
+            return result
+        finally:
+            _lease_held.reset(token)
+            lease.release()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if _lease_held.get():
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        lease = await self._gateway_aacquire(messages)
+        token = _lease_held.set(True)
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            lease.record_tokens(_result_total_tokens(result))
+            return result
+        finally:
+            _lease_held.reset(token)
+            lease.release()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if _lease_held.get():
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return
+        lease = self._gateway_acquire(messages)
+        usage_tokens = 0
+        try:
+            for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                usage_metadata = getattr(chunk.message, 'usage_metadata', None)
+                if usage_metadata:
+                    usage_tokens += usage_metadata.get('total_tokens', 0) or 0
+                yield chunk
+            lease.record_tokens(usage_tokens or None)
+        finally:
+            lease.release()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if _lease_held.get():
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+        lease = await self._gateway_aacquire(messages)
+        usage_tokens = 0
+        try:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                usage_metadata = getattr(chunk.message, 'usage_metadata', None)
+                if usage_metadata:
+                    usage_tokens += usage_metadata.get('total_tokens', 0) or 0
+                yield chunk
+            lease.record_tokens(usage_tokens or None)
+        finally:
+            lease.release()
+
+
+# 全局LLM网关实例
+llm_gateway = LLMGateway()
@@ -0,0 +1,130 @@
+"""
+Django管理命令：迁移对话检查点
+将 chat_history.sqlite 中的会话（thread）复制到当前配置的检查点后端（如PostgreSQL），
+用于从单机SQLite部署切换到多进程/多主机部署
+"""
+import os
+import sqlite3
+from collections import defaultdict
+from contextlib import closing, contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from langgraph_integration.checkpointer import (
+    BACKEND_SQLITE, get_checkpointer_backend, get_sqlite_path, sync_checkpointer
+)
+
+
+class Command(BaseCommand):
+    help = '将SQLite对话检查点迁移到当前配置的检查点后端'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            help='源SQLite文件路径，默认为 CHAT_HISTORY_SQLITE_PATH',
+        )
+        parser.add_argument(
+            '--target-sqlite',
+            help='迁移到指定的SQLite文件，而不是当前配置的检查点后端',
+        )
+        parser.add_argument(
+            '--thread-prefix',
+            default='',
+            help='只迁移以该前缀开头的会话，例如 "USERID_PROJECTID_"',
+        )
+        parser.add_argument(
+            '--skip-existing',
+            action='store_true',
+            help='跳过目标后端中已存在的会话',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='只统计需要迁移的会话，不写入目标后端',
+        )
+
+    def handle(self, *args, **options):
+        source_path = options.get('source') or get_sqlite_path()
+        target_path = options.get('target_sqlite')
+        if not os.path.exists(source_path):
+            raise CommandError(f'源文件不存在: {source_path}')
+
+        if target_path:
+            if os.path.abspath(target_path) == os.path.abspath(source_path):
+                raise CommandError('目标文件不能与源文件相同')
+            target_label = target_path
+        else:
+            if get_checkpointer_backend() == BACKEND_SQLITE and \
+                    os.path.abspath(get_sqlite_path()) == os.path.abspath(source_path):
+                raise CommandError('当前检查点后端就是源SQLite文件，请设置 CHAT_CHECKPOINTER_BACKEND 或使用 --target-sqlite')
+            target_label = get_checkpointer_backend()
+
+        thread_ids = self._list_source_threads(source_path, options['thread_prefix'])
+        self.stdout.write(f'找到 {len(thread_ids)} 个会话，目标: {target_label}')
+        if options['dry_run']:
+            return
+
+        migrated_threads = 0
+        migrated_checkpoints = 0
+        skipped_threads = 0
+        with SqliteSaver.from_conn_string(source_path) as source, self._target(target_path) as target:
+            for thread_id in thread_ids:
+                thread_config = {"configurable": {"thread_id": thread_id}}
+                if options['skip_existing'] and target.get_tuple(thread_config) is not None:
+                    skipped_threads += 1
+                    continue
+                migrated_checkpoints += self._copy_thread(source, target, thread_config)
+                migrated_threads += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'迁移完成: {migrated_threads} 个会话, {migrated_checkpoints} 个检查点, 跳过 {skipped_threads} 个会话'
+        ))
+
+    @staticmethod
+    def _list_source_threads(source_path, prefix):
+        with closing(sqlite3.connect(source_path)) as conn:
+            try:
+                rows = conn.execute(
+                    "SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id LIKE ? ORDER BY thread_id",
+                    (prefix + '%',)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                return []
+        return [row[0] for row in rows]
+
+    @staticmethod
+    @contextmanager
+    def _target(target_path):
+        if target_path:
+            with SqliteSaver.from_conn_string(target_path) as saver:
+                yield saver
+        else:
+            with sync_checkpointer() as saver:
+                yield saver
+
+    @staticmethod
+    def _copy_thread(source, target, thread_config):
+        """按时间顺序复制一个会话的检查点及其待写入记录，保持父子关系"""
+        # list按时间倒序返回，反转后从最早的检查点开始写入
+        checkpoint_tuples = list(source.list(thread_config))[::-1]
+        for checkpoint_tuple in checkpoint_tuples:
+            configurable = checkpoint_tuple.config["configurable"]
+            put_config = {"configurable": {
+                "thread_id": configurable["thread_id"],
+                "checkpoint_ns": configurable.get("checkpoint_ns", ""),
+            }}
+            if checkpoint_tuple.parent_config:
+                put_config["configurable"]["checkpoint_id"] = \
+                    checkpoint_tuple.parent_config["configurable"]["checkpoint_id"]
+
+            checkpoint = checkpoint_tuple.checkpoint
+            saved_config = target.put(put_config, checkpoint, checkpoint_tuple.metadata,
+                                      checkpoint.get("channel_versions", {}))
+
+            writes_by_task = defaultdict(list)
+            for task_id, channel, value in checkpoint_tuple.pending_writes or []:
+                writes_by_task[task_id].append((channel, value))
+            for task_id, writes in writes_by_task.items():
+                target.put_writes(saved_config, writes, task_id)
+        return len(checkpoint_tuples)
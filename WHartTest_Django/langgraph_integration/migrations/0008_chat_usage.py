@@ -0,0 +1,88 @@
+# Generated by Django 5.2 on 2026-10-19 00:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('langgraph_integration', '0007_alter_llmconfig_provider_chatsession_chatmessage'),
+        ('projects', '0002_project_creator'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfig',
+            name='completion_price_per_million',
+            field=models.DecimalField(blank=True, decimal_places=4, help_text='每百万输出token的价格', max_digits=12, null=True, verbose_name='输出单价'),
+        ),
+        migrations.AddField(
+            model_name='llmconfig',
+            name='prompt_price_per_million',
+            field=models.DecimalField(blank=True, decimal_places=4, help_text='每百万输入token的价格', max_digits=12, null=True, verbose_name='输入单价'),
+        ),
+        migrations.CreateModel(
+            name='ChatTurnUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(db_index=True, max_length=255, verbose_name='会话ID')),
+                ('model_name', models.CharField(blank=True, max_length=255, verbose_name='模型名称')),
+                ('status', models.CharField(choices=[('completed', '已完成'), ('interrupted', '已中断'), ('error', '出错')], default='completed', max_length=20, verbose_name='状态')),
+                ('prompt_tokens', models.PositiveIntegerField(default=0, verbose_name='输入token数')),
+                ('completion_tokens', models.PositiveIntegerField(default=0, verbose_name='输出token数')),
+                ('cached_tokens', models.PositiveIntegerField(default=0, verbose_name='缓存命中token数')),
+                ('total_tokens', models.PositiveIntegerField(default=0, verbose_name='总token数')),
+                ('estimated_cost', models.DecimalField(blank=True, decimal_places=6, max_digits=14, null=True, verbose_name='估算成本')),
+                ('time_to_first_token_ms', models.PositiveIntegerField(blank=True, null=True, verbose_name='首token耗时(ms)')),
+                ('llm_duration_ms', models.PositiveIntegerField(default=0, verbose_name='LLM耗时(ms)')),
+                ('tool_duration_ms', models.PositiveIntegerField(default=0, verbose_name='工具耗时(ms)')),
+                ('total_duration_ms', models.PositiveIntegerField(default=0, verbose_name='总耗时(ms)')),
+                ('llm_calls', models.PositiveIntegerField(default=0, verbose_name='LLM调用次数')),
+                ('tool_calls', models.PositiveIntegerField(default=0, verbose_name='工具调用次数')),
+                ('tool_call_details', models.JSONField(blank=True, default=list, help_text='每次工具调用的名称、耗时和状态', verbose_name='工具调用明细')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')),
+                ('llm_config', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='langgraph_integration.llmconfig', verbose_name='LLM配置')),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='projects.project', verbose_name='关联项目')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '对话轮次用量',
+                'verbose_name_plural': '对话轮次用量',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatUsageDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('turns', models.PositiveIntegerField(default=0, verbose_name='对话轮数')),
+                ('interrupted_turns', models.PositiveIntegerField(default=0, verbose_name='中断轮数')),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0, verbose_name='输入token数')),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0, verbose_name='输出token数')),
+                ('cached_tokens', models.PositiveBigIntegerField(default=0, verbose_name='缓存命中token数')),
+                ('total_tokens', models.PositiveBigIntegerField(default=0, verbose_name='总token数')),
+                ('estimated_cost', models.DecimalField(decimal_places=6, default=0, max_digits=16, verbose_name='估算成本')),
+                ('llm_calls', models.PositiveIntegerField(default=0, verbose_name='LLM调用次数')),
+                ('tool_calls', models.PositiveIntegerField(default=0, verbose_name='工具调用次数')),
+                ('llm_duration_ms', models.PositiveBigIntegerField(default=0, verbose_name='LLM耗时(ms)')),
+                ('tool_duration_ms', models.PositiveBigIntegerField(default=0, verbose_name='工具耗时(ms)')),
+                ('total_duration_ms', models.PositiveBigIntegerField(default=0, verbose_name='总耗时(ms)')),
+                ('ttft_sum_ms', models.PositiveBigIntegerField(default=0, verbose_name='首token耗时合计(ms)')),
+                ('ttft_count', models.PositiveIntegerField(default=0, verbose_name='首token统计次数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('llm_config', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='langgraph_integration.llmconfig', verbose_name='LLM配置')),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='projects.project', verbose_name='关联项目')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '对话用量日汇总',
+                'verbose_name_plural': '对话用量日汇总',
+                'ordering': ['-date'],
+                'unique_together': {('date', 'user', 'project', 'llm_config')},
+            },
+        ),
+    ]
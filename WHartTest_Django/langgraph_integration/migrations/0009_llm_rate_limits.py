@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('langgraph_integration', '0008_chat_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfig',
+            name='max_concurrent_requests',
+            field=models.PositiveIntegerField(blank=True, help_text='同时发往该配置的最大请求数，为空时使用系统默认值', null=True, verbose_name='最大并发请求数'),
+        ),
+        migrations.AddField(
+            model_name='llmconfig',
+            name='tokens_per_minute',
+            field=models.PositiveIntegerField(blank=True, help_text='每分钟允许消耗的token数，为空时不限制', null=True, verbose_name='每分钟token上限'),
+        ),
+    ]
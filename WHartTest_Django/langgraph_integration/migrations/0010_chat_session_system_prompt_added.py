@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('langgraph_integration', '0009_llm_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='system_prompt_added',
+            field=models.BooleanField(default=False, help_text='会话历史中是否已包含系统提示词，避免每轮读取checkpoint检查', verbose_name='已写入系统提示词'),
+        ),
+    ]
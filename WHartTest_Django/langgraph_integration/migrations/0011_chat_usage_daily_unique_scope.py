@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-19 01:42
+
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+SUM_FIELDS = [
+    'turns', 'interrupted_turns', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'total_tokens',
+    'estimated_cost', 'llm_calls', 'tool_calls', 'llm_duration_ms', 'tool_duration_ms', 'total_duration_ms',
+    'ttft_sum_ms', 'ttft_count',
+]
+
+
+def fill_keys_and_merge_duplicates(apps, schema_editor):
+    """回填llm_config_key，并合并项目或LLM配置为空时产生的重复日汇总行"""
+    ChatUsageDaily = apps.get_model('langgraph_integration', 'ChatUsageDaily')
+    ChatUsageDaily.objects.filter(llm_config__isnull=False).update(llm_config_key=models.F('llm_config_id'))
+
+    keeper = {}
+    for row in ChatUsageDaily.objects.order_by('id'):
+        key = (row.date, row.user_id, row.project_id, row.llm_config_key)
+        target = keeper.get(key)
+        if target is None:
+            keeper[key] = row
+            continue
+        for field in SUM_FIELDS:
+            setattr(target, field, getattr(target, field) + getattr(row, field))
+        target.save(update_fields=SUM_FIELDS)
+        row.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('langgraph_integration', '0010_chat_session_system_prompt_added'),
+        ('projects', '0002_project_creator'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='chatusagedaily',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='chatusagedaily',
+            name='llm_config_key',
+            field=models.PositiveBigIntegerField(default=0, help_text='创建时的LLM配置ID（无配置为0），配置删除后保留，用于唯一性判断', verbose_name='LLM配置ID'),
+        ),
+        migrations.RunPython(fill_keys_and_merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatusagedaily',
+            constraint=models.UniqueConstraint(models.F('date'), models.F('user'), django.db.models.functions.comparison.Coalesce('project', 0, output_field=models.BigIntegerField()), models.F('llm_config_key'), name='unique_chat_usage_daily_scope'),
+        ),
+    ]
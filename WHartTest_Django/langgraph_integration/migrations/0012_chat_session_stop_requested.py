@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 01:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('langgraph_integration', '0011_chat_usage_daily_unique_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='stop_requested_at',
+            field=models.DateTimeField(blank=True, help_text='用户最近一次请求停止流式对话的时间，各进程中的流式输出据此中止', null=True, verbose_name='请求停止时间'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.utils import timezone
 
@@ -37,6 +38,18 @@ class LLMConfig(models.Model):
     system_prompt = models.TextField(blank=True, null=True, verbose_name="系统提示词",
                                     help_text="指导LLM行为的系统级提示词")
     
+    # 计费配置（可选，用于估算对话成本）
+    prompt_price_per_million = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True,
+                                                   verbose_name="输入单价", help_text="每百万输入token的价格")
+    completion_price_per_million = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True,
+                                                       verbose_name="输出单价", help_text="每百万输出token的价格")
+
+    # 限流配置（可选，为空时使用全局默认值）
+    max_concurrent_requests = models.PositiveIntegerField(null=True, blank=True, verbose_name="最大并发请求数",
+                                                          help_text="同时发往该配置的最大请求数，为空时使用系统默认值")
+    tokens_per_minute = models.PositiveIntegerField(null=True, blank=True, verbose_name="每分钟token上限",
+                                                    help_text="每分钟允许消耗的token数，为空时不限制")
+
     # 状态字段（保持不变）
     is_active = models.BooleanField(default=False, verbose_name="是否激活",
                                    help_text="是否为当前激活的LLM配置")
@@ -63,13 +76,17 @@ class LLMConfig(models.Model):
 class ChatSession(models.Model):
     """
     对话会话模型 - 用于权限管理，不存储实际聊天数据
-    实际聊天数据存储在 chat_history.sqlite 中，此模型仅用于Django权限系统
+    实际聊天数据存储在对话检查点后端中（默认 chat_history.sqlite），此模型仅用于Django权限系统
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="用户")
     session_id = models.CharField(max_length=255, unique=True, verbose_name="会话ID", 
                                   help_text="LangGraph会话的唯一标识符")
     title = models.CharField(max_length=200, verbose_name="对话标题", default="新对话")
     project = models.ForeignKey('projects.Project', on_delete=models.CASCADE, null=True, blank=True, verbose_name="关联项目")
+    system_prompt_added = models.BooleanField(default=False, verbose_name="已写入系统提示词",
+                                              help_text="会话历史中是否已包含系统提示词，避免每轮读取checkpoint检查")
+    stop_requested_at = models.DateTimeField(null=True, blank=True, verbose_name="请求停止时间",
+                                             help_text="用户最近一次请求停止流式对话的时间，各进程中的流式输出据此中止")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
 
@@ -85,7 +102,7 @@ class ChatSession(models.Model):
 class ChatMessage(models.Model):
     """
     对话消息模型 - 用于权限管理，不存储实际消息内容
-    实际消息内容存储在 chat_history.sqlite 中，此模型仅用于Django权限系统
+    实际消息内容存储在对话检查点后端中（默认 chat_history.sqlite），此模型仅用于Django权限系统
     """
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, verbose_name="对话会话")
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="用户")
@@ -102,3 +119,99 @@ class ChatMessage(models.Model):
         
     def __str__(self):
         return f"{self.session.title} - {self.role} [{self.created_at}]"
+
+
+class ChatTurnUsage(models.Model):
+    """
+    对话轮次用量模型 - 记录每一轮对话的token用量、耗时和工具调用情况
+    """
+    STATUS_CHOICES = [
+        ('completed', '已完成'),
+        ('interrupted', '已中断'),
+        ('error', '出错'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="用户")
+    project = models.ForeignKey('projects.Project', on_delete=models.CASCADE, null=True, blank=True, verbose_name="关联项目")
+    llm_config = models.ForeignKey(LLMConfig, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="LLM配置")
+    session_id = models.CharField(max_length=255, db_index=True, verbose_name="会话ID")
+    model_name = models.CharField(max_length=255, blank=True, verbose_name="模型名称")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='completed', verbose_name="状态")
+
+    # token用量
+    prompt_tokens = models.PositiveIntegerField(default=0, verbose_name="输入token数")
+    completion_tokens = models.PositiveIntegerField(default=0, verbose_name="输出token数")
+    cached_tokens = models.PositiveIntegerField(default=0, verbose_name="缓存命中token数")
+    total_tokens = models.PositiveIntegerField(default=0, verbose_name="总token数")
+    estimated_cost = models.DecimalField(max_digits=14, decimal_places=6, null=True, blank=True, verbose_name="估算成本")
+
+    # 耗时（毫秒）
+    time_to_first_token_ms = models.PositiveIntegerField(null=True, blank=True, verbose_name="首token耗时(ms)")
+    llm_duration_ms = models.PositiveIntegerField(default=0, verbose_name="LLM耗时(ms)")
+    tool_duration_ms = models.PositiveIntegerField(default=0, verbose_name="工具耗时(ms)")
+    total_duration_ms = models.PositiveIntegerField(default=0, verbose_name="总耗时(ms)")
+
+    # 调用明细
+    llm_calls = models.PositiveIntegerField(default=0, verbose_name="LLM调用次数")
+    tool_calls = models.PositiveIntegerField(default=0, verbose_name="工具调用次数")
+    tool_call_details = models.JSONField(default=list, blank=True, verbose_name="工具调用明细",
+                                         help_text="每次工具调用的名称、耗时和状态")
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="创建时间")
+
+    class Meta:
+        verbose_name = "对话轮次用量"
+        verbose_name_plural = "对话轮次用量"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.session_id} - {self.total_tokens} tokens [{self.created_at}]"
+
+
+class ChatUsageDaily(models.Model):
+    """
+    对话用量日汇总模型 - 按 日期/用户/项目/LLM配置 聚合对话轮次用量
+    """
+    date = models.DateField(verbose_name="日期")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="用户")
+    project = models.ForeignKey('projects.Project', on_delete=models.CASCADE, null=True, blank=True, verbose_name="关联项目")
+    llm_config = models.ForeignKey(LLMConfig, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="LLM配置")
+    llm_config_key = models.PositiveBigIntegerField(default=0, verbose_name="LLM配置ID",
+                                                    help_text="创建时的LLM配置ID（无配置为0），配置删除后保留，用于唯一性判断")
+
+    turns = models.PositiveIntegerField(default=0, verbose_name="对话轮数")
+    interrupted_turns = models.PositiveIntegerField(default=0, verbose_name="中断轮数")
+    prompt_tokens = models.PositiveBigIntegerField(default=0, verbose_name="输入token数")
+    completion_tokens = models.PositiveBigIntegerField(default=0, verbose_name="输出token数")
+    cached_tokens = models.PositiveBigIntegerField(default=0, verbose_name="缓存命中token数")
+    total_tokens = models.PositiveBigIntegerField(default=0, verbose_name="总token数")
+    estimated_cost = models.DecimalField(max_digits=16, decimal_places=6, default=0, verbose_name="估算成本")
+
+    llm_calls = models.PositiveIntegerField(default=0, verbose_name="LLM调用次数")
+    tool_calls = models.PositiveIntegerField(default=0, verbose_name="工具调用次数")
+    llm_duration_ms = models.PositiveBigIntegerField(default=0, verbose_name="LLM耗时(ms)")
+    tool_duration_ms = models.PositiveBigIntegerField(default=0, verbose_name="工具耗时(ms)")
+    total_duration_ms = models.PositiveBigIntegerField(default=0, verbose_name="总耗时(ms)")
+    ttft_sum_ms = models.PositiveBigIntegerField(default=0, verbose_name="首token耗时合计(ms)")
+    ttft_count = models.PositiveIntegerField(default=0, verbose_name="首token统计次数")
+
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "对话用量日汇总"
+        verbose_name_plural = "对话用量日汇总"
+        ordering = ['-date']
+        # 普通唯一约束中NULL互不相等，项目或LLM配置为空时会产生重复的汇总行（SQLite不支持nulls_distinct）：
+        # 项目空值按0参与判断；LLM配置删除后会置空，改用不随之变化的llm_config_key
+        constraints = [
+            models.UniqueConstraint(
+                models.F('date'),
+                models.F('user'),
+                Coalesce('project', 0, output_field=models.BigIntegerField()),
+                models.F('llm_config_key'),
+                name='unique_chat_usage_daily_scope'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.user_id} - {self.total_tokens} tokens"
@@ -0,0 +1,297 @@
+"""
+LLM响应缓存
+- 精确缓存：实现LangChain的BaseCache接口，以 (模型参数, 提示词哈希) 为键，用于需求拆分、评审等确定性调用
+- 语义缓存：按问题向量相似度复用RAG回答，仅在知识库、模型和检索上下文都一致时命中
+两者都保存在SQLite中（服务重启后仍然有效），并统计命中率与节省的token数
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import warnings
+from typing import Any, Dict, List, Optional, Sequence
+
+from django.conf import settings
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_DEFAULT = 'default'
+NAMESPACE_SEMANTIC = 'semantic'
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _generation_tokens(generation) -> int:
+    """读取生成结果中记录的token用量（命中缓存时即为节省的token数）"""
+    usage_metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+    if usage_metadata:
+        return usage_metadata.get('total_tokens', 0) or 0
+    return 0
+
+
+def _cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class LLMResponseCache(BaseCache):
+    """
+    基于SQLite的LLM响应缓存
+    作为模型的cache参数传入后，invoke/ainvoke会先查缓存，命中时不再调用LLM（也不占用LLM网关许可）
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int = 7 * 24 * 3600, namespace: str = NAMESPACE_DEFAULT):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._misses = 0
+        self._session_hits = 0
+
+    # --- 存储 ---
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS llm_response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    llm_hash TEXT NOT NULL,
+                    prompt_hash TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    expires_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_llm_response_cache_namespace ON llm_response_cache (namespace);
+                CREATE TABLE IF NOT EXISTS llm_semantic_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    namespace TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    llm_hash TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    embedding TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    expires_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_llm_semantic_cache_scope ON llm_semantic_cache (scope, llm_hash);
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl_seconds if self.ttl_seconds else None
+
+    @staticmethod
+    def _cache_key(prompt: str, llm_string: str) -> str:
+        return _sha256(f"{_sha256(llm_string)}:{_sha256(prompt)}")
+
+    # --- BaseCache接口 ---
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        cache_key = self._cache_key(prompt, llm_string)
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT response, expires_at FROM llm_response_cache WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                self._misses += 1
+                return None
+            conn.execute("UPDATE llm_response_cache SET hits = hits + 1 WHERE cache_key = ?", (cache_key,))
+            conn.commit()
+            self._session_hits += 1
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # langchain的loads带有beta警告
+                return [loads(item) for item in json.loads(row[0])]
+        except Exception as e:
+            logger.warning(f"LLMResponseCache: Failed to deserialize cached response, ignoring: {e}")
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        response = json.dumps([dumps(generation) for generation in return_val])
+        tokens = sum(_generation_tokens(generation) for generation in return_val)
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_response_cache "
+                "(cache_key, namespace, llm_hash, prompt_hash, response, tokens, hits, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (self._cache_key(prompt, llm_string), self.namespace, _sha256(llm_string), _sha256(prompt),
+                 response, tokens, time.time(), self._expires_at())
+            )
+            conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        """清空缓存；传入namespace时只清空该命名空间"""
+        namespace = kwargs.get('namespace')
+        with self._lock:
+            conn = self._connection()
+            if namespace:
+                conn.execute("DELETE FROM llm_response_cache WHERE namespace = ?", (namespace,))
+                conn.execute("DELETE FROM llm_semantic_cache WHERE namespace = ?", (namespace,))
+            else:
+                conn.execute("DELETE FROM llm_response_cache")
+                conn.execute("DELETE FROM llm_semantic_cache")
+            conn.commit()
+
+    def purge_expired(self) -> int:
+        """删除过期条目，返回删除数量"""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            deleted = conn.execute(
+                "DELETE FROM llm_response_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)
+            ).rowcount
+            deleted += conn.execute(
+                "DELETE FROM llm_semantic_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)
+            ).rowcount
+            conn.commit()
+        return deleted
+
+    # --- 语义缓存 ---
+    def semantic_lookup(self, scope: str, llm_string: str, embedding: List[float],
+                        threshold: float) -> Optional[Dict[str, Any]]:
+        """在同一作用域内查找相似度不低于阈值的已缓存回答"""
+        llm_hash = _sha256(llm_string)
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute(
+                "SELECT id, question, embedding, answer FROM llm_semantic_cache "
+                "WHERE scope = ? AND llm_hash = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (scope, llm_hash, time.time())
+            ).fetchall()
+
+            best, best_score = None, threshold
+            for row_id, question, stored_embedding, answer in rows:
+                score = _cosine_similarity(embedding, json.loads(stored_embedding))
+                if score >= best_score:
+                    best, best_score = (row_id, question, answer), score
+
+            if best is None:
+                self._misses += 1
+                return None
+            conn.execute("UPDATE llm_semantic_cache SET hits = hits + 1 WHERE id = ?", (best[0],))
+            conn.commit()
+            self._session_hits += 1
+        return {'answer': best[2], 'matched_question': best[1], 'similarity': best_score}
+
+    def semantic_update(self, scope: str, llm_string: str, question: str, embedding: List[float],
+                        answer: str, tokens: int = 0) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO llm_semantic_cache "
+                "(namespace, scope, llm_hash, question, embedding, answer, tokens, hits, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (NAMESPACE_SEMANTIC, scope, _sha256(llm_string), question, json.dumps(embedding), answer,
+                 tokens, time.time(), self._expires_at())
+            )
+            conn.commit()
+
+    # --- 统计 ---
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connection()
+            by_namespace = {}
+            for table in ('llm_response_cache', 'llm_semantic_cache'):
+                for namespace, entries, hits, saved_tokens in conn.execute(
+                        f"SELECT namespace, COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * tokens), 0) "
+                        f"FROM {table} GROUP BY namespace"):
+                    item = by_namespace.setdefault(namespace, {'entries': 0, 'hits': 0, 'saved_tokens': 0})
+                    item['entries'] += entries
+                    item['hits'] += hits
+                    item['saved_tokens'] += saved_tokens
+            lookups = self._session_hits + self._misses
+            return {
+                'db_path': self.db_path,
+                'ttl_seconds': self.ttl_seconds,
+                'entries': sum(item['entries'] for item in by_namespace.values()),
+                'total_hits': sum(item['hits'] for item in by_namespace.values()),
+                'saved_tokens': sum(item['saved_tokens'] for item in by_namespace.values()),
+                'namespaces': by_namespace,
+                # 以下为本进程启动以来的统计
+                'session_hits': self._session_hits,
+                'session_misses': self._misses,
+                'session_hit_rate': round(self._session_hits / lookups, 4) if lookups else None,
+            }
+
+
+_response_caches: Dict[str, LLMResponseCache] = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache(namespace: str = NAMESPACE_DEFAULT) -> Optional[LLMResponseCache]:
+    """获取命名空间对应的响应缓存，未启用时返回None"""
+    if not getattr(settings, 'LLM_RESPONSE_CACHE_ENABLED', False):
+        return None
+    return _open_cache(namespace)
+
+
+def _open_cache(namespace: str) -> LLMResponseCache:
+    """打开（并复用）命名空间对应的缓存，不检查开关"""
+    with _response_caches_lock:
+        cache = _response_caches.get(namespace)
+        if cache is None:
+            db_path = getattr(settings, 'LLM_RESPONSE_CACHE_PATH', None) \
+                or os.path.join(str(settings.BASE_DIR), "llm_response_cache.sqlite")
+            cache = LLMResponseCache(db_path, getattr(settings, 'LLM_RESPONSE_CACHE_TTL', 7 * 24 * 3600), namespace)
+            _response_caches[namespace] = cache
+        return cache
+
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    """汇总所有命名空间的缓存统计"""
+    with _response_caches_lock:
+        caches = list(_response_caches.values())
+    if not caches:
+        cache = get_response_cache() or get_semantic_cache()
+        if cache is None:
+            return {'enabled': False, 'semantic_enabled': False}
+        caches = [cache]
+
+    stats = caches[0].stats()
+    stats['session_hits'] = sum(cache._session_hits for cache in caches)
+    stats['session_misses'] = sum(cache._misses for cache in caches)
+    lookups = stats['session_hits'] + stats['session_misses']
+    stats['session_hit_rate'] = round(stats['session_hits'] / lookups, 4) if lookups else None
+    stats['enabled'] = getattr(settings, 'LLM_RESPONSE_CACHE_ENABLED', False)
+    stats['semantic_enabled'] = getattr(settings, 'LLM_SEMANTIC_CACHE_ENABLED', False)
+    return stats
+
+
+def get_semantic_cache() -> Optional[LLMResponseCache]:
+    """获取RAG回答的语义缓存，未启用时返回None（与精确缓存的开关相互独立）"""
+    if not getattr(settings, 'LLM_SEMANTIC_CACHE_ENABLED', False):
+        return None
+    return _open_cache(NAMESPACE_SEMANTIC)
+
+
+def get_llm_cache_key(llm) -> str:
+    """模型参数标识（包含模型名称、温度等），与LangChain缓存使用的llm_string一致"""
+    try:
+        return llm._get_llm_string()
+    except Exception:
+        return f"{type(llm).__name__}:{getattr(llm, 'model_name', None) or getattr(llm, 'model', '')}"
+
+
+def build_context_fingerprint(context: List[Dict[str, Any]]) -> str:
+    """检索上下文指纹：语义缓存只在上下文完全相同时命中，避免复用基于过期资料的回答"""
+    return _sha256(json.dumps([item.get('content', '') for item in context or []], ensure_ascii=False))
@@ -12,6 +12,8 @@ class LLMConfigSerializer(serializers.ModelSerializer):
         model = LLMConfig
         fields = [
             'id', 'config_name', 'provider', 'name', 'api_url', 'api_key', 'system_prompt', 
+            'prompt_price_per_million', 'completion_price_per_million',
+            'max_concurrent_requests', 'tokens_per_minute',
             'is_active', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
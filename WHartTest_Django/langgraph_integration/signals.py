@@ -0,0 +1,26 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from prompts.models import UserPrompt
+from .config_cache import chat_config_cache
+from .models import ChatSession, LLMConfig
+
+
+@receiver(post_save, sender=LLMConfig)
+@receiver(post_delete, sender=LLMConfig)
+def invalidate_llm_config_cache(sender, instance, **kwargs):
+    """LLM配置变更后使激活配置缓存失效"""
+    chat_config_cache.invalidate_llm_config()
+
+
+@receiver(post_save, sender=UserPrompt)
+@receiver(post_delete, sender=UserPrompt)
+def invalidate_user_prompt_cache(sender, instance, **kwargs):
+    """用户提示词变更后使该用户的提示词缓存失效"""
+    chat_config_cache.invalidate_user_prompts(instance.user_id)
+
+
+@receiver(post_delete, sender=ChatSession)
+def invalidate_chat_session_cache(sender, instance, **kwargs):
+    """会话删除后移除其元数据缓存"""
+    chat_config_cache.invalidate_session(instance.session_id)
@@ -0,0 +1,149 @@
+"""
+聊天流任务控制
+跟踪正在运行的流式对话任务，在客户端断开或用户主动停止时取消LLM与MCP工具调用，
+并把未完成的回合以“已中断”状态写回checkpoint
+
+- 停止请求写入会话的 stop_requested_at，流式输出在各数据块之间（以及空闲时定期）检查该标记，
+  因此停止接口与流式请求落在不同的工作进程时同样有效；同进程内的任务还会被立即取消
+- 客户端断开时取消图任务依赖ASGI服务器（uvicorn/daphne）关闭异步生成器；
+  在WSGI下异步流式响应会被整体缓冲，既无法逐块输出也无法感知断开
+"""
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+
+from .models import ChatSession
+
+logger = logging.getLogger(__name__)
+
+INTERRUPTED_MARKER = "[回复已中断]"
+
+
+class ChatStreamRegistry:
+    """
+    进程内的流式对话任务注册表
+    按thread_id记录正在执行的图任务及其所属事件循环，支持跨线程取消
+    """
+
+    def __init__(self):
+        self._runs: Dict[str, Dict[str, Any]] = {}  # thread_id -> {'task', 'loop'}
+        self._lock = threading.Lock()
+
+    def register(self, thread_id: str, task: asyncio.Task):
+        """登记任务；同一会话已有任务在运行时先取消旧任务"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            previous = self._runs.get(thread_id)
+            self._runs[thread_id] = {'task': task, 'loop': loop}
+
+        if previous and not previous['task'].done():
+            logger.info(f"ChatStreamRegistry: Superseding running stream for thread_id: {thread_id}")
+            self._cancel_run(previous)
+
+    def unregister(self, thread_id: str, task: asyncio.Task):
+        """注销任务（仅当登记的仍是该任务时）"""
+        with self._lock:
+            run = self._runs.get(thread_id)
+            if run and run['task'] is task:
+                del self._runs[thread_id]
+
+    def is_running(self, thread_id: str) -> bool:
+        with self._lock:
+            run = self._runs.get(thread_id)
+        return bool(run and not run['task'].done())
+
+    def cancel(self, thread_id: str) -> bool:
+        """取消指定会话正在运行的任务，返回是否找到可取消的任务"""
+        with self._lock:
+            run = self._runs.get(thread_id)
+        if not run or run['task'].done():
+            return False
+        self._cancel_run(run)
+        logger.info(f"ChatStreamRegistry: Cancellation requested for thread_id: {thread_id}")
+        return True
+
+    def request_stop(self, user, session_id: str, thread_id: str) -> bool:
+        """
+        请求停止会话的流式对话：写入共享的停止标记，并取消本进程内的任务
+        返回是否找到该会话
+        """
+        flagged = ChatSession.objects.filter(user=user, session_id=session_id).update(
+            stop_requested_at=timezone.now()
+        )
+        cancelled = self.cancel(thread_id)
+        return bool(flagged) or cancelled
+
+    @staticmethod
+    async def astop_requested(user, session_id: str, since: datetime) -> bool:
+        """流式对话开始后是否有停止请求"""
+        return await ChatSession.objects.filter(
+            user=user, session_id=session_id, stop_requested_at__gte=since
+        ).aexists()
+
+    @staticmethod
+    def poll_interval() -> float:
+        """检查停止标记的最小间隔（秒）"""
+        return max(0.1, getattr(settings, 'CHAT_STOP_POLL_INTERVAL', 1.0))
+
+    @staticmethod
+    def _cancel_run(run: Dict[str, Any]):
+        loop = run['loop']
+        if loop.is_closed():
+            return
+        # 停止请求可能来自其他线程（同步视图），必须通过所属事件循环调度取消
+        loop.call_soon_threadsafe(run['task'].cancel)
+
+
+def extract_stream_text(chunk) -> str:
+    """从messages流模式的数据块中提取AI增量文本"""
+    message = chunk[0] if isinstance(chunk, tuple) and chunk else chunk
+    if isinstance(message, AIMessageChunk) and isinstance(message.content, str):
+        return message.content
+    return ""
+
+
+async def record_interrupted_turn(runnable, config: Dict[str, Any], as_node: str,
+                                  input_messages: List, partial_content: str = ""):
+    """
+    将被中断的回合写回checkpoint
+    - 为悬空的工具调用补齐ToolMessage，避免下一轮因缺少工具结果而报错
+    - 追加一条带interrupted标记的AI消息，保存已生成的部分内容
+    """
+    snapshot = await runnable.aget_state(config)
+    existing_messages = (snapshot.values or {}).get('messages', []) if snapshot else []
+
+    patch = []
+
+    # 中断发生在输入写入checkpoint之前时，补写本轮输入
+    latest_human = next((m for m in reversed(existing_messages) if isinstance(m, HumanMessage)), None)
+    input_human = next((m for m in reversed(input_messages) if isinstance(m, HumanMessage)), None)
+    if input_human and (latest_human is None or latest_human.content != input_human.content):
+        patch.extend(input_messages)
+
+    answered_ids = {m.tool_call_id for m in existing_messages if isinstance(m, ToolMessage)}
+    for message in existing_messages:
+        if isinstance(message, AIMessage):
+            for tool_call in message.tool_calls or []:
+                if tool_call.get('id') and tool_call['id'] not in answered_ids:
+                    patch.append(ToolMessage(
+                        content="工具调用已被中断",
+                        tool_call_id=tool_call['id'],
+                        name=tool_call.get('name'),
+                        status="error",
+                    ))
+
+    content = f"{partial_content}\n\n{INTERRUPTED_MARKER}" if partial_content else INTERRUPTED_MARKER
+    patch.append(AIMessage(content=content, response_metadata={'interrupted': True}))
+
+    await runnable.aupdate_state(config, {"messages": patch}, as_node=as_node)
+    logger.info(f"Recorded interrupted turn for thread_id: {config['configurable']['thread_id']}")
+
+
+# 全局流任务注册表实例
+chat_stream_registry = ChatStreamRegistry()
@@ -1,3 +1,627 @@
-from django.test import TestCase
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import StringIO
+from contextlib import closing
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGenerationChunk
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import StateGraph, END
+from rest_framework.test import APIClient
+
+from knowledge import langgraph_integration as knowledge_integration
+from knowledge.langgraph_integration import KnowledgeRAGService
+from knowledge.models import KnowledgeBase
+from projects.models import Project, ProjectMember
+from prompts.models import UserPrompt
+from .checkpointer import (
+    ThreadedAsyncSaverMixin, count_thread_checkpoints, delete_thread, get_sqlite_path, list_thread_ids,
+    sync_checkpointer,
+)
+from .config_cache import ChatConfigCache, chat_config_cache
+from .context_manager import ConversationContextManager, SUMMARY_PREFIX
+from .llm_gateway import LLMGateway, ProviderLimiter, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from .models import ChatSession, ChatTurnUsage, ChatUsageDaily, LLMConfig
+from . import response_cache
+from .response_cache import LLMResponseCache
+from .stream_control import ChatStreamRegistry, INTERRUPTED_MARKER, record_interrupted_turn
+from .usage import ChatUsageTracker, record_chat_turn_usage
+from .views import AgentState, create_llm_instance, get_effective_system_prompt_async, session_needs_system_prompt
+
+
+class ThreadedSqliteSaver(ThreadedAsyncSaverMixin, SqliteSaver):
+    """在线程中执行同步方法的SQLite检查点存储，用于测试异步路径"""
+
+
+class ChatStreamCancellationTests(SimpleTestCase):
+    """流式对话取消与中断记录测试"""
+
+    def _build_graph(self, started, node_reply=None):
+        async def slow_node(state: AgentState):
+            started.set()
+            if node_reply is not None:
+                return {"messages": [node_reply]}
+            await asyncio.sleep(60)
+            return {"messages": [AIMessage(content="never")]}
+
+        builder = StateGraph(AgentState)
+        builder.add_node("chatbot", slow_node)
+        builder.set_entry_point("chatbot")
+        builder.add_edge("chatbot", END)
+        return builder.compile(checkpointer=MemorySaver())
+
+    async def test_cancel_stops_running_graph_and_records_interrupted_turn(self):
+        started = asyncio.Event()
+        graph = self._build_graph(started)
+        config = {"configurable": {"thread_id": "1_1_abc"}}
+        input_messages = [HumanMessage(content="你好")]
+        registry = ChatStreamRegistry()
+
+        async def run():
+            try:
+                async for _ in graph.astream({"messages": input_messages}, config=config):
+                    pass
+            except asyncio.CancelledError:
+                await record_interrupted_turn(graph, config, "chatbot", input_messages, "部分回复")
+                raise
+
+        task = asyncio.create_task(run())
+        registry.register("1_1_abc", task)
+        await asyncio.wait_for(started.wait(), timeout=5)
+
+        self.assertTrue(registry.is_running("1_1_abc"))
+        self.assertTrue(registry.cancel("1_1_abc"))
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=5)
+        registry.unregister("1_1_abc", task)
+
+        self.assertFalse(registry.cancel("1_1_abc"))
+        messages = (await graph.aget_state(config)).values["messages"]
+        self.assertIsInstance(messages[0], HumanMessage)
+        self.assertEqual(messages[-1].content, f"部分回复\n\n{INTERRUPTED_MARKER}")
+        self.assertTrue(messages[-1].response_metadata.get("interrupted"))
+
+    async def test_dangling_tool_calls_are_closed(self):
+        started = asyncio.Event()
+        tool_call_reply = AIMessage(
+            content="",
+            tool_calls=[{"id": "call_1", "name": "search", "args": {}}],
+        )
+        graph = self._build_graph(started, node_reply=tool_call_reply)
+        config = {"configurable": {"thread_id": "1_1_tool"}}
+        input_messages = [HumanMessage(content="查一下")]
+        await graph.ainvoke({"messages": input_messages}, config=config)
+
+        await record_interrupted_turn(graph, config, "chatbot", input_messages)
+
+        messages = (await graph.aget_state(config)).values["messages"]
+        tool_messages = [m for m in messages if isinstance(m, ToolMessage)]
+        self.assertEqual([m.tool_call_id for m in tool_messages], ["call_1"])
+        self.assertEqual(messages[-1].content, INTERRUPTED_MARKER)
+        # 输入已在checkpoint中，不应重复写入
+        self.assertEqual(len([m for m in messages if isinstance(m, HumanMessage)]), 1)
+
+
+class ChatStopFlagTests(TestCase):
+    """跨进程停止标记测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="stop_user", password="pass")
+        ChatSession.objects.create(user=self.user, session_id="abc")
+
+    def test_stop_request_is_visible_without_local_task(self):
+        started_at = timezone.now()
+        # 另一个进程的注册表中没有该任务，只能写入共享标记
+        other_process = ChatStreamRegistry()
+        self.assertFalse(async_to_sync(ChatStreamRegistry.astop_requested)(self.user, "abc", started_at))
+
+        self.assertTrue(other_process.request_stop(self.user, "abc", f"{self.user.id}_1_abc"))
+        self.assertTrue(async_to_sync(ChatStreamRegistry.astop_requested)(self.user, "abc", started_at))
+        # 之后开始的流不受先前停止请求的影响
+        self.assertFalse(async_to_sync(ChatStreamRegistry.astop_requested)(self.user, "abc", timezone.now()))
+        self.assertFalse(other_process.request_stop(self.user, "missing", f"{self.user.id}_1_missing"))
+
+
+class AsyncRAGNodeTests(SimpleTestCase):
+    """异步RAG节点测试：慢速检索不应阻塞事件循环上的其他对话"""
+
+    async def test_concurrent_queries_progress_independently(self):
+        rag_service = KnowledgeRAGService(FakeListChatModel(responses=["回答"] * 4))
+        # 两次检索必须同时在线程池中等待才能通过屏障；检索阻塞期间事件循环仍需调度ticker才能放行
+        both_searching = threading.Barrier(2, timeout=5)
+        searches_started = threading.Event()
+        loop_responsive = threading.Event()
+
+        def blocking_search(knowledge_base_id, query, top_k=5, similarity_threshold=0.7):
+            both_searching.wait()
+            searches_started.set()
+            if not loop_responsive.wait(timeout=5):
+                raise RuntimeError("事件循环在检索期间被阻塞")
+            return [{"content": f"关于{query}的资料", "metadata": {}, "similarity_score": 0.9}]
+
+        async def ticker():
+            while not searches_started.is_set():
+                await asyncio.sleep(0.01)
+            loop_responsive.set()
+
+        with mock.patch('knowledge.langgraph_integration.search_knowledge_base', side_effect=blocking_search):
+            results = await asyncio.wait_for(asyncio.gather(
+                rag_service.aquery("问题一", knowledge_base_id="kb"),
+                rag_service.aquery("问题二", knowledge_base_id="kb"),
+                ticker(),
+            ), timeout=10)
+
+        self.assertEqual(results[0]["answer"], "回答")
+        self.assertEqual(results[0]["context"][0]["content"], "关于问题一的资料")
+        self.assertEqual(results[1]["context"][0]["content"], "关于问题二的资料")
+
+
+class KnowledgeVectorManagerCacheTests(TestCase):
+    """知识库向量存储管理器复用测试"""
+
+    def setUp(self):
+        user = User.objects.create_user(username="kb_user", password="pass")
+        project = Project.objects.create(name="知识库项目", creator=user)
+        self.knowledge_base = KnowledgeBase.objects.create(name="kb", project=project, creator=user)
+        knowledge_integration._vector_managers.clear()
+
+    def test_manager_is_reused_until_knowledge_base_changes(self):
+        with mock.patch.object(knowledge_integration, "VectorStoreManager") as manager_class:
+            manager_class.return_value.similarity_search.return_value = []
+            knowledge_integration.search_knowledge_base(self.knowledge_base.id, "问题")
+            knowledge_integration.embed_knowledge_base_query(self.knowledge_base.id, "问题")
+            self.assertEqual(manager_class.call_count, 1)
+
+            self.knowledge_base.name = "kb2"
+            self.knowledge_base.save()
+            knowledge_integration.search_knowledge_base(self.knowledge_base.id, "问题")
+            self.assertEqual(manager_class.call_count, 2)
+
+    def test_executor_tasks_clean_up_connections(self):
+        with mock.patch.object(knowledge_integration, "close_old_connections") as close_connections:
+            result = async_to_sync(knowledge_integration.run_in_retrieval_executor)(threading.current_thread)
+        self.assertTrue(result.name.startswith("rag-retrieval"))
+        self.assertEqual(close_connections.call_count, 2)
+
+
+class ConversationContextManagerTests(SimpleTestCase):
+    """对话上下文摘要测试"""
+
+    async def test_prompt_size_stays_flat_as_conversation_grows(self):
+        summarizer = FakeListChatModel(responses=["用户在设计登录模块的测试用例"] * 50)
+        manager = ConversationContextManager(
+            summarizer, "gpt-4", max_context_tokens=400, trigger_ratio=0.75, keep_last_turns=2
+        )
+        state = {"messages": [SystemMessage(content="你是测试专家", id="sys")]}
+        prompt_sizes = []
+
+        for turn in range(30):
+            state["messages"].append(HumanMessage(content=f"第{turn}轮：请补充登录模块的边界值测试用例" * 3, id=f"h{turn}"))
+            prepared = await manager.aprepare(state)
+            llm_input = prepared.pop("llm_input_messages")
+            state.update(prepared)
+            prompt_sizes.append(manager.count_tokens(llm_input))
+
+            self.assertIsInstance(llm_input[0], SystemMessage)
+            self.assertTrue(llm_input[0].content.startswith("你是测试专家"))
+            self.assertEqual(llm_input[-1].id, f"h{turn}")
+            state["messages"].append(AIMessage(content=f"第{turn}轮的回复：已补充用例" * 3, id=f"a{turn}"))
+
+        self.assertIn(SUMMARY_PREFIX, llm_input[0].content)
+        self.assertTrue(state["summary_until_id"].startswith("a"))
+        # 完整历史持续增长，但发送给LLM的提示词大小保持在阈值附近
+        self.assertGreater(manager.count_tokens(state["messages"]), 4 * manager.token_threshold)
+        self.assertLessEqual(max(prompt_sizes), manager.token_threshold + 150)
+
+    async def test_short_conversation_is_untouched(self):
+        manager = ConversationContextManager(FakeListChatModel(responses=["unused"]), "gpt-4")
+        state = {"messages": [HumanMessage(content="你好", id="h0")]}
+        prepared = await manager.aprepare(state)
+        self.assertEqual(prepared, {"llm_input_messages": state["messages"]})
+
+
+class UsageChunkChatModel(FakeListChatModel):
+    """逐字流式输出，并像开启stream_usage的OpenAI一样在最后一个chunk附带用量"""
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self.responses[0]
+        for char in response:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=char))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata={
+            "input_tokens": 12, "output_tokens": len(response), "total_tokens": 12 + len(response),
+        }))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._stream(messages, stop=stop):
+            if run_manager and chunk.message.content:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+class ChatUsageTests(TestCase):
+    """对话用量统计测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="usage_user", password="pass")
+        self.project = Project.objects.create(name="用量项目", creator=self.user)
+        self.llm_config = LLMConfig.objects.create(
+            config_name="usage-config", name="gpt-4", api_url="https://example.com/v1", api_key="key",
+            prompt_price_per_million=Decimal("2"), completion_price_per_million=Decimal("8"),
+        )
+
+    def test_tracker_collects_llm_and_tool_metrics(self):
+        tracker = ChatUsageTracker()
+        llm = FakeListChatModel(responses=["你好"])
+
+        async def run():
+            await llm.ainvoke("hi", config={"callbacks": [tracker]})
+            await tracker.on_tool_start({"name": "search"}, "{}", run_id="00000000-0000-0000-0000-000000000001")
+            await tracker.on_tool_end("ok", run_id="00000000-0000-0000-0000-000000000001")
+
+        asyncio.run(run())
+        usage = tracker.summary()
+        self.assertEqual(usage["llm_calls"], 1)
+        self.assertEqual(usage["tool_calls"], 1)
+        self.assertEqual(usage["tool_call_details"][0]["name"], "search")
+        self.assertIsNotNone(usage["time_to_first_token_ms"])
+
+    def test_openai_clients_request_stream_usage(self):
+        for provider in ("openai", "openai_compatible"):
+            self.llm_config.provider = provider
+            llm = create_llm_instance(self.llm_config)
+            self.assertTrue(llm.stream_usage, provider)
+
+    def test_streamed_turn_records_token_usage(self):
+        tracker = ChatUsageTracker()
+        llm = UsageChunkChatModel(responses=["你好世界"])
+
+        async def run():
+            chunks = [chunk async for chunk in llm.astream("hi", config={"callbacks": [tracker]})]
+            self.assertGreater(len(chunks), 1)
+
+        asyncio.run(run())
+        record_chat_turn_usage(self.user, self.project, self.llm_config, "s1", tracker.summary())
+
+        daily = ChatUsageDaily.objects.get()
+        self.assertEqual((daily.prompt_tokens, daily.completion_tokens), (12, 4))
+        self.assertEqual(daily.total_tokens, 16)
+
+    def test_turns_roll_up_into_daily_totals(self):
+        usage = {
+            "prompt_tokens": 1000, "completion_tokens": 500, "cached_tokens": 200, "total_tokens": 1500,
+            "llm_calls": 2, "tool_calls": 1, "time_to_first_token_ms": 300, "llm_duration_ms": 1200,
+            "tool_duration_ms": 400, "total_duration_ms": 1700,
+            "tool_call_details": [{"name": "search", "duration_ms": 400, "status": "success"}],
+        }
+        record_chat_turn_usage(self.user, self.project, self.llm_config, "s1", usage)
+        record_chat_turn_usage(self.user, self.project, self.llm_config, "s1",
+                               dict(usage, time_to_first_token_ms=None), status="interrupted")
+
+        self.assertEqual(ChatTurnUsage.objects.count(), 2)
+        self.assertEqual(ChatTurnUsage.objects.first().estimated_cost, Decimal("0.006"))
+        daily = ChatUsageDaily.objects.get()
+        self.assertEqual(daily.turns, 2)
+        self.assertEqual(daily.interrupted_turns, 1)
+        self.assertEqual(daily.total_tokens, 3000)
+        self.assertEqual(daily.estimated_cost, Decimal("0.012"))
+        self.assertEqual((daily.ttft_sum_ms, daily.ttft_count), (300, 1))
+
+    def test_null_scoped_turns_share_one_daily_row(self):
+        usage = {
+            "prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0, "total_tokens": 15,
+            "llm_calls": 1, "tool_calls": 0, "time_to_first_token_ms": None, "llm_duration_ms": 10,
+            "tool_duration_ms": 0, "total_duration_ms": 10, "tool_call_details": [],
+        }
+        record_chat_turn_usage(self.user, None, None, "s1", usage)
+        record_chat_turn_usage(self.user, None, None, "s2", usage)
+        record_chat_turn_usage(self.user, None, self.llm_config, "s3", usage)
+
+        self.assertEqual(ChatUsageDaily.objects.count(), 2)
+        self.assertEqual(ChatUsageDaily.objects.get(llm_config__isnull=True).turns, 2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ChatUsageDaily.objects.create(date=timezone.localdate(), user=self.user)
+
+        # 删除LLM配置后汇总行保留，且不与无配置的汇总行冲突
+        self.llm_config.delete()
+        self.assertEqual(ChatUsageDaily.objects.filter(llm_config__isnull=True).count(), 2)
+
+
+class LLMGatewayTests(SimpleTestCase):
+    """LLM网关限流测试"""
+
+    async def test_concurrency_is_capped(self):
+        limiter = ProviderLimiter("cfg", "cfg", max_concurrency=2)
+        active = []
+
+        async def call():
+            lease = await limiter.aacquire(10)
+            active.append(limiter.stats()["active"])
+            await asyncio.sleep(0.02)
+            lease.release()
+
+        await asyncio.gather(*(call() for _ in range(6)))
+        self.assertEqual(max(active), 2)
+        stats = limiter.stats()
+        self.assertEqual((stats["active"], stats["queue_depth"], stats["total_requests"]), (0, 0, 6))
+
+    async def test_interactive_requests_jump_ahead_of_batch(self):
+        limiter = ProviderLimiter("cfg", "cfg", max_concurrency=1)
+        holder = await limiter.aacquire(10)
+        order = []
+
+        async def call(name, priority, user_key):
+            lease = await limiter.aacquire(10, priority=priority, user_key=user_key)
+            order.append(name)
+            lease.release()
+
+        tasks = [asyncio.create_task(call("review", PRIORITY_BATCH, 1))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call("chat", PRIORITY_INTERACTIVE, 2)))
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.stats()["queued_by_priority"], {"batch": 1, "interactive": 1})
+
+        holder.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["chat", "review"])
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        limiter = ProviderLimiter("cfg", "cfg", max_concurrency=1)
+        holder = await limiter.aacquire(10)
+        waiting = asyncio.create_task(limiter.aacquire(10))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        holder.release()
+        self.assertEqual((limiter.stats()["active"], limiter.stats()["queue_depth"]), (0, 0))
+
+    def test_gated_model_acquires_for_invoke_and_stream(self):
+        gateway = LLMGateway()
+        config = SimpleNamespace(pk=1, provider="openai", api_url="", name="fake", config_name="fake",
+                                 max_concurrent_requests=1, tokens_per_minute=None)
+        llm = gateway.create_llm(FakeListChatModel, config, priority=PRIORITY_BATCH, responses=["你好", "世界"])
+
+        self.assertEqual(llm.invoke("hi").content, "你好")
+        self.assertEqual("".join(chunk.content for chunk in llm.stream("hi")), "世界")
+        stats = gateway.stats()[0]
+        self.assertEqual((stats["total_requests"], stats["active"]), (2, 0))
+
+
+class LLMResponseCacheTests(SimpleTestCase):
+    """LLM响应缓存测试"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_exact_cache_survives_restart(self):
+        llm = FakeListChatModel(responses=["模块A", "模块B"], cache=LLMResponseCache(self.db_path))
+        self.assertEqual(llm.invoke("拆分文档").content, "模块A")
+        self.assertEqual(llm.invoke("拆分文档").content, "模块A")
+
+        # 新的缓存实例（模拟重启）仍能命中；不同提示词或不同模型参数不命中
+        restarted = FakeListChatModel(responses=["模块A", "模块B"], cache=LLMResponseCache(self.db_path))
+        self.assertEqual(restarted.invoke("拆分文档").content, "模块A")
+        restarted.invoke("另一份文档")
+        other_model = FakeListChatModel(responses=["其他模型"], cache=restarted.cache)
+        self.assertEqual(other_model.invoke("拆分文档").content, "其他模型")
+
+        stats = restarted.cache.stats()
+        self.assertEqual((stats["entries"], stats["total_hits"]), (3, 2))
+        self.assertEqual((stats["session_hits"], stats["session_misses"]), (1, 2))
+
+    def test_expired_entries_are_ignored(self):
+        cache = LLMResponseCache(self.db_path, ttl_seconds=1)
+        llm = FakeListChatModel(responses=["旧", "新"], cache=cache)
+        llm.invoke("问题")
+        with mock.patch("langgraph_integration.response_cache.time.time", return_value=time.time() + 5):
+            self.assertEqual(llm.invoke("问题").content, "新")
+
+    def test_semantic_cache_matches_similar_questions_in_same_scope(self):
+        cache = LLMResponseCache(self.db_path)
+        cache.semantic_update("kb1:ctx", "llm", "登录失败怎么办", [1.0, 0.0, 0.1], "检查密码", tokens=120)
+
+        hit = cache.semantic_lookup("kb1:ctx", "llm", [0.99, 0.01, 0.1], threshold=0.95)
+        self.assertEqual(hit["answer"], "检查密码")
+        self.assertIsNone(cache.semantic_lookup("kb1:ctx", "llm", [0.0, 1.0, 0.0], threshold=0.95))
+        self.assertIsNone(cache.semantic_lookup("kb1:other", "llm", [1.0, 0.0, 0.1], threshold=0.95))
+        self.assertIsNone(cache.semantic_lookup("kb1:ctx", "other-llm", [1.0, 0.0, 0.1], threshold=0.95))
+        self.assertEqual(cache.stats()["saved_tokens"], 120)
+
+    def test_rag_generation_reuses_semantic_answer(self):
+        rag_service = KnowledgeRAGService(FakeListChatModel(responses=["第一次回答", "第二次回答"]))
+        context = [{"content": "密码错误超过5次锁定账号", "metadata": {}, "similarity_score": 0.9}]
+        embeddings = {"账号为什么被锁定": [1.0, 0.0], "账号怎么被锁了": [0.98, 0.05]}
+        response_cache._response_caches.clear()
+        self.addCleanup(response_cache._response_caches.clear)
+
+        # 只开启语义缓存，精确响应缓存保持关闭
+        with override_settings(LLM_SEMANTIC_CACHE_ENABLED=True, LLM_RESPONSE_CACHE_ENABLED=False,
+                               LLM_RESPONSE_CACHE_PATH=self.db_path), \
+                mock.patch("knowledge.langgraph_integration.embed_knowledge_base_query",
+                           side_effect=lambda kb_id, text: embeddings[text]):
+            self.assertIsNone(response_cache.get_response_cache())
+            first = rag_service._generate_node({"question": "账号为什么被锁定", "knowledge_base_id": "kb", "context": context})
+            second = rag_service._generate_node({"question": "账号怎么被锁了", "knowledge_base_id": "kb", "context": context})
+            stats = response_cache.get_response_cache_stats()
+
+        self.assertEqual(first["answer"], "第一次回答")
+        self.assertEqual(second["answer"], "第一次回答")
+        self.assertEqual((stats["enabled"], stats["semantic_enabled"], stats["total_hits"]), (False, True, 1))
+
+
+class ChatConfigCacheTests(TestCase):
+    """对话配置缓存测试"""
+
+    def setUp(self):
+        chat_config_cache.clear()
+        self.user = User.objects.create_user(username="cache_user", password="pass")
+        self.llm_config = LLMConfig.objects.create(
+            config_name="cache-config", name="gpt-4", api_url="https://example.com/v1", api_key="key",
+            system_prompt="全局提示词", is_active=True,
+        )
+
+    def tearDown(self):
+        chat_config_cache.clear()
+
+    def test_prompt_resolution_is_cached_and_invalidated_by_signals(self):
+        self.assertEqual(async_to_sync(get_effective_system_prompt_async)(self.user), ("全局提示词", "global"))
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(get_effective_system_prompt_async)(self.user), ("全局提示词", "global"))
+
+        UserPrompt.objects.create(user=self.user, name="默认", content="我的提示词", is_default=True)
+        self.assertEqual(async_to_sync(get_effective_system_prompt_async)(self.user), ("我的提示词", "user_default"))
+
+        self.llm_config.name = "gpt-4o"
+        self.llm_config.save()
+        self.assertEqual(chat_config_cache.get_active_llm_config().name, "gpt-4o")
+
+    def test_system_prompt_flag_tracked_in_session_metadata(self):
+        ChatSession.objects.create(user=self.user, session_id="s-new")
+        ChatSession.objects.create(user=self.user, session_id="s-legacy")
+        checkpointer = MemorySaver()
+
+        async def run():
+            needs_new = await session_needs_system_prompt(checkpointer, self.user, "s-new", "t-new")
+            await chat_config_cache.amark_system_prompt_added(self.user, "s-new")
+
+            # 旧会话：元数据未记录，但checkpoint中已有系统提示词
+            builder = StateGraph(AgentState)
+            builder.add_node("chatbot", lambda state: {"messages": [AIMessage(content="hi")]})
+            builder.set_entry_point("chatbot")
+            builder.add_edge("chatbot", END)
+            graph = builder.compile(checkpointer=checkpointer)
+            await graph.ainvoke({"messages": [SystemMessage(content="sys"), HumanMessage(content="hi")]},
+                                config={"configurable": {"thread_id": "t-legacy"}})
+            needs_legacy = await session_needs_system_prompt(checkpointer, self.user, "s-legacy", "t-legacy")
+            return needs_new, needs_legacy
+
+        self.assertEqual(async_to_sync(run)(), (True, False))
+        self.assertEqual(
+            set(ChatSession.objects.filter(system_prompt_added=True).values_list("session_id", flat=True)),
+            {"s-new", "s-legacy"},
+        )
+        with self.assertNumQueries(0):
+            self.assertFalse(async_to_sync(session_needs_system_prompt)(checkpointer, self.user, "s-new", "t-new"))
+
+
+    def test_clearing_history_reinserts_system_prompt(self):
+        project = Project.objects.create(name="清空历史项目", creator=self.user)
+        ProjectMember.objects.create(project=project, user=self.user, role="owner")
+        ChatSession.objects.create(user=self.user, session_id="s1", project=project, system_prompt_added=True)
+        thread_id = f"{self.user.id}_{project.id}_s1"
+        other_worker = ChatConfigCache()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                override_settings(CHAT_CHECKPOINTER_BACKEND="sqlite",
+                                  CHAT_HISTORY_SQLITE_PATH=os.path.join(tmp, "history.sqlite")):
+            async def needs_system_prompt():
+                with closing(sqlite3.connect(get_sqlite_path(), check_same_thread=False)) as conn:
+                    return await session_needs_system_prompt(ThreadedSqliteSaver(conn), self.user, "s1", thread_id)
+
+            with sync_checkpointer() as saver:
+                builder = StateGraph(AgentState)
+                builder.add_node("chatbot", lambda state: {"messages": [AIMessage(content="hi")]})
+                builder.set_entry_point("chatbot")
+                builder.add_edge("chatbot", END)
+                builder.compile(checkpointer=saver).invoke(
+                    {"messages": [SystemMessage(content="sys"), HumanMessage(content="hi")]},
+                    config={"configurable": {"thread_id": thread_id}},
+                )
+            # 两个进程都缓存了“已写入系统提示词”
+            self.assertFalse(async_to_sync(needs_system_prompt)())
+            self.assertTrue(async_to_sync(other_worker.ais_system_prompt_added)(self.user, "s1"))
+
+            response = client.delete(f"/api/lg/chat/history/?session_id=s1&project_id={project.id}")
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(ChatSession.objects.get(session_id="s1").system_prompt_added)
+
+            # 下一轮重新写入系统提示词；其他进程的缓存过期后同样如此
+            self.assertTrue(async_to_sync(needs_system_prompt)())
+            with mock.patch("langgraph_integration.config_cache.time.monotonic",
+                            return_value=time.monotonic() + other_worker.ttl + 1):
+                self.assertFalse(async_to_sync(other_worker.ais_system_prompt_added)(self.user, "s1"))
+
+
+class ChatCheckpointerTests(SimpleTestCase):
+    """对话检查点后端与迁移命令测试"""
+
+    def _write_thread(self, db_path, thread_id, text):
+        builder = StateGraph(AgentState)
+        builder.add_node("chatbot", lambda state: {"messages": [AIMessage(content=f"re: {text}")]})
+        builder.set_entry_point("chatbot")
+        builder.add_edge("chatbot", END)
+        with SqliteSaver.from_conn_string(db_path) as saver:
+            graph = builder.compile(checkpointer=saver)
+            graph.invoke({"messages": [HumanMessage(content=text)]},
+                         config={"configurable": {"thread_id": thread_id}})
+
+    def test_sqlite_helpers_and_migration_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.sqlite")
+            target = os.path.join(tmp, "target.sqlite")
+            self._write_thread(source, "1_2_a", "hello")
+            self._write_thread(source, "1_2_b", "world")
+            self._write_thread(source, "1_3_c", "other project")
+
+            with override_settings(CHAT_CHECKPOINTER_BACKEND="sqlite", CHAT_HISTORY_SQLITE_PATH=source):
+                self.assertEqual(sorted(list_thread_ids("1_2_")), ["1_2_a", "1_2_b"])
+                checkpoint_count = count_thread_checkpoints("1_2_a")
+                self.assertGreater(checkpoint_count, 0)
+
+                call_command("migrate_chat_checkpoints", target_sqlite=target, thread_prefix="1_2_",
+                             stdout=StringIO())
+
+                self.assertEqual(delete_thread("1_2_b"), count_thread_checkpoints("1_2_a"))
+                self.assertEqual(list_thread_ids("1_2_"), ["1_2_a"])
+
+            with override_settings(CHAT_HISTORY_SQLITE_PATH=target):
+                self.assertEqual(sorted(list_thread_ids("1_")), ["1_2_a", "1_2_b"])
+                self.assertEqual(count_thread_checkpoints("1_2_a"), checkpoint_count)
+                with sync_checkpointer() as saver:
+                    messages = saver.get_tuple({"configurable": {"thread_id": "1_2_b"}}).checkpoint["channel_values"]["messages"]
+                self.assertEqual([m.content for m in messages], ["world", "re: world"])
+
+    def test_threaded_saver_serves_async_graphs_from_any_event_loop(self):
+        builder = StateGraph(AgentState)
+        builder.add_node("chatbot", lambda state: {"messages": [AIMessage(content="re")]})
+        builder.set_entry_point("chatbot")
+        builder.add_edge("chatbot", END)
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, "threaded.sqlite"), check_same_thread=False)
+            self.addCleanup(conn.close)
+            graph = builder.compile(checkpointer=ThreadedSqliteSaver(conn))
+            config = {"configurable": {"thread_id": "t1"}}
+
+            # 每次asyncio.run都是新的事件循环，模拟WSGI下按请求创建的循环
+            for text in ("一", "二"):
+                asyncio.run(graph.ainvoke({"messages": [HumanMessage(content=text)]}, config=config))
+
+            async def history():
+                return [item async for item in graph.checkpointer.alist(config)]
+
+            state = asyncio.run(graph.aget_state(config))
+            self.assertEqual([m.content for m in state.values["messages"]], ["一", "re", "二", "re"])
+            self.assertGreater(len(asyncio.run(history())), 0)
+            asyncio.run(graph.checkpointer.adelete_thread("t1"))
+            self.assertIsNone(graph.checkpointer.get_tuple(config))
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import LLMConfigViewSet, ChatAPIView, ChatHistoryAPIView, UserChatSessionsAPIView, ChatStreamAPIView, KnowledgeRAGAPIView, ProviderChoicesAPIView
+from .views import LLMConfigViewSet, ChatAPIView, ChatHistoryAPIView, UserChatSessionsAPIView, ChatStreamAPIView, ChatStopAPIView, ChatUsageAPIView, KnowledgeRAGAPIView, LLMGatewayStatsAPIView, LLMResponseCacheStatsAPIView, ProviderChoicesAPIView
 
 # Create a router and register our viewsets with it.
 router = DefaultRouter()
@@ -11,9 +11,13 @@ router.register(r'llm-configs', LLMConfigViewSet, basename='llmconfig')
 urlpatterns = [
     path('', include(router.urls)),
     path('providers/', ProviderChoicesAPIView.as_view(), name='provider_choices_api'),
+    path('llm-gateway/stats/', LLMGatewayStatsAPIView.as_view(), name='llm_gateway_stats_api'),
+    path('llm-cache/stats/', LLMResponseCacheStatsAPIView.as_view(), name='llm_cache_stats_api'),
     path('chat/', ChatAPIView.as_view(), name='chat_api'),
     path('chat/stream/', ChatStreamAPIView.as_view(), name='chat_stream_api'),
+    path('chat/stop/', ChatStopAPIView.as_view(), name='chat_stop_api'),
     path('chat/history/', ChatHistoryAPIView.as_view(), name='chat_history_api'),
     path('chat/sessions/', UserChatSessionsAPIView.as_view(), name='user_chat_sessions_api'),
+    path('chat/usage/', ChatUsageAPIView.as_view(), name='chat_usage_api'),
     path('knowledge/rag/', KnowledgeRAGAPIView.as_view(), name='knowledge_rag_api'),
 ]
\ No newline at end of file
@@ -0,0 +1,229 @@
+"""
+对话用量统计
+通过LangChain回调收集每轮对话的token用量、首token耗时、LLM与工具耗时，
+并写入轮次明细表和日汇总表
+"""
+import logging
+import time
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from .models import ChatTurnUsage, ChatUsageDaily
+
+logger = logging.getLogger(__name__)
+
+
+def extract_token_usage(response: LLMResult) -> Dict[str, int]:
+    """从LLM结果中提取token用量，兼容usage_metadata与各供应商的llm_output格式"""
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+
+    found = False
+    for generations in response.generations or []:
+        for generation in generations:
+            message = getattr(generation, 'message', None)
+            usage_metadata = getattr(message, 'usage_metadata', None) if message else None
+            if usage_metadata:
+                found = True
+                usage['prompt_tokens'] += usage_metadata.get('input_tokens', 0) or 0
+                usage['completion_tokens'] += usage_metadata.get('output_tokens', 0) or 0
+                input_details = usage_metadata.get('input_token_details') or {}
+                usage['cached_tokens'] += input_details.get('cache_read', 0) or 0
+    if found:
+        return usage
+
+    llm_output = response.llm_output or {}
+    token_usage = llm_output.get('token_usage') or llm_output.get('usage') or {}
+    usage['prompt_tokens'] = token_usage.get('prompt_tokens') or token_usage.get('input_tokens') or 0
+    usage['completion_tokens'] = token_usage.get('completion_tokens') or token_usage.get('output_tokens') or 0
+    prompt_details = token_usage.get('prompt_tokens_details') or {}
+    usage['cached_tokens'] = prompt_details.get('cached_tokens') or token_usage.get('cache_read_input_tokens') or 0
+    return usage
+
+
+class ChatUsageTracker(AsyncCallbackHandler):
+    """
+    单轮对话的用量收集器
+    作为回调传入图的config，自动覆盖Agent内的所有LLM调用和工具调用
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.llm_calls = 0
+        self.llm_duration = 0.0
+        self.tool_calls: List[Dict[str, Any]] = []
+        self._llm_starts: Dict[UUID, float] = {}
+        self._tool_starts: Dict[UUID, Dict[str, Any]] = {}
+
+    # --- LLM回调 ---
+    async def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs) -> None:
+        self._llm_starts[run_id] = time.monotonic()
+
+    async def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs) -> None:
+        self._llm_starts[run_id] = time.monotonic()
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs) -> None:
+        if self.first_token_at is None and token:
+            self.first_token_at = time.monotonic()
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        started = self._llm_starts.pop(run_id, None)
+        if started is not None:
+            self.llm_duration += time.monotonic() - started
+        self.llm_calls += 1
+        usage = extract_token_usage(response)
+        self.prompt_tokens += usage['prompt_tokens']
+        self.completion_tokens += usage['completion_tokens']
+        self.cached_tokens += usage['cached_tokens']
+        if self.first_token_at is None:
+            # 非流式调用没有逐token回调，以首次LLM调用完成时间作为首token时间
+            self.first_token_at = time.monotonic()
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        started = self._llm_starts.pop(run_id, None)
+        if started is not None:
+            self.llm_duration += time.monotonic() - started
+        self.llm_calls += 1
+
+    # --- 工具回调 ---
+    async def on_tool_start(self, serialized, input_str: str, *, run_id: UUID, **kwargs) -> None:
+        name = (serialized or {}).get('name') or kwargs.get('name') or 'unknown'
+        self._tool_starts[run_id] = {'name': name, 'started': time.monotonic()}
+
+    async def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs) -> None:
+        self._finish_tool(run_id, 'success')
+
+    async def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._finish_tool(run_id, 'error')
+
+    def _finish_tool(self, run_id: UUID, status: str):
+        tool = self._tool_starts.pop(run_id, None)
+        if tool:
+            self.tool_calls.append({
+                'name': tool['name'],
+                'duration_ms': int((time.monotonic() - tool['started']) * 1000),
+                'status': status,
+            })
+
+    # --- 汇总 ---
+    def summary(self) -> Dict[str, Any]:
+        """本轮用量汇总（可直接返回给前端）"""
+        # 未结束的工具调用（例如被中断）按已耗时计入
+        for run_id in list(self._tool_starts):
+            self._finish_tool(run_id, 'interrupted')
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'total_tokens': self.prompt_tokens + self.completion_tokens,
+            'llm_calls': self.llm_calls,
+            'tool_calls': len(self.tool_calls),
+            'time_to_first_token_ms': int((self.first_token_at - self.started_at) * 1000) if self.first_token_at else None,
+            'llm_duration_ms': int(self.llm_duration * 1000),
+            'tool_duration_ms': sum(tool['duration_ms'] for tool in self.tool_calls),
+            'total_duration_ms': int((time.monotonic() - self.started_at) * 1000),
+            'tool_call_details': list(self.tool_calls),
+        }
+
+
+def estimate_cost(llm_config, prompt_tokens: int, completion_tokens: int) -> Optional[Decimal]:
+    """按LLM配置的单价估算成本，未配置单价时返回None"""
+    if not llm_config or (llm_config.prompt_price_per_million is None
+                          and llm_config.completion_price_per_million is None):
+        return None
+    prompt_price = llm_config.prompt_price_per_million or Decimal('0')
+    completion_price = llm_config.completion_price_per_million or Decimal('0')
+    return (prompt_price * prompt_tokens + completion_price * completion_tokens) / Decimal('1000000')
+
+
+def _get_or_create_daily(user, project, llm_config) -> ChatUsageDaily:
+    """
+    获取当日汇总行，不存在时创建
+    并发创建时由唯一约束保证只有一行成功，失败方回退为查询已创建的行；
+    之后的累加使用F表达式原子更新，无需行锁（SQLite也不支持select_for_update）
+    """
+    lookup = {
+        'date': timezone.localdate(),
+        'user': user,
+        'project': project,
+        'llm_config_key': llm_config.pk if llm_config else 0,
+    }
+    daily = ChatUsageDaily.objects.filter(**lookup).first()
+    if daily is not None:
+        return daily
+    try:
+        with transaction.atomic():
+            return ChatUsageDaily.objects.create(llm_config=llm_config, **lookup)
+    except IntegrityError:
+        return ChatUsageDaily.objects.get(**lookup)
+
+
+def record_chat_turn_usage(user, project, llm_config, session_id: str, usage: Dict[str, Any],
+                           status: str = 'completed') -> ChatTurnUsage:
+    """写入轮次明细并累加到日汇总"""
+    cost = estimate_cost(llm_config, usage['prompt_tokens'], usage['completion_tokens'])
+
+    with transaction.atomic():
+        turn = ChatTurnUsage.objects.create(
+            user=user,
+            project=project,
+            llm_config=llm_config,
+            session_id=session_id,
+            model_name=llm_config.name if llm_config else '',
+            status=status,
+            prompt_tokens=usage['prompt_tokens'],
+            completion_tokens=usage['completion_tokens'],
+            cached_tokens=usage['cached_tokens'],
+            total_tokens=usage['total_tokens'],
+            estimated_cost=cost,
+            time_to_first_token_ms=usage['time_to_first_token_ms'],
+            llm_duration_ms=usage['llm_duration_ms'],
+            tool_duration_ms=usage['tool_duration_ms'],
+            total_duration_ms=usage['total_duration_ms'],
+            llm_calls=usage['llm_calls'],
+            tool_calls=usage['tool_calls'],
+            tool_call_details=usage['tool_call_details'],
+        )
+
+        daily = _get_or_create_daily(user, project, llm_config)
+        ttft = usage['time_to_first_token_ms']
+        ChatUsageDaily.objects.filter(pk=daily.pk).update(
+            turns=F('turns') + 1,
+            interrupted_turns=F('interrupted_turns') + (1 if status == 'interrupted' else 0),
+            prompt_tokens=F('prompt_tokens') + usage['prompt_tokens'],
+            completion_tokens=F('completion_tokens') + usage['completion_tokens'],
+            cached_tokens=F('cached_tokens') + usage['cached_tokens'],
+            total_tokens=F('total_tokens') + usage['total_tokens'],
+            estimated_cost=F('estimated_cost') + (cost or Decimal('0')),
+            llm_calls=F('llm_calls') + usage['llm_calls'],
+            tool_calls=F('tool_calls') + usage['tool_calls'],
+            llm_duration_ms=F('llm_duration_ms') + usage['llm_duration_ms'],
+            tool_duration_ms=F('tool_duration_ms') + usage['tool_duration_ms'],
+            total_duration_ms=F('total_duration_ms') + usage['total_duration_ms'],
+            ttft_sum_ms=F('ttft_sum_ms') + (ttft or 0),
+            ttft_count=F('ttft_count') + (1 if ttft is not None else 0),
+        )
+
+    return turn
+
+
+async def arecord_chat_turn_usage(tracker: ChatUsageTracker, user, project, llm_config, session_id: str,
+                                  status: str = 'completed') -> Dict[str, Any]:
+    """异步写入本轮用量，失败只记录日志，不影响对话"""
+    usage = tracker.summary()
+    try:
+        await sync_to_async(record_chat_turn_usage)(user, project, llm_config, session_id, usage, status)
+    except Exception as e:
+        logger.error(f"Failed to record chat turn usage for session {session_id}: {e}", exc_info=True)
+    return usage
@@ -5,7 +5,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from django.db.models import Q
 from django.utils import timezone
-from .models import LLMConfig, ChatSession, ChatMessage
+from .models import LLMConfig, ChatSession, ChatMessage, ChatTurnUsage, ChatUsageDaily
 from .serializers import LLMConfigSerializer
 import logging
 from asgiref.sync import sync_to_async
@@ -21,7 +21,6 @@ from wharttest_django.viewsets import BaseModelViewSet
 from wharttest_django.permissions import HasModelPermission
 
 # 导入提示词管理
-from prompts.models import UserPrompt
 
 # --- New Imports ---
 from typing import TypedDict, Annotated, List
@@ -33,17 +32,13 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.chat_models.tongyi import ChatTongyi
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages # Correct import for add_messages
-from langgraph.checkpoint.sqlite import SqliteSaver # For sync operations in ChatHistoryAPIView
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver # Use Async version for async views
 from langgraph.prebuilt import create_react_agent # For agent with tools
 # from langgraph.checkpoint.memory import InMemorySaver # Remove InMemorySaver import if no longer globally needed
-import os
 import uuid # Import uuid module
 # Knowledge base integration
-from knowledge.langgraph_integration import KnowledgeRAGService, ConversationalRAGService, LangGraphKnowledgeIntegration
+from knowledge.langgraph_integration import KnowledgeRAGService, ConversationalRAGService, LangGraphKnowledgeIntegration, asearch_knowledge_base
 from knowledge.models import KnowledgeBase
 import sqlite3 # Import sqlite3 module
-from django.conf import settings
 import logging # Import logging
 from asgiref.sync import sync_to_async # For async operations in sync context
 import json # For JSON serialization in streaming
@@ -55,21 +50,35 @@ from django.http import StreamingHttpResponse
 from mcp_tools.models import RemoteMCPConfig # To load remote MCP server configs
 from langchain_mcp_adapters.client import MultiServerMCPClient # To connect to remote MCPs
 from mcp_tools.persistent_client import mcp_session_manager # 持久化MCP会话管理器
+from .llm_gateway import llm_gateway, PRIORITY_INTERACTIVE
+from .response_cache import get_response_cache, get_response_cache_stats, get_semantic_cache
+from .checkpointer import (
+    async_checkpointer, count_thread_checkpoints, delete_thread, list_thread_ids, sync_checkpointer
+)
+from .config_cache import chat_config_cache
+from .stream_control import chat_stream_registry, extract_stream_text, record_interrupted_turn
+from .context_manager import ChatAgentState, create_context_manager
+from .usage import ChatUsageTracker, arecord_chat_turn_usage
 # --- End New Imports ---
 
 logger = logging.getLogger(__name__) # Initialize logger
 
 # --- Helper Functions ---
-def create_llm_instance(active_config, temperature=0.7):
+def create_llm_instance(active_config, temperature=0.7, priority=PRIORITY_INTERACTIVE, user=None,
+                        cache_namespace=None):
     """
     根据配置创建合适的LLM实例，支持多种供应商
+    实例通过LLM网关创建，共享该配置的并发与TPM限流队列；
+    指定cache_namespace时启用响应缓存（需开启LLM_RESPONSE_CACHE_ENABLED）
     """
     model_identifier = active_config.name or "gpt-3.5-turbo"
     provider = active_config.provider
+    gateway_kwargs = {"priority": priority, "user": user}
     
     if provider == 'anthropic':
         # Anthropic/Claude
-        llm = ChatAnthropic(
+        llm = llm_gateway.create_llm(
+            ChatAnthropic, active_config, **gateway_kwargs,
             model=model_identifier,
             api_key=active_config.api_key,
             temperature=temperature
@@ -77,15 +86,18 @@ def create_llm_instance(active_config, temperature=0.7):
         logger.info(f"Initialized ChatAnthropic with model: {model_identifier}")
     elif provider == 'openai':
         # OpenAI 官方
-        llm = ChatOpenAI(
+        llm = llm_gateway.create_llm(
+            ChatOpenAI, active_config, **gateway_kwargs,
             model=model_identifier,
             temperature=temperature,
             api_key=active_config.api_key,
+            stream_usage=True,  # 流式输出时在最后一个chunk返回token用量
         )
         logger.info(f"Initialized ChatOpenAI with model: {model_identifier}")
     elif provider == 'ollama':
         # Ollama 本地部署
-        llm = ChatOllama(
+        llm = llm_gateway.create_llm(
+            ChatOllama, active_config, **gateway_kwargs,
             model=model_identifier,
             base_url=active_config.api_url,
             temperature=temperature
@@ -93,7 +105,8 @@ def create_llm_instance(active_config, temperature=0.7):
         logger.info(f"Initialized ChatOllama with model: {model_identifier}")
     elif provider == 'gemini':
         # Google Gemini
-        llm = ChatGoogleGenerativeAI(
+        llm = llm_gateway.create_llm(
+            ChatGoogleGenerativeAI, active_config, **gateway_kwargs,
             model=model_identifier,
             google_api_key=active_config.api_key,
             temperature=temperature
@@ -101,7 +114,8 @@ def create_llm_instance(active_config, temperature=0.7):
         logger.info(f"Initialized ChatGoogleGenerativeAI with model: {model_identifier}")
     elif provider == 'qwen':
         # Alibaba Qwen (Tongyi)
-        llm = ChatTongyi(
+        llm = llm_gateway.create_llm(
+            ChatTongyi, active_config, **gateway_kwargs,
             model=model_identifier,
             dashscope_api_key=active_config.api_key,
             temperature=temperature
@@ -113,22 +127,47 @@ def create_llm_instance(active_config, temperature=0.7):
             "model": model_identifier,
             "temperature": temperature,
             "api_key": active_config.api_key,
-            "base_url": active_config.api_url
+            "base_url": active_config.api_url,
+            "stream_usage": True,  # 流式输出时返回token用量
         }
         
-        llm = ChatOpenAI(**llm_kwargs)
+        llm = llm_gateway.create_llm(ChatOpenAI, active_config, **gateway_kwargs, **llm_kwargs)
         logger.info(f"Initialized OpenAI-compatible LLM with model: {model_identifier}")
     else:
         # 默认使用OpenAI
-        llm = ChatOpenAI(
+        llm = llm_gateway.create_llm(
+            ChatOpenAI, active_config, **gateway_kwargs,
             model=model_identifier,
             temperature=temperature,
             api_key=active_config.api_key,
+            stream_usage=True,
         )
         logger.info(f"Initialized default ChatOpenAI with model: {model_identifier}")
     
+    response_cache = get_response_cache(cache_namespace) if cache_namespace else None
+    if response_cache is not None:
+        llm.cache = response_cache
+    
     return llm
 
+# RAG服务缓存：按 (服务类型, LLM配置ID, 配置更新时间) 复用，避免每轮对话重复构建LLM客户端和RAG图
+_rag_service_cache = {}
+
+
+def get_rag_service(service_class, active_config):
+    """获取可跨对话轮次复用的RAG服务实例，LLM配置变更后自动重建"""
+    cache_key = (service_class.__name__, active_config.pk, active_config.updated_at)
+    rag_service = _rag_service_cache.get(cache_key)
+    if rag_service is None:
+        # 丢弃同一服务类型下旧配置对应的实例
+        for key in [k for k in _rag_service_cache if k[0] == service_class.__name__]:
+            del _rag_service_cache[key]
+        rag_service = service_class(create_llm_instance(active_config, temperature=0.7, cache_namespace='knowledge_rag'))
+        _rag_service_cache[cache_key] = rag_service
+        logger.info(f"Created {service_class.__name__} for LLM config: {active_config.config_name}")
+    return rag_service
+
+
 def create_sse_data(data_dict):
     """
     创建SSE格式的数据，确保中文字符正确编码
@@ -136,9 +175,24 @@ def create_sse_data(data_dict):
     json_str = json.dumps(data_dict, ensure_ascii=False)
     return f"data: {json_str}\n\n"
 
+async def prepare_llm_messages(context_manager, state):
+    """
+    计算聊天节点发送给LLM的消息
+    返回 (llm_messages, state_update)；state_update包含需要写回checkpoint的摘要字段
+    """
+    if not context_manager:
+        return state['messages'], {}
+    prepared = await context_manager.aprepare(state)
+    llm_messages = prepared.pop('llm_input_messages')
+    return llm_messages, prepared
+
+
 # --- AgentState Definition ---
 class AgentState(TypedDict):
     messages: Annotated[List[AnyMessage], add_messages]
+    # 滚动摘要（由ConversationContextManager维护）
+    context_summary: str
+    summary_until_id: str
 # --- End AgentState Definition ---
 
 # --- Global Checkpointer ---
@@ -172,6 +226,7 @@ def get_effective_system_prompt(user, prompt_id=None):
     """
     获取有效的系统提示词（同步版本）
     优先级：用户指定的提示词 > 用户默认提示词 > 全局LLM配置的system_prompt
+    提示词和LLM配置均通过进程内配置缓存读取
 
     Args:
         user: 当前用户
@@ -185,24 +240,19 @@ def get_effective_system_prompt(user, prompt_id=None):
     try:
         # 1. 如果指定了提示词ID，优先使用
         if prompt_id:
-            try:
-                user_prompt = UserPrompt.objects.get(
-                    id=prompt_id,
-                    user=user,
-                    is_active=True
-                )
-                return user_prompt.content, 'user_specified'
-            except UserPrompt.DoesNotExist:
-                logger.warning(f"Specified prompt {prompt_id} not found for user {user.id}")
+            prompt_content = chat_config_cache.get_user_prompt(user, prompt_id)
+            if prompt_content:
+                return prompt_content, 'user_specified'
+            logger.warning(f"Specified prompt {prompt_id} not found for user {user.id}")
 
         # 2. 尝试获取用户的默认提示词
-        default_prompt = UserPrompt.get_user_default_prompt(user)
-        if default_prompt:
-            return default_prompt.content, 'user_default'
+        default_content = chat_config_cache.get_user_prompt(user)
+        if default_content:
+            return default_content, 'user_default'
 
         # 3. 使用全局LLM配置的system_prompt
         try:
-            active_config = LLMConfig.objects.get(is_active=True)
+            active_config = chat_config_cache.get_active_llm_config()
             if active_config.system_prompt and active_config.system_prompt.strip():
                 return active_config.system_prompt.strip(), 'global'
         except LLMConfig.DoesNotExist:
@@ -215,7 +265,7 @@ def get_effective_system_prompt(user, prompt_id=None):
         logger.error(f"Error getting effective system prompt: {e}")
         # 降级到全局配置
         try:
-            active_config = LLMConfig.objects.get(is_active=True)
+            active_config = chat_config_cache.get_active_llm_config()
             if active_config.system_prompt and active_config.system_prompt.strip():
                 return active_config.system_prompt.strip(), 'global'
         except:
@@ -227,6 +277,7 @@ async def get_effective_system_prompt_async(user, prompt_id=None):
     """
     获取有效的系统提示词（异步版本）
     优先级：用户指定的提示词 > 用户默认提示词 > 全局LLM配置的system_prompt
+    缓存命中时不访问数据库，未命中时通过线程池加载
 
     Args:
         user: 当前用户
@@ -240,31 +291,19 @@ async def get_effective_system_prompt_async(user, prompt_id=None):
     try:
         # 1. 如果指定了提示词ID，优先使用
         if prompt_id:
-            try:
-                user_prompt = await sync_to_async(UserPrompt.objects.get)(
-                    id=prompt_id,
-                    user=user,
-                    is_active=True
-                )
-                return user_prompt.content, 'user_specified'
-            except UserPrompt.DoesNotExist:
-                logger.warning(f"Specified prompt {prompt_id} not found for user {user.id}")
+            prompt_content = await chat_config_cache.aget_user_prompt(user, prompt_id)
+            if prompt_content:
+                return prompt_content, 'user_specified'
+            logger.warning(f"Specified prompt {prompt_id} not found for user {user.id}")
 
         # 2. 尝试获取用户的默认提示词
-        try:
-            default_prompt = await sync_to_async(UserPrompt.objects.get)(
-                user=user,
-                is_default=True,
-                is_active=True
-            )
-            if default_prompt:
-                return default_prompt.content, 'user_default'
-        except UserPrompt.DoesNotExist:
-            pass
+        default_content = await chat_config_cache.aget_user_prompt(user)
+        if default_content:
+            return default_content, 'user_default'
 
         # 3. 使用全局LLM配置的system_prompt
         try:
-            active_config = await sync_to_async(LLMConfig.objects.get)(is_active=True)
+            active_config = await chat_config_cache.aget_active_llm_config()
             if active_config.system_prompt and active_config.system_prompt.strip():
                 return active_config.system_prompt.strip(), 'global'
         except LLMConfig.DoesNotExist:
@@ -277,7 +316,7 @@ async def get_effective_system_prompt_async(user, prompt_id=None):
         logger.error(f"Error getting effective system prompt: {e}")
         # 降级到全局配置
         try:
-            active_config = await sync_to_async(LLMConfig.objects.get)(is_active=True)
+            active_config = await chat_config_cache.aget_active_llm_config()
             if active_config.system_prompt and active_config.system_prompt.strip():
                 return active_config.system_prompt.strip(), 'global'
         except:
@@ -285,6 +324,23 @@ async def get_effective_system_prompt_async(user, prompt_id=None):
         return None, 'none'
 
 
+async def session_needs_system_prompt(checkpointer, user, session_id, thread_id):
+    """
+    判断本轮是否需要写入系统提示词
+    优先读取会话元数据（缓存）；未记录时回退到异步读取最新checkpoint，确认已有系统提示词后补记元数据
+    """
+    if await chat_config_cache.ais_system_prompt_added(user, session_id):
+        return False
+
+    checkpoint_tuple = await checkpointer.aget_tuple({"configurable": {"thread_id": thread_id}})
+    checkpoint = checkpoint_tuple.checkpoint if checkpoint_tuple else None
+    existing_messages = ((checkpoint or {}).get('channel_values') or {}).get('messages')
+    if existing_messages and isinstance(existing_messages[0], SystemMessage):
+        await chat_config_cache.amark_system_prompt_added(user, session_id)
+        return False
+    return True
+
+
 class ChatAPIView(APIView):
     """
     API endpoint for handling chat with the currently active LLM using LangGraph,
@@ -397,7 +453,7 @@ class ChatAPIView(APIView):
                 except Exception as e:
                     logger.error(f"ChatAPIView: Failed to create ChatSession entry: {e}", exc_info=True)
 
-            active_config = await sync_to_async(LLMConfig.objects.get)(is_active=True)
+            active_config = await chat_config_cache.aget_active_llm_config()
             logger.info(f"ChatAPIView: Using active LLMConfig: {active_config.name}")
         except LLMConfig.DoesNotExist:
             logger.error("ChatAPIView: No active LLM configuration found.")
@@ -414,13 +470,13 @@ class ChatAPIView(APIView):
                 "errors": {"llm_config": ["Multiple active LLM configurations found."]}
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        mcp_lease = None
         try:
             # 使用新的LLM工厂函数，支持多供应商
-            llm = create_llm_instance(active_config, temperature=0.7)
+            llm = create_llm_instance(active_config, temperature=0.7, user=request.user)
             logger.info(f"ChatAPIView: Initialized LLM with provider auto-detection")
 
-            db_path = os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
-            async with AsyncSqliteSaver.from_conn_string(db_path) as actual_memory_checkpointer: # Use async with and AsyncSqliteSaver
+            async with async_checkpointer() as actual_memory_checkpointer: # 按配置选择SQLite或PostgreSQL检查点存储
                 # Load remote MCP tools
                 logger.info("ChatAPIView: Attempting to load remote MCP tools.")
                 mcp_tools_list = []
@@ -442,11 +498,13 @@ class ChatAPIView(APIView):
                         if client_mcp_config:
                             logger.info(f"ChatAPIView: Initializing persistent MCP client with config: {client_mcp_config}")
                             # 使用持久化MCP会话管理器，传递用户和项目信息以支持跨对话轮次的状态保持
-                            mcp_tools_list = await mcp_session_manager.get_tools_for_config(
+                            # 租约在本轮对话结束时释放，期间会话不会被回收
+                            mcp_lease = await mcp_session_manager.acquire_tools(
                                 client_mcp_config,
                                 user_id=str(request.user.id),
                                 project_id=str(project_id)
                             )
+                            mcp_tools_list = mcp_lease.tools
                             logger.info(f"ChatAPIView: Successfully loaded {len(mcp_tools_list)} persistent tools from remote MCP servers: {[tool.name for tool in mcp_tools_list if hasattr(tool, 'name')]}")
                         else:
                             logger.info("ChatAPIView: No active remote MCP configurations to build client config.")
@@ -456,6 +514,10 @@ class ChatAPIView(APIView):
                     logger.error(f"ChatAPIView: Error loading remote MCP tools: {e}", exc_info=True)
                     # mcp_tools_list remains empty, will fallback to basic chatbot
 
+                # 对话上下文管理：超过token阈值时将较早轮次压缩为滚动摘要
+                context_manager = create_context_manager(llm, active_config.name)
+                agent_context_kwargs = {"pre_model_hook": context_manager.aprepare, "state_schema": ChatAgentState} if context_manager else {}
+
                 # Prepare LangGraph runnable
                 runnable_to_invoke = None
                 is_agent_with_tools = False
@@ -479,13 +541,13 @@ class ChatAPIView(APIView):
 
                             # 将知识库工具添加到MCP工具列表
                             enhanced_tools = mcp_tools_list + [knowledge_tool]
-                            agent_executor = create_react_agent(llm, enhanced_tools, checkpointer=actual_memory_checkpointer)
+                            agent_executor = create_react_agent(llm, enhanced_tools, checkpointer=actual_memory_checkpointer, **agent_context_kwargs)
                             runnable_to_invoke = agent_executor
                             is_agent_with_tools = True
                             logger.info(f"ChatAPIView: Knowledge-enhanced agent created with {len(enhanced_tools)} tools (including knowledge base)")
                         else:
                             # 只有MCP工具，创建普通Agent
-                            agent_executor = create_react_agent(llm, mcp_tools_list, checkpointer=actual_memory_checkpointer)
+                            agent_executor = create_react_agent(llm, mcp_tools_list, checkpointer=actual_memory_checkpointer, **agent_context_kwargs)
                             runnable_to_invoke = agent_executor
                             is_agent_with_tools = True
                             logger.info("ChatAPIView: Agent with remote tools created with checkpointer.")
@@ -496,32 +558,33 @@ class ChatAPIView(APIView):
                     logger.info("ChatAPIView: No remote tools or agent creation failed. Using knowledge-enhanced chatbot.")
                     is_agent_with_tools = False # Ensure flag is false for basic chatbot
 
-                    def knowledge_enhanced_chatbot_node(state: AgentState):
+                    rag_service = None
+                    if use_knowledge_base and knowledge_base_id:
+                        rag_service = get_rag_service(ConversationalRAGService, active_config)
+
+                    async def knowledge_enhanced_chatbot_node(state: AgentState):
                         """知识库增强的聊天机器人节点"""
+                        llm_messages, summary_update = state['messages'], {}
                         try:
+                            llm_messages, summary_update = await prepare_llm_messages(context_manager, state)
+
                             # 获取最新的用户消息
                             user_messages = [msg for msg in state['messages']
                                            if isinstance(msg, HumanMessage)]
 
                             if not user_messages:
                                 # 如果没有用户消息，直接调用LLM
-                                invoked_response = llm.invoke(state['messages'])
-                                return {"messages": [invoked_response]}
+                                invoked_response = await llm.ainvoke(llm_messages)
+                                return {"messages": [invoked_response], **summary_update}
 
                             latest_user_message = user_messages[-1].content
 
                             # 检查是否需要使用知识库
-                            should_use_kb = use_knowledge_base and knowledge_base_id
-
-                            if should_use_kb:
+                            if rag_service:
                                 logger.info(f"ChatAPIView: Using knowledge base {knowledge_base_id} for query")
 
-                                # 使用知识库RAG服务
-                                from knowledge.langgraph_integration import ConversationalRAGService
-                                rag_service = ConversationalRAGService(llm)
-
                                 # 执行RAG查询
-                                rag_result = rag_service.query(
+                                rag_result = await rag_service.aquery(
                                     question=latest_user_message,
                                     knowledge_base_id=knowledge_base_id,
                                     user=request.user,
@@ -536,20 +599,20 @@ class ChatAPIView(APIView):
                                 rag_messages = rag_result.get("messages", [])
                                 if rag_messages:
                                     logger.info(f"ChatAPIView: RAG returned {len(rag_messages)} messages")
-                                    return {"messages": rag_messages}
+                                    return {"messages": rag_messages, **summary_update}
                                 else:
                                     logger.warning("ChatAPIView: RAG returned no messages, falling back to basic chat")
 
                             # 降级到基础对话
                             logger.info("ChatAPIView: Using basic chat without knowledge base")
-                            invoked_response = llm.invoke(state['messages'])
-                            return {"messages": [invoked_response]}
+                            invoked_response = await llm.ainvoke(llm_messages)
+                            return {"messages": [invoked_response], **summary_update}
 
                         except Exception as e:
                             logger.error(f"ChatAPIView: Error in knowledge-enhanced chatbot: {e}")
                             # 降级到基础对话
-                            invoked_response = llm.invoke(state['messages'])
-                            return {"messages": [invoked_response]}
+                            invoked_response = await llm.ainvoke(llm_messages)
+                            return {"messages": [invoked_response], **summary_update}
 
                     graph_builder = StateGraph(AgentState)
                     graph_builder.add_node("chatbot", knowledge_enhanced_chatbot_node)
@@ -569,31 +632,15 @@ class ChatAPIView(APIView):
                 messages_list = []
 
                 # 获取有效的系统提示词（用户提示词优先）
-                effective_prompt, prompt_source = get_effective_system_prompt(request.user, prompt_id)
+                effective_prompt, prompt_source = await get_effective_system_prompt_async(request.user, prompt_id)
 
                 # 检查当前会话是否已经有系统提示词
                 should_add_system_prompt = False
                 if effective_prompt:
                     try:
-                        # 尝试获取当前会话的历史消息
-                        with SqliteSaver.from_conn_string(db_path) as memory:
-                            checkpoint_generator = memory.list(config={"configurable": {"thread_id": thread_id}})
-                            checkpoint_tuples_list = list(checkpoint_generator)
-
-                            if checkpoint_tuples_list:
-                                # 检查最新checkpoint中是否已有系统提示词
-                                latest_checkpoint = checkpoint_tuples_list[0].checkpoint
-                                if (latest_checkpoint and 'channel_values' in latest_checkpoint
-                                    and 'messages' in latest_checkpoint['channel_values']):
-                                    existing_messages = latest_checkpoint['channel_values']['messages']
-                                    # 检查第一条消息是否是系统消息
-                                    if not existing_messages or not isinstance(existing_messages[0], SystemMessage):
-                                        should_add_system_prompt = True
-                                else:
-                                    should_add_system_prompt = True
-                            else:
-                                # 新会话，需要添加系统提示词
-                                should_add_system_prompt = True
+                        should_add_system_prompt = await session_needs_system_prompt(
+                            actual_memory_checkpointer, request.user, session_id, thread_id
+                        )
                     except Exception as e:
                         logger.warning(f"ChatAPIView: Error checking existing messages: {e}")
                         should_add_system_prompt = True
@@ -605,17 +652,30 @@ class ChatAPIView(APIView):
                 messages_list.append(HumanMessage(content=user_message_content))
                 input_messages = {"messages": messages_list}
 
+                # 用量统计：token、首token耗时、LLM与工具耗时
+                usage_tracker = ChatUsageTracker()
                 invoke_config = {
                     "configurable": {"thread_id": thread_id},
-                    "recursion_limit": 100  # 增加递归限制，支持生成更多测试用例
+                    "recursion_limit": 100,  # 增加递归限制，支持生成更多测试用例
+                    "callbacks": [usage_tracker]
                 }
                 logger.info(f"ChatAPIView: Set recursion_limit to 100 for thread_id: {thread_id}")
                 # Checkpointer is already configured in both agent and basic chatbot
 
-                final_state = await runnable_to_invoke.ainvoke(
-                    input_messages,
-                    config=invoke_config
-                )
+                try:
+                    final_state = await runnable_to_invoke.ainvoke(
+                        input_messages,
+                        config=invoke_config
+                    )
+                except Exception:
+                    await arecord_chat_turn_usage(usage_tracker, request.user, project, active_config, session_id, status='error')
+                    raise
+                turn_usage = await arecord_chat_turn_usage(usage_tracker, request.user, project, active_config, session_id)
+                if should_add_system_prompt:
+                    try:
+                        await chat_config_cache.amark_system_prompt_added(request.user, session_id)
+                    except Exception as e:
+                        logger.warning(f"ChatAPIView: Failed to update session metadata: {e}")
 
                 ai_response_content = "No valid AI response found."
                 conversation_flow = []  # 存储完整的对话流程
@@ -694,6 +754,7 @@ class ChatAPIView(APIView):
                         "user_message": user_message_content,
                         "llm_response": ai_response_content,
                         "conversation_flow": conversation_flow,  # 新增：完整的对话流程
+                        "usage": turn_usage,
                         "active_llm": active_config.name,
                         "thread_id": thread_id,
                         "session_id": session_id,
@@ -706,13 +767,16 @@ class ChatAPIView(APIView):
                     }
                 }, status=status.HTTP_200_OK)
 
-        except Exception as e: # This outer try-except catches errors from the 'with SqliteSaver' block or LLM init
+        except Exception as e: # This outer try-except catches errors from the checkpointer block or LLM init
             logger.error(f"ChatAPIView: Error interacting with LLM or LangGraph: {e}", exc_info=True)
             return Response({
                 "status": "error", "code": status.HTTP_500_INTERNAL_SERVER_ERROR,
                 "message": f"Error interacting with LLM or LangGraph: {str(e)}", "data": {},
                 "errors": {"llm_interaction": [str(e)]}
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            if mcp_lease:
+                mcp_lease.release()
 
 
 class ChatHistoryAPIView(APIView):
@@ -766,35 +830,21 @@ class ChatHistoryAPIView(APIView):
         thread_id_parts = [str(request.user.id), str(project_id), str(session_id)]
         thread_id = "_".join(thread_id_parts)
 
-        db_path = os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
         history_messages = []
 
         try:
-            # 首先尝试直接查询数据库以检查是否有数据
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            # 检查是否有对应的thread_id记录
-            cursor.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = ?", (thread_id,))
-            checkpoint_count = cursor.fetchone()[0]
+            # 首先检查是否有对应的thread_id记录
+            checkpoint_count = count_thread_checkpoints(thread_id)
             logger.info(f"ChatHistoryAPIView: Found {checkpoint_count} checkpoints in database for thread_id: {thread_id}")
 
-            if checkpoint_count == 0:
-                # 如果没有找到记录，检查所有的thread_id
-                cursor.execute("SELECT DISTINCT thread_id FROM checkpoints LIMIT 10")
-                all_threads = cursor.fetchall()
-                logger.info(f"ChatHistoryAPIView: Available thread_ids in database: {[t[0] for t in all_threads]}")
-
-            conn.close()
-
-            # 使用SqliteSaver读取数据
-            with SqliteSaver.from_conn_string(db_path) as memory:
+            # 读取检查点数据（SQLite或PostgreSQL）
+            with sync_checkpointer() as memory:
                 # Fetch all checkpoints for the thread
                 # The list method returns CheckpointTuple, we need the 'checkpoint' attribute
                 checkpoint_generator = memory.list(config={"configurable": {"thread_id": thread_id}})
                 checkpoint_tuples_list = list(checkpoint_generator) # Convert generator to list
 
-                logger.info(f"ChatHistoryAPIView: SqliteSaver found {len(checkpoint_tuples_list)} checkpoints for thread_id: {thread_id}")
+                logger.info(f"ChatHistoryAPIView: Checkpointer found {len(checkpoint_tuples_list)} checkpoints for thread_id: {thread_id}")
 
                 if checkpoint_tuples_list: # Check if the list is not empty
                     # 构建消息到时间戳的映射
@@ -954,26 +1004,9 @@ class ChatHistoryAPIView(APIView):
         thread_id_parts = [str(request.user.id), str(project_id), str(session_id)]
         thread_id = "_".join(thread_id_parts)
 
-        db_path = os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
-
-        if not os.path.exists(db_path):
-            return Response({
-                "status": "success", # Or "error" with 404 if preferred
-                "code": status.HTTP_200_OK, # Or 404
-                "message": "No chat history found to delete (history file does not exist).",
-                "data": {"thread_id": thread_id, "session_id": session_id, "deleted_count": 0}
-            }, status=status.HTTP_200_OK)
-
-        conn = None
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            # It's good practice to check how many rows were affected.
-            cursor.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
-            deleted_count = cursor.rowcount # Get the number of rows deleted
-
-            conn.commit()
+            deleted_count = delete_thread(thread_id)
+            chat_config_cache.reset_system_prompt_added(request.user, session_id)
 
             if deleted_count > 0:
                 message = f"Successfully deleted chat history for session_id: {session_id} (Thread ID: {thread_id}). {deleted_count} records removed."
@@ -1002,9 +1035,6 @@ class ChatHistoryAPIView(APIView):
                 "message": f"An unexpected error occurred: {str(e)}", "data": {},
                 "errors": {"unexpected_error": [str(e)]}
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        finally:
-            if conn:
-                conn.close()
 
 
 class UserChatSessionsAPIView(APIView):
@@ -1048,31 +1078,14 @@ class UserChatSessionsAPIView(APIView):
                 "errors": {"project_id": ["Permission denied or project not found."]}
             }, status=status.HTTP_403_FORBIDDEN)
 
-        db_path = os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
         session_ids = set() # Use a set to store unique session_ids
 
-        if not os.path.exists(db_path):
-            return Response({
-                "status": "success",
-                "code": status.HTTP_200_OK,
-                "message": "No chat history found (history file does not exist).",
-                "data": {"user_id": user_id, "sessions": []}
-            }, status=status.HTTP_200_OK)
-
-        conn = None
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
             # Query for distinct thread_ids starting with the user_id and project_id prefix
             # The thread_id is stored as "USERID_PROJECTID_SESSIONID"
             thread_id_prefix = f"{user_id}_{project_id}_"
-            cursor.execute("SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id LIKE ?", (thread_id_prefix + '%',))
-
-            rows = cursor.fetchall()
 
-            for row in rows:
-                full_thread_id = row[0]
+            for full_thread_id in list_thread_ids(thread_id_prefix):
                 # Extract session_id part: everything after "USERID_PROJECTID_"
                 if full_thread_id.startswith(thread_id_prefix):
                     session_id_part = full_thread_id[len(thread_id_prefix):]
@@ -1106,9 +1119,6 @@ class UserChatSessionsAPIView(APIView):
                 "message": f"An unexpected error occurred: {str(e)}", "data": {},
                 "errors": {"unexpected_error": [str(e)]}
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        finally:
-            if conn:
-                conn.close()
 
 
 from django.views import View
@@ -1125,6 +1135,7 @@ class ChatStreamAPIView(View):
     支持项目隔离，聊天记录按项目分组。
     使用Server-Sent Events (SSE)实现流式响应。
     使用Django原生View绕过DRF的渲染器系统。
+    需要以ASGI方式部署（uvicorn/daphne）：WSGI下异步流式响应会被整体缓冲，且无法感知客户端断开。
     """
 
     async def authenticate_request(self, request):
@@ -1163,7 +1174,7 @@ class ChatStreamAPIView(View):
         """创建SSE数据生成器"""
         try:
             # 获取活跃的LLM配置
-            active_config = await sync_to_async(LLMConfig.objects.get)(is_active=True)
+            active_config = await chat_config_cache.aget_active_llm_config()
             logger.info(f"ChatStreamAPIView: Using active LLMConfig: {active_config.name}")
         except LLMConfig.DoesNotExist:
             yield f"data: {json.dumps({'type': 'error', 'message': 'No active LLM configuration found'})}\n\n"
@@ -1172,13 +1183,13 @@ class ChatStreamAPIView(View):
             yield f"data: {json.dumps({'type': 'error', 'message': 'Multiple active LLM configurations found'})}\n\n"
             return
 
+        mcp_lease = None
         try:
             # 使用新的LLM工厂函数，支持多供应商
-            llm = create_llm_instance(active_config, temperature=0.7)
+            llm = create_llm_instance(active_config, temperature=0.7, user=request.user)
             logger.info(f"ChatStreamAPIView: Initialized LLM with provider auto-detection")
 
-            db_path = os.path.join(str(settings.BASE_DIR), "chat_history.sqlite")
-            async with AsyncSqliteSaver.from_conn_string(db_path) as actual_memory_checkpointer:
+            async with async_checkpointer() as actual_memory_checkpointer:
                 # 加载远程MCP工具
                 logger.info("ChatStreamAPIView: Attempting to load remote MCP tools.")
                 mcp_tools_list = []
@@ -1200,12 +1211,16 @@ class ChatStreamAPIView(View):
                         if client_mcp_config:
                             logger.info(f"ChatStreamAPIView: Initializing persistent MCP client with config: {client_mcp_config}")
                             # 使用持久化MCP会话管理器，传递用户和项目信息以支持跨对话轮次的状态保持
-                            mcp_tools_list = await mcp_session_manager.get_tools_for_config(
+                            # 租约在本轮对话结束时释放，期间会话不会被回收
+                            mcp_lease = await mcp_session_manager.acquire_tools(
                                 client_mcp_config,
                                 user_id=str(request.user.id),
                                 project_id=str(project_id)
                             )
+                            mcp_tools_list = mcp_lease.tools
                             logger.info(f"ChatStreamAPIView: Successfully loaded {len(mcp_tools_list)} persistent tools from remote MCP servers")
+                            for warning in mcp_lease.warnings:
+                                yield create_sse_data({'type': 'warning', 'message': warning})
                         else:
                             logger.info("ChatStreamAPIView: No active remote MCP configurations to build client config.")
                     else:
@@ -1214,8 +1229,13 @@ class ChatStreamAPIView(View):
                     logger.error(f"ChatStreamAPIView: Error loading remote MCP tools: {e}", exc_info=True)
                     yield f"data: {json.dumps({'type': 'warning', 'message': f'Failed to load MCP tools: {str(e)}'})}\n\n"
 
+                # 对话上下文管理：超过token阈值时将较早轮次压缩为滚动摘要
+                context_manager = create_context_manager(llm, active_config.name)
+                agent_context_kwargs = {"pre_model_hook": context_manager.aprepare, "state_schema": ChatAgentState} if context_manager else {}
+
                 # 准备LangGraph runnable
                 runnable_to_invoke = None
+                graph_node_name = "agent"  # 中断时写回checkpoint所用的节点名
 
                 # 检查是否需要创建Agent（有MCP工具）
                 if mcp_tools_list:
@@ -1236,13 +1256,13 @@ class ChatStreamAPIView(View):
 
                             # 将知识库工具添加到MCP工具列表
                             enhanced_tools = mcp_tools_list + [knowledge_tool]
-                            agent_executor = create_react_agent(llm, enhanced_tools, checkpointer=actual_memory_checkpointer)
+                            agent_executor = create_react_agent(llm, enhanced_tools, checkpointer=actual_memory_checkpointer, **agent_context_kwargs)
                             runnable_to_invoke = agent_executor
                             logger.info(f"ChatStreamAPIView: Knowledge-enhanced agent created with {len(enhanced_tools)} tools (including knowledge base)")
                             yield create_sse_data({'type': 'info', 'message': f'Knowledge-enhanced agent initialized with {len(enhanced_tools)} tools'})
                         else:
                             # 只有MCP工具，创建普通Agent
-                            agent_executor = create_react_agent(llm, mcp_tools_list, checkpointer=actual_memory_checkpointer)
+                            agent_executor = create_react_agent(llm, mcp_tools_list, checkpointer=actual_memory_checkpointer, **agent_context_kwargs)
                             runnable_to_invoke = agent_executor
                             logger.info("ChatStreamAPIView: Agent with remote tools created with checkpointer.")
                             yield create_sse_data({'type': 'info', 'message': f'Agent initialized with {len(mcp_tools_list)} tools'})
@@ -1253,7 +1273,7 @@ class ChatStreamAPIView(View):
                 if not runnable_to_invoke:
                     logger.info("ChatStreamAPIView: No remote tools or agent creation failed. Using knowledge-enhanced chatbot.")
 
-                    def knowledge_enhanced_chatbot_node(state: AgentState):
+                    async def knowledge_enhanced_chatbot_node(state: AgentState):
                         """知识库增强的聊天机器人节点"""
                         messages = state['messages']
                         if not messages:
@@ -1266,40 +1286,39 @@ class ChatStreamAPIView(View):
                         else:
                             user_query = str(last_message)
 
+                        # 历史过长时使用摘要 + 最近轮次作为LLM输入
+                        llm_messages, summary_update = await prepare_llm_messages(context_manager, state)
+
                         # 检查是否需要使用知识库
                         if knowledge_base_id and use_knowledge_base:
                             try:
-                                # 使用知识库增强回答
-                                from knowledge.langgraph_integration import KnowledgeRAGService
-                                rag_service = KnowledgeRAGService(llm)
-                                rag_result = rag_service.query(
-                                    question=user_query,
-                                    knowledge_base_id=knowledge_base_id,
-                                    user=request.user,
-                                    similarity_threshold=similarity_threshold,
-                                    top_k=top_k
+                                # 仅检索上下文（有界线程池执行），回答由下方流式LLM调用生成
+                                context = await asearch_knowledge_base(
+                                    knowledge_base_id, user_query,
+                                    top_k=top_k, similarity_threshold=similarity_threshold
                                 )
 
                                 # 使用RAG结果作为上下文
-                                context_prompt = f"基于以下相关信息回答用户问题：\n\n{rag_result['context']}\n\n用户问题：{user_query}"
-                                enhanced_messages = messages[:-1] + [HumanMessage(content=context_prompt)]
-                                invoked_response = llm.invoke(enhanced_messages)
+                                context_prompt = f"基于以下相关信息回答用户问题：\n\n{context}\n\n用户问题：{user_query}"
+                                enhanced_messages = llm_messages[:-1] + [HumanMessage(content=context_prompt)]
+                                invoked_response = await llm.ainvoke(enhanced_messages)
                                 logger.info(f"ChatStreamAPIView: Used knowledge base {knowledge_base_id} for enhanced response")
 
                             except Exception as e:
                                 logger.warning(f"ChatStreamAPIView: Knowledge base query failed: {e}, falling back to normal response")
-                                invoked_response = llm.invoke(messages)
+                                invoked_response = await llm.ainvoke(llm_messages)
                         else:
                             # 普通聊天回复
-                            invoked_response = llm.invoke(messages)
+                            invoked_response = await llm.ainvoke(llm_messages)
 
-                        return {"messages": [invoked_response]}
+                        return {"messages": [invoked_response], **summary_update}
 
                     graph_builder = StateGraph(AgentState)
                     graph_builder.add_node("chatbot", knowledge_enhanced_chatbot_node)
                     graph_builder.set_entry_point("chatbot")
                     graph_builder.add_edge("chatbot", END)
                     runnable_to_invoke = graph_builder.compile(checkpointer=actual_memory_checkpointer)
+                    graph_node_name = "chatbot"
 
                     if knowledge_base_id and use_knowledge_base:
                         logger.info(f"ChatStreamAPIView: Knowledge-enhanced chatbot initialized with KB: {knowledge_base_id}")
@@ -1326,25 +1345,9 @@ class ChatStreamAPIView(View):
                 should_add_system_prompt = False
                 if effective_prompt:
                     try:
-                        # 尝试获取当前会话的历史消息 - 使用异步接口
-                        checkpoint_tuples_list = []
-                        async for checkpoint_tuple in actual_memory_checkpointer.alist(config={"configurable": {"thread_id": thread_id}}):
-                            checkpoint_tuples_list.append(checkpoint_tuple)
-
-                        if checkpoint_tuples_list:
-                            # 检查最新checkpoint中是否已有系统提示词
-                            latest_checkpoint = checkpoint_tuples_list[0].checkpoint
-                            if (latest_checkpoint and 'channel_values' in latest_checkpoint
-                                and 'messages' in latest_checkpoint['channel_values']):
-                                existing_messages = latest_checkpoint['channel_values']['messages']
-                                # 检查第一条消息是否是系统消息
-                                if not existing_messages or not isinstance(existing_messages[0], SystemMessage):
-                                    should_add_system_prompt = True
-                            else:
-                                should_add_system_prompt = True
-                        else:
-                            # 新会话，需要添加系统提示词
-                            should_add_system_prompt = True
+                        should_add_system_prompt = await session_needs_system_prompt(
+                            actual_memory_checkpointer, request.user, session_id, thread_id
+                        )
                     except Exception as e:
                         logger.warning(f"ChatStreamAPIView: Error checking existing messages: {e}")
                         should_add_system_prompt = True
@@ -1385,9 +1388,12 @@ class ChatStreamAPIView(View):
                     logger.info(f"ChatStreamAPIView: Message {i}: {type(msg).__name__} with content length {len(str(msg.content))}")
 
                 input_messages = {"messages": messages_list}
+                # 用量统计：token、首token耗时、LLM与工具耗时
+                usage_tracker = ChatUsageTracker()
                 invoke_config = {
                     "configurable": {"thread_id": thread_id},
-                    "recursion_limit": 100  # 增加递归限制，支持生成更多测试用例
+                    "recursion_limit": 100,  # 增加递归限制，支持生成更多测试用例
+                    "callbacks": [usage_tracker]
                 }
                 logger.info(f"ChatStreamAPIView: Set recursion_limit to 100 for thread_id: {thread_id}")
                 logger.info(f"ChatStreamAPIView: Input messages structure: {input_messages}")
@@ -1402,36 +1408,103 @@ class ChatStreamAPIView(View):
                 # 使用astream进行流式处理，支持多种模式
                 stream_modes = ["updates", "messages"]
 
-                try:
-                    async for stream_mode, chunk in runnable_to_invoke.astream(
-                        input_messages,
-                        config=invoke_config,
-                        stream_mode=stream_modes
-                    ):
-                        if stream_mode == "updates":
-                            # 代理进度更新 - 安全地序列化复杂对象
-                            try:
-                                # 尝试将chunk转换为可序列化的格式
-                                if hasattr(chunk, '__dict__'):
-                                    serializable_chunk = str(chunk)
+                # 图执行放在独立任务中，通过队列向SSE输出；客户端断开或调用停止接口时取消该任务，
+                # 取消会传递到正在进行的LLM请求和MCP工具调用
+                event_queue = asyncio.Queue()
+                partial_chunks = []
+
+                async def run_graph():
+                    turn_status = 'completed'
+                    try:
+                        async for stream_mode, chunk in runnable_to_invoke.astream(
+                            input_messages,
+                            config=invoke_config,
+                            stream_mode=stream_modes
+                        ):
+                            if stream_mode == "updates":
+                                # 节点完成后其输出已写入checkpoint，清空未完成的增量文本
+                                partial_chunks.clear()
+                                # 代理进度更新 - 安全地序列化复杂对象
+                                try:
+                                    # 尝试将chunk转换为可序列化的格式
+                                    if hasattr(chunk, '__dict__'):
+                                        serializable_chunk = str(chunk)
+                                    else:
+                                        serializable_chunk = chunk
+                                    event_queue.put_nowait(create_sse_data({'type': 'update', 'data': serializable_chunk}))
+                                except (TypeError, ValueError) as e:
+                                    event_queue.put_nowait(create_sse_data({'type': 'update', 'data': f'Update: {str(chunk)}'}))
+                            elif stream_mode == "messages":
+                                partial_chunks.append(extract_stream_text(chunk))
+                                # LLM令牌流式传输
+                                if hasattr(chunk, 'content') and chunk.content:
+                                    event_queue.put_nowait(create_sse_data({'type': 'message', 'data': chunk.content}))
                                 else:
-                                    serializable_chunk = chunk
-                                yield create_sse_data({'type': 'update', 'data': serializable_chunk})
-                            except (TypeError, ValueError) as e:
-                                yield create_sse_data({'type': 'update', 'data': f'Update: {str(chunk)}'})
-                        elif stream_mode == "messages":
-                            # LLM令牌流式传输
-                            if hasattr(chunk, 'content') and chunk.content:
-                                yield create_sse_data({'type': 'message', 'data': chunk.content})
-                            else:
-                                yield create_sse_data({'type': 'message', 'data': str(chunk)})
+                                    event_queue.put_nowait(create_sse_data({'type': 'message', 'data': str(chunk)}))
 
-                        # 添加小延迟以确保流式传输效果
-                        await asyncio.sleep(0.01)
+                            # 添加小延迟以确保流式传输效果
+                            await asyncio.sleep(0.01)
 
-                except Exception as e:
-                    logger.error(f"ChatStreamAPIView: Error during streaming: {e}", exc_info=True)
-                    yield create_sse_data({'type': 'error', 'message': f'Streaming error: {str(e)}'})
+                    except asyncio.CancelledError:
+                        turn_status = 'interrupted'
+                        logger.info(f"ChatStreamAPIView: Stream cancelled for thread_id: {thread_id}")
+                        try:
+                            await record_interrupted_turn(
+                                runnable_to_invoke, invoke_config, graph_node_name,
+                                messages_list, ''.join(partial_chunks)
+                            )
+                        except Exception as e:
+                            logger.error(f"ChatStreamAPIView: Failed to record interrupted turn: {e}", exc_info=True)
+                        event_queue.put_nowait(create_sse_data({'type': 'interrupted', 'thread_id': thread_id, 'session_id': session_id}))
+                        raise
+                    except Exception as e:
+                        turn_status = 'error'
+                        logger.error(f"ChatStreamAPIView: Error during streaming: {e}", exc_info=True)
+                        event_queue.put_nowait(create_sse_data({'type': 'error', 'message': f'Streaming error: {str(e)}'}))
+                    finally:
+                        if should_add_system_prompt and turn_status != 'error':
+                            try:
+                                await chat_config_cache.amark_system_prompt_added(request.user, session_id)
+                            except Exception as e:
+                                logger.warning(f"ChatStreamAPIView: Failed to update session metadata: {e}")
+                        turn_usage = await arecord_chat_turn_usage(
+                            usage_tracker, request.user, project, active_config, session_id, status=turn_status
+                        )
+                        event_queue.put_nowait(create_sse_data({'type': 'usage', 'data': turn_usage}))
+                        event_queue.put_nowait(None)
+
+                stream_started_at = timezone.now()
+                graph_task = asyncio.create_task(run_graph())
+                chat_stream_registry.register(thread_id, graph_task)
+                stop_poll_interval = chat_stream_registry.poll_interval()
+                last_stop_check = asyncio.get_running_loop().time()
+                try:
+                    while True:
+                        try:
+                            event = await asyncio.wait_for(event_queue.get(), timeout=stop_poll_interval)
+                        except asyncio.TimeoutError:
+                            event = ''  # 空闲超时，仅用于检查停止标记
+                        # 停止请求可能由其他工作进程处理，在数据块之间和空闲时检查共享的停止标记
+                        now = asyncio.get_running_loop().time()
+                        if not graph_task.done() and now - last_stop_check >= stop_poll_interval:
+                            last_stop_check = now
+                            if await chat_stream_registry.astop_requested(request.user, session_id, stream_started_at):
+                                logger.info(f"ChatStreamAPIView: Stop requested, cancelling graph for thread_id: {thread_id}")
+                                graph_task.cancel()
+                        if event is None:
+                            break
+                        if event:
+                            yield event
+                finally:
+                    chat_stream_registry.unregister(thread_id, graph_task)
+                    if not graph_task.done():
+                        # 客户端已断开：取消图任务，并等待中断状态写回后再关闭checkpointer
+                        logger.info(f"ChatStreamAPIView: Client disconnected, cancelling graph for thread_id: {thread_id}")
+                        graph_task.cancel()
+                        try:
+                            await graph_task
+                        except asyncio.CancelledError:
+                            pass
 
                 # 发送完成信号
                 yield create_sse_data({'type': 'complete'})
@@ -1442,6 +1515,9 @@ class ChatStreamAPIView(View):
         except Exception as e:
             logger.error(f"ChatStreamAPIView: Error in stream generator: {e}", exc_info=True)
             yield create_sse_data({'type': 'error', 'message': f'Generator error: {str(e)}'})
+        finally:
+            if mcp_lease:
+                mcp_lease.release()
 
     async def post(self, request, *args, **kwargs):
         """处理流式聊天请求"""
@@ -1570,6 +1646,226 @@ class ChatStreamAPIView(View):
         return response
 
 
+class ChatStopAPIView(APIView):
+    """
+    API endpoint for stopping a running streaming chat for a given session_id.
+    取消正在执行的LLM与MCP工具调用，已生成的部分回复以“已中断”状态保存到聊天记录。
+    停止标记写入会话记录，流式请求由其他工作进程处理时也会在下一次检查时中止。
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def _check_project_permission(self, user, project_id):
+        """检查用户是否有访问指定项目的权限"""
+        try:
+            project = Project.objects.get(id=project_id)
+            # 超级用户可以访问所有项目
+            if user.is_superuser:
+                return project
+            # 检查用户是否是项目成员
+            if ProjectMember.objects.filter(project=project, user=user).exists():
+                return project
+            return None
+        except Project.DoesNotExist:
+            return None
+
+    def post(self, request, *args, **kwargs):
+        session_id = request.data.get('session_id')
+        project_id = request.data.get('project_id')
+
+        if not session_id:
+            return Response({
+                "status": "error", "code": status.HTTP_400_BAD_REQUEST,
+                "message": "session_id is required.", "data": {},
+                "errors": {"session_id": ["This field is required."]}
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if not project_id:
+            return Response({
+                "status": "error", "code": status.HTTP_400_BAD_REQUEST,
+                "message": "project_id is required.", "data": {},
+                "errors": {"project_id": ["This field is required."]}
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # 检查项目权限
+        project = self._check_project_permission(request.user, project_id)
+        if not project:
+            return Response({
+                "status": "error", "code": status.HTTP_403_FORBIDDEN,
+                "message": "You don't have permission to access this project or project doesn't exist.", "data": {},
+                "errors": {"project_id": ["Permission denied or project not found."]}
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        # thread_id包含当前用户ID，用户只能停止自己的会话
+        thread_id = "_".join([str(request.user.id), str(project_id), str(session_id)])
+        stopped = chat_stream_registry.request_stop(request.user, session_id, thread_id)
+
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "Chat stream stop requested." if stopped else "No chat stream found for this session.",
+            "data": {"thread_id": thread_id, "session_id": session_id, "stopped": stopped}
+        }, status=status.HTTP_200_OK)
+
+
+class ChatUsageAPIView(APIView):
+    """
+    API endpoint for chat token usage, latency and cost statistics.
+    按 日期/用户/项目/LLM配置 返回日汇总数据；普通用户只能查看自己的用量。
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    GROUP_BY_FIELDS = {
+        'day': ['date'],
+        'user': ['user_id', 'user__username'],
+        'project': ['project_id', 'project__name'],
+        'llm_config': ['llm_config_id', 'llm_config__config_name'],
+    }
+    SUM_FIELDS = [
+        'turns', 'interrupted_turns', 'prompt_tokens', 'completion_tokens', 'cached_tokens',
+        'total_tokens', 'estimated_cost', 'llm_calls', 'tool_calls', 'llm_duration_ms',
+        'tool_duration_ms', 'total_duration_ms', 'ttft_sum_ms', 'ttft_count',
+    ]
+
+    def _format_row(self, row):
+        """补充平均值字段并移除中间统计字段"""
+        turns = row.get('turns') or 0
+        ttft_count = row.pop('ttft_count', 0) or 0
+        ttft_sum = row.pop('ttft_sum_ms', 0) or 0
+        row['avg_time_to_first_token_ms'] = int(ttft_sum / ttft_count) if ttft_count else None
+        row['avg_total_duration_ms'] = int((row.get('total_duration_ms') or 0) / turns) if turns else None
+        row['avg_tokens_per_turn'] = int((row.get('total_tokens') or 0) / turns) if turns else None
+        if row.get('estimated_cost') is not None:
+            row['estimated_cost'] = str(row['estimated_cost'])
+        if row.get('date') is not None:
+            row['date'] = row['date'].isoformat()
+        return row
+
+    def get(self, request, *args, **kwargs):
+        from datetime import date as date_cls
+        from django.db.models import Sum
+
+        group_by = request.query_params.get('group_by', 'day')
+        if group_by not in self.GROUP_BY_FIELDS:
+            return Response({
+                "status": "error", "code": status.HTTP_400_BAD_REQUEST,
+                "message": f"group_by must be one of: {', '.join(self.GROUP_BY_FIELDS)}.", "data": {},
+                "errors": {"group_by": ["Invalid value."]}
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = {}
+        try:
+            start_date = request.query_params.get('start_date')
+            end_date = request.query_params.get('end_date')
+            if start_date:
+                filters['date__gte'] = date_cls.fromisoformat(start_date)
+            if end_date:
+                filters['date__lte'] = date_cls.fromisoformat(end_date)
+        except ValueError:
+            return Response({
+                "status": "error", "code": status.HTTP_400_BAD_REQUEST,
+                "message": "start_date and end_date must be in YYYY-MM-DD format.", "data": {},
+                "errors": {"date": ["Invalid date format."]}
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        project_id = request.query_params.get('project_id')
+        llm_config_id = request.query_params.get('llm_config_id')
+        user_id = request.query_params.get('user_id')
+        if project_id:
+            filters['project_id'] = project_id
+        if llm_config_id:
+            filters['llm_config_id'] = llm_config_id
+
+        # 普通用户只能查看自己的用量，超级用户可按用户筛选或查看全部
+        if not request.user.is_superuser:
+            filters['user'] = request.user
+        elif user_id:
+            filters['user_id'] = user_id
+
+        daily_qs = ChatUsageDaily.objects.filter(**filters)
+        group_fields = self.GROUP_BY_FIELDS[group_by]
+        sums = {field: Sum(field) for field in self.SUM_FIELDS}
+        rows = [
+            self._format_row(row)
+            for row in daily_qs.values(*group_fields).annotate(**sums).order_by(*group_fields)
+        ]
+        totals = self._format_row(daily_qs.aggregate(**sums))
+
+        # 工具耗时排行：从轮次明细中汇总
+        turn_filters = {k.replace('date', 'created_at__date'): v for k, v in filters.items()}
+        tool_stats = {}
+        for details in ChatTurnUsage.objects.filter(tool_calls__gt=0, **turn_filters) \
+                .values_list('tool_call_details', flat=True).iterator(chunk_size=500):
+            for call in details or []:
+                stat = tool_stats.setdefault(call.get('name'), {'name': call.get('name'), 'calls': 0, 'errors': 0, 'total_duration_ms': 0})
+                stat['calls'] += 1
+                stat['total_duration_ms'] += call.get('duration_ms') or 0
+                if call.get('status') != 'success':
+                    stat['errors'] += 1
+        tools = sorted(tool_stats.values(), key=lambda item: item['total_duration_ms'], reverse=True)
+        for stat in tools:
+            stat['avg_duration_ms'] = int(stat['total_duration_ms'] / stat['calls'])
+
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "Chat usage retrieved successfully.",
+            "data": {
+                "group_by": group_by,
+                "rows": rows,
+                "totals": totals,
+                "tools": tools
+            }
+        }, status=status.HTTP_200_OK)
+
+
+class LLMGatewayStatsAPIView(APIView):
+    """
+    API endpoint for LLM gateway queue statistics.
+    返回每个LLM配置的并发数、队列深度和等待时间
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "LLM gateway stats retrieved successfully.",
+            "data": {
+                "enabled": llm_gateway.enabled,
+                "limiters": llm_gateway.stats()
+            }
+        }, status=status.HTTP_200_OK)
+
+
+class LLMResponseCacheStatsAPIView(APIView):
+    """
+    API endpoint for LLM response cache statistics.
+    返回缓存条目数、命中率和节省的token数；超级用户可通过DELETE清空缓存
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "LLM response cache stats retrieved successfully.",
+            "data": get_response_cache_stats()
+        }, status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        if not request.user.is_superuser:
+            return Response({
+                "status": "error", "code": status.HTTP_403_FORBIDDEN,
+                "message": "Only superusers can clear the LLM response cache.", "data": {},
+                "errors": {"permission": ["Superuser required."]}
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        # 两种缓存共用同一数据库，任一开启即可清空
+        cache = get_response_cache() or get_semantic_cache()
+        if cache is not None:
+            cache.clear(namespace=request.query_params.get('namespace'))
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "LLM response cache cleared.", "data": {}
+        }, status=status.HTTP_200_OK)
+
+
 class ProviderChoicesAPIView(APIView):
     """获取可用的LLM供应商选项"""
     permission_classes = [IsAuthenticated]
@@ -1647,8 +1943,8 @@ class KnowledgeRAGAPIView(APIView):
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
                     )
 
-                # 使用新的LLM工厂函数，支持多供应商
-                llm = create_llm_instance(active_config, temperature=0.7)
+                # 复用按LLM配置缓存的RAG服务
+                rag_service = get_rag_service(KnowledgeRAGService, active_config)
             except Exception as e:
                 logger.error(f"LLM配置错误: {e}")
                 return Response(
@@ -1657,7 +1953,6 @@ class KnowledgeRAGAPIView(APIView):
                 )
 
             # 执行RAG查询
-            rag_service = KnowledgeRAGService(llm)
             result = rag_service.query(
                 question=query,
                 knowledge_base_id=knowledge_base_id,
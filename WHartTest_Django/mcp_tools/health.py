@@ -0,0 +1,242 @@
+"""
+远程MCP服务器健康跟踪与熔断
+- 按服务器记录滚动时间窗口内的调用结果与耗时
+- 连续失败或窗口内错误率过高时熔断（open），冷却期内不再连接该服务器，其工具从Agent工具列表中移除
+- 冷却期结束后进入半开（half_open）状态，放行一次探测请求：成功则恢复，失败则重新熔断
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langchain_core.tools import StructuredTool, ToolException
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+
+class MCPCircuitOpenError(Exception):
+    """服务器处于熔断状态"""
+
+
+def describe_error(error: BaseException) -> str:
+    """简短的错误描述，展开MCP客户端（anyio任务组）包装的异常组"""
+    while isinstance(error, BaseExceptionGroup) and error.exceptions:
+        error = error.exceptions[0]
+    if isinstance(error, asyncio.TimeoutError):
+        return "timed out"
+    return str(error) or type(error).__name__
+
+
+class ServerHealth:
+    """单个MCP服务器的健康状态"""
+
+    def __init__(self, server_name: str):
+        self.server_name = server_name
+        self.calls = deque(maxlen=200)  # (timestamp, success, latency_ms)
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.last_error = ''
+        self.total_calls = 0
+        self.total_failures = 0
+
+    def window_calls(self, now: float, window: float) -> List[tuple]:
+        while self.calls and now - self.calls[0][0] > window:
+            self.calls.popleft()
+        return list(self.calls)
+
+
+class MCPHealthTracker:
+    """进程内的MCP服务器健康跟踪器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers: Dict[str, ServerHealth] = {}
+
+    # --- 配置 ---
+    @property
+    def failure_threshold(self) -> int:
+        return getattr(settings, 'MCP_CIRCUIT_FAILURE_THRESHOLD', 5)
+
+    @property
+    def error_rate_threshold(self) -> float:
+        return getattr(settings, 'MCP_CIRCUIT_ERROR_RATE', 0.5)
+
+    @property
+    def min_calls(self) -> int:
+        return getattr(settings, 'MCP_CIRCUIT_MIN_CALLS', 10)
+
+    @property
+    def window_seconds(self) -> float:
+        return getattr(settings, 'MCP_CIRCUIT_WINDOW_SECONDS', 300)
+
+    @property
+    def cooldown(self) -> float:
+        return getattr(settings, 'MCP_CIRCUIT_COOLDOWN', 60)
+
+    def _get(self, server_name: str) -> ServerHealth:
+        health = self._servers.get(server_name)
+        if health is None:
+            health = self._servers[server_name] = ServerHealth(server_name)
+        return health
+
+    # --- 熔断判断 ---
+    def allow_request(self, server_name: str) -> bool:
+        """是否允许访问该服务器；冷却期结束后只放行一个探测请求"""
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(server_name)
+            if health.state == CIRCUIT_CLOSED:
+                return True
+            if health.state == CIRCUIT_OPEN:
+                if now - health.opened_at < self.cooldown:
+                    return False
+                health.state = CIRCUIT_HALF_OPEN
+                health.probe_started_at = now
+                logger.info(f"MCP server {server_name} circuit half-open, probing")
+                return True
+            # 半开：探测请求未返回前拒绝其他请求，探测超过冷却时间未返回则允许重新探测
+            if health.probe_started_at is None or now - health.probe_started_at >= self.cooldown:
+                health.probe_started_at = now
+                return True
+            return False
+
+    def is_available(self, server_name: str) -> bool:
+        """是否可以访问该服务器（不占用探测名额）：熔断冷却中或探测进行中时返回False"""
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(server_name)
+            if health.state == CIRCUIT_CLOSED:
+                return True
+            if health.state == CIRCUIT_OPEN:
+                return now - health.opened_at >= self.cooldown
+            return health.probe_started_at is None or now - health.probe_started_at >= self.cooldown
+
+    def release_probe(self, server_name: str):
+        """探测请求未得出结果（如被取消）时释放探测名额，允许下一个请求探测"""
+        with self._lock:
+            health = self._get(server_name)
+            if health.state == CIRCUIT_HALF_OPEN:
+                health.probe_started_at = None
+
+    def retry_after(self, server_name: str) -> float:
+        with self._lock:
+            health = self._get(server_name)
+            if health.state != CIRCUIT_OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - health.opened_at))
+
+    def record_success(self, server_name: str, latency_ms: float):
+        with self._lock:
+            health = self._get(server_name)
+            health.calls.append((time.monotonic(), True, latency_ms))
+            health.total_calls += 1
+            health.consecutive_failures = 0
+            if health.state != CIRCUIT_CLOSED:
+                logger.info(f"MCP server {server_name} recovered, circuit closed")
+            health.state = CIRCUIT_CLOSED
+            health.probe_started_at = None
+
+    def record_failure(self, server_name: str, latency_ms: float, error: str):
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(server_name)
+            health.calls.append((now, False, latency_ms))
+            health.total_calls += 1
+            health.total_failures += 1
+            health.consecutive_failures += 1
+            health.last_error = error
+
+            calls = health.window_calls(now, self.window_seconds)
+            failures = sum(1 for _, success, _ in calls if not success)
+            error_rate_exceeded = len(calls) >= self.min_calls and failures / len(calls) >= self.error_rate_threshold
+            if health.state == CIRCUIT_HALF_OPEN or health.consecutive_failures >= self.failure_threshold \
+                    or error_rate_exceeded:
+                if health.state != CIRCUIT_OPEN:
+                    logger.warning(f"MCP server {server_name} circuit opened: {error}")
+                health.state = CIRCUIT_OPEN
+                health.opened_at = now
+                health.probe_started_at = None
+
+    # --- 状态 ---
+    def status(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            for health in self._servers.values():
+                calls = health.window_calls(now, self.window_seconds)
+                latencies = sorted(latency for _, _, latency in calls)
+                failures = sum(1 for _, success, _ in calls if not success)
+                result.append({
+                    'server': health.server_name,
+                    'state': health.state,
+                    'window_calls': len(calls),
+                    'error_rate': round(failures / len(calls), 3) if calls else 0.0,
+                    'avg_latency_ms': round(sum(latencies) / len(latencies), 1) if latencies else None,
+                    'p95_latency_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1)
+                    if latencies else None,
+                    'consecutive_failures': health.consecutive_failures,
+                    'total_calls': health.total_calls,
+                    'total_failures': health.total_failures,
+                    'last_error': health.last_error,
+                    'retry_after_seconds': round(max(0.0, self.cooldown - (now - health.opened_at)), 1)
+                    if health.state == CIRCUIT_OPEN else 0.0,
+                })
+        return result
+
+    def reset(self, server_name: Optional[str] = None):
+        with self._lock:
+            if server_name is None:
+                self._servers.clear()
+            else:
+                self._servers.pop(server_name, None)
+
+
+# 全局健康跟踪实例
+mcp_health_tracker = MCPHealthTracker()
+
+
+def guard_mcp_tool(tool: StructuredTool, server_name: str) -> StructuredTool:
+    """
+    为MCP工具加上熔断检查、调用超时（MCP_TOOL_CALL_TIMEOUT）和健康统计
+    工具自身返回的错误（ToolException）说明服务器正常响应，按成功计入
+    """
+    call_tool = tool.coroutine
+
+    async def guarded_call(**arguments):
+        if not mcp_health_tracker.allow_request(server_name):
+            raise ToolException(f"MCP server {server_name} is temporarily unavailable (circuit open), "
+                                f"retry in {mcp_health_tracker.retry_after(server_name):.0f}s")
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(call_tool(**arguments),
+                                            getattr(settings, 'MCP_TOOL_CALL_TIMEOUT', 120) or None)
+        except asyncio.CancelledError:
+            mcp_health_tracker.release_probe(server_name)
+            raise
+        except ToolException:
+            mcp_health_tracker.record_success(server_name, (time.monotonic() - started) * 1000)
+            raise
+        except Exception as e:
+            reason = describe_error(e)
+            mcp_health_tracker.record_failure(server_name, (time.monotonic() - started) * 1000, reason)
+            raise ToolException(f"MCP server {server_name} call to {tool.name} failed: {reason}") from e
+        mcp_health_tracker.record_success(server_name, (time.monotonic() - started) * 1000)
+        return result
+
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        coroutine=guarded_call,
+        response_format=tool.response_format,
+        metadata=tool.metadata,
+    )
@@ -91,26 +91,31 @@ class Command(BaseCommand):
         self.stdout.write('活跃的MCP会话:')
         self.stdout.write('=' * 50)
         
-        if not mcp_session_manager.session_contexts:
+        sessions = mcp_session_manager.list_sessions()
+        if not sessions:
             self.stdout.write('没有活跃的会话')
             return
         
-        for session_key, context in mcp_session_manager.session_contexts.items():
-            user_id, project_id = session_key.split('_', 1)
+        for session in sessions:
+            owner = session['owner']
+            if '_' not in owner:
+                self.stdout.write(f"会话: {session['server']} / {owner} (共享会话)\n")
+                continue
+            user_id, project_id = owner.split('_', 1)
             
             try:
                 user = User.objects.get(id=user_id)
                 project = Project.objects.get(id=project_id)
                 
                 self.stdout.write(
-                    f"会话: {session_key}\n"
+                    f"会话: {session['server']} / {owner}\n"
                     f"  用户: {user.username} (ID: {user_id})\n"
                     f"  项目: {project.name} (ID: {project_id})\n"
-                    f"  最后使用: {context.get('last_used', 'Unknown')}\n"
+                    f"  使用中: {session['refcount']}，空闲: {session['idle_seconds']} 秒\n"
                 )
             except (User.DoesNotExist, Project.DoesNotExist):
                 self.stdout.write(
-                    f"会话: {session_key} (用户或项目已删除)\n"
+                    f"会话: {session['server']} / {owner} (用户或项目已删除)\n"
                 )
     
     async def _async_cleanup_user_session(self, user_id: int, project_id: int):
@@ -1,221 +1,436 @@
 """
 持久化MCP客户端实现
 解决LangChain MCP适配器每次工具调用都创建新会话的问题
+
+会话归属：
+- 每个MCP服务器（按名称和连接配置区分）对应一个会话池 MCPServerPool
+- 池内按所有者（用户+项目）维护独立的逻辑会话，PlaywrightMCP等有状态工具的浏览器状态不会在用户间共享
+- 对话轮次通过租约（MCPSessionLease）持有会话，引用计数大于0的会话不会被回收或淘汰
+- 后台回收任务关闭空闲超过 MCP_SESSION_IDLE_TTL 的会话；每个用户、每个服务器的会话数均有上限
 """
 import asyncio
-from typing import Dict, Any, Optional, List
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langchain_mcp_adapters.tools import load_mcp_tools
-from langchain_core.tools import BaseTool
 import logging
-import weakref
-import atexit
-
-logger = logging.getLogger(__name__)
-
-class PersistentMCPClient:
-    """
-    持久化MCP客户端，维持长连接会话
-    解决PlaywrightMCP等有状态工具的会话问题
-    """
-
-    def __init__(self, server_configs: Dict[str, Any]):
-        self.server_configs = server_configs
-        self.client = MultiServerMCPClient(server_configs)
-        self.sessions = {}
-        self.tools_cache = {}
-        self._closed = False
-
-        # 注册清理函数
-        atexit.register(self._cleanup_sync)
-
-    async def get_persistent_tools(self, server_name: str) -> List[BaseTool]:
-        """获取指定服务器的持久会话工具"""
-        if self._closed:
-            raise RuntimeError("Client has been closed")
-
-        if server_name not in self.sessions:
-            try:
-                logger.info(f"Creating persistent session for server: {server_name}")
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-                # 创建持久会话
-                session_context = self.client.session(server_name)
-                session = await session_context.__aenter__()
+from django.conf import settings
+from langchain_core.tools import BaseTool
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
 
-                # 保存会话上下文管理器，用于后续清理
-                self.sessions[server_name] = {
-                    'session': session,
-                    'context': session_context
-                }
+from .health import MCPCircuitOpenError, describe_error, guard_mcp_tool, mcp_health_tracker
+from .tool_catalog import get_server_key, mcp_tool_catalog
 
-                # 加载工具并缓存
-                tools = await load_mcp_tools(session)
-                self.tools_cache[server_name] = tools
+logger = logging.getLogger(__name__)
 
-                logger.info(f"Created persistent session for {server_name} with {len(tools)} tools")
+SHARED_OWNER = 'shared'  # 未提供用户/项目时使用的所有者
 
-            except Exception as e:
-                logger.error(f"Failed to create persistent session for {server_name}: {e}")
-                raise
 
-        return self.tools_cache.get(server_name, [])
+class MCPSessionLimitError(Exception):
+    """会话数达到上限且没有可淘汰的空闲会话"""
 
-    async def get_all_persistent_tools(self) -> List[BaseTool]:
-        """获取所有服务器的持久工具"""
-        all_tools = []
-        for server_name in self.server_configs.keys():
-            try:
-                tools = await self.get_persistent_tools(server_name)
-                all_tools.extend(tools)
-            except Exception as e:
-                logger.error(f"Failed to get tools from server {server_name}: {e}")
-                continue
 
-        logger.info(f"Total persistent tools loaded: {len(all_tools)}")
-        return all_tools
+@asynccontextmanager
+async def open_mcp_session(server_name: str, server_config: Dict[str, Any]):
+    """
+    连接MCP服务器并加载工具（工具定义优先取自工具目录缓存），退出时关闭会话
+    工具调用带有熔断检查和超时，避免Agent在故障服务器上反复等待
+    """
+    client = MultiServerMCPClient({server_name: server_config})
+    async with client.session(server_name) as session:
+        tool_definitions = await mcp_tool_catalog.get_tools(server_name, server_config, session=session)
+        yield [guard_mcp_tool(convert_mcp_tool_to_langchain_tool(session, tool), server_name)
+               for tool in tool_definitions]
 
-    async def refresh_session(self, server_name: str) -> List[BaseTool]:
-        """刷新指定服务器的会话（用于错误恢复）"""
-        logger.info(f"Refreshing session for server: {server_name}")
 
-        # 先关闭现有会话
-        if server_name in self.sessions:
-            await self._close_single_session(server_name)
+class MCPUserSession:
+    """
+    单个所有者在单个MCP服务器上的持久会话
+    会话在独立的后台任务中打开和关闭，保证MCP客户端的上下文在同一个任务中进入和退出
+    """
 
-        # 重新创建会话
-        return await self.get_persistent_tools(server_name)
+    def __init__(self, server_name: str, server_config: Dict[str, Any], owner: str, user_id: Optional[str],
+                 opener: Callable):
+        self.server_name = server_name
+        self.server_config = server_config
+        self.owner = owner
+        self.user_id = user_id
+        self.refcount = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.tools: List[BaseTool] = []
+        self._opener = opener
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._close_event: Optional[asyncio.Event] = None
+
+    @property
+    def started(self) -> bool:
+        return self._ready is not None
+
+    @property
+    def closed(self) -> bool:
+        return self._task is not None and self._task.done()
+
+    def idle_seconds(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - self.last_used
+
+    async def ensure_started(self) -> List[BaseTool]:
+        """打开会话（并发调用共享同一次连接）"""
+        if self._ready is None:
+            self._loop = asyncio.get_running_loop()
+            self._ready = self._loop.create_future()
+            # 等待方可能已超时离开，标记异常已读取，避免"Future exception was never retrieved"
+            self._ready.add_done_callback(lambda future: future.cancelled() or future.exception())
+            self._close_event = asyncio.Event()
+            self._task = self._loop.create_task(self._run(), name=f"mcp-session-{self.server_name}-{self.owner}")
+        self.tools = await asyncio.shield(self._ready)
+        return self.tools
+
+    async def _run(self):
+        try:
+            async with self._opener(self.server_name, self.server_config) as tools:
+                logger.info(f"Created MCP session for server {self.server_name}, owner {self.owner} "
+                            f"with {len(tools)} tools")
+                self._ready.set_result(tools)
+                await self._close_event.wait()
+        except Exception as e:
+            if not self._ready.done():
+                self._ready.set_exception(e)
+            else:
+                logger.warning(f"MCP session for server {self.server_name}, owner {self.owner} ended: {e}")
+        finally:
+            # 连接被中止（如超时取消）时通知所有等待方
+            if not self._ready.done():
+                self._ready.set_exception(ConnectionError(f"MCP session for {self.server_name} aborted"))
+
+    def abort(self):
+        """中止尚未完成的连接"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def close(self, timeout: float = 10):
+        """关闭会话；会话属于其他事件循环时只通知其关闭"""
+        if self._task is None or self._task.done():
+            return
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
 
-    async def _close_single_session(self, server_name: str):
-        """关闭单个会话"""
-        if server_name in self.sessions:
-            session_info = self.sessions[server_name]
+        if current_loop is self._loop:
+            self._close_event.set()
             try:
-                await session_info['context'].__aexit__(None, None, None)
-                logger.info(f"Closed session for {server_name}")
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
             except Exception as e:
-                logger.error(f"Error closing session for {server_name}: {e}")
-            finally:
-                del self.sessions[server_name]
-                if server_name in self.tools_cache:
-                    del self.tools_cache[server_name]
-
-    async def close_sessions(self):
-        """关闭所有持久会话"""
-        if self._closed:
+                logger.error(f"Error closing MCP session for {self.server_name}, owner {self.owner}: {e}")
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._close_event.set)
+        logger.info(f"Closed MCP session for server {self.server_name}, owner {self.owner}")
+
+    def info(self, now: Optional[float] = None) -> Dict[str, Any]:
+        return {
+            'server': self.server_name,
+            'owner': self.owner,
+            'user_id': self.user_id,
+            'refcount': self.refcount,
+            'tools': len(self.tools),
+            'idle_seconds': round(self.idle_seconds(now), 1),
+            'age_seconds': round((now or time.monotonic()) - self.created_at, 1),
+        }
+
+
+class MCPServerPool:
+    """单个MCP服务器的会话池，按所有者隔离会话"""
+
+    def __init__(self, server_key: str, server_name: str, server_config: Dict[str, Any]):
+        self.server_key = server_key
+        self.server_name = server_name
+        self.server_config = server_config
+        self.sessions: "OrderedDict[str, MCPUserSession]" = OrderedDict()  # owner -> session
+
+
+class MCPSessionLease:
+    """一次对话轮次对一组MCP会话的租约，释放前会话不会被回收"""
+
+    def __init__(self, sessions: List[MCPUserSession], warnings: Optional[List[str]] = None):
+        self.sessions = sessions
+        self.tools: List[BaseTool] = [tool for session in sessions for tool in session.tools]
+        self.warnings: List[str] = warnings or []  # 不可用服务器的提示信息
+        # 工具目录版本，工具列表变化时改变，可作为Agent图缓存的键
+        self.catalog_version = mcp_tool_catalog.catalog_version(
+            [(session.server_name, session.server_config) for session in sessions]
+        )
+        self._released = False
+
+    def release(self):
+        if self._released:
             return
-
-        logger.info("Closing all persistent MCP sessions...")
-
-        for server_name in list(self.sessions.keys()):
-            await self._close_single_session(server_name)
-
-        self._closed = True
-        logger.info("All MCP sessions closed")
-
-    def _cleanup_sync(self):
-        """同步清理函数（用于atexit）"""
-        if not self._closed and self.sessions:
-            logger.warning("Cleaning up unclosed MCP sessions...")
-            # 在同步上下文中无法直接调用异步函数
-            # 这里只是记录警告，实际清理需要在异步上下文中进行
-
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.close_sessions()
-
-    def __del__(self):
-        if not self._closed and self.sessions:
-            logger.warning(f"PersistentMCPClient was not properly closed. {len(self.sessions)} sessions may leak.")
+        self._released = True
+        now = time.monotonic()
+        for session in self.sessions:
+            session.refcount = max(0, session.refcount - 1)
+            session.last_used = now
 
 
 class GlobalMCPSessionManager:
     """
     全局MCP会话管理器
     在Django应用中管理所有MCP会话
-    支持跨对话轮次的浏览器状态保持
+    支持跨对话轮次的浏览器状态保持，并按用户和项目隔离会话
     """
-    _instance = None
-    _lock = asyncio.Lock()
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
-
-    def __init__(self):
-        if not self._initialized:
-            self.clients = {}  # config_hash -> PersistentMCPClient
-            self.session_contexts = {}  # user_project_key -> session_context
-            self._initialized = True
-
-    async def get_persistent_client(self, server_configs: Dict[str, Any]) -> PersistentMCPClient:
-        """获取或创建持久化客户端"""
-        config_hash = hash(str(sorted(server_configs.items())))
-
-        async with self._lock:
-            if config_hash not in self.clients:
-                logger.info(f"Creating new persistent MCP client for config hash: {config_hash}")
-                client = PersistentMCPClient(server_configs)
-                self.clients[config_hash] = client
-
-            return self.clients[config_hash]
+    def __init__(self, opener: Callable = open_mcp_session):
+        self.opener = opener
+        self.pools: Dict[str, MCPServerPool] = {}  # server_key -> MCPServerPool
+        self._lock = threading.Lock()
+        self._reaper_task: Optional[asyncio.Task] = None
+
+    # --- 配置 ---
+    @property
+    def idle_ttl(self) -> float:
+        return getattr(settings, 'MCP_SESSION_IDLE_TTL', 1800)
+
+    @property
+    def max_sessions_per_server(self) -> int:
+        return getattr(settings, 'MCP_MAX_SESSIONS_PER_SERVER', 50)
+
+    @property
+    def max_sessions_per_user(self) -> int:
+        return getattr(settings, 'MCP_MAX_SESSIONS_PER_USER', 5)
+
+    @property
+    def connect_timeout(self) -> float:
+        return getattr(settings, 'MCP_CONNECT_TIMEOUT', 15)
+
+    @property
+    def reap_interval(self) -> float:
+        return getattr(settings, 'MCP_SESSION_REAP_INTERVAL', 60)
+
+    # --- 会话获取 ---
+    def _iter_sessions(self):
+        for pool in self.pools.values():
+            yield from pool.sessions.values()
+
+    @staticmethod
+    def _pick_idle(sessions) -> Optional[MCPUserSession]:
+        idle = [session for session in sessions if session.refcount == 0]
+        return min(idle, key=lambda session: session.last_used) if idle else None
+
+    def _remove(self, session: MCPUserSession):
+        pool = self.pools.get(get_server_key(session.server_name, session.server_config))
+        if pool and pool.sessions.get(session.owner) is session:
+            del pool.sessions[session.owner]
+
+    def _checkout(self, server_name: str, server_config: Dict[str, Any], owner: str,
+                  user_id: Optional[str]) -> Tuple[MCPUserSession, List[MCPUserSession]]:
+        """在锁内取得（或创建）会话并增加引用计数，返回会话和需要关闭的被淘汰会话"""
+        evicted = []
+        server_key = get_server_key(server_name, server_config)
+        with self._lock:
+            pool = self.pools.get(server_key)
+            if pool is None:
+                pool = self.pools[server_key] = MCPServerPool(server_key, server_name, server_config)
+
+            session = pool.sessions.get(owner)
+            if session is not None and session.closed:
+                # 连接已断开（如服务器重启），重新创建
+                del pool.sessions[owner]
+                session = None
+
+            if session is None:
+                if len(pool.sessions) >= self.max_sessions_per_server:
+                    victim = self._pick_idle(pool.sessions.values())
+                    if victim is None:
+                        raise MCPSessionLimitError(
+                            f"MCP server {server_name} reached {self.max_sessions_per_server} sessions, all in use")
+                    self._remove(victim)
+                    evicted.append(victim)
+                if user_id is not None:
+                    user_sessions = [s for s in self._iter_sessions() if s.user_id == user_id]
+                    if len(user_sessions) >= self.max_sessions_per_user:
+                        victim = self._pick_idle(user_sessions)
+                        if victim is None:
+                            raise MCPSessionLimitError(
+                                f"User {user_id} reached {self.max_sessions_per_user} MCP sessions, all in use")
+                        self._remove(victim)
+                        evicted.append(victim)
+                session = MCPUserSession(server_name, server_config, owner, user_id, self.opener)
+                pool.sessions[owner] = session
+
+            pool.sessions.move_to_end(owner)
+            session.refcount += 1
+            session.last_used = time.monotonic()
+        return session, evicted
+
+    async def _start_session(self, server_name: str, server_config: Dict[str, Any], owner: str,
+                             user_id: Optional[str]) -> MCPUserSession:
+        """
+        取得会话并等待连接和工具加载完成，超时或失败时释放引用并移出会话池
+        服务器熔断期间直接跳过；只有真正发起连接时才占用半开探测名额，并将连接结果计入健康统计，
+        复用已连接的会话不占用名额（由首次工具调用作为探测）
+        """
+        if not mcp_health_tracker.is_available(server_name):
+            raise MCPCircuitOpenError(
+                f"circuit open, retry in {mcp_health_tracker.retry_after(server_name):.0f}s")
+
+        session, evicted = self._checkout(server_name, server_config, owner, user_id)
+        for victim in evicted:
+            logger.info(f"Evicting idle MCP session {victim.server_name}/{victim.owner} (session limit reached)")
+            await victim.close()
+
+        connecting = not session.started
+        if connecting and not mcp_health_tracker.allow_request(server_name):
+            # 其他请求正在探测该服务器
+            with self._lock:
+                session.refcount = max(0, session.refcount - 1)
+                abandoned = session.refcount == 0
+                if abandoned:
+                    self._remove(session)
+            if abandoned:
+                session.abort()
+            raise MCPCircuitOpenError(
+                f"circuit open, retry in {mcp_health_tracker.retry_after(server_name):.0f}s")
+
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(session.ensure_started(), self.connect_timeout or None)
+            if connecting:
+                mcp_health_tracker.record_success(server_name, (time.monotonic() - started_at) * 1000)
+        except BaseException as e:
+            if connecting and isinstance(e, Exception):
+                reason = "connect timed out" if isinstance(e, asyncio.TimeoutError) else describe_error(e)
+                mcp_health_tracker.record_failure(server_name, (time.monotonic() - started_at) * 1000, reason)
+            elif connecting:
+                mcp_health_tracker.release_probe(server_name)
+            with self._lock:
+                session.refcount = max(0, session.refcount - 1)
+                self._remove(session)
+                abandoned = session.refcount == 0
+            if abandoned:
+                session.abort()
+            raise
+        return session
+
+    async def acquire_tools(self, server_configs: Dict[str, Any],
+                            user_id: str = None, project_id: str = None) -> MCPSessionLease:
+        """
+        为用户项目获取各服务器的会话工具，返回租约
+        调用方在对话轮次结束后必须调用 lease.release()
+        各服务器并发连接，每个服务器单独超时（MCP_CONNECT_TIMEOUT）；
+        失败的服务器不影响其他服务器，失败信息记录在 lease.warnings 中
+        """
+        self._ensure_reaper()
+        owner = f"{user_id}_{project_id}" if user_id and project_id else SHARED_OWNER
+        server_names = list(server_configs.keys())
+        results = await asyncio.gather(
+            *(self._start_session(name, server_configs[name], owner, user_id) for name in server_names),
+            return_exceptions=True,
+        )
+
+        sessions, warnings = [], []
+        for server_name, result in zip(server_names, results):
+            if isinstance(result, BaseException):
+                if isinstance(result, asyncio.TimeoutError):
+                    reason = f"timed out after {self.connect_timeout}s"
+                else:
+                    reason = describe_error(result)
+                logger.error(f"Failed to get tools from server {server_name}: {reason}")
+                warnings.append(f"MCP server {server_name} unavailable: {reason}")
+            else:
+                sessions.append(result)
+
+        lease = MCPSessionLease(sessions, warnings)
+        logger.info(f"Total persistent tools loaded for {owner}: {len(lease.tools)} "
+                    f"({len(sessions)}/{len(server_names)} servers)")
+        return lease
 
     async def get_tools_for_config(self, server_configs: Dict[str, Any],
                                    user_id: str = None, project_id: str = None) -> List[BaseTool]:
         """
-        根据配置获取工具
-        支持用户和项目级别的会话隔离
+        根据配置获取工具（不持有租约，会话保留到空闲超时）
+        对话轮次中应使用 acquire_tools，避免会话在使用中被淘汰
         """
-        client = await self.get_persistent_client(server_configs)
-        tools = await client.get_all_persistent_tools()
-
-        # 如果提供了用户和项目信息，记录会话上下文
-        if user_id and project_id:
-            session_key = f"{user_id}_{project_id}"
-            self.session_contexts[session_key] = {
-                'config_hash': hash(str(sorted(server_configs.items()))),
-                'client': client,
-                'last_used': asyncio.get_event_loop().time()
-            }
-            logger.info(f"Recorded session context for user {user_id}, project {project_id}")
+        lease = await self.acquire_tools(server_configs, user_id, project_id)
+        lease.release()
+        return lease.tools
+
+    # --- 回收与清理 ---
+    def _ensure_reaper(self):
+        loop = asyncio.get_running_loop()
+        if self._reaper_task is not None and not self._reaper_task.done() \
+                and self._reaper_task.get_loop() is loop:
+            return
+        self._reaper_task = loop.create_task(self._reap_loop(), name="mcp-session-reaper")
 
-        return tools
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap_idle_sessions()
+            except Exception as e:
+                logger.error(f"MCP session reaper failed: {e}", exc_info=True)
+
+    async def reap_idle_sessions(self, now: Optional[float] = None) -> int:
+        """关闭空闲超过TTL或已断开的会话，返回关闭数量"""
+        now = now or time.monotonic()
+        with self._lock:
+            victims = [
+                session for session in self._iter_sessions()
+                if session.closed or (session.refcount == 0 and session.idle_seconds(now) > self.idle_ttl)
+            ]
+            for session in victims:
+                self._remove(session)
+            for server_key in [key for key, pool in self.pools.items() if not pool.sessions]:
+                del self.pools[server_key]
+
+        for session in victims:
+            await session.close()
+        if victims:
+            logger.info(f"Reaped {len(victims)} idle MCP sessions")
+        return len(victims)
+
+    def list_sessions(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [session.info(now) for session in self._iter_sessions()]
 
     async def get_session_context(self, user_id: str, project_id: str) -> Optional[Dict[str, Any]]:
-        """获取用户项目的会话上下文"""
-        session_key = f"{user_id}_{project_id}"
-        return self.session_contexts.get(session_key)
+        """获取用户项目的会话信息"""
+        owner = f"{user_id}_{project_id}"
+        sessions = [info for info in self.list_sessions() if info['owner'] == owner]
+        return {'owner': owner, 'sessions': sessions} if sessions else None
 
     async def cleanup_all(self):
-        """清理所有客户端"""
+        """清理所有会话"""
         logger.info("Cleaning up all MCP clients...")
-
-        for config_hash, client in self.clients.items():
-            try:
-                await client.close_sessions()
-            except Exception as e:
-                logger.error(f"Error cleaning up client {config_hash}: {e}")
-
-        self.clients.clear()
-        self.session_contexts.clear()
+        with self._lock:
+            sessions = list(self._iter_sessions())
+            self.pools.clear()
+
+        for session in sessions:
+            await session.close()
+        if self._reaper_task is not None and not self._reaper_task.done():
+            self._reaper_task.cancel()
         logger.info("All MCP clients and session contexts cleaned up")
 
     async def cleanup_user_session(self, user_id: str, project_id: str):
-        """清理特定用户项目的会话"""
-        session_key = f"{user_id}_{project_id}"
-        if session_key in self.session_contexts:
-            context = self.session_contexts[session_key]
-            try:
-                client = context['client']
-                await client.close_sessions()
-                logger.info(f"Cleaned up session for user {user_id}, project {project_id}")
-            except Exception as e:
-                logger.error(f"Error cleaning up session for {session_key}: {e}")
-            finally:
-                del self.session_contexts[session_key]
+        """清理特定用户项目的会话，不影响其他用户"""
+        owner = f"{user_id}_{project_id}"
+        with self._lock:
+            sessions = [session for session in self._iter_sessions() if session.owner == owner]
+            for session in sessions:
+                self._remove(session)
+
+        for session in sessions:
+            await session.close()
+        logger.info(f"Cleaned up {len(sessions)} sessions for user {user_id}, project {project_id}")
 
 
 # 全局会话管理器实例
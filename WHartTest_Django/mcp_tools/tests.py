@@ -1,3 +1,334 @@
-from django.test import TestCase
+import asyncio
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import uvicorn
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, override_settings
+from langchain_core.tools import ToolException
+from mcp.server.fastmcp import FastMCP
+from mcp.types import ListToolsResult, Tool
+from starlette.responses import PlainTextResponse
+
+from .health import CIRCUIT_CLOSED, CIRCUIT_OPEN, mcp_health_tracker
+from .persistent_client import GlobalMCPSessionManager
+from .tool_catalog import MCPToolCatalog
+
+
+class FakeMCPServer:
+    """模拟MCP服务器：记录打开和关闭的会话"""
+
+    def __init__(self):
+        self.opened = []
+        self.closed = []
+
+    @asynccontextmanager
+    async def open_session(self, server_name, server_config):
+        session_no = len(self.opened) + 1
+        self.opened.append(server_name)
+        if server_config.get("delay"):
+            await asyncio.sleep(server_config["delay"])
+        if server_config.get("fail"):
+            raise ConnectionError("connection refused")
+        try:
+            yield [SimpleNamespace(name=f"{server_name}_tool_{session_no}")]
+        finally:
+            self.closed.append(server_name)
+
+
+SERVERS = {"playwright": {"url": "http://mcp.local/mcp", "transport": "streamable_http"}}
+
+
+class MCPSessionManagerTests(SimpleTestCase):
+    """MCP会话隔离、上限与回收测试"""
+
+    def setUp(self):
+        mcp_health_tracker.reset()
+        self.server = FakeMCPServer()
+        self.manager = GlobalMCPSessionManager(opener=self.server.open_session)
+
+    def test_sessions_are_isolated_per_user_and_cleanup_is_scoped(self):
+        async def run():
+            lease_a = await self.manager.acquire_tools(SERVERS, user_id="1", project_id="1")
+            lease_b = await self.manager.acquire_tools(SERVERS, user_id="2", project_id="1")
+            again_a = await self.manager.acquire_tools(SERVERS, user_id="1", project_id="1")
+            for lease in (lease_a, lease_b, again_a):
+                lease.release()
+            await self.manager.cleanup_user_session("1", "1")
+            owners = [info["owner"] for info in self.manager.list_sessions()]
+            await self.manager.cleanup_all()
+            return lease_a, lease_b, again_a, owners
+
+        lease_a, lease_b, again_a, owners = async_to_sync(run)()
+        self.assertEqual(len(self.server.opened), 2)
+        self.assertNotEqual(lease_a.tools[0].name, lease_b.tools[0].name)
+        self.assertIs(again_a.tools[0], lease_a.tools[0])
+        self.assertEqual(owners, ["2_1"])
+        self.assertEqual(len(self.server.closed), 2)
+
+    @override_settings(MCP_MAX_SESSIONS_PER_SERVER=2, MCP_SESSION_IDLE_TTL=60)
+    def test_limits_evict_idle_sessions_and_reaper_skips_leased(self):
+        async def run():
+            first = await self.manager.acquire_tools(SERVERS, user_id="1", project_id="1")
+            first.release()
+            held = await self.manager.acquire_tools(SERVERS, user_id="2", project_id="1")
+            # 达到服务器上限：淘汰最久未使用的空闲会话（用户1）
+            third = await self.manager.acquire_tools(SERVERS, user_id="3", project_id="1")
+            owners_after_evict = sorted(info["owner"] for info in self.manager.list_sessions())
+            # 所有会话都在使用中时拒绝新会话
+            rejected = await self.manager.acquire_tools(SERVERS, user_id="4", project_id="1")
+            third.release()
+
+            reaped = await self.manager.reap_idle_sessions(now=time.monotonic() + 120)
+            remaining = [info["owner"] for info in self.manager.list_sessions()]
+            held.release()
+            await self.manager.cleanup_all()
+            return owners_after_evict, rejected, reaped, remaining
+
+        owners_after_evict, rejected, reaped, remaining = async_to_sync(run)()
+        self.assertEqual(owners_after_evict, ["2_1", "3_1"])
+        self.assertEqual(rejected.tools, [])
+        self.assertEqual(reaped, 1)
+        self.assertEqual(remaining, ["2_1"])
+        self.assertEqual(len(self.server.closed), 3)
+
+    @override_settings(MCP_CONNECT_TIMEOUT=0.3)
+    def test_servers_connect_concurrently_with_partial_results(self):
+        servers = {
+            "slow_a": {"url": "http://a.local/mcp", "delay": 0.1},
+            "slow_b": {"url": "http://b.local/mcp", "delay": 0.1},
+            "dead": {"url": "http://dead.local/mcp", "fail": True},
+            "hung": {"url": "http://hung.local/mcp", "delay": 5},
+        }
+
+        async def run():
+            started = time.monotonic()
+            lease = await self.manager.acquire_tools(servers, user_id="1", project_id="1")
+            elapsed = time.monotonic() - started
+            owners = sorted(info["server"] for info in self.manager.list_sessions())
+            lease.release()
+            await self.manager.cleanup_all()
+            return lease, elapsed, owners
+
+        lease, elapsed, servers_open = async_to_sync(run)()
+        self.assertLess(elapsed, 1)
+        self.assertEqual(sorted(tool.name.rsplit("_tool_", 1)[0] for tool in lease.tools), ["slow_a", "slow_b"])
+        self.assertEqual(len(lease.warnings), 2)
+        self.assertIn("timed out", next(w for w in lease.warnings if "hung" in w))
+        self.assertEqual(servers_open, ["slow_a", "slow_b"])
+
+
+class FakeToolSession:
+    """分两页返回工具定义的MCP会话"""
+
+    def __init__(self, names):
+        self.names = names
+        self.list_calls = 0
+
+    async def list_tools(self, cursor=None):
+        self.list_calls += 1
+        tools = [Tool(name=name, inputSchema={"type": "object"}) for name in self.names]
+        if cursor is None:
+            return ListToolsResult(tools=tools[:1], nextCursor="page-2")
+        return ListToolsResult(tools=tools[1:])
+
+
+class MCPToolCatalogTests(SimpleTestCase):
+    """MCP工具目录缓存测试"""
+
+    def test_catalog_caches_tools_and_bumps_version_on_change(self):
+        catalog = MCPToolCatalog()
+        config = SERVERS["playwright"]
+        session = FakeToolSession(["navigate", "click"])
+
+        async def run():
+            first = await catalog.get_tools("playwright", config, session=session)
+            cached = await catalog.get_tools("playwright", config, session=session)
+            version_before = catalog.catalog_version([("playwright", config)])
+            catalog.update("playwright", config, list(first))  # 内容未变化
+            unchanged_version = catalog.get_entry("playwright", config).version
+
+            # 过期后返回旧目录，并在后台刷新为新的工具列表
+            catalog.get_entry("playwright", config).fetched_at -= 1000
+            refreshed_tools = [Tool(name="navigate", inputSchema={"type": "object"})]
+            with mock.patch.object(catalog, "refresh",
+                                   side_effect=lambda name, cfg: catalog.update(name, cfg, refreshed_tools)) as refresh:
+                stale = await catalog.get_tools("playwright", config)
+                catalog.get_entry("playwright", config).refresh_thread.join(timeout=5)
+            return first, cached, stale, version_before, unchanged_version, refresh.call_count
+
+        first, cached, stale, version_before, unchanged_version, refresh_calls = async_to_sync(run)()
+        self.assertEqual([tool.name for tool in first], ["navigate", "click"])
+        self.assertEqual(session.list_calls, 2)  # 仅首次获取（两页）
+        self.assertIs(cached, first)
+        self.assertEqual(unchanged_version, 1)
+        self.assertEqual([tool.name for tool in stale], ["navigate", "click"])
+        self.assertEqual(refresh_calls, 1)
+        entry = catalog.get_entry("playwright", config)
+        self.assertEqual((entry.version, [tool.name for tool in entry.tools]), (2, ["navigate"]))
+        self.assertNotEqual(catalog.catalog_version([("playwright", config)]), version_before)
+
+    def test_background_refresh_outlives_request_loop(self):
+        catalog = MCPToolCatalog()
+        config = SERVERS["playwright"]
+        catalog.update("playwright", config, [Tool(name="navigate", inputSchema={"type": "object"})])
+        catalog.get_entry("playwright", config).fetched_at -= 1000
+        refreshed_tools = [Tool(name="navigate", inputSchema={"type": "object"}),
+                           Tool(name="click", inputSchema={"type": "object"})]
+
+        async def slow_refresh(name, cfg):
+            await asyncio.sleep(0.2)
+            return catalog.update(name, cfg, refreshed_tools)
+
+        with mock.patch.object(catalog, "refresh", side_effect=slow_refresh):
+            # 请求的事件循环在刷新完成前结束
+            stale = async_to_sync(catalog.get_tools)("playwright", config)
+            catalog.get_entry("playwright", config).refresh_thread.join(timeout=5)
+
+        self.assertEqual([tool.name for tool in stale], ["navigate"])
+        entry = catalog.get_entry("playwright", config)
+        self.assertEqual((entry.version, [tool.name for tool in entry.tools]), (2, ["navigate", "click"]))
+
+
+class FakeRemoteMCPServer:
+    """本地运行的真实MCP服务器（streamable HTTP），可切换为宕机（503）或工具调用卡住"""
+
+    def __init__(self):
+        self.down = False
+        self.hang = False
+        mcp = FastMCP("fake", host="127.0.0.1")
+
+        @mcp.tool()
+        async def echo(text: str) -> str:
+            """Echo text back"""
+            while self.hang:
+                await asyncio.sleep(0.05)
+            return f"echo: {text}"
+
+        inner_app = mcp.streamable_http_app()
+
+        async def app(scope, receive, send):
+            if scope["type"] == "http" and self.down:
+                await PlainTextResponse("down", status_code=503)(scope, receive, send)
+                return
+            await inner_app(scope, receive, send)
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def config(self):
+        return {"url": f"http://127.0.0.1:{self.port}/mcp", "transport": "streamable_http"}
+
+    def start(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.05)
+
+    def stop(self):
+        self.hang = False
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+@override_settings(MCP_TOOL_CALL_TIMEOUT=0.3, MCP_CIRCUIT_FAILURE_THRESHOLD=2, MCP_CIRCUIT_COOLDOWN=0.5,
+                   MCP_CONNECT_TIMEOUT=5)
+class MCPCircuitBreakerTests(SimpleTestCase):
+    """MCP服务器熔断测试（基于本地MCP服务器）"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.remote = FakeRemoteMCPServer()
+        cls.remote.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.remote.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        mcp_health_tracker.reset()
+
+    def test_failing_server_is_dropped_until_probe_succeeds(self):
+        manager = GlobalMCPSessionManager()
+        servers = {"fake": self.remote.config}
+
+        async def run():
+            results = {}
+            lease = await manager.acquire_tools(servers, user_id="1", project_id="1")
+            echo = lease.tools[0]
+            results["ok"] = await echo.ainvoke({"text": "hi"})
+
+            # 工具调用卡住：超时两次后熔断，之后的调用立即失败
+            self.remote.hang = True
+            for _ in range(2):
+                with self.assertRaisesRegex(ToolException, "timed out"):
+                    await echo.ainvoke({"text": "hi"})
+            started = time.monotonic()
+            with self.assertRaisesRegex(ToolException, "circuit open"):
+                await echo.ainvoke({"text": "hi"})
+            results["fail_fast"] = time.monotonic() - started
+            self.remote.hang = False
+            results["open_lease"] = await manager.acquire_tools(servers, user_id="2", project_id="1")
+
+            # 冷却后半开探测：服务器宕机则重新熔断
+            self.remote.down = True
+            await asyncio.sleep(0.6)
+            results["probe_failed"] = await manager.acquire_tools(servers, user_id="3", project_id="1")
+            results["state_after_failed_probe"] = mcp_health_tracker.status()[0]["state"]
+
+            # 服务器恢复后探测成功，工具重新可用
+            self.remote.down = False
+            await asyncio.sleep(0.6)
+            results["recovered"] = await manager.acquire_tools(servers, user_id="4", project_id="1")
+            results["status"] = mcp_health_tracker.status()[0]
+            for item in (lease, results["open_lease"], results["probe_failed"], results["recovered"]):
+                item.release()
+            await manager.cleanup_all()
+            return results
+
+        results = async_to_sync(run)()
+        self.assertIn("echo: hi", str(results["ok"]))
+        self.assertLess(results["fail_fast"], 0.1)
+        self.assertEqual(results["open_lease"].tools, [])
+        self.assertIn("circuit open", results["open_lease"].warnings[0])
+        self.assertEqual(results["probe_failed"].tools, [])
+        self.assertEqual(results["state_after_failed_probe"], CIRCUIT_OPEN)
+        self.assertEqual([tool.name for tool in results["recovered"].tools], ["echo"])
+        self.assertEqual(results["status"]["state"], CIRCUIT_CLOSED)
+        self.assertEqual(results["status"]["total_failures"], 3)
+
+    def test_reused_session_after_cooldown_lets_first_tool_call_probe(self):
+        manager = GlobalMCPSessionManager()
+        servers = {"fake": self.remote.config}
+
+        async def run():
+            lease = await manager.acquire_tools(servers, user_id="1", project_id="1")
+            self.remote.hang = True
+            for _ in range(2):
+                with self.assertRaisesRegex(ToolException, "timed out"):
+                    await lease.tools[0].ainvoke({"text": "hi"})
+            self.remote.hang = False
+            lease.release()
+
+            # 冷却后复用已连接的会话：不占用探测名额，首次工具调用作为探测
+            await asyncio.sleep(0.6)
+            reused = await manager.acquire_tools(servers, user_id="1", project_id="1")
+            result = await reused.tools[0].ainvoke({"text": "again"})
+            status = mcp_health_tracker.status()[0]
+            reused.release()
+            await manager.cleanup_all()
+            return reused, result, status
+
+        reused, result, status = async_to_sync(run)()
+        self.assertEqual([tool.name for tool in reused.tools], ["echo"])
+        self.assertIn("echo: again", str(result))
+        self.assertEqual(status["state"], CIRCUIT_CLOSED)
@@ -0,0 +1,160 @@
+"""
+MCP工具目录缓存
+缓存每个MCP服务器的工具列表与参数schema，带TTL和内容哈希：
+- 新建会话时直接用缓存的工具定义构建LangChain工具，不再每次调用 list_tools
+- 缓存过期后先返回旧目录，同时在后台线程（独立事件循环，不依赖请求的事件循环）中刷新；工具列表内容变化时版本号加一，
+  Agent图等上层缓存可以用 catalog_version 作为键
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from mcp.types import Tool
+
+logger = logging.getLogger(__name__)
+
+
+def get_server_key(server_name: str, server_config: Dict[str, Any]) -> str:
+    return f"{server_name}:{json.dumps(server_config, sort_keys=True, default=str)}"
+
+
+async def list_all_tools(session) -> List[Tool]:
+    """分页获取MCP服务器的全部工具定义"""
+    tools: List[Tool] = []
+    cursor = None
+    while True:
+        result = await session.list_tools(cursor=cursor)
+        tools.extend(result.tools)
+        cursor = result.nextCursor
+        if not cursor:
+            return tools
+
+
+def compute_tools_hash(tools: List[Tool]) -> str:
+    payload = [tool.model_dump(mode='json', exclude_none=True) for tool in sorted(tools, key=lambda t: t.name)]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class ToolCatalogEntry:
+    """单个MCP服务器的工具目录"""
+
+    def __init__(self, server_name: str):
+        self.server_name = server_name
+        self.tools: List[Tool] = []
+        self.content_hash = ''
+        self.version = 0
+        self.fetched_at = 0.0
+        self.refresh_thread: Optional[threading.Thread] = None
+
+    def age(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - self.fetched_at
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'server': self.server_name,
+            'version': self.version,
+            'hash': self.content_hash,
+            'tools': [tool.name for tool in self.tools],
+            'age_seconds': round(self.age(), 1),
+        }
+
+
+class MCPToolCatalog:
+    """进程内的MCP工具目录缓存"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, ToolCatalogEntry] = {}  # server_key -> entry
+
+    @property
+    def ttl(self) -> float:
+        return getattr(settings, 'MCP_TOOL_CATALOG_TTL', 300)
+
+    def get_entry(self, server_name: str, server_config: Dict[str, Any]) -> Optional[ToolCatalogEntry]:
+        with self._lock:
+            entry = self._entries.get(get_server_key(server_name, server_config))
+        return entry if entry and entry.fetched_at else None
+
+    def update(self, server_name: str, server_config: Dict[str, Any], tools: List[Tool]) -> ToolCatalogEntry:
+        """写入最新的工具列表，内容变化时版本号加一"""
+        content_hash = compute_tools_hash(tools)
+        server_key = get_server_key(server_name, server_config)
+        with self._lock:
+            entry = self._entries.get(server_key)
+            if entry is None:
+                entry = self._entries[server_key] = ToolCatalogEntry(server_name)
+            if content_hash != entry.content_hash:
+                entry.version += 1
+                entry.content_hash = content_hash
+                logger.info(f"MCP tool catalog for {server_name} changed: version {entry.version}, {len(tools)} tools")
+            entry.tools = list(tools)
+            entry.fetched_at = time.monotonic()
+        return entry
+
+    async def refresh(self, server_name: str, server_config: Dict[str, Any]) -> ToolCatalogEntry:
+        """使用临时会话重新获取工具列表"""
+        client = MultiServerMCPClient({server_name: server_config})
+        async with client.session(server_name) as session:
+            tools = await list_all_tools(session)
+        return self.update(server_name, server_config, tools)
+
+    def _schedule_refresh(self, entry: ToolCatalogEntry, server_name: str, server_config: Dict[str, Any]):
+        """
+        在后台线程的独立事件循环中刷新工具目录
+        请求的事件循环（async_to_sync或WSGI下）在请求结束后即关闭，不能承载后台任务
+        """
+        with self._lock:
+            if entry.refresh_thread is not None and entry.refresh_thread.is_alive():
+                return
+
+            def run():
+                try:
+                    asyncio.run(self.refresh(server_name, server_config))
+                except Exception as e:
+                    logger.warning(f"Background refresh of MCP tool catalog for {server_name} failed: {e}")
+
+            entry.refresh_thread = threading.Thread(target=run, name=f"mcp-catalog-{server_name}", daemon=True)
+            entry.refresh_thread.start()
+
+    async def get_tools(self, server_name: str, server_config: Dict[str, Any], session=None) -> List[Tool]:
+        """
+        获取工具定义：缓存新鲜时直接返回；过期时返回旧目录并在后台刷新；
+        没有缓存时通过session（或临时会话）同步获取
+        """
+        entry = self.get_entry(server_name, server_config)
+        if entry is not None:
+            if entry.age() >= self.ttl:
+                self._schedule_refresh(entry, server_name, server_config)
+            return entry.tools
+
+        if session is not None:
+            return self.update(server_name, server_config, await list_all_tools(session)).tools
+        return (await self.refresh(server_name, server_config)).tools
+
+    def catalog_version(self, servers: List[tuple]) -> str:
+        """多个服务器 (server_name, server_config) 的组合版本，任一服务器工具变化时改变"""
+        parts = []
+        for server_name, server_config in sorted(servers, key=lambda item: item[0]):
+            entry = self.get_entry(server_name, server_config)
+            parts.append(f"{server_name}:{entry.content_hash if entry else ''}")
+        return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()[:16]
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [entry.info() for entry in self._entries.values() if entry.fetched_at]
+
+    def invalidate(self, server_name: Optional[str] = None):
+        with self._lock:
+            for server_key in [key for key, entry in self._entries.items()
+                               if server_name is None or entry.server_name == server_name]:
+                self._entries[server_key].fetched_at = 0.0
+
+
+# 全局工具目录实例
+mcp_tool_catalog = MCPToolCatalog()
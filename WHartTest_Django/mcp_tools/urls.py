@@ -10,6 +10,8 @@ app_name = 'mcp_tools' # Optional: for namespacing URLs if needed later
 urlpatterns = [
     # New URL for pinging Remote MCP Configurations (must be before router.urls to avoid conflict)
     path('remote-configs/ping/', views.RemoteMCPConfigPingView.as_view(), name='remote-mcp-config-ping'),
+    # 远程MCP服务器健康与熔断状态
+    path('remote-configs/health/', views.MCPServerHealthView.as_view(), name='remote-mcp-config-health'),
     # Include router URLs directly for RemoteMCPConfigViewSet
     path('', include(router.urls)),
     # New generic endpoint for calling any registered MCP tool
@@ -14,11 +14,16 @@ from .serializers import RemoteMCPConfigSerializer
 # import urllib.error # No longer needed
 import json
 import asyncio # 确保导入 asyncio
+import time
 import logging # 导入 logging 模块
 # from fastmcp import Client # No longer directly used here
 # from fastmcp.client.transports import StreamableHttpTransport # No longer directly used here
 from langchain_mcp_adapters.client import MultiServerMCPClient # Import LangGraph's MCP client
 from wharttest_django.permissions import HasModelPermission
+from django.conf import settings
+from .health import describe_error, mcp_health_tracker
+from .persistent_client import mcp_session_manager
+from .tool_catalog import mcp_tool_catalog
 
 logger = logging.getLogger(__name__) # 获取 logger 实例
 
@@ -213,16 +218,28 @@ class RemoteMCPConfigPingView(APIView):
 
             logger.info(f"Attempting to connect to MCP server using MultiServerMCPClient with config: {client_config}")
 
-            # Instantiate the MultiServerMCPClient
-            # Note: MultiServerMCPClient itself is not an async context manager.
-            # Its methods like get_tools are async.
+            # 只建立一个会话并发送ping检查连通性；工具列表取自工具目录缓存，缓存缺失时复用该会话获取
             mcp_client = MultiServerMCPClient(client_config)
 
-            # Use get_tools() as a way to "ping" or check connectivity and basic server health.
-            # This will attempt to connect and fetch the list of tools from the /mcp/tools endpoint.
-            tools_list = await mcp_client.get_tools() # This is an async call
+            async def ping_server():
+                async with mcp_client.session(server_config_key) as session:
+                    await session.send_ping()
+                    return await mcp_tool_catalog.get_tools(
+                        server_config_key, client_config[server_config_key], session=session
+                    )
+
+            # 手动ping不受熔断限制，结果计入健康统计，成功时可使熔断的服务器恢复
+            ping_started = time.monotonic()
+            try:
+                tools_list = await asyncio.wait_for(ping_server(), getattr(settings, 'MCP_CONNECT_TIMEOUT', 15) or None)
+            except Exception as e:
+                mcp_health_tracker.record_failure(server_config_key, (time.monotonic() - ping_started) * 1000,
+                                                  describe_error(e))
+                raise
+            mcp_health_tracker.record_success(server_config_key, (time.monotonic() - ping_started) * 1000)
             tools_count = len(tools_list)
-            logger.info(f"Successfully connected to MCP server at {target_mcp_url} and retrieved {tools_count} tools.")
+            catalog_entry = mcp_tool_catalog.get_entry(server_config_key, client_config[server_config_key])
+            logger.info(f"Successfully pinged MCP server at {target_mcp_url} ({tools_count} tools in catalog).")
 
             return Response({
                 "status": "success",
@@ -232,7 +249,8 @@ class RemoteMCPConfigPingView(APIView):
                     "status": "online",
                     "url": target_mcp_url,
                     "tools_count": tools_count,
-                    "tools": [tool.name for tool in tools_list if hasattr(tool, 'name')] # Include names of the tools
+                    "tools": [tool.name for tool in tools_list], # Include names of the tools
+                    "catalog_version": catalog_entry.version if catalog_entry else None,
                 }
             }, status=status.HTTP_200_OK)
 
@@ -254,6 +272,40 @@ class RemoteMCPConfigPingView(APIView):
                 "errors": {"mcp_check": [f"{type(e).__name__}: {str(e)}"]}
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class MCPServerHealthView(APIView):
+    """
+    远程MCP服务器健康状态：熔断状态、滚动窗口内的错误率与耗时、工具目录版本和活跃会话数
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.has_perm('mcp_tools.view_remotemcpconfig'):
+            return Response({
+                "status": "error", "code": status.HTTP_403_FORBIDDEN,
+                "message": "You do not have permission to view MCP server health.",
+                "data": {}, "errors": {"permission": ["mcp_tools.view_remotemcpconfig required"]}
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        sessions = mcp_session_manager.list_sessions()
+        catalogs = {catalog['server']: catalog for catalog in mcp_tool_catalog.stats()}
+        servers = []
+        for health in mcp_health_tracker.status():
+            catalog = catalogs.get(health['server'])
+            servers.append({
+                **health,
+                'active_sessions': sum(1 for session in sessions if session['server'] == health['server']),
+                'catalog_version': catalog['version'] if catalog else None,
+                'tools_count': len(catalog['tools']) if catalog else None,
+            })
+
+        return Response({
+            "status": "success", "code": status.HTTP_200_OK,
+            "message": "MCP server health retrieved successfully.",
+            "data": {"servers": servers, "total_sessions": len(sessions)}
+        }, status=status.HTTP_200_OK)
+
+
 class RemoteMCPConfigViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows Remote MCP Configurations to be viewed or edited.
@@ -6,6 +6,7 @@ from rest_framework import filters
 
 from wharttest_django.viewsets import BaseModelViewSet
 from wharttest_django.permissions import HasModelPermission
+from langgraph_integration.config_cache import chat_config_cache
 from .models import UserPrompt
 from .serializers import (
     UserPromptSerializer,
@@ -158,6 +159,8 @@ class UserPromptViewSet(BaseModelViewSet):
             user=request.user,
             is_default=True
         ).update(is_default=False)
+        # 批量update不会触发模型信号，需要手动使对话配置缓存失效
+        chat_config_cache.invalidate_user_prompts(request.user.id)
 
         return Response({
             "status": "success",
@@ -1,6 +1,34 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+# 启动评审任务看门狗的Web服务进程
+SERVER_COMMANDS = ('runserver', 'gunicorn', 'uvicorn', 'daphne', 'hypercorn')
+
+
+def _command_name(arg: str) -> str:
+    """命令名；python -m gunicorn 等方式启动时 argv[0] 为包内的 __main__.py，取包名"""
+    name = os.path.basename(arg)
+    if name == '__main__.py':
+        name = os.path.basename(os.path.dirname(arg))
+    return name
 
 
 class RequirementsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "requirements"
+
+    def ready(self):
+        """Web服务启动时开启评审任务看门狗，恢复因重启中断的评审；迁移、测试等命令中不启动"""
+        if not getattr(settings, 'REQUIREMENT_REVIEW_JOB_WATCHDOG', True):
+            return
+        if not any(_command_name(arg) in SERVER_COMMANDS for arg in sys.argv[:2]):
+            return
+        # runserver 自动重载时只在实际提供服务的子进程中启动
+        if 'runserver' in sys.argv and '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+            return
+
+        from .review_jobs import review_job_runner
+        review_job_runner.start_watchdog()
@@ -1,9 +1,25 @@
 """
 模型上下文限制配置和检测
+token计数：
+- 编码器按编码名称加载一次，加载失败（如离线环境无法下载编码文件）时记录失败，间隔一段时间后才重试，期间使用快速估算
+- 较长文本的计数结果按 (计数方式, 模型, 内容哈希) 缓存在进程内，文档和模块的计数结果还持久化在数据库中
+- 超长文本在换行处切分为多块，由tiktoken多线程并行编码
+- 快速估算按中日韩字符、英文单词、数字、标点和空白分别计数，误差上限见 REQUIREMENT_TOKEN_ESTIMATE_ERROR，
+  可用 calibrate_token_estimator 命令在实际文档上测量
 """
 
-import tiktoken
+import hashlib
 import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import tiktoken
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
@@ -41,38 +57,163 @@ MODEL_CONTEXT_LIMITS = {
 # 预留token数（用于系统提示词、响应等）
 RESERVED_TOKENS = 1000
 
+# 不少于该字符数的文本缓存计数结果
+TOKEN_CACHE_MIN_CHARS = 2000
+# 进程内缓存的计数结果条数
+TOKEN_CACHE_SIZE = 512
+# 不少于该字符数的文本切分后并行编码
+PARALLEL_COUNT_MIN_CHARS = 200000
+# 并行编码时每块的字符数
+PARALLEL_CHUNK_CHARS = 50000
+# 编码器加载失败后的重试间隔（秒）
+ENCODER_RETRY_SECONDS = 600
+# 快速估算的默认相对误差上限
+DEFAULT_ESTIMATE_ERROR = 0.25
+
+# 快速估算：按 cl100k_base 的预分词规则分类计数
+# 中日韩字符平均约1.2个token；常见英文单词为1个token，超过8个字母的长单词每8个字母多1个；数字每3位1个token；
+# 连续换行、连续空白（缩进）各1个token，单个空格并入后面的单词；其余标点符号每个1个token
+CJK_RUN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+WORD_RE = re.compile(r'[A-Za-z]+')
+DIGITS_RE = re.compile(r'\d+')
+NEWLINE_RUN_RE = re.compile(r'[\r\n]+')
+SPACE_RUN_RE = re.compile(r'[^\S\n]{2,}')
+WHITESPACE_RE = re.compile(r'\s')
+CJK_TOKENS_PER_CHAR = 1.2
+WORD_CHARS_PER_EXTRA_TOKEN = 8
+DIGITS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """快速估算token数，不依赖编码器"""
+    if not text:
+        return 0
+    cjk_chars = sum(map(len, CJK_RUN_RE.findall(text)))
+    words = WORD_RE.findall(text)
+    letters = sum(map(len, words))
+    digit_runs = DIGITS_RE.findall(text)
+    digits = sum(map(len, digit_runs))
+    whitespace = len(WHITESPACE_RE.findall(text))
+    other_chars = max(0, len(text) - cjk_chars - letters - digits - whitespace)
+
+    tokens = cjk_chars * CJK_TOKENS_PER_CHAR
+    tokens += sum(1 + (len(word) - 1) // WORD_CHARS_PER_EXTRA_TOKEN for word in words)
+    tokens += sum(math.ceil(len(run) / DIGITS_PER_TOKEN) for run in digit_runs)
+    tokens += len(NEWLINE_RUN_RE.findall(text)) + len(SPACE_RUN_RE.findall(text))
+    tokens += other_chars
+    return max(1, int(math.ceil(tokens)))
+
+
+def estimate_error_bound() -> float:
+    """快速估算相对tiktoken计数的误差上限"""
+    return getattr(settings, 'REQUIREMENT_TOKEN_ESTIMATE_ERROR', DEFAULT_ESTIMATE_ERROR)
+
+
+def split_at_newlines(text: str, chunk_chars: int) -> List[str]:
+    """
+    在连续换行之后切分文本，每块约 chunk_chars 个字符
+    tiktoken的预分词不会把换行和后面的内容合并为一个词元，在换行之后切分不改变编码结果
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > chunk_chars:
+        end = text.find('\n', start + chunk_chars)
+        if end < 0:
+            break
+        while end < len(text) and text[end] in '\r\n':
+            end += 1
+        chunks.append(text[start:end])
+        start = end
+    chunks.append(text[start:])
+    return chunks
+
+
 class ContextLimitChecker:
     """上下文限制检测器"""
     
     def __init__(self):
         self.encoders = {}
+        self._encodings = {}  # 编码名称 -> 编码器，加载失败时为None
+        self._encoding_failed_at = {}  # 编码名称 -> 上次加载失败的时间
+        self._lock = threading.Lock()
+        self._token_cache = OrderedDict()
     
+    def _load_encoding(self, encoding_name: str):
+        """按名称加载编码器，失败后在重试间隔内直接返回None"""
+        with self._lock:
+            if encoding_name in self._encodings:
+                return self._encodings[encoding_name]
+            failed_at = self._encoding_failed_at.get(encoding_name)
+            if failed_at is not None and time.monotonic() - failed_at < ENCODER_RETRY_SECONDS:
+                return None
+        try:
+            encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logger.warning(f"无法加载编码器 {encoding_name}，{ENCODER_RETRY_SECONDS}秒内使用快速估算token数: {e}")
+            with self._lock:
+                self._encoding_failed_at[encoding_name] = time.monotonic()
+            return None
+        with self._lock:
+            self._encodings[encoding_name] = encoding
+            self._encoding_failed_at.pop(encoding_name, None)
+        return encoding
+
     def get_encoder(self, model_name: str):
-        """获取对应模型的编码器"""
+        """获取对应模型的编码器，编码器不可用时返回None"""
         if model_name not in self.encoders:
-            try:
+            encoding_name = 'cl100k_base'
+            if model_name.startswith('gpt'):
                 # 尝试获取模型特定的编码器
-                if model_name.startswith('gpt'):
-                    self.encoders[model_name] = tiktoken.encoding_for_model(model_name)
-                else:
-                    # 对于其他模型，使用通用编码器
-                    self.encoders[model_name] = tiktoken.get_encoding("cl100k_base")
-            except Exception as e:
-                logger.warning(f"无法获取模型 {model_name} 的编码器，使用默认编码器: {e}")
-                self.encoders[model_name] = tiktoken.get_encoding("cl100k_base")
-        
-        return self.encoders[model_name]
-    
+                try:
+                    encoding_name = tiktoken.encoding_name_for_model(model_name)
+                except KeyError:
+                    logger.warning(f"未知模型 {model_name} 的编码器，使用默认编码器 cl100k_base")
+            self.encoders[model_name] = encoding_name
+
+        return self._load_encoding(self.encoders[model_name])
+
+    def count_method(self, model_name: str) -> str:
+        """当前的计数方式：tiktoken 或 estimate"""
+        return 'tiktoken' if self.get_encoder(model_name) is not None else 'estimate'
+
+    def token_count_key(self, text: str, model_name: str) -> str:
+        """计数结果的缓存键：计数方式、模型和内容的哈希，编码器恢复可用后估算结果自动失效"""
+        digest = hashlib.sha256(f"{self.count_method(model_name)}\x00{model_name}\x00".encode('utf-8'))
+        digest.update((text or '').encode('utf-8'))
+        return digest.hexdigest()
+
     def count_tokens(self, text: str, model_name: str = 'gpt-3.5-turbo') -> int:
-        """计算文本的token数量"""
+        """计算文本的token数量，较长文本的结果按内容哈希缓存"""
+        text = text or ''
+        if len(text) < TOKEN_CACHE_MIN_CHARS:
+            return self._count(text, model_name)
+
+        key = self.token_count_key(text, model_name)
+        with self._lock:
+            if key in self._token_cache:
+                self._token_cache.move_to_end(key)
+                return self._token_cache[key]
+        count = self._count(text, model_name)
+        with self._lock:
+            self._token_cache[key] = count
+            while len(self._token_cache) > TOKEN_CACHE_SIZE:
+                self._token_cache.popitem(last=False)
+        return count
+
+    def _count(self, text: str, model_name: str) -> int:
+        encoder = self.get_encoder(model_name)
+        if encoder is None:
+            return estimate_tokens(text)
         try:
-            encoder = self.get_encoder(model_name)
-            return len(encoder.encode(text))
+            # 按普通文本编码，文本中出现的特殊token字符串不会导致编码失败
+            if len(text) < PARALLEL_COUNT_MIN_CHARS:
+                return len(encoder.encode_ordinary(text))
+            chunks = split_at_newlines(text, PARALLEL_CHUNK_CHARS)
+            num_threads = max(1, min(len(chunks), os.cpu_count() or 1, 8))
+            return sum(map(len, encoder.encode_ordinary_batch(chunks, num_threads=num_threads)))
         except Exception as e:
-            logger.error(f"计算token数量失败: {e}")
-            # 粗略估算：中文约1.5字符/token，英文约4字符/token
-            # 取平均值2.5字符/token
-            return len(text) // 2.5
+            logger.error(f"计算token数量失败，使用快速估算: {e}")
+            return estimate_tokens(text)
     
     def get_context_limit(self, model_name: str) -> int:
         """获取模型的上下文限制"""
@@ -80,24 +221,29 @@ class ContextLimitChecker:
         if model_name in MODEL_CONTEXT_LIMITS:
             return MODEL_CONTEXT_LIMITS[model_name]
         
-        # 尝试模糊匹配
-        for model_key, limit in MODEL_CONTEXT_LIMITS.items():
-            if model_key in model_name.lower():
-                return limit
+        # 尝试模糊匹配，取最长的匹配项（如 gpt-4o-2024-08-06 匹配 gpt-4o 而不是 gpt-4）
+        matches = [model_key for model_key in MODEL_CONTEXT_LIMITS if model_key in model_name.lower()]
+        if matches:
+            return MODEL_CONTEXT_LIMITS[max(matches, key=len)]
         
         # 返回默认值
         logger.warning(f"未知模型 {model_name}，使用默认上下文限制")
         return MODEL_CONTEXT_LIMITS['default']
     
-    def check_context_limit(self, text: str, model_name: str = 'gpt-3.5-turbo') -> dict:
-        """检查文本是否超过模型上下文限制"""
-        token_count = self.count_tokens(text, model_name)
+    def check_context_limit(self, text: str, model_name: str = 'gpt-3.5-turbo',
+                            token_count: Optional[int] = None) -> dict:
+        """检查文本是否超过模型上下文限制，token_count 为已知的计数结果"""
+        if token_count is None:
+            token_count = self.count_tokens(text, model_name)
         context_limit = self.get_context_limit(model_name)
         available_tokens = context_limit - RESERVED_TOKENS
+        method = self.count_method(model_name)
         
         result = {
             'model_name': model_name,
             'token_count': token_count,
+            'token_count_method': method,
+            'token_count_error': 0 if method == 'tiktoken' else estimate_error_bound(),
             'context_limit': context_limit,
             'available_tokens': available_tokens,
             'reserved_tokens': RESERVED_TOKENS,
@@ -119,9 +265,11 @@ class ContextLimitChecker:
         
         return result
     
-    def calculate_optimal_chunk_size(self, total_text: str, model_name: str = 'gpt-3.5-turbo') -> dict:
-        """计算最优的分块大小"""
-        total_tokens = self.count_tokens(total_text, model_name)
+    def calculate_optimal_chunk_size(self, total_text: str, model_name: str = 'gpt-3.5-turbo',
+                                     total_tokens: Optional[int] = None) -> dict:
+        """计算最优的分块大小，total_tokens 为已知的计数结果"""
+        if total_tokens is None:
+            total_tokens = self.count_tokens(total_text, model_name)
         available_tokens = self.get_context_limit(model_name) - RESERVED_TOKENS
         
         if total_tokens <= available_tokens:
@@ -136,8 +284,8 @@ class ContextLimitChecker:
         chunks_needed = (total_tokens // available_tokens) + 1
         optimal_chunk_tokens = total_tokens // chunks_needed
         
-        # 转换为字符数（粗略估算）
-        optimal_chunk_chars = optimal_chunk_tokens * 2.5
+        # 按本文档实际的字符/token比例转换为字符数
+        optimal_chunk_chars = optimal_chunk_tokens * len(total_text) / max(total_tokens, 1)
         
         return {
             'needs_splitting': True,
@@ -152,20 +300,31 @@ class ContextLimitChecker:
 # 全局实例
 context_checker = ContextLimitChecker()
 
-def check_document_context_limit(content: str, model_name: str = None) -> dict:
+def _default_model_name() -> str:
+    # 从配置中获取默认模型
+    return getattr(settings, 'DEFAULT_LLM_MODEL', 'gpt-3.5-turbo')
+
+def get_persisted_token_count(instance, model_name: str = None) -> int:
+    """
+    文档或模块内容的token数：按 (计数方式, 模型, 内容哈希) 持久化在 token_count/token_count_key 字段，
+    内容未变化时直接返回，否则重新计数并保存
+    """
+    model_name = model_name or _default_model_name()
+    text = instance.content or ''
+    key = context_checker.token_count_key(text, model_name)
+    if instance.token_count is not None and instance.token_count_key == key:
+        return instance.token_count
+
+    token_count = int(context_checker.count_tokens(text, model_name))
+    type(instance).objects.filter(pk=instance.pk).update(token_count=token_count, token_count_key=key)
+    instance.token_count, instance.token_count_key = token_count, key
+    return token_count
+
+def check_document_context_limit(content: str, model_name: str = None, token_count: int = None) -> dict:
     """检查文档是否超过上下文限制的便捷函数"""
-    if not model_name:
-        # 从配置中获取默认模型
-        from django.conf import settings
-        model_name = getattr(settings, 'DEFAULT_LLM_MODEL', 'gpt-3.5-turbo')
-    
-    return context_checker.check_context_limit(content, model_name)
+    return context_checker.check_context_limit(content, model_name or _default_model_name(), token_count)
 
-def get_optimal_split_size(content: str, model_name: str = None) -> int:
+def get_optimal_split_size(content: str, model_name: str = None, token_count: int = None) -> int:
     """获取最优拆分大小的便捷函数"""
-    if not model_name:
-        from django.conf import settings
-        model_name = getattr(settings, 'DEFAULT_LLM_MODEL', 'gpt-3.5-turbo')
-    
-    result = context_checker.calculate_optimal_chunk_size(content, model_name)
+    result = context_checker.calculate_optimal_chunk_size(content, model_name or _default_model_name(), token_count)
     return result.get('optimal_chunk_chars', 2000)
@@ -0,0 +1,180 @@
+"""
+评审提示词的上下文打包
+按模型的上下文限制（MODEL_CONTEXT_LIMITS）和 ContextLimitChecker 的token计数组装提示词内容，取代固定字符数截断：
+- 预留输出token，并扣除系统提示词和提示词模板本身占用的token，剩余部分作为内容预算
+- 内容按Markdown标题切分为章节，按优先级整节放入预算，放不下的章节跳过，最终按原文顺序输出
+- 整篇文档放不下时做 map-reduce 摘要：按预算分块并行摘要后合并，合并结果仍超出预算则继续摘要
+"""
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from .context_limits import context_checker
+
+logger = logging.getLogger(__name__)
+
+# 消息格式、章节分隔符等的估算开销
+PROMPT_OVERHEAD_TOKENS = 50
+# 摘要最多合并的轮数，超过后截断
+MAX_SUMMARY_ROUNDS = 3
+# 摘要分块的最小token数
+MIN_CHUNK_TOKENS = 200
+
+HEADING_RE = re.compile(r'^\s*(#{1,6})\s')
+
+SUMMARY_SYSTEM_PROMPT = "你是一位专业的需求分析师，擅长提炼需求文档的要点。"
+SUMMARY_USER_PROMPT = """请将下面的需求文档片段压缩为摘要，供后续的需求评审使用。
+要求：
+1. 保留章节标题结构（使用Markdown标题）
+2. 保留业务流程、数据实体、业务规则、约束条件、数值和接口等关键信息
+3. 省略重复和修饰性内容，摘要控制在{max_chars}字以内，直接输出摘要内容
+
+需求文档片段：
+{content}"""
+
+
+def split_sections(text: str) -> List[Dict]:
+    """按Markdown标题将文本切分为章节，标题之前的内容作为级别为0的前言章节"""
+    sections = []
+    current = {'title': '', 'level': 0, 'lines': []}
+    for line in (text or '').split('\n'):
+        match = HEADING_RE.match(line)
+        if match:
+            if current['lines']:
+                sections.append(current)
+            current = {'title': line.strip(), 'level': len(match.group(1)), 'lines': []}
+        current['lines'].append(line)
+    if current['lines']:
+        sections.append(current)
+
+    return [
+        {'title': section['title'], 'content': '\n'.join(section['lines']), 'priority': (section['level'], order)}
+        for order, section in enumerate(sections)
+    ]
+
+
+class ContextPacker:
+    """按token预算组装提示词内容"""
+
+    def __init__(self, model_name: str, context_limit: Optional[int] = None,
+                 reserved_output_tokens: Optional[int] = None):
+        self.model_name = model_name or 'default'
+        self.context_limit = context_limit or getattr(settings, 'REQUIREMENT_REVIEW_CONTEXT_TOKENS', 0) \
+            or context_checker.get_context_limit(self.model_name)
+        reserved = reserved_output_tokens or getattr(settings, 'REQUIREMENT_REVIEW_OUTPUT_TOKENS', 2048)
+        # 小上下文模型最多预留四分之一给输出
+        self.reserved_output_tokens = min(reserved, self.context_limit // 4)
+
+    def count_tokens(self, text: str) -> int:
+        return int(context_checker.count_tokens(text or '', self.model_name))
+
+    def budget_for(self, *fixed_texts: str) -> int:
+        """扣除预留输出和固定部分（系统提示词、提示词模板等）后，可用于填充内容的token数"""
+        fixed_tokens = sum(self.count_tokens(text) for text in fixed_texts)
+        return max(0, self.context_limit - self.reserved_output_tokens - fixed_tokens - PROMPT_OVERHEAD_TOKENS)
+
+    def truncate(self, text: str, budget: int) -> str:
+        """截断到预算以内（无法整节放入时的兜底）"""
+        tokens = self.count_tokens(text)
+        if tokens <= budget:
+            return text
+        if budget <= 0:
+            return ''
+        end = int(len(text) * budget / tokens)
+        while end > 0 and self.count_tokens(text[:end]) > budget:
+            end = int(end * 0.9)
+        return text[:end]
+
+    def pack_sections(self, sections: List[Dict], budget: int, separator: str = '\n\n') -> Dict:
+        """
+        按优先级（priority越小越优先）整节放入预算，放不下的章节跳过，按原顺序输出
+        返回 {'text', 'tokens', 'included', 'omitted'}，included/omitted 为章节标题列表
+        """
+        separator_tokens = self.count_tokens(separator) if separator.strip() else 1
+        costs = [self.count_tokens(section['content']) + separator_tokens for section in sections]
+        chosen = set()
+        used = 0
+        for index in sorted(range(len(sections)), key=lambda i: sections[i].get('priority', i)):
+            if used + costs[index] <= budget:
+                chosen.add(index)
+                used += costs[index]
+
+        return {
+            'text': separator.join(sections[i]['content'] for i in range(len(sections)) if i in chosen),
+            'tokens': used,
+            'included': [sections[i]['title'] for i in range(len(sections)) if i in chosen],
+            'omitted': [sections[i]['title'] for i in range(len(sections)) if i not in chosen],
+        }
+
+    def fit(self, text: str, budget: int, invoke: Callable = None, tokens: Optional[int] = None) -> str:
+        """
+        将文本放入预算：能完整放入时原样返回；否则提供 invoke 时做 map-reduce 摘要，
+        未提供时按优先级整节放入，一节都放不下时截断。tokens 为已知的文本token数
+        """
+        text = text or ''
+        if (self.count_tokens(text) if tokens is None else tokens) <= budget:
+            return text
+        if invoke is not None:
+            return self.summarize(text, budget, invoke)
+
+        packed = self.pack_sections(split_sections(text), budget)
+        if packed['omitted']:
+            logger.info(f"内容超出{budget}tokens预算，省略{len(packed['omitted'])}个章节")
+        return packed['text'] or self.truncate(text, budget)
+
+    def _chunk(self, text: str, chunk_budget: int) -> List[str]:
+        """按原文顺序将章节合并为不超过预算的分块，超大章节按行拆分"""
+        chunks, current, used = [], [], 0
+        for section in split_sections(text):
+            pieces = [section['content']]
+            if self.count_tokens(section['content']) > chunk_budget:
+                pieces = section['content'].split('\n')
+            for piece in pieces:
+                cost = self.count_tokens(piece) + 1
+                if cost > chunk_budget:
+                    piece, cost = self.truncate(piece, chunk_budget - 1), chunk_budget
+                if current and used + cost > chunk_budget:
+                    chunks.append('\n'.join(current))
+                    current, used = [], 0
+                current.append(piece)
+                used += cost
+        if current:
+            chunks.append('\n'.join(current))
+        return chunks
+
+    def summarize(self, text: str, budget: int, invoke: Callable) -> str:
+        """
+        map-reduce 摘要：按单次调用的预算分块，并行摘要各分块后按顺序合并；
+        合并结果仍超出预算时对摘要继续摘要，最多 MAX_SUMMARY_ROUNDS 轮
+        """
+        chunk_budget = max(self.budget_for(SUMMARY_SYSTEM_PROMPT, SUMMARY_USER_PROMPT), MIN_CHUNK_TOKENS)
+        for round_index in range(MAX_SUMMARY_ROUNDS):
+            tokens = self.count_tokens(text)
+            chunks = self._chunk(text, chunk_budget)
+            # 各分块摘要的目标长度按预算平均分配，按当前文本的字符/token比例换算为字数
+            chars_per_token = len(text) / max(tokens, 1)
+            max_chars = max(200, int(budget / len(chunks) * chars_per_token * 0.9))
+            logger.info(f"内容{tokens}tokens超出{budget}tokens预算，第{round_index + 1}轮摘要，分{len(chunks)}块")
+
+            def summarize_chunk(chunk):
+                try:
+                    response = invoke([
+                        SystemMessage(content=SUMMARY_SYSTEM_PROMPT),
+                        HumanMessage(content=SUMMARY_USER_PROMPT.format(max_chars=max_chars, content=chunk))
+                    ])
+                    return response.content.strip()
+                except Exception as e:
+                    logger.warning(f"分块摘要失败，使用截断内容: {e}")
+                    return self.truncate(chunk, int(max_chars / chars_per_token))
+
+            max_workers = max(1, min(getattr(settings, 'REQUIREMENT_REVIEW_MAX_CONCURRENCY', 4), len(chunks)))
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='context-summary') as executor:
+                text = '\n\n'.join(executor.map(summarize_chunk, chunks))
+            if self.count_tokens(text) <= budget:
+                return text
+
+        return self.truncate(text, budget)
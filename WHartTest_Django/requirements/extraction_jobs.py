@@ -0,0 +1,196 @@
+"""
+需求文档内容提取后台任务
+上传PDF后立即返回，内容在后台提取：
+- 按页范围拆分，由进程池（spawn方式启动，子进程只导入不依赖Django的 pdf_extraction 模块）并行提取
+- 各页范围的结果按页序追加写入文档内容，同时更新提取进度；乱序完成的范围最多缓存有限个
+- 单页或单个范围提取失败时跳过并记录页码，其余页面照常写入
+- 超过 REQUIREMENT_PDF_MAX_PAGES 的页面不提取，避免单个超大PDF长期占用进程池
+"""
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Set
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, TextField, Value
+from django.db.models.functions import Coalesce, Concat
+
+from .pdf_extraction import count_pdf_pages, extract_pdf_pages, format_page
+
+logger = logging.getLogger(__name__)
+
+
+def needs_background_extraction(document) -> bool:
+    """上传的PDF文件在后台提取内容"""
+    return bool(document.file) and not document.content and document.file.name.lower().endswith('.pdf')
+
+
+class DocumentExtractionRunner:
+    """进程内的文档内容提取执行器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._running: Set[str] = set()
+
+    @property
+    def process_count(self) -> int:
+        return getattr(settings, 'REQUIREMENT_PDF_EXTRACT_PROCESSES', 2)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'REQUIREMENT_EXTRACTION_JOB_WORKERS', 2),
+                    thread_name_prefix='document-extraction'
+                )
+            return self._executor
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        """提取进程池，进程数为0时在当前线程中提取"""
+        if self.process_count <= 0:
+            return None
+        with self._lock:
+            if self._pool is None:
+                # 服务进程中有多个线程，fork可能复制持有中的锁，使用spawn启动子进程
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.process_count, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def _reset_pool(self):
+        """子进程异常退出后进程池不可用，丢弃后下次重新创建"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def is_running(self, document_id) -> bool:
+        with self._lock:
+            return str(document_id) in self._running
+
+    def submit(self, document_id):
+        """提交提取任务，同一文档已在本进程提取时忽略，返回Future或None"""
+        document_id = str(document_id)
+        with self._lock:
+            if document_id in self._running:
+                return None
+            self._running.add(document_id)
+        return self._get_executor().submit(self._run, document_id)
+
+    def _run(self, document_id: str):
+        from .models import RequirementDocument
+
+        try:
+            # 认领任务：只有等待提取的文档会被执行
+            if not RequirementDocument.objects.filter(pk=document_id, extraction_status='pending').update(
+                    extraction_status='extracting', extraction_progress=0, extraction_error='', content=''):
+                logger.info(f"文档 {document_id} 不在等待提取状态，跳过")
+                return
+            document = RequirementDocument.objects.get(pk=document_id)
+            self._extract_pdf(document)
+        except Exception as e:
+            logger.error(f"文档 {document_id} 内容提取失败: {e}")
+            RequirementDocument.objects.filter(pk=document_id, extraction_status='extracting') \
+                .update(extraction_status='failed', extraction_error=str(e))
+        finally:
+            with self._lock:
+                self._running.discard(document_id)
+            close_old_connections()
+
+    def _extract_pdf(self, document):
+        from .models import RequirementDocument
+
+        path = document.file.path
+        total_pages = count_pdf_pages(path)
+        max_pages = getattr(settings, 'REQUIREMENT_PDF_MAX_PAGES', 300)
+        page_limit = min(total_pages, max_pages) if max_pages else total_pages
+        step = max(1, getattr(settings, 'REQUIREMENT_PDF_PAGES_PER_TASK', 10))
+        ranges = [(start, min(start + step, page_limit)) for start in range(0, page_limit, step)]
+        logger.info(f"开始提取PDF {document.id}，共{total_pages}页，提取{page_limit}页，分{len(ranges)}个范围")
+
+        queryset = RequirementDocument.objects.filter(pk=document.pk)
+        failed_pages: List[int] = []
+        written = 0  # 已写入的字符数
+
+        def append(pages, done_ranges):
+            nonlocal written
+            parts = []
+            for page_num, text in pages:
+                if text is None:
+                    failed_pages.append(page_num + 1)
+                    continue
+                page_text = format_page(page_num, text)
+                if page_text:
+                    parts.append(page_text)
+            chunk = "\n\n".join(parts)
+            updates = {'extraction_progress': int(done_ranges * 100 / len(ranges))}
+            if chunk:
+                chunk = f"\n\n{chunk}" if written else chunk
+                written += len(chunk)
+                updates['content'] = Concat(Coalesce(F('content'), Value('')), Value(chunk), output_field=TextField())
+            if not queryset.update(**updates):
+                raise RuntimeError('文档已被删除')
+
+        ready = {}  # 范围序号 -> 结果，等待前面的范围完成后按页序写入
+        next_index = 0
+        pool = self._get_pool()
+        if pool is None:
+            for index, (start, end) in enumerate(ranges):
+                append(extract_pdf_pages(path, start, end), index + 1)
+        else:
+            # 在途和已完成待写入的范围总数不超过窗口大小，限制乱序结果占用的内存
+            window = self.process_count * 2
+            pending_ranges = iter(enumerate(ranges))
+            in_flight = {}
+            try:
+                while True:
+                    while len(in_flight) + len(ready) < window:
+                        item = next(pending_ranges, None)
+                        if item is None:
+                            break
+                        index, (start, end) = item
+                        future = pool.submit(extract_pdf_pages, path, start, end)
+                        in_flight[future] = (index, start, end, pool)
+                    if not in_flight:
+                        break
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index, start, end, used_pool = in_flight.pop(future)
+                        try:
+                            ready[index] = future.result()
+                        except Exception as e:
+                            logger.warning(f"提取PDF第{start + 1}-{end}页失败: {e}")
+                            ready[index] = [(page_num, None) for page_num in range(start, end)]
+                            if isinstance(e, BrokenProcessPool) and used_pool is pool:
+                                self._reset_pool()
+                                pool = self._get_pool()
+                    while next_index in ready:
+                        append(ready.pop(next_index), next_index + 1)
+                        next_index += 1
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+        notes = []
+        if failed_pages:
+            notes.append(f"第{', '.join(map(str, failed_pages))}页提取失败")
+        if page_limit < total_pages:
+            notes.append(f"PDF共{total_pages}页，超过上限{max_pages}页，只提取了前{page_limit}页")
+        queryset.update(
+            extraction_status='completed' if written else 'failed',
+            extraction_progress=100,
+            extraction_error='；'.join(notes) or ('' if written else '未提取到文本内容'),
+            word_count=written,
+            page_count=max(1, (written // 500) + 1),
+        )
+        logger.info(f"PDF {document.id} 提取完成，内容长度: {written}，失败页数: {len(failed_pages)}")
+
+
+# 全局文档内容提取执行器
+document_extraction_runner = DocumentExtractionRunner()
@@ -0,0 +1,73 @@
+"""
+Django管理命令：模块拆分器性能基准
+生成不同标题数量的文档，测量按标题拆分的耗时，用于观察耗时随文档规模的增长情况
+"""
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from requirements.services import ModuleSplitter
+
+
+class Command(BaseCommand):
+    help = '测量按标题拆分文档的耗时随标题数量的变化'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='500,1000,2000,5000,10000',
+            help='逗号分隔的标题数量',
+        )
+        parser.add_argument(
+            '--level',
+            default='h2',
+            choices=['h1', 'h2', 'h3'],
+            help='拆分的标题级别',
+        )
+        parser.add_argument(
+            '--numbered',
+            action='store_true',
+            help='使用编号标题（如"3.2 标题"）代替Markdown标题',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='每个规模重复次数，取最短耗时',
+        )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        level = options['level']
+        depth = int(level[1])
+        splitter = ModuleSplitter()
+
+        # 拆分过程中每个模块都会记录日志，计时时关闭
+        logging.disable(logging.INFO)
+        try:
+            self.stdout.write(f"{'标题数':>8} {'文档字符数':>10} {'模块数':>8} {'耗时(ms)':>10} {'每标题(us)':>10}")
+            for size in sizes:
+                content = self._build_document(size, depth, options['numbered'])
+                elapsed = None
+                for _ in range(max(1, options['repeat'])):
+                    started = time.perf_counter()
+                    modules = splitter._split_by_heading_level(content, level, numbered_headings=options['numbered'])
+                    duration = time.perf_counter() - started
+                    elapsed = duration if elapsed is None else min(elapsed, duration)
+                self.stdout.write(
+                    f"{size:>8} {len(content):>10} {len(modules):>8} {elapsed * 1000:>10.1f} "
+                    f"{elapsed * 1e6 / size:>10.1f}"
+                )
+        finally:
+            logging.disable(logging.NOTSET)
+
+    @staticmethod
+    def _build_document(size: int, depth: int, numbered: bool) -> str:
+        """生成包含 size 个目标级别标题的需求文档"""
+        lines = ['需求规格说明书', '']
+        for i in range(size):
+            number = '.'.join([str(i + 1)] + ['1'] * (depth - 1))
+            lines.append(f"{number} 功能模块{i + 1}" if numbered else f"{'#' * depth} {number} 功能模块{i + 1}")
+            lines.extend(['用户可以在该模块中完成相应的业务操作', '- 输入校验规则说明', '- 异常处理说明', ''])
+        return '\n'.join(lines)
@@ -0,0 +1,75 @@
+"""
+Django管理命令：校准token快速估算
+用tiktoken对已有的需求文档和模块内容（或指定文件）计数，与快速估算结果对比，
+报告相对误差，用于确定 REQUIREMENT_TOKEN_ESTIMATE_ERROR
+"""
+import math
+
+from django.core.management.base import BaseCommand, CommandError
+
+from requirements.context_limits import (
+    CJK_RUN_RE, context_checker, estimate_error_bound, estimate_tokens
+)
+from requirements.models import RequirementDocument, RequirementModule
+
+
+class Command(BaseCommand):
+    help = '对比token快速估算与tiktoken计数，报告估算误差'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            default='gpt-4',
+            help='计数使用的模型（决定tiktoken编码）',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=200,
+            help='最多取样的文档和模块数',
+        )
+        parser.add_argument(
+            '--file',
+            action='append',
+            default=[],
+            help='额外取样的文本文件，可重复指定',
+        )
+
+    def handle(self, *args, **options):
+        encoder = context_checker.get_encoder(options['model'])
+        if encoder is None:
+            raise CommandError('tiktoken编码器不可用（无法加载编码文件），无法校准')
+
+        samples = []
+        for path in options['file']:
+            with open(path, encoding='utf-8', errors='ignore') as f:
+                samples.append((path, f.read()))
+        limit = options['limit']
+        documents = RequirementDocument.objects.exclude(content__isnull=True).exclude(content='')
+        samples.extend((f"文档 {d.title}", d.content) for d in documents.only('title', 'content')[:limit])
+        modules = RequirementModule.objects.exclude(content='')
+        samples.extend((f"模块 {m.title}", m.content) for m in modules.only('title', 'content')[:limit])
+        if not samples:
+            raise CommandError('没有可用于校准的文本')
+
+        errors = []
+        self.stdout.write(f"{'tiktoken':>10} {'估算':>10} {'误差':>8} {'中日韩字符':>10}  样本")
+        for name, text in samples:
+            exact = len(encoder.encode_ordinary(text))
+            if not exact:
+                continue
+            estimate = estimate_tokens(text)
+            error = (estimate - exact) / exact
+            errors.append(error)
+            cjk_ratio = sum(map(len, CJK_RUN_RE.findall(text))) / len(text)
+            self.stdout.write(f"{exact:>10} {estimate:>10} {error:>+8.1%} {cjk_ratio:>10.0%}  {name[:40]}")
+
+        errors.sort(key=abs)
+        p95 = abs(errors[min(len(errors) - 1, math.ceil(len(errors) * 0.95) - 1)])
+        self.stdout.write('')
+        self.stdout.write(f"样本数: {len(errors)}")
+        self.stdout.write(f"平均误差: {sum(errors) / len(errors):+.1%}（正数表示估算偏高）")
+        self.stdout.write(f"平均绝对误差: {sum(map(abs, errors)) / len(errors):.1%}")
+        self.stdout.write(f"95%分位绝对误差: {p95:.1%}")
+        self.stdout.write(f"最大绝对误差: {abs(errors[-1]):.1%}")
+        self.stdout.write(f"当前配置的误差上限 REQUIREMENT_TOKEN_ESTIMATE_ERROR: {estimate_error_bound():.0%}")
@@ -0,0 +1,22 @@
+"""
+Django管理命令：恢复未完成的需求评审
+在当前进程中从检查点继续执行心跳已过期（服务重启或崩溃中断）的全面评审，并等待执行结束
+"""
+from django.core.management.base import BaseCommand
+
+from requirements.review_jobs import review_job_runner
+
+
+class Command(BaseCommand):
+    help = '从检查点继续执行未完成的需求评审任务'
+
+    def handle(self, *args, **options):
+        futures = review_job_runner.resume_pending_reviews()
+        if not futures:
+            self.stdout.write('没有需要恢复的评审任务')
+            return
+
+        self.stdout.write(f'正在恢复 {len(futures)} 个评审任务...')
+        for future in futures:
+            future.result()
+        self.stdout.write(self.style.SUCCESS('评审任务恢复完成'))
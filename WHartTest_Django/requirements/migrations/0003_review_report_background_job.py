@@ -0,0 +1,89 @@
+# Generated by Django 5.2 on 2026-10-19 00:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_reports_finished(apps, schema_editor):
+    """已有的已结束报告标记为完成阶段，避免显示为排队中"""
+    ReviewReport = apps.get_model('requirements', 'ReviewReport')
+    ReviewReport.objects.filter(status='completed').update(current_stage='finished', progress=100)
+    ReviewReport.objects.filter(status='failed').update(current_stage='finished')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requirements', '0002_reviewreport_clarity_score_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reviewreport',
+            name='analysis_options',
+            field=models.JSONField(blank=True, default=dict, verbose_name='评审参数'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='cancel_requested',
+            field=models.BooleanField(default=False, verbose_name='请求取消'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='checkpoint',
+            field=models.JSONField(blank=True, default=dict, help_text='已完成阶段和模块的分析结果，服务重启后从最后完成的模块继续', verbose_name='评审检查点'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='completed_modules',
+            field=models.IntegerField(default=0, verbose_name='已完成模块数'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='current_stage',
+            field=models.CharField(choices=[('queued', '排队中'), ('global_analysis', '全局结构分析'), ('module_analysis', '模块分析'), ('consistency_analysis', '跨模块一致性检查'), ('report_generation', '生成评审报告'), ('finished', '已结束')], default='queued', max_length=30, verbose_name='当前阶段'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='error_message',
+            field=models.TextField(blank=True, verbose_name='错误信息'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='结束时间'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='心跳时间'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='progress',
+            field=models.IntegerField(default=0, help_text='0-100', verbose_name='评审进度'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='requested_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='requested_review_reports', to=settings.AUTH_USER_MODEL, verbose_name='发起人'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='开始时间'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='total_modules',
+            field=models.IntegerField(default=0, verbose_name='模块总数'),
+        ),
+        migrations.AlterField(
+            model_name='reviewreport',
+            name='status',
+            field=models.CharField(choices=[('pending', '待开始'), ('in_progress', '评审中'), ('completed', '已完成'), ('failed', '评审失败'), ('cancelled', '已取消')], default='pending', max_length=20, verbose_name='评审状态'),
+        ),
+        migrations.RunPython(mark_existing_reports_finished, migrations.RunPython.noop),
+    ]
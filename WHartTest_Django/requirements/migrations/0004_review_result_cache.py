@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-19 00:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requirements', '0003_review_report_background_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modulereviewresult',
+            name='from_cache',
+            field=models.BooleanField(default=False, help_text='模块内容未变化，复用了之前的分析结果', verbose_name='复用缓存结果'),
+        ),
+        migrations.AddField(
+            model_name='reviewreport',
+            name='reused_results',
+            field=models.JSONField(blank=True, default=dict, help_text='从评审结果缓存复用的部分，例如 {"global_analysis": true, "module_ids": [...]}', verbose_name='复用的分析结果'),
+        ),
+        migrations.CreateModel(
+            name='ReviewResultCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('global', '全局分析'), ('module', '模块分析')], max_length=20, verbose_name='分析类型')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='内容哈希')),
+                ('prompt_hash', models.CharField(max_length=64, verbose_name='提示词版本')),
+                ('model_name', models.CharField(blank=True, max_length=200, verbose_name='模型')),
+                ('result', models.JSONField(default=dict, verbose_name='分析结果')),
+                ('hit_count', models.IntegerField(default=0, verbose_name='命中次数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('last_used_at', models.DateTimeField(auto_now=True, verbose_name='最近使用时间')),
+            ],
+            options={
+                'verbose_name': '评审结果缓存',
+                'verbose_name_plural': '评审结果缓存',
+                'unique_together': {('kind', 'content_hash', 'prompt_hash', 'model_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-19 00:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requirements', '0004_review_result_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requirementdocument',
+            name='extraction_error',
+            field=models.TextField(blank=True, help_text='提取失败的原因、失败的页码或超出页数上限的提示', verbose_name='内容提取说明'),
+        ),
+        migrations.AddField(
+            model_name='requirementdocument',
+            name='extraction_progress',
+            field=models.IntegerField(default=0, verbose_name='内容提取进度'),
+        ),
+        migrations.AddField(
+            model_name='requirementdocument',
+            name='extraction_status',
+            field=models.CharField(choices=[('not_required', '无需提取'), ('pending', '等待提取'), ('extracting', '提取中'), ('completed', '提取完成'), ('failed', '提取失败')], default='not_required', max_length=20, verbose_name='内容提取状态'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-19 01:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requirements', '0005_document_content_extraction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requirementdocument',
+            name='token_count',
+            field=models.IntegerField(blank=True, null=True, verbose_name='token数'),
+        ),
+        migrations.AddField(
+            model_name='requirementdocument',
+            name='token_count_key',
+            field=models.CharField(blank=True, help_text='计数方式、模型和内容的哈希，内容变化后重新计数', max_length=64, verbose_name='token数计算依据'),
+        ),
+        migrations.AddField(
+            model_name='requirementmodule',
+            name='token_count',
+            field=models.IntegerField(blank=True, null=True, verbose_name='token数'),
+        ),
+        migrations.AddField(
+            model_name='requirementmodule',
+            name='token_count_key',
+            field=models.CharField(blank=True, help_text='计数方式、模型和内容的哈希，内容变化后重新计数', max_length=64, verbose_name='token数计算依据'),
+        ),
+    ]
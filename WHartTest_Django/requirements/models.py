@@ -34,6 +34,14 @@ class RequirementDocument(models.Model):
         ('failed', '处理失败'),
     ]
 
+    EXTRACTION_STATUS_CHOICES = [
+        ('not_required', '无需提取'),
+        ('pending', '等待提取'),
+        ('extracting', '提取中'),
+        ('completed', '提取完成'),
+        ('failed', '提取失败'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     project = models.ForeignKey(
         Project,
@@ -56,6 +64,16 @@ class RequirementDocument(models.Model):
     )
     content = models.TextField(_('文档内容'), blank=True, null=True)
 
+    # 内容提取（PDF在后台按页提取，内容随提取进度逐步写入）
+    extraction_status = models.CharField(
+        _('内容提取状态'),
+        max_length=20,
+        choices=EXTRACTION_STATUS_CHOICES,
+        default='not_required'
+    )
+    extraction_progress = models.IntegerField(_('内容提取进度'), default=0)
+    extraction_error = models.TextField(_('内容提取说明'), blank=True, help_text='提取失败的原因、失败的页码或超出页数上限的提示')
+
     # 状态管理
     status = models.CharField(
         _('状态'),
@@ -90,6 +108,9 @@ class RequirementDocument(models.Model):
     # 统计信息
     word_count = models.IntegerField(_('字数'), default=0)
     page_count = models.IntegerField(_('页数'), default=0)
+    token_count = models.IntegerField(_('token数'), null=True, blank=True)
+    token_count_key = models.CharField(_('token数计算依据'), max_length=64, blank=True,
+                                       help_text='计数方式、模型和内容的哈希，内容变化后重新计数')
 
     class Meta:
         verbose_name = _('需求文档')
@@ -100,15 +121,20 @@ class RequirementDocument(models.Model):
             models.Index(fields=['uploader', 'uploaded_at']),
         ]
 
+    def get_token_count(self, model_name: str = None) -> int:
+        """文档内容的token数，内容未变化时使用已保存的结果"""
+        from .context_limits import get_persisted_token_count
+        return get_persisted_token_count(self, model_name)
+
     def check_context_limit(self, model_name: str = None) -> dict:
         """检查文档是否超过模型上下文限制"""
         from .context_limits import check_document_context_limit
-        return check_document_context_limit(self.content or '', model_name)
+        return check_document_context_limit(self.content or '', model_name, self.get_token_count(model_name))
 
     def get_optimal_split_size(self, model_name: str = None) -> int:
         """获取最优拆分大小"""
         from .context_limits import get_optimal_split_size
-        return get_optimal_split_size(self.content or '', model_name)
+        return get_optimal_split_size(self.content or '', model_name, self.get_token_count(model_name))
 
     def __str__(self):
         return f"{self.project.name} - {self.title} v{self.version}"
@@ -150,6 +176,11 @@ class RequirementModule(models.Model):
     confidence_score = models.FloatField(_('置信度'), null=True, blank=True)
     ai_suggested_title = models.CharField(_('AI建议标题'), max_length=200, blank=True)
 
+    # 统计信息
+    token_count = models.IntegerField(_('token数'), null=True, blank=True)
+    token_count_key = models.CharField(_('token数计算依据'), max_length=64, blank=True,
+                                       help_text='计数方式、模型和内容的哈希，内容变化后重新计数')
+
     # 元数据
     created_at = models.DateTimeField(_('创建时间'), auto_now_add=True)
     updated_at = models.DateTimeField(_('更新时间'), auto_now=True)
@@ -162,6 +193,11 @@ class RequirementModule(models.Model):
             models.Index(fields=['document', 'order']),
         ]
 
+    def get_token_count(self, model_name: str = None) -> int:
+        """模块内容的token数，内容未变化时使用已保存的结果"""
+        from .context_limits import get_persisted_token_count
+        return get_persisted_token_count(self, model_name)
+
     def __str__(self):
         return f"{self.document.title} - {self.title}"
 
@@ -175,6 +211,16 @@ class ReviewReport(models.Model):
         ('in_progress', '评审中'),
         ('completed', '已完成'),
         ('failed', '评审失败'),
+        ('cancelled', '已取消'),
+    ]
+
+    REVIEW_STAGE_CHOICES = [
+        ('queued', '排队中'),
+        ('global_analysis', '全局结构分析'),
+        ('module_analysis', '模块分析'),
+        ('consistency_analysis', '跨模块一致性检查'),
+        ('report_generation', '生成评审报告'),
+        ('finished', '已结束'),
     ]
 
     OVERALL_RATING_CHOICES = [
@@ -237,6 +283,39 @@ class ReviewReport(models.Model):
     summary = models.TextField(_('评审摘要'), blank=True)
     recommendations = models.TextField(_('改进建议'), blank=True)
 
+    # 后台评审任务
+    requested_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='requested_review_reports',
+        verbose_name=_('发起人')
+    )
+    analysis_options = models.JSONField(_('评审参数'), default=dict, blank=True)
+    current_stage = models.CharField(
+        _('当前阶段'),
+        max_length=30,
+        choices=REVIEW_STAGE_CHOICES,
+        default='queued'
+    )
+    progress = models.IntegerField(_('评审进度'), default=0, help_text='0-100')
+    total_modules = models.IntegerField(_('模块总数'), default=0)
+    completed_modules = models.IntegerField(_('已完成模块数'), default=0)
+    checkpoint = models.JSONField(
+        _('评审检查点'), default=dict, blank=True,
+        help_text='已完成阶段和模块的分析结果，服务重启后从最后完成的模块继续'
+    )
+    cancel_requested = models.BooleanField(_('请求取消'), default=False)
+    error_message = models.TextField(_('错误信息'), blank=True)
+    started_at = models.DateTimeField(_('开始时间'), null=True, blank=True)
+    finished_at = models.DateTimeField(_('结束时间'), null=True, blank=True)
+    heartbeat_at = models.DateTimeField(_('心跳时间'), null=True, blank=True)
+    reused_results = models.JSONField(
+        _('复用的分析结果'), default=dict, blank=True,
+        help_text='从评审结果缓存复用的部分，例如 {"global_analysis": true, "module_ids": [...]}'
+    )
+
     # 元数据
     created_at = models.DateTimeField(_('创建时间'), auto_now_add=True)
     updated_at = models.DateTimeField(_('更新时间'), auto_now=True)
@@ -359,6 +438,7 @@ class ModuleReviewResult(models.Model):
     strengths = models.TextField(_('优点'), blank=True)
     weaknesses = models.TextField(_('不足'), blank=True)
     recommendations = models.TextField(_('改进建议'), blank=True)
+    from_cache = models.BooleanField(_('复用缓存结果'), default=False, help_text='模块内容未变化，复用了之前的分析结果')
 
     # 元数据
     created_at = models.DateTimeField(_('创建时间'), auto_now_add=True)
@@ -372,3 +452,31 @@ class ModuleReviewResult(models.Model):
 
     def __str__(self):
         return f"{self.module.title} - {self.module_rating or '未评级'}"
+
+
+class ReviewResultCache(models.Model):
+    """
+    评审结果缓存
+    按 (内容哈希, 提示词版本, 模型) 缓存全局分析和模块分析的结果，重新评审时内容未变化的部分直接复用
+    """
+    KIND_CHOICES = [
+        ('global', '全局分析'),
+        ('module', '模块分析'),
+    ]
+
+    kind = models.CharField(_('分析类型'), max_length=20, choices=KIND_CHOICES)
+    content_hash = models.CharField(_('内容哈希'), max_length=64)
+    prompt_hash = models.CharField(_('提示词版本'), max_length=64)
+    model_name = models.CharField(_('模型'), max_length=200, blank=True)
+    result = models.JSONField(_('分析结果'), default=dict)
+    hit_count = models.IntegerField(_('命中次数'), default=0)
+    created_at = models.DateTimeField(_('创建时间'), auto_now_add=True)
+    last_used_at = models.DateTimeField(_('最近使用时间'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('评审结果缓存')
+        verbose_name_plural = _('评审结果缓存')
+        unique_together = ['kind', 'content_hash', 'prompt_hash', 'model_name']
+
+    def __str__(self):
+        return f"{self.get_kind_display()} - {self.content_hash[:12]}"
@@ -0,0 +1,41 @@
+"""
+PDF文本按页提取
+本模块不依赖Django，进程池的子进程（spawn方式启动）只需导入本模块即可执行提取
+"""
+import logging
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _open_reader(path: str):
+    from pypdf import PdfReader
+
+    return PdfReader(path)
+
+
+def count_pdf_pages(path: str) -> int:
+    """PDF总页数"""
+    return len(_open_reader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, end: int) -> List[Tuple[int, Optional[str]]]:
+    """
+    提取第 start 到 end-1 页（从0开始）的文本，返回 (页码, 文本) 列表
+    单页提取失败时该页文本为None，不影响同一范围内的其他页
+    """
+    reader = _open_reader(path)
+    results = []
+    for page_num in range(start, min(end, len(reader.pages))):
+        try:
+            results.append((page_num, reader.pages[page_num].extract_text() or ''))
+        except Exception as e:
+            logger.warning(f"提取PDF第{page_num + 1}页失败: {e}")
+            results.append((page_num, None))
+    return results
+
+
+def format_page(page_num: int, text: str) -> str:
+    """单页文本的Markdown片段，空白页返回空字符串"""
+    text = (text or '').strip()
+    return f"=== 第{page_num + 1}页 ===\n{text}" if text else ''
@@ -0,0 +1,73 @@
+"""
+需求评审结果缓存
+全局分析和模块分析的结果按 (内容哈希, 提示词版本, 模型) 保存在数据库中：
+重新评审时内容和提示词都未变化的部分直接复用，只有变化的模块和跨模块一致性检查需要调用LLM
+"""
+import hashlib
+import logging
+from datetime import timedelta
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ReviewResultCache
+
+logger = logging.getLogger(__name__)
+
+# 分析消息格式或结果解析方式变化时递增，使旧缓存失效
+REVIEW_CACHE_VERSION = '1'
+
+
+def hash_text(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part or '').encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def review_cache_enabled() -> bool:
+    return getattr(settings, 'REQUIREMENT_REVIEW_CACHE_ENABLED', True)
+
+
+def prompt_version(system_prompt: str, user_prompt: str) -> str:
+    """提示词版本：系统提示词和用户提示词模板的哈希"""
+    return hash_text(REVIEW_CACHE_VERSION, system_prompt, user_prompt)
+
+
+def get_cached_results(kind: str, content_hashes: Iterable[str], prompt_hash: str,
+                       model_name: str) -> Dict[str, dict]:
+    """批量查询缓存的分析结果，返回 content_hash -> result"""
+    content_hashes = set(content_hashes)
+    if not content_hashes:
+        return {}
+    queryset = ReviewResultCache.objects.filter(
+        kind=kind, content_hash__in=content_hashes, prompt_hash=prompt_hash, model_name=model_name or ''
+    )
+    ttl_days = getattr(settings, 'REQUIREMENT_REVIEW_CACHE_TTL_DAYS', 30)
+    if ttl_days:
+        queryset = queryset.filter(last_used_at__gte=timezone.now() - timedelta(days=ttl_days))
+
+    results = {entry.content_hash: entry.result for entry in queryset.only('content_hash', 'result')}
+    if results:
+        ReviewResultCache.objects.filter(
+            kind=kind, content_hash__in=results.keys(), prompt_hash=prompt_hash, model_name=model_name or ''
+        ).update(hit_count=F('hit_count') + 1, last_used_at=timezone.now())
+    return results
+
+
+def get_cached_result(kind: str, content_hash: str, prompt_hash: str, model_name: str) -> Optional[dict]:
+    return get_cached_results(kind, [content_hash], prompt_hash, model_name).get(content_hash)
+
+
+def store_result(kind: str, content_hash: str, prompt_hash: str, model_name: str, result: dict):
+    """保存分析结果，写入失败只记录日志，不影响评审"""
+    try:
+        ReviewResultCache.objects.update_or_create(
+            kind=kind, content_hash=content_hash, prompt_hash=prompt_hash, model_name=model_name or '',
+            defaults={'result': result}
+        )
+    except Exception as e:
+        logger.warning(f"保存评审结果缓存失败: {e}")
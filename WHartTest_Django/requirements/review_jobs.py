@@ -0,0 +1,268 @@
+"""
+需求评审后台任务
+全面评审在进程内线程池中执行，任务状态保存在 ReviewReport 上：
+- 提交后立即返回，当前阶段、进度、已完成模块的结果（检查点）随执行写入数据库
+- 取消通过报告的 cancel_requested 标记传递，在模块之间检查
+- 执行中的任务由执行器的心跳线程定期更新心跳；看门狗线程发现心跳过期（进程重启或崩溃）的未完成评审时，
+  从检查点（最后完成的模块）继续执行，也可以使用 resume_review_jobs 命令手动恢复
+- 多个进程通过心跳时间认领任务，同一评审只会由一个进程执行
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List, Optional, Set
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+# 事件流在没有新事件时发送保活注释的间隔（秒）
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+class ReviewJobRunner:
+    """进程内的评审任务执行器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._running: Set[str] = set()  # 已提交（排队或执行中）的任务
+        self._claimed: Set[str] = set()  # 本进程认领并正在执行的任务
+        self._watchdog: Optional[threading.Thread] = None
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @property
+    def heartbeat_interval(self) -> float:
+        return getattr(settings, 'REQUIREMENT_REVIEW_JOB_HEARTBEAT', 30)
+
+    @property
+    def stale_seconds(self) -> float:
+        return getattr(settings, 'REQUIREMENT_REVIEW_JOB_STALE_SECONDS', 120)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'REQUIREMENT_REVIEW_JOB_WORKERS', 2),
+                    thread_name_prefix='review-job'
+                )
+            return self._executor
+
+    def is_running(self, report_id) -> bool:
+        with self._lock:
+            return str(report_id) in self._running
+
+    def submit(self, report_id):
+        """提交评审任务，同一报告已在本进程执行时忽略，返回Future或None"""
+        report_id = str(report_id)
+        with self._lock:
+            if report_id in self._running:
+                return None
+            self._running.add(report_id)
+        return self._get_executor().submit(self._run, report_id)
+
+    def _claim(self, report_id: str) -> bool:
+        """认领任务：心跳过期（或从未开始）的待执行任务才能被认领"""
+        from .models import ReviewReport
+
+        stale_before = timezone.now() - timedelta(seconds=self.stale_seconds)
+        return ReviewReport.objects.filter(
+            pk=report_id, status__in=['pending', 'in_progress']
+        ).filter(
+            Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=stale_before)
+        ).update(heartbeat_at=timezone.now()) == 1
+
+    def _run(self, report_id: str):
+        from .models import RequirementDocument, ReviewReport
+        from .services import RequirementReviewService
+
+        try:
+            if not self._claim(report_id):
+                logger.info(f"评审任务 {report_id} 已结束或正由其他进程执行，跳过")
+                return
+            with self._lock:
+                self._claimed.add(report_id)
+            self._ensure_heartbeat()
+            review_report = ReviewReport.objects.select_related('document', 'requested_by').get(pk=report_id)
+            if review_report.cancel_requested:
+                RequirementReviewService.mark_cancelled(review_report)
+                return
+            service = RequirementReviewService(user=review_report.requested_by)
+            service.run_comprehensive_review(review_report)
+        except Exception as e:
+            logger.error(f"评审任务 {report_id} 执行失败: {e}")
+            if ReviewReport.objects.filter(pk=report_id, status__in=['pending', 'in_progress']).update(
+                    status='failed', current_stage='finished', error_message=str(e), finished_at=timezone.now()):
+                RequirementDocument.objects.filter(review_reports__id=report_id, status='reviewing') \
+                    .update(status='failed')
+        finally:
+            with self._lock:
+                self._running.discard(report_id)
+                self._claimed.discard(report_id)
+            close_old_connections()
+
+    def resume_pending_reviews(self) -> list:
+        """重新提交未完成且心跳过期（或从未开始）的全面评审，返回提交任务的Future列表"""
+        from .models import ReviewReport
+
+        stale_before = timezone.now() - timedelta(seconds=self.stale_seconds)
+        report_ids = ReviewReport.objects.filter(
+            review_type='comprehensive', status__in=['pending', 'in_progress']
+        ).filter(
+            Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=stale_before)
+        ).values_list('id', flat=True)
+        futures = [future for future in map(self.submit, report_ids) if future is not None]
+        if futures:
+            logger.info(f"已重新提交 {len(futures)} 个未完成的评审任务")
+        return futures
+
+    def _beat(self):
+        """更新本进程内执行中任务的心跳"""
+        from .models import ReviewReport
+
+        with self._lock:
+            claimed = list(self._claimed)
+        if claimed:
+            ReviewReport.objects.filter(pk__in=claimed, status__in=['pending', 'in_progress']) \
+                .update(heartbeat_at=timezone.now())
+
+    def _ensure_heartbeat(self):
+        """本进程有认领的任务时确保心跳线程在运行（与看门狗无关，任何进程执行评审都会更新心跳）"""
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='review-job-heartbeat', daemon=True)
+            heartbeat = self._heartbeat
+        heartbeat.start()
+
+    def _heartbeat_loop(self):
+        """定期更新心跳，没有认领的任务时退出"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                if not self._claimed:
+                    if self._heartbeat is threading.current_thread():
+                        self._heartbeat = None
+                    return
+            try:
+                self._beat()
+            except Exception as e:
+                logger.warning(f"评审任务心跳更新失败: {e}")
+            finally:
+                close_old_connections()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.resume_pending_reviews()
+            except Exception as e:
+                logger.warning(f"评审任务看门狗执行失败: {e}")
+            finally:
+                close_old_connections()
+
+    def start_watchdog(self):
+        """启动看门狗线程：定期恢复心跳过期的未完成评审"""
+        with self._lock:
+            if self._watchdog is not None:
+                return
+            self._watchdog = threading.Thread(target=self._watch, name='review-job-watchdog', daemon=True)
+        self._watchdog.start()
+
+
+# 全局评审任务执行器
+review_job_runner = ReviewJobRunner()
+
+
+def format_sse(data: dict) -> str:
+    """SSE消息，保留中文字符"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _load_report_state(report_id):
+    from .models import ReviewReport
+    from .services import get_report_progress
+
+    review_report = ReviewReport.objects.get(pk=report_id)
+    return get_report_progress(review_report), (review_report.checkpoint or {}).get('module_analyses') or {}
+
+
+class _ReviewEventState:
+    """事件流状态：对比上次推送的进度和模块，生成需要推送的SSE消息"""
+
+    def __init__(self):
+        self.sent_modules = set()
+        self.last_progress = None
+        self.last_event_at = time.monotonic()
+        self.finished = False
+
+    def collect(self, progress: dict, module_analyses: dict) -> List[str]:
+        events = []
+        if progress != self.last_progress:
+            self.last_progress = progress
+            events.append({'type': 'progress', **progress})
+        for module_id, analysis in module_analyses.items():
+            if module_id in self.sent_modules:
+                continue
+            self.sent_modules.add(module_id)
+            events.append({
+                'type': 'module',
+                'module_id': module_id,
+                'module_name': analysis.get('module_name'),
+                'overall_score': analysis.get('overall_score'),
+                'issues': analysis.get('issues', []),
+            })
+        chunks = [format_sse(event) for event in events]
+
+        if progress['status'] in FINISHED_STATUSES:
+            self.finished = True
+            chunks.append(format_sse({'type': 'done', 'status': progress['status'],
+                                      'report_id': progress['report_id']}))
+        elif events:
+            self.last_event_at = time.monotonic()
+        elif time.monotonic() - self.last_event_at >= EVENT_KEEPALIVE_SECONDS:
+            self.last_event_at = time.monotonic()
+            chunks.append(": keepalive\n\n")
+        return chunks
+
+
+def review_event_stream(report_id, poll_interval: float = None):
+    """
+    评审进度事件流：轮询数据库中的评审报告（多进程部署时同样有效）
+    进度或阶段变化时推送 progress 事件；新完成的模块推送 module 事件（含该模块发现的问题）；
+    评审结束时推送 done 事件后关闭，空闲时定期发送保活注释
+    同步生成器用于WSGI，逐条推送，每个连接占用一个工作线程
+    """
+    poll_interval = poll_interval or getattr(settings, 'REQUIREMENT_REVIEW_EVENT_POLL_INTERVAL', 1.0)
+    state = _ReviewEventState()
+    while True:
+        yield from state.collect(*_load_report_state(report_id))
+        if state.finished:
+            return
+        time.sleep(poll_interval)
+
+
+async def areview_event_stream(report_id, poll_interval: float = None):
+    """
+    review_event_stream 的异步版本，用于ASGI
+    （Django迭代同步生成器时会先在线程中读完整个生成器，事件无法逐条推送）
+    """
+    poll_interval = poll_interval or getattr(settings, 'REQUIREMENT_REVIEW_EVENT_POLL_INTERVAL', 1.0)
+    load_report_state = sync_to_async(_load_report_state)
+    state = _ReviewEventState()
+    while True:
+        for chunk in state.collect(*await load_report_state(report_id)):
+            yield chunk
+        if state.finished:
+            return
+        await asyncio.sleep(poll_interval)
@@ -19,9 +19,12 @@ class RequirementDocumentSerializer(serializers.ModelSerializer):
             'status', 'version', 'is_latest', 'parent_document',
             'uploader', 'uploader_name', 'project', 'project_name',
             'uploaded_at', 'updated_at', 'word_count', 'page_count',
-            'modules_count'
+            'modules_count', 'extraction_status', 'extraction_progress', 'extraction_error'
+        ]
+        read_only_fields = [
+            'id', 'uploader', 'uploaded_at', 'updated_at',
+            'extraction_status', 'extraction_progress', 'extraction_error'
         ]
-        read_only_fields = ['id', 'uploader', 'uploaded_at', 'updated_at']
     
     def get_modules_count(self, obj):
         """获取模块数量"""
@@ -35,9 +38,9 @@ class RequirementDocumentUploadSerializer(serializers.ModelSerializer):
         model = RequirementDocument
         fields = [
             'id', 'title', 'description', 'document_type', 'file', 'content', 'project',
-            'status', 'word_count', 'uploaded_at'
+            'status', 'word_count', 'uploaded_at', 'extraction_status'
         ]
-        read_only_fields = ['id', 'status', 'word_count', 'uploaded_at']
+        read_only_fields = ['id', 'status', 'word_count', 'uploaded_at', 'extraction_status']
     
     def validate(self, data):
         """验证文档内容"""
@@ -92,10 +95,10 @@ class ModuleReviewResultSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'module', 'module_name', 'module_rating', 'module_rating_display',
             'issues_count', 'severity_score', 'analysis_content',
-            'strengths', 'weaknesses', 'recommendations',
+            'strengths', 'weaknesses', 'recommendations', 'from_cache',
             'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'from_cache', 'created_at', 'updated_at']
 
 
 class ReviewReportSerializer(serializers.ModelSerializer):
@@ -114,9 +117,15 @@ class ReviewReportSerializer(serializers.ModelSerializer):
             'completion_score', 'total_issues', 'high_priority_issues',
             'medium_priority_issues', 'low_priority_issues',
             'summary', 'recommendations', 'issues', 'module_results',
+            'current_stage', 'progress', 'total_modules', 'completed_modules',
+            'cancel_requested', 'error_message', 'started_at', 'finished_at', 'reused_results',
+            'created_at', 'updated_at'
+        ]
+        read_only_fields = [
+            'id', 'review_date', 'current_stage', 'progress', 'total_modules', 'completed_modules',
+            'cancel_requested', 'error_message', 'started_at', 'finished_at', 'reused_results',
             'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'review_date', 'created_at', 'updated_at']
 
 
 class RequirementDocumentDetailSerializer(RequirementDocumentSerializer):
@@ -236,19 +245,14 @@ class ModuleBatchUpdateSerializer(serializers.Serializer):
     operations = ModuleOperationSerializer(many=True)
 
     def validate_operations(self, value):
-        """验证操作列表"""
+        """
+        验证操作列表
+        操作按顺序执行，同一模块可被多个操作引用（如先重命名再合并）；
+        引用已被前面的操作合并、拆分或删除的模块由 ModuleOperationService.validate_operations 按模块现状校验
+        """
         if not value:
             raise serializers.ValidationError("至少需要一个操作")
 
-        # 检查操作冲突
-        target_modules = set()
-        for op in value:
-            if op.get('target_modules'):
-                for module_id in op['target_modules']:
-                    if module_id in target_modules:
-                        raise serializers.ValidationError(f"模块 {module_id} 被多个操作引用")
-                    target_modules.add(module_id)
-
         return value
 
 
@@ -1,22 +1,38 @@
+import io
 import logging
 import json
+import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 from typing import List, Dict, Any, Optional
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langgraph_integration.models import LLMConfig
+from langgraph_integration.llm_gateway import llm_gateway, PRIORITY_BATCH
+from langgraph_integration.response_cache import get_response_cache
 from .models import RequirementDocument, RequirementModule
+from .pdf_extraction import format_page
+from .context_packer import ContextPacker
+from .review_cache import (
+    get_cached_result, get_cached_results, hash_text, prompt_version, review_cache_enabled, store_result
+)
 from prompts.models import UserPrompt
 
 logger = logging.getLogger(__name__)
 
 
-def create_llm_instance(active_config, temperature=0.1):
+def create_llm_instance(active_config, temperature=0.1, priority=PRIORITY_BATCH, user=None, cache_namespace=None):
     """
     根据配置创建合适的LLM实例，支持多种供应商
+    默认以批量优先级接入LLM网关，与对话共享限流队列且让位于交互式对话；
+    指定cache_namespace时启用响应缓存（需开启LLM_RESPONSE_CACHE_ENABLED）
     """
     model_identifier = active_config.name or "gpt-3.5-turbo"
     
@@ -25,7 +41,8 @@ def create_llm_instance(active_config, temperature=0.1):
     
     if "anthropic.com" in api_url or "claude" in model_identifier.lower():
         # Anthropic/Claude
-        llm = ChatAnthropic(
+        llm = llm_gateway.create_llm(
+            ChatAnthropic, active_config, priority=priority, user=user,
             model=model_identifier,
             api_key=active_config.api_key,
             temperature=temperature
@@ -46,12 +63,53 @@ def create_llm_instance(active_config, temperature=0.1):
             if "ollama" in api_url or not active_config.api_key:
                 llm_kwargs["api_key"] = "ollama"
         
-        llm = ChatOpenAI(**llm_kwargs)
+        llm = llm_gateway.create_llm(ChatOpenAI, active_config, priority=priority, user=user, **llm_kwargs)
         logger.info(f"Initialized ChatOpenAI with model: {model_identifier}")
     
+    response_cache = get_response_cache(cache_namespace) if cache_namespace else None
+    if response_cache is not None:
+        llm.cache = response_cache
+    
     return llm
 
 
+def _is_rate_limit_error(error: Exception) -> bool:
+    """是否为供应商限流错误（HTTP 429 / RateLimitError）"""
+    if getattr(error, 'status_code', None) == 429 or 'RateLimit' in type(error).__name__:
+        return True
+    message = str(error).lower()
+    return '429' in message or 'rate limit' in message or 'too many requests' in message
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """读取限流响应中的 Retry-After 头"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def invoke_with_backoff(llm, messages):
+    """
+    调用LLM，遇到限流错误时按 Retry-After 或指数退避（带随机抖动）重试，
+    重试次数和基础间隔由 REQUIREMENT_REVIEW_MAX_RETRIES、REQUIREMENT_REVIEW_RETRY_BASE_DELAY 配置
+    """
+    max_retries = getattr(settings, 'REQUIREMENT_REVIEW_MAX_RETRIES', 3)
+    base_delay = getattr(settings, 'REQUIREMENT_REVIEW_RETRY_BASE_DELAY', 2.0)
+    attempt = 0
+    while True:
+        try:
+            return llm.invoke(messages)
+        except Exception as e:
+            if attempt >= max_retries or not _is_rate_limit_error(e):
+                raise
+            delay = _retry_after_seconds(e) or base_delay * (2 ** attempt) * (1 + random.random() * 0.5)
+            attempt += 1
+            logger.warning(f"LLM请求被限流，{delay:.1f}秒后第{attempt}次重试: {e}")
+            time.sleep(delay)
+
+
 class DocumentProcessor:
     """文档处理器 - 负责文档内容提取和预处理"""
     
@@ -132,34 +190,39 @@ class DocumentProcessor:
         return self._extract_from_txt(file)  # Markdown本质上是文本文件
 
     def _extract_from_pdf(self, file) -> str:
-        """提取PDF文件内容"""
+        """提取PDF文件内容（同步）；上传的PDF由 document_extraction_runner 在后台并行提取"""
         try:
-            import PyPDF2
+            from pypdf import PdfReader
 
             # 重置文件指针
             file.seek(0)
 
             # 创建PDF读取器
-            pdf_reader = PyPDF2.PdfReader(file)
-
-            # 提取所有页面的文本
+            pdf_reader = PdfReader(file)
+            max_pages = getattr(settings, 'REQUIREMENT_PDF_MAX_PAGES', 300)
+            total_pages = len(pdf_reader.pages)
+            if max_pages and total_pages > max_pages:
+                logger.warning(f"PDF共{total_pages}页，超过上限，只提取前{max_pages}页")
+                total_pages = max_pages
+
+            # 提取页面的文本
             text_content = []
-            for page_num, page in enumerate(pdf_reader.pages):
+            for page_num in range(total_pages):
                 try:
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        text_content.append(f"=== 第{page_num + 1}页 ===\n{page_text.strip()}")
+                    page_text = format_page(page_num, pdf_reader.pages[page_num].extract_text())
+                    if page_text:
+                        text_content.append(page_text)
                 except Exception as e:
                     logger.warning(f"提取PDF第{page_num + 1}页失败: {e}")
                     continue
 
             content = "\n\n".join(text_content)
-            logger.info(f"成功提取PDF内容，页数: {len(pdf_reader.pages)}, 内容长度: {len(content)}")
+            logger.info(f"成功提取PDF内容，页数: {total_pages}, 内容长度: {len(content)}")
 
             return content
 
         except ImportError:
-            logger.error("PyPDF2库未安装，无法解析PDF文档")
+            logger.error("pypdf库未安装，无法解析PDF文档")
             return ""
         except Exception as e:
             logger.error(f"PDF文档解析失败: {e}")
@@ -170,8 +233,6 @@ class DocumentProcessor:
         """提取Word文件内容，保留标题格式和表格位置"""
         try:
             from docx import Document
-            from docx.table import Table
-            from docx.text.paragraph import Paragraph
 
             # 重置文件指针
             file.seek(0)
@@ -179,31 +240,17 @@ class DocumentProcessor:
             # 使用python-docx读取Word文档
             doc = Document(file)
 
-            # 按文档顺序处理所有元素（段落和表格）
-            content_parts = []
-
-            # 遍历文档的所有元素
-            for element in doc.element.body:
-                if element.tag.endswith('p'):  # 段落元素
-                    # 找到对应的段落对象
-                    for paragraph in doc.paragraphs:
-                        if paragraph._element == element:
-                            text = paragraph.text.strip()
-                            if text:
-                                markdown_text = self._convert_paragraph_to_markdown(paragraph)
-                                content_parts.append(markdown_text)
-                            break
-                elif element.tag.endswith('tbl'):  # 表格元素
-                    # 找到对应的表格对象
-                    for table in doc.tables:
-                        if table._element == element:
-                            table_content = self._extract_table_content(table)
-                            if table_content:
-                                content_parts.append(table_content)
-                            break
+            # 按文档顺序逐个写入段落和表格，不保留中间结果列表
+            output = io.StringIO()
+            element_count = 0
+            for block in self._iter_word_blocks(doc):
+                if element_count:
+                    output.write("\n\n")
+                output.write(block)
+                element_count += 1
 
-            content = "\n\n".join(content_parts)
-            logger.info(f"成功提取Word文档内容，元素数: {len(content_parts)}, 内容长度: {len(content)}")
+            content = output.getvalue()
+            logger.info(f"成功提取Word文档内容，元素数: {element_count}, 内容长度: {len(content)}")
 
             return content
 
@@ -215,6 +262,35 @@ class DocumentProcessor:
             # 如果解析失败，使用简化方法
             return self._extract_from_word_simple(file)
 
+    def _iter_word_blocks(self, doc):
+        """
+        按文档顺序生成段落和表格的Markdown文本，跳过空内容
+        直接遍历文档主体的子元素并包装为段落/表格对象，不再为每个元素在全部段落/表格中查找对应对象
+        （也不使用 XPath 合并查询，libxml2 合并大节点集的耗时随元素数超线性增长）
+        """
+        from docx.oxml.ns import qn
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+
+        paragraph_tag, table_tag = qn('w:p'), qn('w:tbl')
+        heading_prefixes = {}  # 段落样式ID -> 标题前缀，同一样式只解析一次
+        for element in doc.element.body.iterchildren():
+            if element.tag == table_tag:
+                table_content = self._extract_table_content(Table(element, doc._body))
+                if table_content:
+                    yield table_content
+            elif element.tag == paragraph_tag:
+                paragraph = Paragraph(element, doc._body)
+                text = paragraph.text.strip()
+                if not text:
+                    continue
+                style_id = element.style
+                if style_id not in heading_prefixes:
+                    heading_prefixes[style_id] = self._heading_prefix(
+                        paragraph.style.name if paragraph.style else ""
+                    )
+                yield f"{heading_prefixes[style_id]}{text}"
+
     def _extract_from_word_simple(self, file) -> str:
         """简化的Word文档提取方法（备用）"""
         try:
@@ -255,25 +331,17 @@ class DocumentProcessor:
         # 检查段落样式
         style_name = paragraph.style.name if paragraph.style else ""
 
-        # 根据样式名称转换为Markdown标题
-        if 'Heading 1' in style_name or 'heading 1' in style_name.lower():
-            return f"# {text}"
-        elif 'Heading 2' in style_name or 'heading 2' in style_name.lower():
-            return f"## {text}"
-        elif 'Heading 3' in style_name or 'heading 3' in style_name.lower():
-            return f"### {text}"
-        elif 'Heading 4' in style_name or 'heading 4' in style_name.lower():
-            return f"#### {text}"
-        elif 'Heading 5' in style_name or 'heading 5' in style_name.lower():
-            return f"##### {text}"
-        elif 'Heading 6' in style_name or 'heading 6' in style_name.lower():
-            return f"###### {text}"
-        else:
-            # 对于非标题样式的段落，直接返回原文本
-            # 不再根据粗体格式推测标题，避免误判
-            return text
-
+        # 根据样式名称转换为Markdown标题；对于非标题样式的段落，直接返回原文本
+        # 不再根据粗体格式推测标题，避免误判
+        return f"{self._heading_prefix(style_name)}{text}"
 
+    @staticmethod
+    def _heading_prefix(style_name: str) -> str:
+        """根据段落样式名称返回Markdown标题前缀（Heading 1-6），非标题样式返回空字符串"""
+        for level in range(1, 7):
+            if f'Heading {level}' in style_name or f'heading {level}' in style_name.lower():
+                return '#' * level + ' '
+        return ""
 
     def _extract_table_content(self, table) -> str:
         """提取表格内容为Markdown格式"""
@@ -388,13 +456,30 @@ class DocumentProcessor:
         return content.strip()
 
 
+# Markdown标题级别
+HEADING_PATTERNS = {
+    'h1': '# ',
+    'h2': '## ',
+    'h3': '### '
+}
+# 编号标题："3 标题"、"3.2 标题"、"3.2.1. 标题"，段数即标题级别
+NUMBERED_HEADING_RE = re.compile(r'^(\d+(?:\.\d+){0,2})\.?\s+\S')
+# 超过该长度或以句末标点结尾的编号行视为列表项或正文，而不是标题
+NUMBERED_HEADING_MAX_LENGTH = 60
+SENTENCE_ENDINGS = ('。', '；', ';', '，', ',', '：', ':')
+
+
 class ModuleSplitter:
     """模块拆分器 - 负责AI智能模块识别和拆分"""
 
     def __init__(self, user=None):
         self.user = user
-        self.llm = self._get_llm_instance()
-    
+
+    @cached_property
+    def llm(self):
+        """LLM实例，首次使用时创建（按标题或字数拆分不需要LLM）"""
+        return self._get_llm_instance()
+
     def _get_llm_instance(self):
         """获取LLM实例"""
         try:
@@ -403,7 +488,8 @@ class ModuleSplitter:
                 raise Exception("没有可用的LLM配置")
 
             # 使用新的LLM工厂函数，支持多供应商
-            return create_llm_instance(active_config, temperature=0.1)
+            return create_llm_instance(active_config, temperature=0.1, user=self.user,
+                                       cache_namespace='requirement_split')
         except Exception as e:
             logger.error(f"获取LLM实例失败: {e}")
             raise
@@ -435,8 +521,10 @@ class ModuleSplitter:
             # 根据拆分级别选择方法
             if split_level == 'auto':
                 modules_data = self._split_by_character_length(content, chunk_size)
-            elif split_level in ['h1', 'h2', 'h3']:
-                modules_data = self._split_by_heading_level(content, split_level, include_context)
+            elif split_level in HEADING_PATTERNS:
+                modules_data = self._split_by_heading_level(
+                    content, split_level, include_context, split_options.get('numbered_headings', False)
+                )
             else:
                 raise ValueError(f"不支持的拆分级别: {split_level}")
 
@@ -886,58 +974,45 @@ class ModuleSplitter:
         logger.info(f"拆分完成，共生成 {len(modules_data)} 个分块")
         return modules_data
 
-    def _split_by_heading_level(self, content: str, level: str, include_context: bool = True) -> List[Dict[str, Any]]:
-        """根据标题级别拆分文档"""
+    def _split_by_heading_level(self, content: str, level: str, include_context: bool = True,
+                                numbered_headings: bool = False) -> List[Dict[str, Any]]:
+        """
+        根据标题级别拆分文档
+        单次遍历所有行，逐行累加字符位置，耗时与文档长度成线性关系；
+        numbered_headings 为 True 时，"3.2 标题"这类编号标题也按编号层级（段数）视为对应级别的标题
+        """
         lines = content.split('\n')
 
-        # 标题模式映射
-        heading_patterns = {
-            'h1': '# ',
-            'h2': '## ',
-            'h3': '### '
-        }
-
-        target_pattern = heading_patterns.get(level)
+        target_pattern = HEADING_PATTERNS.get(level)
         if not target_pattern:
             raise ValueError(f"不支持的标题级别: {level}")
+        target_depth = len(target_pattern) - 1
 
         logger.info(f"按 {level.upper()} 级别标题拆分文档")
 
-        # 查找所有目标级别的标题
-        heading_positions = []
-        context_headings = {}  # 存储上级标题作为上下文
-
-        current_h1 = ""
-        current_h2 = ""
-
+        # 查找所有目标级别的标题：(行号, 行首之前文本的长度, 标题)
+        headings = []
+        preface_title = None
+        offset = 0  # 当前行在原文中的起始字符位置
         for i, line in enumerate(lines):
             stripped = line.strip()
-
-            # 跟踪上级标题
-            if stripped.startswith('# ') and not stripped.startswith('## '):
-                current_h1 = stripped
-            elif stripped.startswith('## ') and not stripped.startswith('### '):
-                current_h2 = stripped
-
-            # 找到目标级别的标题
             if stripped.startswith(target_pattern) and not stripped.startswith(target_pattern + '#'):
-                heading_positions.append(i)
-
-                # 保存上下文
-                context = []
-                if include_context:
-                    if level == 'h2' and current_h1:
-                        context.append(current_h1)
-                    elif level == 'h3' and current_h1:
-                        context.append(current_h1)
-                        if current_h2:
-                            context.append(current_h2)
-
-                context_headings[i] = context
-
-        logger.info(f"找到 {len(heading_positions)} 个 {level.upper()} 级别标题")
-
-        if len(heading_positions) == 0:
+                # 位置为该行之前的文本（不含末尾换行）的长度
+                headings.append((i, max(offset - 1, 0), stripped.replace(target_pattern, '').strip()))
+            elif numbered_headings and self._numbered_heading_depth(stripped) == target_depth:
+                headings.append((i, max(offset - 1, 0), stripped))
+
+            # 第一个目标标题之前的一级标题作为前言标题
+            if not headings and preface_title is None:
+                if stripped.startswith('# ') and not stripped.startswith('## '):
+                    preface_title = stripped.replace('# ', '').strip()
+                elif numbered_headings and self._numbered_heading_depth(stripped) == 1:
+                    preface_title = stripped
+            offset += len(line) + 1
+
+        logger.info(f"找到 {len(headings)} 个 {level.upper()} 级别标题")
+
+        if len(headings) == 0:
             # 没有找到目标级别的标题，fallback到字数拆分
             logger.warning(f"未找到 {level.upper()} 级别标题，使用字数拆分")
             return self._split_by_character_length(content)
@@ -947,57 +1022,36 @@ class ModuleSplitter:
         order = 1
 
         # 处理第一个目标标题之前的内容（前言部分）
-        if heading_positions and heading_positions[0] > 0:
-            preface_lines = lines[:heading_positions[0]]
-            preface_content = '\n'.join(preface_lines).strip()
+        first_idx, first_char, _ = headings[0]
+        if first_idx > 0:
+            preface_content = '\n'.join(lines[:first_idx]).strip()
 
             if preface_content:  # 如果前言部分有内容
-                # 尝试从前言中提取标题
-                preface_title = "前言"
-                for line in preface_lines:
-                    stripped = line.strip()
-                    if stripped.startswith('# ') and not stripped.startswith('## '):
-                        preface_title = stripped.replace('# ', '').strip()
-                        break
-
-                start_char = 0
-                end_char = len('\n'.join(lines[:heading_positions[0]]))
-                start_page = 1
-                end_page = (end_char // 500) + 1
-
+                preface_title = preface_title or "前言"
                 modules_data.append({
                     'title': preface_title,
                     'content': preface_content,
                     'confidence_score': 0.90,
                     'estimated_complexity': 'medium',
                     'order': order,
-                    'start_page': start_page,
-                    'end_page': end_page,
-                    'start_position': start_char,
-                    'end_position': end_char,
+                    'start_page': 1,
+                    'end_page': (first_char // 500) + 1,
+                    'start_position': 0,
+                    'end_position': first_char,
                     'split_method': f'{level}_heading_preface'
                 })
 
                 logger.info(f"模块 {order}: {preface_title} (前言), 内容长度: {len(preface_content)}")
                 order += 1
 
-        # 处理每个目标级别标题的内容
-        for i, start_idx in enumerate(heading_positions):
-            end_idx = heading_positions[i + 1] if i + 1 < len(heading_positions) else len(lines)
-
-            # 构建模块内容（从目标标题开始到下一个同级标题）
-            module_lines = lines[start_idx:end_idx]
-            module_content = '\n'.join(module_lines).strip()
-
-            # 生成模块标题
-            title_line = lines[start_idx].strip()
-            title = title_line.replace(target_pattern, '').strip()
+        # 处理每个目标级别标题的内容（从目标标题开始到下一个同级标题）
+        for i, (start_idx, start_char, title) in enumerate(headings):
+            if i + 1 < len(headings):
+                end_idx, end_char, _ = headings[i + 1]
+            else:
+                end_idx, end_char = len(lines), len(content)
 
-            # 计算字符位置和页数
-            start_char = len('\n'.join(lines[:start_idx]))
-            end_char = len('\n'.join(lines[:end_idx]))
-            start_page = (start_char // 500) + 1
-            end_page = (end_char // 500) + 1
+            module_content = '\n'.join(lines[start_idx:end_idx]).strip()
 
             modules_data.append({
                 'title': title,
@@ -1005,8 +1059,8 @@ class ModuleSplitter:
                 'confidence_score': 0.95,  # 按标题拆分，置信度很高
                 'estimated_complexity': 'medium',
                 'order': order,
-                'start_page': start_page,
-                'end_page': end_page,
+                'start_page': (start_char // 500) + 1,
+                'end_page': (end_char // 500) + 1,
                 'start_position': start_char,
                 'end_position': end_char,
                 'split_method': f'{level}_heading'
@@ -1017,6 +1071,14 @@ class ModuleSplitter:
 
         return modules_data
 
+    @staticmethod
+    def _numbered_heading_depth(stripped: str) -> int:
+        """编号标题（如"3"、"3.2"、"3.2.1 标题"）的层级，不是编号标题时返回0"""
+        if len(stripped) > NUMBERED_HEADING_MAX_LENGTH or stripped.endswith(SENTENCE_ENDINGS):
+            return 0
+        match = NUMBERED_HEADING_RE.match(stripped)
+        return match.group(1).count('.') + 1 if match else 0
+
     def _split_by_equal_parts(self, content: str, num_parts: int) -> List[Dict[str, Any]]:
         """按相等部分分割内容"""
         lines = content.split('\n')
@@ -1154,10 +1216,9 @@ class RequirementModuleService:
             # 模块拆分（支持多种拆分方式）
             modules_data = self.module_splitter.split_into_modules(document, processed_content, split_options)
             
-            # 创建模块对象
-            modules = []
-            for module_data in modules_data:
-                module = RequirementModule.objects.create(
+            # 创建模块对象，与文档状态在同一事务中批量写入
+            modules = [
+                RequirementModule(
                     document=document,
                     title=module_data['title'],
                     content=module_data['content'],
@@ -1170,11 +1231,14 @@ class RequirementModuleService:
                     is_auto_generated=True,
                     ai_suggested_title=module_data['title']
                 )
-                modules.append(module)
-            
-            # 更新文档状态
-            document.status = 'user_reviewing'
-            document.save()
+                for module_data in modules_data
+            ]
+            with transaction.atomic():
+                RequirementModule.objects.bulk_create(modules)
+
+                # 更新文档状态
+                document.status = 'user_reviewing'
+                document.save()
             
             logger.info(f"文档 {document.id} 模块拆分完成，生成 {len(modules)} 个模块")
             return modules
@@ -1212,16 +1276,28 @@ class ModuleOperationService:
             raise ValueError(f"不支持的操作类型: {operation}")
 
     def execute_batch_operations(self, operations_data: List[dict]) -> dict:
-        """执行批量模块操作"""
-        results = []
+        """
+        按顺序执行批量模块操作
+        执行前按当前模块校验全部操作，有错误时不做任何修改；全部操作在一个事务中执行，
+        任一操作失败时整体回滚，最后统一规范化一次排序
+        """
+        errors = self.validate_operations(operations_data)
+        if errors:
+            return {
+                'success': False,
+                'error': f'{len(errors)} 个操作校验失败，未执行任何操作',
+                'errors': errors,
+                'completed_operations': 0
+            }
 
+        results = []
         try:
-            for operation_data in operations_data:
-                result = self.execute_operation(operation_data)
-                results.append(result)
+            with transaction.atomic():
+                for operation_data in operations_data:
+                    results.append(self.execute_operation(operation_data))
 
-            # 重新计算所有模块的排序
-            self._normalize_module_orders()
+                # 重新计算所有模块的排序
+                self._normalize_module_orders()
 
             return {
                 'success': True,
@@ -1231,13 +1307,67 @@ class ModuleOperationService:
             }
 
         except Exception as e:
-            logger.error(f"批量操作失败: {e}")
+            logger.error(f"批量操作失败，已回滚: {e}")
             return {
                 'success': False,
-                'error': str(e),
-                'completed_operations': len(results)
+                'error': f'第 {len(results) + 1} 个操作失败，已回滚全部操作: {e}',
+                'failed_operation': len(results),
+                'completed_operations': 0
             }
 
+    def validate_operations(self, operations_data: List[dict]) -> List[dict]:
+        """
+        按顺序模拟执行操作，校验目标模块是否存在（包括被前面的操作合并、拆分或删除）、拆分点和标题是否匹配等
+        返回错误列表 [{'index', 'operation', 'error'}]，为空表示全部有效
+        """
+        modules = {str(module.id): module for module in self.document.modules.all()}
+        alive = set(modules)
+        created = 0
+        errors = []
+
+        for index, operation_data in enumerate(operations_data):
+            operation = operation_data.get('operation')
+            targets = [str(module_id) for module_id in operation_data.get('target_modules') or []]
+            missing = [module_id for module_id in targets if module_id not in alive]
+            if operation == 'reorder':
+                missing = [str(module_id) for module_id in operation_data.get('new_orders', {})
+                           if str(module_id) not in alive]
+
+            def add_error(message):
+                errors.append({'index': index, 'operation': operation, 'error': message})
+
+            if missing:
+                add_error(f"模块 {', '.join(missing)} 不存在或已被前面的操作合并、拆分或删除")
+                continue
+
+            if operation == 'merge':
+                if len(set(targets)) < 2:
+                    add_error("合并操作至少需要2个不同的模块")
+                    continue
+                alive.difference_update(targets)
+                created += 1
+            elif operation == 'split':
+                split_titles = operation_data.get('split_titles') or []
+                parts = self._split_content(modules[targets[0]].content, operation_data.get('split_points') or [])
+                if len(parts) != len(split_titles):
+                    add_error(f"拆分后有 {len(parts)} 段内容，但提供了 {len(split_titles)} 个标题")
+                    continue
+                alive.discard(targets[0])
+                created += len(parts)
+            elif operation == 'delete':
+                alive.discard(targets[0])
+            elif operation in ('rename', 'create'):
+                title = (operation_data.get('new_module_data') or {}).get('title')
+                if not isinstance(title, str) or not title.strip() or len(title) > 200:
+                    add_error("模块标题不能为空且不能超过200个字符")
+                    continue
+                if operation == 'create':
+                    created += 1
+
+        if not errors and not alive and not created:
+            errors.append({'index': None, 'operation': None, 'error': '操作后文档至少需要保留一个模块'})
+        return errors
+
     def _merge_modules(self, operation_data: dict) -> dict:
         """合并模块"""
         target_module_ids = operation_data['target_modules']
@@ -1250,13 +1380,14 @@ class ModuleOperationService:
             document=self.document
         ).order_by('order')
 
-        if modules.count() < 2:
+        modules = list(modules)
+        if len(modules) < 2:
             raise ValueError("合并操作至少需要2个模块")
 
         # 合并内容
         merged_content = '\n\n'.join([module.content for module in modules])
-        first_module = modules.first()
-        last_module = modules.last()
+        first_module = modules[0]
+        last_module = modules[-1]
 
         # 创建新的合并模块
         merged_module = RequirementModule.objects.create(
@@ -1271,13 +1402,13 @@ class ModuleOperationService:
         )
 
         # 删除原模块
-        modules.delete()
+        RequirementModule.objects.filter(id__in=[module.id for module in modules]).delete()
 
         return {
             'operation': 'merge',
             'new_module_id': str(merged_module.id),
-            'merged_modules_count': modules.count(),
-            'message': f'成功合并 {modules.count()} 个模块为 "{merge_title}"'
+            'merged_modules_count': len(modules),
+            'message': f'成功合并 {len(modules)} 个模块为 "{merge_title}"'
         }
 
     def _split_module(self, operation_data: dict) -> dict:
@@ -1292,45 +1423,31 @@ class ModuleOperationService:
             document=self.document
         )
 
-        content = module.content
-
-        # 按拆分点分割内容
-        content_parts = []
-        last_pos = 0
-
-        for split_point in sorted(split_points):
-            if split_point > last_pos and split_point < len(content):
-                content_parts.append(content[last_pos:split_point])
-                last_pos = split_point
-
-        # 添加最后一部分
-        content_parts.append(content[last_pos:])
-
-        # 过滤空内容
-        content_parts = [part.strip() for part in content_parts if part.strip()]
-
+        content_parts = self._split_content(module.content, split_points)
         if len(content_parts) != len(split_titles):
             raise ValueError("拆分内容数量与标题数量不匹配")
 
-        # 创建新模块
-        new_modules = []
+        # 创建新模块，占用原模块的位置，后面的模块依次后移
         base_order = module.order
-
-        for i, (content_part, title) in enumerate(zip(content_parts, split_titles)):
-            new_module = RequirementModule.objects.create(
+        new_modules = [
+            RequirementModule(
                 document=self.document,
                 title=title,
                 content=content_part,
                 start_page=module.start_page,
                 end_page=module.end_page,
-                order=base_order + i * 0.1,  # 使用小数保持顺序
+                order=base_order + i,
                 is_auto_generated=False,
                 confidence_score=0.8
             )
-            new_modules.append(new_module)
+            for i, (content_part, title) in enumerate(zip(content_parts, split_titles))
+        ]
+        with transaction.atomic():
+            self.document.modules.filter(order__gt=base_order).update(order=F('order') + len(new_modules) - 1)
+            RequirementModule.objects.bulk_create(new_modules)
 
-        # 删除原模块
-        module.delete()
+            # 删除原模块
+            module.delete()
 
         return {
             'operation': 'split',
@@ -1339,27 +1456,48 @@ class ModuleOperationService:
             'message': f'成功将模块拆分为 {len(new_modules)} 个子模块'
         }
 
+    @staticmethod
+    def _split_content(content: str, split_points: List[int]) -> List[str]:
+        """按拆分点（字符位置）分割内容，忽略越界和重复的拆分点，去掉空白部分"""
+        content_parts = []
+        last_pos = 0
+
+        for split_point in sorted(split_points):
+            if split_point > last_pos and split_point < len(content):
+                content_parts.append(content[last_pos:split_point])
+                last_pos = split_point
+
+        # 添加最后一部分
+        content_parts.append(content[last_pos:])
+
+        # 过滤空内容
+        return [part.strip() for part in content_parts if part.strip()]
+
     def _reorder_modules(self, operation_data: dict) -> dict:
         """重新排序模块"""
+        from django.utils import timezone
+
         new_orders = operation_data['new_orders']
 
-        updated_count = 0
+        # 一次查询取出全部目标模块，批量更新排序
+        modules = RequirementModule.objects.filter(id__in=new_orders.keys(), document=self.document)
+        modules_by_id = {str(module.id): module for module in modules}
+        now = timezone.now()
+        updated_modules = []
         for module_id, new_order in new_orders.items():
-            try:
-                module = RequirementModule.objects.get(
-                    id=module_id,
-                    document=self.document
-                )
-                module.order = new_order
-                module.save()
-                updated_count += 1
-            except RequirementModule.DoesNotExist:
+            module = modules_by_id.get(str(module_id))
+            if module is None:
                 logger.warning(f"模块 {module_id} 不存在")
+                continue
+            module.order = new_order
+            module.updated_at = now
+            updated_modules.append(module)
+        RequirementModule.objects.bulk_update(updated_modules, ['order', 'updated_at'])
 
         return {
             'operation': 'reorder',
-            'updated_count': updated_count,
-            'message': f'成功重新排序 {updated_count} 个模块'
+            'updated_count': len(updated_modules),
+            'message': f'成功重新排序 {len(updated_modules)} 个模块'
         }
 
     def _rename_module(self, operation_data: dict) -> dict:
@@ -1432,12 +1570,101 @@ class ModuleOperationService:
         return (last_module.order + 1) if last_module else 1
 
     def _normalize_module_orders(self):
-        """规范化模块排序（确保连续的整数）"""
-        modules = self.document.modules.order_by('order')
-        for i, module in enumerate(modules, 1):
+        """规范化模块排序（确保连续的整数），只批量更新排序有变化的模块"""
+        changed = []
+        for i, module in enumerate(self.document.modules.order_by('order'), 1):
             if module.order != i:
                 module.order = i
-                module.save()
+                changed.append(module)
+        RequirementModule.objects.bulk_update(changed, ['order'])
+
+
+class ReviewCancelled(Exception):
+    """评审已被取消"""
+
+
+class ReviewProgressListener:
+    """评审进度监听器，默认不记录进度、不可取消；后台评审任务通过子类持久化进度和检查点"""
+
+    def on_stage(self, stage: str, checkpoint: dict):
+        pass
+
+    def on_module_done(self, module: RequirementModule, analysis: dict, completed: Dict[str, dict]):
+        pass
+
+    def is_cancelled(self) -> bool:
+        return False
+
+
+# 各阶段在总进度中所占的区间
+STAGE_PROGRESS = {
+    'queued': (0, 0),
+    'global_analysis': (0, 10),
+    'module_analysis': (10, 80),
+    'consistency_analysis': (80, 90),
+    'report_generation': (90, 99),
+}
+
+
+class ReviewJobListener(ReviewProgressListener):
+    """将评审阶段、模块进度和检查点写入评审报告，并从数据库读取取消标记"""
+
+    def __init__(self, review_report):
+        self.report = review_report
+
+    def _save(self, *fields):
+        from django.utils import timezone
+
+        stage_start, stage_end = STAGE_PROGRESS.get(self.report.current_stage, (0, 0))
+        if self.report.current_stage == 'module_analysis' and self.report.total_modules:
+            completed = min(self.report.completed_modules, self.report.total_modules)
+            stage_start += (stage_end - stage_start) * completed // self.report.total_modules
+        self.report.progress = max(self.report.progress, stage_start)
+        self.report.heartbeat_at = timezone.now()
+        self.report.save(update_fields=['progress', 'heartbeat_at', 'updated_at', *fields])
+
+    def on_stage(self, stage, checkpoint):
+        self.report.current_stage = stage
+        self.report.checkpoint = checkpoint
+        self._save('current_stage', 'checkpoint')
+
+    def on_module_done(self, module, analysis, completed):
+        self.report.completed_modules = len(completed)
+        self._save('completed_modules', 'checkpoint')
+
+    def is_cancelled(self):
+        from .models import ReviewReport
+        return ReviewReport.objects.filter(pk=self.report.pk, cancel_requested=True).exists()
+
+
+def get_report_progress(review_report) -> dict:
+    """评审报告的实时进度，包括当前阶段、已完成模块数和错误信息"""
+    messages = {
+        'pending': '评审任务排队中',
+        'in_progress': '正在进行评审分析...',
+        'completed': '评审已完成',
+        'failed': '评审失败，请重试',
+        'cancelled': '评审已取消',
+    }
+    return {
+        'report_id': str(review_report.id),
+        'status': review_report.status,
+        'progress': review_report.progress,
+        'message': messages.get(review_report.status, ''),
+        'current_stage': review_report.current_stage,
+        'current_step': review_report.get_current_stage_display(),
+        'total_modules': review_report.total_modules,
+        'completed_modules': review_report.completed_modules,
+        'cancel_requested': review_report.cancel_requested,
+        'error_message': review_report.error_message,
+        'started_at': review_report.started_at.isoformat() if review_report.started_at else None,
+        'finished_at': review_report.finished_at.isoformat() if review_report.finished_at else None,
+    }
+
+
+GLOBAL_ANALYSIS_SYSTEM_PROMPT = "你是一位专业的需求分析师，擅长需求文档评审。"
+MODULE_ANALYSIS_SYSTEM_PROMPT = "你是一位专业的需求分析师，正在进行需求评审。"
+CONSISTENCY_ANALYSIS_SYSTEM_PROMPT = "你是一位专业的需求分析师，擅长跨模块一致性检查。"
 
 
 class RequirementReviewEngine:
@@ -1446,6 +1673,8 @@ class RequirementReviewEngine:
     def __init__(self, user=None):
         self.user = user
         self.llm = self._get_llm_instance()
+        # 按模型上下文限制组装提示词内容，取代固定字符数截断
+        self.context_packer = ContextPacker(self._get_model_name())
 
     def _get_llm_instance(self):
         """获取LLM实例"""
@@ -1455,7 +1684,8 @@ class RequirementReviewEngine:
                 raise Exception("没有可用的LLM配置")
 
             # 使用新的LLM工厂函数，支持多供应商
-            return create_llm_instance(active_config, temperature=0.1)
+            return create_llm_instance(active_config, temperature=0.1, user=self.user,
+                                       cache_namespace='requirement_review')
         except Exception as e:
             logger.error(f"获取LLM实例失败: {e}")
             raise
@@ -1480,9 +1710,13 @@ class RequirementReviewEngine:
             if not direct_prompt:
                 raise ValueError("用户未配置直接分析提示词，请先在提示词管理中配置")
 
+            # 文档超出模型上下文预算时先做分块摘要
+            budget = self.context_packer.budget_for(GLOBAL_ANALYSIS_SYSTEM_PROMPT, direct_prompt)
             messages = [
-                SystemMessage(content="你是一位专业的需求分析师，擅长需求文档评审。"),
-                HumanMessage(content=direct_prompt.format(content=content[:8000]))  # 限制长度
+                SystemMessage(content=GLOBAL_ANALYSIS_SYSTEM_PROMPT),
+                HumanMessage(content=direct_prompt.format(
+                    content=self.context_packer.fit(content, budget, self._invoke)
+                ))
             ]
 
             response = self.llm.invoke(messages)
@@ -1537,31 +1771,116 @@ class RequirementReviewEngine:
             ]
         }
 
-    def analyze_document_comprehensive(self, document: RequirementDocument) -> dict:
-        """全面分析需求文档"""
+    def analyze_document_comprehensive(self, document: RequirementDocument, analysis_options: dict = None,
+                                       checkpoint: dict = None, listener: 'ReviewProgressListener' = None) -> dict:
+        """
+        全面分析需求文档
+        checkpoint 保存已完成阶段和模块的结果，传入上次中断时的检查点可跳过已完成的部分；
+        listener 接收阶段切换和模块完成事件，并在模块之间检查是否已取消
+        """
+        analysis_options = analysis_options or {}
+        checkpoint = checkpoint if checkpoint is not None else {}
+        listener = listener or ReviewProgressListener()
         try:
             # 第一步：全局结构分析
-            global_analysis = self._analyze_global_structure(document)
+            use_cache = analysis_options.get('use_cache', True) and review_cache_enabled()
+            if 'global_analysis' not in checkpoint:
+                listener.on_stage('global_analysis', checkpoint)
+                checkpoint['global_analysis'], checkpoint['reused_global'] = self._analyze_global_structure_cached(
+                    document, use_cache
+                )
+            global_analysis = checkpoint['global_analysis']
+            if listener.is_cancelled():
+                raise ReviewCancelled()
 
             # 第二步：模块级详细分析
-            module_analyses = self._analyze_modules_detailed(document, global_analysis)
+            listener.on_stage('module_analysis', checkpoint)
+            module_analyses = self._analyze_modules_detailed(
+                document, global_analysis, parallel=analysis_options.get('parallel_processing', True),
+                completed=checkpoint.setdefault('module_analyses', {}), listener=listener,
+                use_cache=use_cache, reused=checkpoint.setdefault('reused_modules', [])
+            )
 
             # 第三步：跨模块一致性检查
-            consistency_analysis = self._analyze_cross_module_consistency(
-                document, module_analyses, global_analysis
-            )
+            if 'consistency_analysis' not in checkpoint:
+                listener.on_stage('consistency_analysis', checkpoint)
+                checkpoint['consistency_analysis'] = self._analyze_cross_module_consistency(
+                    document, module_analyses, global_analysis
+                )
+            consistency_analysis = checkpoint['consistency_analysis']
 
             # 第四步：生成综合评审报告
+            listener.on_stage('report_generation', checkpoint)
             comprehensive_report = self._generate_comprehensive_report(
                 global_analysis, module_analyses, consistency_analysis
             )
+            # 记录从缓存复用的部分
+            comprehensive_report['reused_results'] = {
+                'global_analysis': bool(checkpoint.get('reused_global')),
+                'module_ids': list(checkpoint.get('reused_modules', [])),
+            }
 
             return comprehensive_report
 
+        except ReviewCancelled:
+            logger.info(f"文档 {document.id} 的评审已取消")
+            raise
         except Exception as e:
             logger.error(f"需求文档分析失败: {e}")
             raise
 
+    def _get_model_name(self) -> str:
+        """当前LLM的模型名，作为评审结果缓存键的一部分"""
+        return getattr(self.llm, 'model_name', None) or getattr(self.llm, 'model', None) or ''
+
+    def _analyze_global_structure_cached(self, document: RequirementDocument, use_cache: bool = True):
+        """全局结构分析，文档内容和提示词未变化时复用缓存结果；返回 (分析结果, 是否复用)"""
+        if not use_cache:
+            return self._analyze_global_structure(document), False
+
+        global_prompt = self._get_user_prompt('global_analysis')
+        if not global_prompt:
+            raise ValueError("用户未配置全局分析提示词，请先在提示词管理中配置")
+        content_hash = hash_text(document.title, document.description, document.content)
+        prompt_hash = prompt_version(GLOBAL_ANALYSIS_SYSTEM_PROMPT, global_prompt)
+        model_name = self._get_model_name()
+
+        cached = get_cached_result('global', content_hash, prompt_hash, model_name)
+        if cached is not None:
+            logger.info(f"文档 {document.id} 的全局分析复用缓存结果")
+            return cached, True
+        try:
+            global_analysis = self._request_global_analysis(document, global_prompt)
+        except Exception as e:
+            logger.error(f"全局结构分析失败: {e}")
+            return self._get_default_global_analysis(), False
+        store_result('global', content_hash, prompt_hash, model_name, global_analysis)
+        return global_analysis, False
+
+    def _request_global_analysis(self, document: RequirementDocument, global_prompt: str) -> dict:
+        """调用LLM进行全局分析，未返回有效JSON时抛出异常"""
+        description = document.description or "无描述"
+        # 文档超出模型上下文预算时先做分块摘要
+        budget = self.context_packer.budget_for(GLOBAL_ANALYSIS_SYSTEM_PROMPT, global_prompt, document.title,
+                                                description)
+        messages = [
+            SystemMessage(content=GLOBAL_ANALYSIS_SYSTEM_PROMPT),
+            HumanMessage(content=global_prompt.format(
+                title=document.title,
+                description=description,
+                content=self.context_packer.fit(
+                    document.content, budget, self._invoke, document.get_token_count(self.context_packer.model_name)
+                )
+            ))
+        ]
+        response = self.llm.invoke(messages)
+        json_match = re.search(r'```json\s*(.*?)\s*```', response.content, re.DOTALL)
+        if not json_match:
+            raise ValueError("全局分析结果中没有JSON内容")
+        global_analysis = json.loads(json_match.group(1))
+        logger.info(f"全局分析完成，总体评分: {global_analysis.get('overall_score', 0)}")
+        return global_analysis
+
     def _analyze_global_structure(self, document: RequirementDocument) -> dict:
         """分析文档的全局结构和上下文"""
 
@@ -1571,28 +1890,7 @@ class RequirementReviewEngine:
             raise ValueError("用户未配置全局分析提示词，请先在提示词管理中配置")
 
         try:
-            messages = [
-                SystemMessage(content="你是一位专业的需求分析师，擅长需求文档评审。"),
-                HumanMessage(content=global_prompt.format(
-                    title=document.title,
-                    description=document.description or "无描述",
-                    content=document.content[:6000]  # 限制长度
-                ))
-            ]
-
-            response = self.llm.invoke(messages)
-
-            # 提取JSON内容
-            json_match = re.search(r'```json\s*(.*?)\s*```', response.content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                global_analysis = json.loads(json_str)
-            else:
-                # 如果没有找到JSON，返回默认结构
-                global_analysis = self._get_default_global_analysis()
-
-            logger.info(f"全局分析完成，总体评分: {global_analysis.get('overall_score', 0)}")
-            return global_analysis
+            return self._request_global_analysis(document, global_prompt)
 
         except json.JSONDecodeError as e:
             logger.error(f"解析全局分析JSON失败: {e}")
@@ -1601,61 +1899,128 @@ class RequirementReviewEngine:
             logger.error(f"全局结构分析失败: {e}")
             return self._get_default_global_analysis()
 
-    def _analyze_modules_detailed(self, document: RequirementDocument, global_context: dict) -> List[dict]:
-        """详细分析各个模块"""
-        modules = document.modules.order_by('order')
-        module_analyses = []
+    def _analyze_modules_detailed(self, document: RequirementDocument, global_context: dict,
+                                  parallel: bool = True, completed: Dict[str, dict] = None,
+                                  listener: 'ReviewProgressListener' = None, use_cache: bool = False,
+                                  reused: List[str] = None) -> List[dict]:
+        """
+        详细分析各个模块
+        并行时最多同时分析 REQUIREMENT_REVIEW_MAX_CONCURRENCY 个模块，结果按模块顺序返回；
+        单个模块失败时使用默认分析结果，不影响其他模块。
+        completed 为已完成模块的结果（模块ID -> 分析结果），这些模块不再重复分析，新完成的模块也写入其中；
+        use_cache 时标题和内容未变化的模块复用缓存结果，复用的模块ID追加到 reused
+        """
+        modules = list(document.modules.order_by('order'))
+        completed = completed if completed is not None else {}
+        listener = listener or ReviewProgressListener()
+        pending_modules = [module for module in modules if str(module.id) not in completed]
+        if not pending_modules:
+            return [completed[str(module.id)] for module in modules]
+
+        # 提示词在主线程查询一次，工作线程只调用LLM、不访问数据库
+        module_prompt = self._get_user_prompt('module_analysis')
+        if not module_prompt:
+            raise ValueError("用户未配置模块分析提示词，请先在提示词管理中配置")
 
-        for module in modules:
+        reused = reused if reused is not None else []
+        prompt_hash = prompt_version(MODULE_ANALYSIS_SYSTEM_PROMPT, module_prompt)
+        model_name = self._get_model_name()
+        # 模块提示词注入了全局分析得到的业务流程、数据实体和全局规则，全局上下文变化时缓存结果不可复用
+        context_hash = hash_text(*self._module_context_fields(global_context).values())
+        content_hashes = {
+            module.id: hash_text(module.title, module.content, context_hash) for module in pending_modules
+        } if use_cache else {}
+
+        def analyze(module):
+            # 返回 (分析结果, 是否为LLM返回的有效结果)
             try:
-                analysis = self._analyze_single_module(module, global_context)
-                module_analyses.append(analysis)
+                return self._request_module_analysis(
+                    module, global_context, module_prompt, token_counts.get(module.id)
+                ), True
             except Exception as e:
                 logger.error(f"模块 {module.title} 分析失败: {e}")
                 # 添加默认分析结果
-                module_analyses.append(self._get_default_module_analysis(module))
-
-        return module_analyses
-
-    def _analyze_single_module(self, module: RequirementModule, global_context: dict) -> dict:
-        """分析单个模块"""
-
-        # 从数据库获取用户的提示词
-        module_prompt = self._get_user_prompt('module_analysis')
-        if not module_prompt:
-            raise ValueError("用户未配置模块分析提示词，请先在提示词管理中配置")
-
-        try:
-            messages = [
-                SystemMessage(content="你是一位专业的需求分析师，正在进行需求评审。"),
-                HumanMessage(content=module_prompt.format(
-                    module_id=str(module.id),
-                    module_title=module.title,
-                    module_content=module.content[:3000],  # 限制长度
-                    business_flows=", ".join(global_context.get('business_flows', [])),
-                    data_entities=", ".join(global_context.get('data_entities', [])),
-                    global_rules=", ".join(global_context.get('global_rules', []))
-                ))
-            ]
+                return self._get_default_module_analysis(module), False
+
+        def record(module, analysis, succeeded=False):
+            # 在调用线程中记录结果和进度，成功的结果写入缓存
+            if succeeded and use_cache:
+                store_result('module', content_hashes[module.id], prompt_hash, model_name, analysis)
+            completed[str(module.id)] = analysis
+            listener.on_module_done(module, analysis, completed)
+            if listener.is_cancelled():
+                raise ReviewCancelled()
+
+        if use_cache:
+            cached = get_cached_results('module', content_hashes.values(), prompt_hash, model_name)
+            hits = [module for module in pending_modules if content_hashes[module.id] in cached]
+            if hits:
+                logger.info(f"{len(hits)}/{len(pending_modules)} 个模块内容未变化，复用缓存的分析结果")
+            for module in hits:
+                analysis = dict(cached[content_hashes[module.id]], module_id=str(module.id))
+                reused.append(str(module.id))
+                record(module, analysis)
+            pending_modules = [module for module in pending_modules if content_hashes[module.id] not in cached]
+            if not pending_modules:
+                return [completed[str(module.id)] for module in modules]
+
+        # 模块内容的token数在主线程读取（内容未变化时使用已保存的结果）
+        token_counts = {
+            module.id: module.get_token_count(self.context_packer.model_name) for module in pending_modules
+        }
+        max_workers = getattr(settings, 'REQUIREMENT_REVIEW_MAX_CONCURRENCY', 4) if parallel else 1
+        max_workers = max(1, min(max_workers, len(pending_modules)))
+        if max_workers == 1:
+            for module in pending_modules:
+                record(module, *analyze(module))
+        else:
+            logger.info(f"并行分析 {len(pending_modules)} 个模块，并发数: {max_workers}")
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='module-review')
+            try:
+                futures = {executor.submit(analyze, module): module for module in pending_modules}
+                for future in as_completed(futures):
+                    record(futures[future], *future.result())
+            finally:
+                # 取消时丢弃尚未开始的模块
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        return [completed[str(module.id)] for module in modules]
+
+    @staticmethod
+    def _module_context_fields(global_context: dict) -> Dict[str, str]:
+        """注入模块分析提示词的全局上下文"""
+        return {
+            'business_flows': ", ".join(global_context.get('business_flows', [])),
+            'data_entities': ", ".join(global_context.get('data_entities', [])),
+            'global_rules': ", ".join(global_context.get('global_rules', [])),
+        }
 
-            response = self.llm.invoke(messages)
+    def _request_module_analysis(self, module: RequirementModule, global_context: dict,
+                                 module_prompt: str, content_tokens: Optional[int] = None) -> dict:
+        """调用LLM分析单个模块，未返回有效JSON时抛出异常，content_tokens 为已知的模块内容token数"""
+        context_fields = self._module_context_fields(global_context)
+        # 模块内容超出预算时按小节优先级整节放入
+        budget = self.context_packer.budget_for(MODULE_ANALYSIS_SYSTEM_PROMPT, module_prompt, module.title,
+                                                *context_fields.values())
+        messages = [
+            SystemMessage(content=MODULE_ANALYSIS_SYSTEM_PROMPT),
+            HumanMessage(content=module_prompt.format(
+                module_id=str(module.id),
+                module_title=module.title,
+                module_content=self.context_packer.fit(module.content, budget, tokens=content_tokens),
+                **context_fields
+            ))
+        ]
 
-            # 提取JSON内容
-            json_match = re.search(r'```json\s*(.*?)\s*```', response.content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                analysis = json.loads(json_str)
-                analysis['module_id'] = str(module.id)  # 确保ID正确
-                return analysis
-            else:
-                return self._get_default_module_analysis(module)
+        response = invoke_with_backoff(self.llm, messages)
 
-        except json.JSONDecodeError as e:
-            logger.error(f"解析模块分析JSON失败: {e}")
-            return self._get_default_module_analysis(module)
-        except Exception as e:
-            logger.error(f"模块分析失败: {e}")
-            return self._get_default_module_analysis(module)
+        # 提取JSON内容
+        json_match = re.search(r'```json\s*(.*?)\s*```', response.content, re.DOTALL)
+        if not json_match:
+            raise ValueError("模块分析结果中没有JSON内容")
+        analysis = json.loads(json_match.group(1))
+        analysis['module_id'] = str(module.id)  # 确保ID正确
+        return analysis
 
     def _analyze_cross_module_consistency(self, document: RequirementDocument,
                                         module_analyses: List[dict], global_context: dict) -> dict:
@@ -1667,15 +2032,23 @@ class RequirementReviewEngine:
             raise ValueError("用户未配置一致性分析提示词，请先在提示词管理中配置")
 
         try:
-            # 准备上下文数据
-            context_str = json.dumps(global_context, ensure_ascii=False, indent=2)
-            analyses_str = json.dumps(module_analyses, ensure_ascii=False, indent=2)
+            # 准备上下文数据：全局上下文最多占四分之一预算，其余按模块问题严重程度整条放入模块分析结果
+            budget = self.context_packer.budget_for(CONSISTENCY_ANALYSIS_SYSTEM_PROMPT, consistency_prompt)
+            context_str = self.context_packer.fit(
+                json.dumps(global_context, ensure_ascii=False, indent=2), budget // 4
+            )
+            packed = self.context_packer.pack_sections(
+                self._module_analysis_sections(module_analyses),
+                budget - self.context_packer.count_tokens(context_str), separator=',\n'
+            )
+            if packed['omitted']:
+                logger.info(f"一致性检查省略了{len(packed['omitted'])}个模块的分析结果")
 
             messages = [
-                SystemMessage(content="你是一位专业的需求分析师，擅长跨模块一致性检查。"),
+                SystemMessage(content=CONSISTENCY_ANALYSIS_SYSTEM_PROMPT),
                 HumanMessage(content=consistency_prompt.format(
-                    global_context=context_str[:2000],  # 限制长度
-                    module_analyses=analyses_str[:4000]  # 限制长度
+                    global_context=context_str,
+                    module_analyses=f"[\n{packed['text']}\n]"
                 ))
             ]
 
@@ -1699,6 +2072,24 @@ class RequirementReviewEngine:
             logger.error(f"一致性分析失败: {e}")
             return self._get_default_consistency_analysis()
 
+    @staticmethod
+    def _module_analysis_sections(module_analyses: List[dict]) -> List[dict]:
+        """模块分析结果作为打包章节：高优先级问题多、评分低的模块优先"""
+        sections = []
+        for order, analysis in enumerate(module_analyses):
+            high_issues = sum(1 for issue in analysis.get('issues', []) if issue.get('priority') == 'high')
+            score = analysis.get('overall_score')
+            sections.append({
+                'title': analysis.get('module_name', ''),
+                'content': json.dumps(analysis, ensure_ascii=False),
+                'priority': (-high_issues, score if isinstance(score, (int, float)) else 0, order),
+            })
+        return sections
+
+    def _invoke(self, messages):
+        """调用LLM（限流时退避重试），供上下文摘要使用"""
+        return invoke_with_backoff(self.llm, messages)
+
     def _generate_comprehensive_report(self, global_analysis: dict,
                                      module_analyses: List[dict],
                                      consistency_analysis: dict) -> dict:
@@ -1899,7 +2290,9 @@ class RequirementReviewService:
                 document=document,
                 status='in_progress',
                 reviewer='AI需求评审助手',
-                review_type='direct'  # 标记为直接评审
+                review_type='direct',  # 标记为直接评审
+                requested_by=self.user,
+                current_stage='global_analysis'
             )
 
             # 更新文档状态
@@ -1921,31 +2314,36 @@ class RequirementReviewService:
             review_report.summary = review_result.get('summary', '')
             review_report.recommendations = review_result.get('recommendations', '')
             review_report.status = 'completed'
+            review_report.current_stage = 'finished'
+            review_report.progress = 100
             review_report.save()
 
-            # 创建问题记录
+            # 创建问题记录，与报告统计和文档状态在同一事务中批量写入
             issues = review_result.get('issues', [])
-            for issue_data in issues:
-                # 映射字段名
-                issue_params = {
-                    'report': review_report,
-                    'title': issue_data.get('title', '未知问题'),
-                    'description': issue_data.get('description', ''),
-                    'priority': issue_data.get('priority', 'medium'),
-                    'issue_type': issue_data.get('category', 'specification'),  # category -> issue_type
-                    'suggestion': issue_data.get('suggestion', ''),
-                    'location': issue_data.get('location', '')
-                }
-                ReviewIssue.objects.create(**issue_params)
+            issue_objects = [
+                ReviewIssue(
+                    report=review_report,
+                    title=str(issue_data.get('title', '未知问题'))[:200],
+                    description=issue_data.get('description', ''),
+                    priority=issue_data.get('priority', 'medium'),
+                    issue_type=issue_data.get('category', 'specification'),  # category -> issue_type
+                    suggestion=issue_data.get('suggestion', ''),
+                    location=str(issue_data.get('location', ''))[:200]
+                )
+                for issue_data in issues
+            ]
 
-            # 更新统计信息
-            review_report.total_issues = len(issues)
-            review_report.high_priority_issues = len([i for i in issues if i.get('priority') == 'high'])
-            review_report.save()
+            with transaction.atomic():
+                ReviewIssue.objects.bulk_create(issue_objects)
 
-            # 更新文档状态
-            document.status = 'review_completed'
-            document.save()
+                # 更新统计信息
+                review_report.total_issues = len(issues)
+                review_report.high_priority_issues = len([i for i in issues if i.get('priority') == 'high'])
+                review_report.save()
+
+                # 更新文档状态
+                document.status = 'review_completed'
+                document.save()
 
             logger.info(f"文档 {document.id} 直接评审完成")
             return review_report
@@ -1957,67 +2355,147 @@ class RequirementReviewService:
                 review_report.save()
             raise
 
-    def start_comprehensive_review(self, document: RequirementDocument,
-                                 analysis_options: dict = None) -> 'ReviewReport':
-        """启动全面的需求评审（基于模块）"""
-        from .models import ReviewReport, ReviewIssue, ModuleReviewResult
-
-        try:
-            # 检查文档状态
-            if document.status != 'ready_for_review':
-                raise ValueError(f"文档状态 {document.status} 不允许开始评审")
+    def _create_comprehensive_report(self, document: RequirementDocument,
+                                     analysis_options: dict = None) -> 'ReviewReport':
+        """创建全面评审报告（待执行），并将文档标记为评审中"""
+        from .models import ReviewReport
+
+        # 检查文档状态
+        if document.status != 'ready_for_review':
+            raise ValueError(f"文档状态 {document.status} 不允许开始评审")
+
+        review_report = ReviewReport.objects.create(
+            document=document,
+            status='pending',
+            reviewer='AI需求评审助手',
+            review_type='comprehensive',  # 标记为全面评审
+            requested_by=self.user,
+            analysis_options=analysis_options or {},
+            total_modules=document.modules.count()
+        )
 
-            # 创建评审报告
-            review_report = ReviewReport.objects.create(
-                document=document,
-                status='in_progress',
-                reviewer='AI需求评审助手',
-                review_type='comprehensive'  # 标记为全面评审
-            )
+        # 更新文档状态
+        document.status = 'reviewing'
+        document.save()
+        return review_report
 
-            # 更新文档状态
-            document.status = 'reviewing'
-            document.save()
-
-            logger.info(f"开始评审文档: {document.title}")
+    def submit_comprehensive_review(self, document: RequirementDocument,
+                                    analysis_options: dict = None) -> 'ReviewReport':
+        """提交后台全面评审任务，立即返回待执行的评审报告"""
+        from .review_jobs import review_job_runner
 
-            # 执行AI分析
-            analysis_result = self.review_engine.analyze_document_comprehensive(document)
+        review_report = self._create_comprehensive_report(document, analysis_options)
+        review_job_runner.submit(review_report.id)
+        logger.info(f"已提交评审任务: {document.title}, 报告 {review_report.id}")
+        return review_report
 
-            # 更新评审报告
-            self._update_review_report(review_report, analysis_result)
+    def start_comprehensive_review(self, document: RequirementDocument,
+                                 analysis_options: dict = None) -> 'ReviewReport':
+        """在当前线程中执行全面的需求评审（基于模块）"""
+        review_report = self._create_comprehensive_report(document, analysis_options)
+        return self.run_comprehensive_review(review_report)
 
-            # 创建问题记录
-            self._create_review_issues(review_report, analysis_result)
+    def run_comprehensive_review(self, review_report: 'ReviewReport') -> 'ReviewReport':
+        """
+        执行全面评审；报告中已有检查点时从最后完成的模块继续
+        取消时报告标记为已取消，文档恢复为待评审；失败时抛出异常
+        """
+        from django.utils import timezone
 
-            # 创建模块评审结果
-            self._create_module_results(review_report, analysis_result)
+        document = review_report.document
+        listener = ReviewJobListener(review_report)
+        try:
+            review_report.status = 'in_progress'
+            review_report.started_at = review_report.started_at or timezone.now()
+            review_report.heartbeat_at = timezone.now()
+            review_report.error_message = ''
+            review_report.save(update_fields=['status', 'started_at', 'heartbeat_at', 'error_message', 'updated_at'])
+            logger.info(f"开始评审文档: {document.title}")
 
-            # 完成评审
-            review_report.status = 'completed'
-            review_report.save()
+            # 执行AI分析
+            analysis_result = self.review_engine.analyze_document_comprehensive(
+                document, review_report.analysis_options, checkpoint=review_report.checkpoint, listener=listener
+            )
 
-            # 更新文档状态
-            document.status = 'review_completed'
-            document.save()
+            # 写入评审结果并完成评审
+            self._save_review_results(review_report, analysis_result)
 
             logger.info(f"评审完成: {document.title}, 总体评分: {review_report.completion_score}")
 
             return review_report
 
+        except ReviewCancelled:
+            self.mark_cancelled(review_report)
+            return review_report
+
         except Exception as e:
             logger.error(f"评审失败: {e}")
 
-            # 更新失败状态
-            if 'review_report' in locals():
-                review_report.status = 'failed'
-                review_report.save()
+            # 更新失败状态，保留检查点以便重新执行时继续
+            review_report.status = 'failed'
+            review_report.current_stage = 'finished'
+            review_report.error_message = str(e)
+            review_report.finished_at = timezone.now()
+            review_report.save(update_fields=['status', 'current_stage', 'error_message', 'finished_at', 'updated_at'])
 
             document.status = 'failed'
             document.save()
 
             raise
 
+    @staticmethod
+    def cancel_review(review_report: 'ReviewReport') -> bool:
+        """请求取消评审，运行中的任务在当前模块完成后停止；尚未开始的任务直接取消"""
+        from .models import ReviewReport
+        from .review_jobs import review_job_runner
+
+        if review_report.status not in ('pending', 'in_progress'):
+            return False
+        ReviewReport.objects.filter(pk=review_report.pk).update(cancel_requested=True)
+        review_report.cancel_requested = True
+        if not review_job_runner.is_running(review_report.id) and review_report.status == 'pending':
+            RequirementReviewService.mark_cancelled(review_report)
+        return True
+
+    @staticmethod
+    def mark_cancelled(review_report: 'ReviewReport'):
+        """将评审标记为已取消，文档恢复为待评审"""
+        from django.utils import timezone
+
+        review_report.status = 'cancelled'
+        review_report.current_stage = 'finished'
+        review_report.finished_at = timezone.now()
+        review_report.save(update_fields=['status', 'current_stage', 'finished_at', 'updated_at'])
+        review_report.document.status = 'ready_for_review'
+        review_report.document.save()
+
+    def _save_review_results(self, review_report: 'ReviewReport', analysis_result: dict):
+        """
+        在一个事务中写入评审结果：报告、问题和模块结果批量写入，完成后更新文档状态
+        续评时先清除上次未完成写入的结果
+        """
+        from django.utils import timezone
+
+        with transaction.atomic():
+            review_report.issues.all().delete()
+            review_report.module_results.all().delete()
+
+            # 问题和模块结果共用一次模块查询
+            modules = list(review_report.document.modules.all())
+            self._create_review_issues(review_report, analysis_result, modules)
+            self._create_module_results(review_report, analysis_result, modules)
+
+            # 更新评审报告并完成评审
+            review_report.status = 'completed'
+            review_report.current_stage = 'finished'
+            review_report.progress = 100
+            review_report.finished_at = timezone.now()
+            self._update_review_report(review_report, analysis_result)
+
+            # 更新文档状态
+            review_report.document.status = 'review_completed'
+            review_report.document.save()
+
     def _update_review_report(self, review_report: 'ReviewReport', analysis_result: dict):
         """更新评审报告基本信息"""
         review_report.overall_rating = analysis_result.get('overall_rating', 'average')
@@ -2028,80 +2506,86 @@ class RequirementReviewService:
         review_report.low_priority_issues = analysis_result.get('low_priority_issues', 0)
         review_report.summary = analysis_result.get('summary', '')
         review_report.recommendations = '\n'.join(analysis_result.get('recommendations', []))
+        review_report.reused_results = analysis_result.get('reused_results', {})
         review_report.save()
 
-    def _create_review_issues(self, review_report: 'ReviewReport', analysis_result: dict):
-        """创建评审问题记录"""
+    def _create_review_issues(self, review_report: 'ReviewReport', analysis_result: dict,
+                              modules: List[RequirementModule] = None):
+        """批量创建评审问题记录，modules 为文档的模块列表（按排序）"""
         from .models import ReviewIssue
 
-        issues = analysis_result.get('issues', [])
-
-        for issue_data in issues:
-            try:
-                # 查找相关模块
-                module = None
-                if issue_data.get('module_name'):
-                    module = review_report.document.modules.filter(
-                        title__icontains=issue_data['module_name']
-                    ).first()
+        if modules is None:
+            modules = list(review_report.document.modules.all())
+        modules_by_name = {}
 
-                # 映射问题类型
-                issue_type = self._map_issue_type(issue_data.get('type', 'clarity'))
+        def find_module(module_name):
+            # 按名称包含关系查找相关模块，取排序最前的一个
+            key = module_name.lower()
+            if key not in modules_by_name:
+                modules_by_name[key] = next((m for m in modules if key in m.title.lower()), None)
+            return modules_by_name[key]
 
-                ReviewIssue.objects.create(
+        issue_objects = []
+        for issue_data in analysis_result.get('issues', []):
+            try:
+                module_name = str(issue_data.get('module_name') or '')
+                issue_objects.append(ReviewIssue(
                     report=review_report,
-                    module=module,
-                    issue_type=issue_type,
+                    module=find_module(module_name) if module_name else None,
+                    issue_type=self._map_issue_type(issue_data.get('type', 'clarity')),
                     priority=issue_data.get('priority', 'medium'),
-                    title=issue_data.get('title', '未知问题'),
+                    title=str(issue_data.get('title', '未知问题'))[:200],
                     description=issue_data.get('description', ''),
                     suggestion=issue_data.get('suggestion', ''),
-                    location=issue_data.get('location', ''),
-                    section=issue_data.get('module_name', '')
-                )
-
+                    location=str(issue_data.get('location', ''))[:200],
+                    section=module_name[:100]
+                ))
             except Exception as e:
                 logger.error(f"创建问题记录失败: {e}")
 
-    def _create_module_results(self, review_report: 'ReviewReport', analysis_result: dict):
-        """创建模块评审结果"""
+        ReviewIssue.objects.bulk_create(issue_objects)
+
+    def _create_module_results(self, review_report: 'ReviewReport', analysis_result: dict,
+                               modules: List[RequirementModule] = None):
+        """批量创建模块评审结果，每个模块一条"""
         from .models import ModuleReviewResult
 
-        module_analyses = analysis_result.get('module_analyses', [])
+        if modules is None:
+            modules = list(review_report.document.modules.all())
+        modules_by_id = {str(module.id): module for module in modules}
+        reused_ids = set(analysis_result.get('reused_results', {}).get('module_ids', []))
 
-        for module_analysis in module_analyses:
+        results = {}
+        for module_analysis in analysis_result.get('module_analyses', []):
             try:
                 # 查找模块
-                module_id = module_analysis.get('module_id')
-                if not module_id:
-                    continue
-
-                module = review_report.document.modules.filter(id=module_id).first()
-                if not module:
+                module_id = str(module_analysis.get('module_id') or '')
+                module = modules_by_id.get(module_id)
+                if not module or module_id in results:
                     continue
 
                 # 计算严重程度评分（分数越高问题越严重）
                 overall_score = module_analysis.get('overall_score', 70)
                 severity_score = max(0, 100 - overall_score)
 
-                # 映射评级
-                module_rating = self._map_module_rating(overall_score)
-
-                ModuleReviewResult.objects.create(
+                results[module_id] = ModuleReviewResult(
                     report=review_report,
                     module=module,
-                    module_rating=module_rating,
+                    module_rating=self._map_module_rating(overall_score),
                     issues_count=len(module_analysis.get('issues', [])),
                     severity_score=severity_score,
                     analysis_content=json.dumps(module_analysis, ensure_ascii=False, indent=2),
                     strengths='\n'.join(module_analysis.get('strengths', [])),
                     weaknesses='\n'.join(module_analysis.get('weaknesses', [])),
-                    recommendations='\n'.join(module_analysis.get('recommendations', []))
+                    recommendations='\n'.join(module_analysis.get('recommendations', [])),
+                    from_cache=module_id in reused_ids
                 )
 
             except Exception as e:
                 logger.error(f"创建模块结果失败: {e}")
 
+        ModuleReviewResult.objects.bulk_create(results.values())
+
     def _map_issue_type(self, ai_type: str) -> str:
         """映射AI分析的问题类型到数据库字段"""
         type_mapping = {
@@ -2129,11 +2613,9 @@ class RequirementReviewService:
         else:
             return 'poor'
 
-    def get_review_progress(self, document: RequirementDocument) -> dict:
-        """获取评审进度（模拟实现）"""
-        # 这里可以实现真实的进度跟踪
-        # 目前返回模拟数据
-
+    @staticmethod
+    def get_review_progress(document: RequirementDocument) -> dict:
+        """获取文档最新一次评审的进度"""
         latest_review = document.review_reports.order_by('-review_date').first()
         if not latest_review:
             return {
@@ -2141,25 +2623,4 @@ class RequirementReviewService:
                 'progress': 0,
                 'message': '尚未开始评审'
             }
-
-        if latest_review.status == 'completed':
-            return {
-                'status': 'completed',
-                'progress': 100,
-                'message': '评审已完成',
-                'report_id': str(latest_review.id)
-            }
-        elif latest_review.status == 'in_progress':
-            return {
-                'status': 'in_progress',
-                'progress': 75,  # 模拟进度
-                'message': '正在进行评审分析...',
-                'current_step': '分析模块一致性',
-                'estimated_remaining': '2分钟'
-            }
-        else:
-            return {
-                'status': 'failed',
-                'progress': 0,
-                'message': '评审失败，请重试'
-            }
+        return get_report_progress(latest_review)
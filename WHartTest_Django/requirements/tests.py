@@ -1,3 +1,796 @@
-from django.test import TestCase
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from projects.models import Project, ProjectMember
+from prompts.models import UserPrompt
+from .context_limits import ContextLimitChecker, context_checker, estimate_tokens, split_at_newlines
+from .context_packer import ContextPacker
+from .extraction_jobs import document_extraction_runner
+from .models import ModuleReviewResult, RequirementDocument, RequirementModule, ReviewIssue, ReviewReport
+from .review_jobs import ReviewJobRunner, review_event_stream, review_job_runner
+from .services import (
+    DocumentProcessor, ModuleOperationService, ModuleSplitter, RequirementModuleService, RequirementReviewEngine,
+    RequirementReviewService
+)
+
+
+SPLIT_FIXTURE = """需求规格说明书
+版本 1.0
+
+# 用户中心
+用户中心包含注册、登录。
+## 1. 注册
+用户通过手机号注册。
+### 1.1 校验规则
+手机号必须为11位。
+### 1.2 C# 客户端
+客户端说明
+## 2. 登录
+支持密码登录。\r
+## #标签
+不是二级标题
+# 订单中心
+## 3. 下单
+下单流程
+   ## 4. 缩进标题
+内容
+
+"""
+
+
+class ModuleSplitterTests(TestCase):
+    """按标题拆分模块测试"""
+
+    def setUp(self):
+        self.splitter = ModuleSplitter()
+
+    def _boundaries(self, content, level, **kwargs):
+        return [(m['title'], m['start_position'], m['end_position'], m['split_method'])
+                for m in self.splitter._split_by_heading_level(content, level, **kwargs)]
+
+    def test_heading_boundaries(self):
+        self.assertEqual(self._boundaries(SPLIT_FIXTURE, 'h1'), [
+            ('前言', 0, 15, 'h1_heading_preface'),
+            ('用户中心', 15, 132, 'h1_heading'),
+            ('订单中心', 132, 172, 'h1_heading'),
+        ])
+        self.assertEqual(self._boundaries(SPLIT_FIXTURE, 'h2'), [
+            ('用户中心', 0, 35, 'h2_heading_preface'),
+            ('1. 注册', 35, 100, 'h2_heading'),
+            ('2. 登录', 100, 139, 'h2_heading'),
+            ('3. 下单', 139, 153, 'h2_heading'),
+            ('4. 缩进标题', 153, 172, 'h2_heading'),
+        ])
+        self.assertEqual(self._boundaries(SPLIT_FIXTURE, 'h3'), [
+            ('用户中心', 0, 55, 'h3_heading_preface'),
+            ('1.1 校验规则', 55, 79, 'h3_heading'),
+            ('1.2 C# 客户端', 79, 172, 'h3_heading'),
+        ])
+        modules = self.splitter._split_by_heading_level(SPLIT_FIXTURE, 'h2')
+        self.assertEqual(modules[2]['content'], '## 2. 登录\n支持密码登录。\r\n## #标签\n不是二级标题\n# 订单中心')
+
+    def test_numbered_headings(self):
+        content = "概述\n1 用户中心\n1.1 注册\n1. 填写手机号；\n1.2 登录\n内容\n2 订单中心\n2.1 下单"
+        self.assertEqual(self._boundaries(content, 'h2', numbered_headings=True), [
+            ('1 用户中心', 0, 9, 'h2_heading_preface'),
+            ('1.1 注册', 9, 26, 'h2_heading'),
+            ('1.2 登录', 26, 43, 'h2_heading'),
+            ('2.1 下单', 43, 50, 'h2_heading'),
+        ])
+        # 未开启时没有Markdown标题，按字数拆分
+        modules = self.splitter._split_by_heading_level(content, 'h2')
+        self.assertEqual(len(modules), 1)
+        self.assertNotIn('split_method', modules[0])
+
+
+class WordExtractionTests(TestCase):
+    """Word文档内容提取测试"""
+
+    def _build_docx(self, paragraphs):
+        from docx import Document
+
+        doc = Document()
+        doc.add_heading('需求规格说明书', level=1)
+        doc.add_paragraph('概述')
+        table = doc.add_table(rows=2, cols=2)
+        for row, values in enumerate([('字段', '说明'), ('手机号', '11位\n必填')]):
+            for col, value in enumerate(values):
+                table.cell(row, col).text = value
+        doc.add_paragraph('')
+        doc.add_heading('用户注册', level=2)
+        for i in range(paragraphs):
+            doc.add_paragraph(f'需求描述 {i}')
+        file = io.BytesIO()
+        doc.save(file)
+        file.name = 'spec.docx'
+        return file
+
+    def test_extracts_in_document_order(self):
+        content = DocumentProcessor()._extract_from_word(self._build_docx(2))
+        self.assertEqual(content, '\n\n'.join([
+            '# 需求规格说明书',
+            '概述',
+            '字段 | 说明\n--- | ---\n手机号 | 11位 必填',
+            '## 用户注册',
+            '需求描述 0',
+            '需求描述 1',
+        ]))
+
+    def test_large_document_extracted_in_linear_time(self):
+        file = self._build_docx(10000)
+        started = time.monotonic()
+        content = DocumentProcessor()._extract_from_word(file)
+        elapsed = time.monotonic() - started
+
+        self.assertTrue(content.endswith('需求描述 9999'))
+        self.assertEqual(content.count('\n\n'), 10003)
+        # 逐个元素查找对应段落的实现处理1万段需要数分钟
+        self.assertLess(elapsed, 10)
+
+
+def build_pdf(page_texts):
+    """生成每页包含一行文本的PDF"""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for text in page_texts:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    pdf += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    return pdf
+
+
+class PdfExtractionTests(TestCase):
+    """PDF后台提取测试（提取任务在当前线程中执行）"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_superuser(username='admin', password='testpass123')
+        self.project = Project.objects.create(name='评审项目', creator=self.user)
+        ProjectMember.objects.create(project=self.project, user=self.user, role='owner')
+
+    def _create_document(self, pages):
+        return RequirementDocument.objects.create(
+            project=self.project, title='PDF需求', document_type='pdf', uploader=self.user,
+            file=SimpleUploadedFile('spec.pdf', build_pdf(pages)), extraction_status='pending'
+        )
+
+    def test_upload_returns_before_extraction(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        upload = SimpleUploadedFile('spec.pdf', build_pdf(['Page one']), content_type='application/pdf')
+        with mock.patch.object(document_extraction_runner, 'submit') as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/api/requirements/documents/', {
+                'title': 'PDF需求', 'document_type': 'pdf', 'project': self.project.id, 'file': upload
+            }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['data']['extraction_status'], 'pending')
+        document = RequirementDocument.objects.get()
+        self.assertFalse(document.content)
+        submit.assert_called_once_with(document.id)
+
+        response = client.post(f'/api/requirements/documents/{document.id}/split-modules/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(REQUIREMENT_PDF_EXTRACT_PROCESSES=0, REQUIREMENT_PDF_PAGES_PER_TASK=2,
+                       REQUIREMENT_PDF_MAX_PAGES=5)
+    def test_failed_pages_skipped_and_page_cap_applied(self):
+        from pypdf import PageObject
+
+        document = self._create_document([f'Page {i}' for i in range(1, 8)])
+        extract_text = PageObject.extract_text
+
+        def flaky_extract_text(page, *args, **kwargs):
+            text = extract_text(page, *args, **kwargs)
+            if 'Page 2' in text:
+                raise ValueError('broken page')
+            return text
+
+        with mock.patch.object(PageObject, 'extract_text', autospec=True, side_effect=flaky_extract_text):
+            document_extraction_runner._run(str(document.id))
+
+        document.refresh_from_db()
+        self.assertEqual(document.extraction_status, 'completed')
+        self.assertEqual(document.extraction_progress, 100)
+        self.assertEqual(document.content, '\n\n'.join(
+            f'=== 第{i}页 ===\nPage {i}' for i in (1, 3, 4, 5)
+        ))
+        self.assertEqual(document.word_count, len(document.content))
+        self.assertIn('第2页提取失败', document.extraction_error)
+        self.assertIn('PDF共7页', document.extraction_error)
+
+    @override_settings(REQUIREMENT_PDF_EXTRACT_PROCESSES=2, REQUIREMENT_PDF_PAGES_PER_TASK=1)
+    def test_pages_extracted_in_process_pool_in_order(self):
+        document = self._create_document([f'Page {i}' for i in range(1, 7)])
+        try:
+            document_extraction_runner._run(str(document.id))
+        finally:
+            document_extraction_runner._reset_pool()
+
+        document.refresh_from_db()
+        self.assertEqual(document.extraction_status, 'completed')
+        self.assertEqual(document.content, '\n\n'.join(f'=== 第{i}页 ===\nPage {i}' for i in range(1, 7)))
+
+
+def count_chars(text, model_name='gpt-3.5-turbo'):
+    """测试中按字符数计算token，不依赖tiktoken编码文件"""
+    return len(text)
+
+
+@mock.patch.object(context_checker, 'count_tokens', count_chars)
+class ContextPackerTests(TestCase):
+    """评审提示词上下文打包测试"""
+
+    def test_budget_reserves_output_and_prompt(self):
+        packer = ContextPacker('gpt-4o-2024-08-06', reserved_output_tokens=1000)
+        self.assertEqual(packer.context_limit, 128000)
+        self.assertEqual(packer.budget_for('x' * 500), 128000 - 1000 - 500 - 50)
+
+    def test_whole_sections_packed_by_priority(self):
+        packer = ContextPacker('gpt-4', context_limit=1000)
+        text = '前言\n# 一\n' + 'a' * 30 + '\n## 二\n' + 'b' * 60 + '\n# 三\n' + 'c' * 30
+        self.assertEqual(packer.fit(text, 1000), text)
+        # 一级标题章节优先于二级标题章节，放不下的章节整节跳过，按原文顺序输出
+        self.assertEqual(packer.fit(text, 90), '前言\n\n# 一\n' + 'a' * 30 + '\n\n# 三\n' + 'c' * 30)
+
+    def test_map_reduce_summary_for_oversized_document(self):
+        packer = ContextPacker('gpt-4', context_limit=2000, reserved_output_tokens=100)
+        text = '\n'.join(f'## 模块{i}\n' + '需求描述。' * 60 for i in range(20))
+        prompts = []
+
+        def invoke(messages):
+            prompts.append(messages[-1].content)
+            return SimpleNamespace(content=f'摘要{len(prompts)}')
+
+        summary = packer.fit(text, 500, invoke)
+        self.assertLessEqual(len(summary), 500)
+        # 每次摘要调用都在上下文限制以内，且按整节发送
+        self.assertGreater(len(prompts), 1)
+        self.assertTrue(all(len(prompt) <= 2000 - 100 for prompt in prompts))
+        self.assertTrue(all(prompt.rstrip().endswith('需求描述。') for prompt in prompts))
+
+
+class FakeEncoder:
+    """按空白切分计数的假编码器"""
+
+    def __init__(self):
+        self.encoded = []
+        self.batches = []
+
+    def encode_ordinary(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=8):
+        self.batches.append(texts)
+        return [text.split() for text in texts]
+
+
+class TokenCountingTests(TestCase):
+    """token计数测试"""
+
+    def test_estimator_counts_cjk_and_latin(self):
+        self.assertEqual(estimate_tokens(''), 0)
+        self.assertEqual(estimate_tokens('需求' * 100), 240)
+        self.assertEqual(estimate_tokens('The quick brown fox jumps over the lazy dog.'), 10)
+        self.assertEqual(estimate_tokens('timeout 7200'), 3)
+        self.assertIsInstance(estimate_tokens('需求 abc。' * 3), int)
+
+    def test_encoder_failure_is_cached(self):
+        checker = ContextLimitChecker()
+        with mock.patch('requirements.context_limits.tiktoken.get_encoding',
+                        side_effect=OSError('offline')) as get_encoding:
+            self.assertEqual(checker.count_tokens('需求描述', 'gpt-4'), estimate_tokens('需求描述'))
+            self.assertEqual(checker.count_tokens('需求描述', 'qwen'), estimate_tokens('需求描述'))
+            self.assertEqual(checker.count_method('gpt-4'), 'estimate')
+        # 同一编码只尝试加载一次
+        get_encoding.assert_called_once_with('cl100k_base')
+
+        result = checker.check_context_limit('需求描述', 'gpt-4')
+        self.assertEqual(result['token_count_method'], 'estimate')
+        self.assertEqual(result['token_count_error'], 0.25)
+
+    def test_large_text_counts_are_memoized(self):
+        checker = ContextLimitChecker()
+        encoder = FakeEncoder()
+        text = 'word ' * 1000
+        with mock.patch('requirements.context_limits.tiktoken.get_encoding', return_value=encoder):
+            self.assertEqual(checker.count_tokens(text, 'gpt-4'), 1000)
+            self.assertEqual(checker.count_tokens(text, 'gpt-4'), 1000)
+            self.assertEqual(checker.count_tokens('short', 'gpt-4'), 1)
+            self.assertEqual(checker.count_tokens('short', 'gpt-4'), 1)
+        self.assertEqual(encoder.encoded, [text, 'short', 'short'])
+
+    def test_very_large_text_encoded_in_parallel_chunks(self):
+        checker = ContextLimitChecker()
+        encoder = FakeEncoder()
+        text = '\n'.join(f'第{i}行 line {i}' for i in range(30000))
+        with mock.patch('requirements.context_limits.tiktoken.get_encoding', return_value=encoder):
+            self.assertEqual(checker.count_tokens(text, 'gpt-4'), len(text.split()))
+        self.assertEqual(len(encoder.batches), 1)
+        chunks = encoder.batches[0]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), text)
+        # 每块都在换行之后切分
+        self.assertTrue(all(chunk.endswith('\n') for chunk in chunks[:-1]))
+        self.assertEqual(split_at_newlines('a\n\nb', 1), ['a\n\n', 'b'])
+
+    def test_document_token_count_persisted_until_content_changes(self):
+        user = User.objects.create_user(username='counter', password='testpass123')
+        project = Project.objects.create(name='计数项目', creator=user)
+        document = RequirementDocument.objects.create(project=project, title='文档', content='需求内容',
+                                                      uploader=user)
+        counter = mock.Mock(side_effect=count_chars)
+        with mock.patch.object(context_checker, 'count_tokens', counter):
+            self.assertEqual(document.get_token_count('gpt-4'), 4)
+            self.assertEqual(RequirementDocument.objects.get(pk=document.pk).get_token_count('gpt-4'), 4)
+            self.assertEqual(counter.call_count, 1)
+
+            document.content = '修改后的需求内容'
+            document.save()
+            self.assertEqual(document.check_context_limit('gpt-4')['token_count'], 8)
+            self.assertEqual(counter.call_count, 2)
+
+
+class BulkWriteTests(TestCase):
+    """模块拆分、排序和评审结果的批量写入测试：查询数不随模块和问题数量增长"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bulk', password='testpass123')
+        self.project = Project.objects.create(name='批量项目', creator=self.user)
+
+    def create_document(self, module_count, status='uploaded'):
+        content = '\n'.join(f'## 模块{i}\n模块{i}的需求内容' for i in range(module_count))
+        return RequirementDocument.objects.create(project=self.project, title='文档', content=content,
+                                                  uploader=self.user, status=status)
+
+    def count_queries(self, func, *args):
+        with CaptureQueriesContext(connection) as context:
+            func(*args)
+        return len(context.captured_queries)
+
+    def test_split_modules_in_constant_queries(self):
+        service = RequirementModuleService(user=self.user)
+        small, large = self.create_document(3), self.create_document(40)
+        small_queries = self.count_queries(service.process_document_and_split, small, {'split_level': 'h2'})
+        large_queries = self.count_queries(service.process_document_and_split, large, {'split_level': 'h2'})
+
+        self.assertEqual(large.modules.count(), 40)
+        self.assertEqual(large.status, 'user_reviewing')
+        self.assertEqual(small_queries, large_queries)
+        self.assertLess(large_queries, 10)
+
+    def create_modules(self, document, count):
+        return RequirementModule.objects.bulk_create(
+            RequirementModule(document=document, title=f'模块{i}', content=f'内容{i}', order=i * 10)
+            for i in range(count)
+        )
+
+    def test_reorder_and_normalize_in_constant_queries(self):
+        counts = []
+        for count in (3, 40):
+            document = self.create_document(0, status='user_reviewing')
+            modules = self.create_modules(document, count)
+            # 倒序排列，排序号不连续，需要规范化
+            new_orders = {str(module.id): (count - i) * 5 for i, module in enumerate(modules)}
+            service = ModuleOperationService(document)
+            with CaptureQueriesContext(connection) as context:
+                result = service.execute_batch_operations([{'operation': 'reorder', 'new_orders': new_orders}])
+            counts.append(len(context.captured_queries))
+            self.assertTrue(result['success'])
+            self.assertEqual(
+                list(document.modules.order_by('order').values_list('title', flat=True)),
+                [f'模块{i}' for i in reversed(range(count))]
+            )
+            self.assertEqual(list(document.modules.order_by('order').values_list('order', flat=True)),
+                             list(range(1, count + 1)))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertLess(counts[1], 10)
+
+    def test_review_results_saved_in_constant_queries(self):
+        with mock.patch.object(RequirementReviewEngine, '_get_llm_instance', return_value=FakeReviewLLM()):
+            service = RequirementReviewService(user=self.user)
+        counts = []
+        for count in (2, 30):
+            document = self.create_document(0, status='reviewing')
+            modules = self.create_modules(document, count)
+            report = ReviewReport.objects.create(document=document, status='in_progress')
+            analysis_result = {
+                'overall_score': 80,
+                'total_issues': count,
+                'issues': [
+                    {'title': f'问题{i}', 'module_name': f'模块{i}', 'type': 'data_inconsistency',
+                     'priority': 'high', 'location': 'x' * 300}
+                    for i in range(count)
+                ],
+                'module_analyses': [{'module_id': str(module.id), 'overall_score': 85} for module in modules],
+                'reused_results': {'module_ids': [str(modules[0].id)]},
+            }
+            counts.append(self.count_queries(service._save_review_results, report, analysis_result))
+
+            report.refresh_from_db()
+            self.assertEqual(report.status, 'completed')
+            self.assertEqual(report.document.status, 'review_completed')
+            issues = ReviewIssue.objects.filter(report=report)
+            self.assertEqual(issues.count(), count)
+            issue = issues.get(title='问题1')
+            self.assertEqual((issue.module, issue.issue_type, len(issue.location)), (modules[1], 'consistency', 200))
+            results = ModuleReviewResult.objects.filter(report=report)
+            self.assertEqual(results.count(), count)
+            self.assertEqual(list(results.filter(from_cache=True).values_list('module', flat=True)), [modules[0].id])
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertLess(counts[1], 10)
+
+
+class ModuleBatchOperationTests(TestCase):
+    """批量模块操作接口测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='admin', password='testpass123')
+        project = Project.objects.create(name='模块项目', creator=self.user)
+        ProjectMember.objects.create(project=project, user=self.user, role='owner')
+        self.document = RequirementDocument.objects.create(project=project, title='文档', content='内容',
+                                                           uploader=self.user, status='user_reviewing')
+        self.modules = RequirementModule.objects.bulk_create(
+            RequirementModule(document=self.document, title=f'模块{i}', content=f'第一段{i}\n第二段{i}', order=i + 1)
+            for i in range(4)
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = f'/api/requirements/documents/{self.document.id}/module-operations/batch/'
+
+    def ids(self, *indexes):
+        return [str(self.modules[i].id) for i in indexes]
+
+    def titles(self):
+        return list(self.document.modules.order_by('order').values_list('title', flat=True))
+
+    def test_operations_applied_in_order_with_final_module_list(self):
+        operations = [
+            {'operation': 'rename', 'target_modules': self.ids(0), 'new_module_data': {'title': '登录'}},
+            {'operation': 'split', 'target_modules': self.ids(1), 'split_points': [4],
+             'split_titles': ['拆分A', '拆分B']},
+            {'operation': 'merge', 'target_modules': self.ids(0, 2), 'merge_title': '合并'},
+            {'operation': 'delete', 'target_modules': self.ids(3)},
+            {'operation': 'create', 'new_module_data': {'title': '新模块', 'content': '新内容', 'order': 100}},
+        ]
+        response = self.client.post(self.url, {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+
+        data = response.json()['data']
+        expected = ['合并', '拆分A', '拆分B', '新模块']
+        self.assertEqual([module['title'] for module in data['modules']], expected)
+        self.assertEqual([module['order'] for module in data['modules']], [1, 2, 3, 4])
+        self.assertEqual(data['operations_count'], 5)
+        self.assertEqual(self.titles(), expected)
+        self.assertEqual(self.document.modules.get(title='合并').content, '第一段0\n第二段0\n\n第一段2\n第二段2')
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, 'ready_for_review')
+
+    def test_invalid_operation_rejected_before_any_change(self):
+        operations = [
+            {'operation': 'rename', 'target_modules': self.ids(0), 'new_module_data': {'title': '登录'}},
+            {'operation': 'delete', 'target_modules': self.ids(1)},
+            # 引用已被删除的模块
+            {'operation': 'merge', 'target_modules': self.ids(1, 2), 'merge_title': '合并'},
+            {'operation': 'split', 'target_modules': self.ids(3), 'split_points': [4], 'split_titles': ['只有一个']},
+        ]
+        response = self.client.post(self.url, {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error['index'] for error in response.json()['errors']['errors']], [2, 3])
+        self.assertEqual(self.titles(), ['模块0', '模块1', '模块2', '模块3'])
+
+    def test_failed_operation_rolls_back_batch(self):
+        operations = [
+            {'operation': 'delete', 'target_modules': self.ids(0)},
+            {'operation': 'rename', 'target_modules': self.ids(1), 'new_module_data': {'title': '重命名'}},
+        ]
+        with mock.patch.object(ModuleOperationService, '_rename_module', side_effect=RuntimeError('写入失败')):
+            response = self.client.post(self.url, {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.titles(), ['模块0', '模块1', '模块2', '模块3'])
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, 'user_reviewing')
+
+    def test_legacy_module_operations_batch_body(self):
+        url = f'/api/requirements/documents/{self.document.id}/module-operations/'
+        new_orders = {module_id: 4 - i for i, module_id in enumerate(self.ids(0, 1, 2, 3))}
+        response = self.client.post(url, {'operations': [{'operation': 'reorder', 'new_orders': new_orders}]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertEqual(self.titles(), ['模块3', '模块2', '模块1', '模块0'])
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FakeReviewLLM:
+    """按模块标题返回结果的假LLM，记录最大并发数"""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.rate_limited = set()
+
+    def invoke(self, messages):
+        prompt = messages[-1].content
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if '限流' in prompt and prompt not in self.rate_limited:
+                self.rate_limited.add(prompt)
+                raise RateLimitError('Error code: 429 - rate limit exceeded')
+            if '失败' in prompt:
+                raise RuntimeError('LLM error')
+            return SimpleNamespace(content=f'```json\n{{"module_name": "{prompt}", "overall_score": 90}}\n```')
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@override_settings(REQUIREMENT_REVIEW_MAX_CONCURRENCY=4, REQUIREMENT_REVIEW_RETRY_BASE_DELAY=0.01)
+@mock.patch.object(context_checker, 'count_tokens', count_chars)
+class ParallelModuleReviewTests(TestCase):
+    """模块并行评审测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reviewer', password='testpass123')
+        project = Project.objects.create(name='评审项目', creator=self.user)
+        UserPrompt.objects.create(user=self.user, name='模块分析', content='{module_title}',
+                                  prompt_type='module_analysis', is_active=True)
+        self.document = RequirementDocument.objects.create(project=project, title='需求文档', content='内容',
+                                                           uploader=self.user)
+        titles = [f'模块{i}' for i in range(8)]
+        titles[2] = '失败模块'
+        titles[5] = '限流模块'
+        for order, title in enumerate(titles):
+            RequirementModule.objects.create(document=self.document, title=title, content='模块内容', order=order)
+        self.titles = titles
+
+        self.llm = FakeReviewLLM()
+        with mock.patch.object(RequirementReviewEngine, '_get_llm_instance', return_value=self.llm):
+            self.engine = RequirementReviewEngine(user=self.user)
+
+    def test_modules_analyzed_concurrently_in_order(self):
+        started = time.monotonic()
+        analyses = self.engine._analyze_modules_detailed(self.document, {})
+        elapsed = time.monotonic() - started
+
+        self.assertEqual([a['module_name'] for a in analyses], self.titles)
+        # 失败模块使用默认结果，限流模块重试后成功
+        self.assertEqual(analyses[2]['overall_score'], 70)
+        self.assertEqual(analyses[5]['overall_score'], 90)
+        self.assertEqual(self.llm.max_active, 4)
+        # 9次调用（含一次重试），串行至少1.8秒
+        self.assertLess(elapsed, 1.2)
+
+    def test_sequential_when_parallel_disabled(self):
+        analyses = self.engine._analyze_modules_detailed(self.document, {}, parallel=False)
+        self.assertEqual([a['module_name'] for a in analyses], self.titles)
+        self.assertEqual(self.llm.max_active, 1)
+
+
+@override_settings(REQUIREMENT_REVIEW_MAX_CONCURRENCY=1)
+@mock.patch.object(context_checker, 'count_tokens', count_chars)
+class ReviewJobTests(TestCase):
+    """后台评审任务测试（任务在当前线程中执行）"""
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='admin', password='testpass123')
+        project = Project.objects.create(name='评审项目', creator=self.user)
+        ProjectMember.objects.create(project=project, user=self.user, role='owner')
+        for prompt_type, content in [('global_analysis', '全局分析'), ('module_analysis', '{module_title}'),
+                                     ('consistency_analysis', '一致性检查')]:
+            UserPrompt.objects.create(user=self.user, name=prompt_type, content=content,
+                                      prompt_type=prompt_type, is_active=True)
+        self.document = RequirementDocument.objects.create(project=project, title='需求文档', content='内容',
+                                                           uploader=self.user, status='ready_for_review')
+        self.modules = [
+            RequirementModule.objects.create(document=self.document, title=f'模块{i}', content='模块内容', order=i)
+            for i in range(4)
+        ]
+        self.llm = FakeReviewLLM(delay=0)
+        self.llm.prompts = []
+        original_invoke = self.llm.invoke
+
+        def invoke(messages):
+            self.llm.prompts.append(messages[-1].content)
+            return original_invoke(messages)
+
+        self.llm.invoke = invoke
+        patcher = mock.patch.object(RequirementReviewEngine, '_get_llm_instance', return_value=self.llm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _submit(self):
+        with mock.patch.object(review_job_runner, 'submit') as submit:
+            report = RequirementReviewService(user=self.user).submit_comprehensive_review(self.document)
+        submit.assert_called_once_with(report.id)
+        return report
+
+    def test_job_records_progress_and_events(self):
+        report = self._submit()
+        self.assertEqual(report.status, 'pending')
+        self.assertEqual(report.total_modules, 4)
+
+        review_job_runner._run(str(report.id))
+
+        report.refresh_from_db()
+        self.assertEqual(report.status, 'completed')
+        self.assertEqual((report.progress, report.completed_modules, report.current_stage), (100, 4, 'finished'))
+        self.assertEqual(set(report.checkpoint['module_analyses']), {str(m.id) for m in self.modules})
+        self.assertEqual(report.module_results.count(), 4)
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, 'review_completed')
+
+        events = [json.loads(chunk[len('data: '):]) for chunk in review_event_stream(report.id, poll_interval=0.01)]
+        self.assertEqual([e['type'] for e in events], ['progress'] + ['module'] * 4 + ['done'])
+        self.assertEqual(events[-1]['status'], 'completed')
+
+        # ASGI下视图返回异步事件流，逐条推送相同的事件
+        token = AccessToken.for_user(self.user)
+
+        async def read_events():
+            response = await self.async_client.get(f'/api/requirements/reports/{report.id}/events/',
+                                                   headers={'Authorization': f'Bearer {token}'})
+            return response.is_async, [chunk.decode() async for chunk in response.streaming_content]
+
+        is_async, chunks = async_to_sync(read_events)()
+        self.assertTrue(is_async)
+        self.assertEqual([json.loads(chunk[len('data: '):]) for chunk in chunks], events)
+
+    @override_settings(REQUIREMENT_REVIEW_JOB_HEARTBEAT=0.01)
+    def test_runner_beats_while_job_is_claimed(self):
+        report = self._submit()
+        runner = ReviewJobRunner()
+        beating = threading.Event()
+        run_review = RequirementReviewService.run_comprehensive_review
+
+        def slow_review(service, review_report):
+            # 评审执行期间心跳线程应持续更新心跳（未启动看门狗）
+            self.assertTrue(beating.wait(timeout=5))
+            return run_review(service, review_report)
+
+        with mock.patch.object(runner, '_beat', side_effect=beating.set), \
+                mock.patch.object(RequirementReviewService, 'run_comprehensive_review', slow_review):
+            runner._run(str(report.id))
+
+        report.refresh_from_db()
+        self.assertEqual(report.status, 'completed')
+        self.assertIsNone(runner._watchdog)
+
+    def test_resume_from_last_completed_module(self):
+        report = self._submit()
+        done = self.modules[:2]
+        report.status = 'in_progress'
+        report.checkpoint = {
+            'global_analysis': {'overall_score': 80},
+            'module_analyses': {str(m.id): {'module_id': str(m.id), 'module_name': m.title, 'overall_score': 90}
+                                for m in done},
+        }
+        report.save()
+
+        review_job_runner._run(str(report.id))
+
+        report.refresh_from_db()
+        self.assertEqual(report.status, 'completed')
+        # 只分析剩余的两个模块和一致性检查，不重复全局分析
+        self.assertEqual(self.llm.prompts, ['模块2', '模块3', '一致性检查'])
+
+    def test_rereview_reuses_unchanged_module_results(self):
+        review_job_runner._run(str(self._submit().id))
+        self.assertEqual(len(self.llm.prompts), 6)
+
+        self.modules[1].content = '修改后的模块内容'
+        self.modules[1].save()
+        self.llm.prompts.clear()
+        self.document.status = 'ready_for_review'  # 与 restart-review 接口一致
+        self.document.save()
+        report = self._submit()
+        review_job_runner._run(str(report.id))
+
+        report.refresh_from_db()
+        self.assertEqual(report.status, 'completed')
+        # 只重新分析修改过的模块和一致性检查
+        self.assertEqual(self.llm.prompts, ['模块1', '一致性检查'])
+        self.assertTrue(report.reused_results['global_analysis'])
+        reused_ids = {str(m.id) for m in self.modules if m.id != self.modules[1].id}
+        self.assertEqual(set(report.reused_results['module_ids']), reused_ids)
+        self.assertEqual(
+            {str(r.module_id) for r in report.module_results.filter(from_cache=True)}, reused_ids
+        )
+
+    def test_module_cache_depends_on_global_context(self):
+        engine = RequirementReviewEngine(user=self.user)
+        context = {'business_flows': ['下单'], 'data_entities': ['订单'], 'global_rules': []}
+        engine._analyze_modules_detailed(self.document, context, parallel=False, use_cache=True)
+        self.assertEqual(len(self.llm.prompts), 4)
+
+        self.llm.prompts.clear()
+        engine._analyze_modules_detailed(self.document, dict(context), parallel=False, use_cache=True)
+        self.assertEqual(self.llm.prompts, [])
+
+        # 全局分析得到的业务流程变化后，模块结果需要重新分析
+        engine._analyze_modules_detailed(self.document, dict(context, business_flows=['下单', '退款']),
+                                         parallel=False, use_cache=True)
+        self.assertEqual(len(self.llm.prompts), 4)
+
+    def test_cancel_between_modules(self):
+        report = self._submit()
+        original_invoke = self.llm.invoke
+
+        def invoke(messages):
+            if messages[-1].content == '模块1':
+                RequirementReviewService.cancel_review(ReviewReport.objects.get(pk=report.pk))
+            return original_invoke(messages)
+
+        self.llm.invoke = invoke
+        review_job_runner._run(str(report.id))
+
+        report.refresh_from_db()
+        self.assertEqual(report.status, 'cancelled')
+        self.assertEqual(report.completed_modules, 2)
+        self.assertNotIn('模块2', self.llm.prompts)
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, 'ready_for_review')
+
+    def test_start_review_submits_background_job(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.get(f'/api/requirements/documents/{self.document.id}/review-progress/')
+        self.assertEqual(response.json()['data']['status'], 'not_started')
+        with mock.patch.object(review_job_runner, 'submit') as submit:
+            response = client.post(f'/api/requirements/documents/{self.document.id}/start-review/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        report_id = response.json()['data']['report_id']
+        submit.assert_called_once()
+
+        response = client.get(f'/api/requirements/reports/{report_id}/progress/')
+        self.assertEqual(response.json()['data']['status'], 'pending')
+        response = client.get(f'/api/requirements/documents/{self.document.id}/review-progress/')
+        self.assertEqual(response.json()['data']['report_id'], report_id)
+        response = client.post(f'/api/requirements/reports/{report_id}/cancel/')
+        self.assertEqual(response.json()['data']['status'], 'cancelled')
@@ -2,12 +2,18 @@ from rest_framework import viewsets, status, filters, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 import logging
 import os
 
 from wharttest_django.viewsets import BaseModelViewSet
+from wharttest_django.permissions import permission_required
+from wharttest_django.renderers import UnifiedResponseRenderer
 from prompts.models import UserPrompt
 from .models import (
     RequirementDocument, RequirementModule, ReviewReport,
@@ -28,11 +34,25 @@ from .permissions import (
     IsProjectMemberForRequirement, IsProjectAdminForRequirement,
     CanManageRequirementDocument, CanStartReview
 )
-from .services import RequirementModuleService, ModuleOperationService, RequirementReviewService
+from .services import (
+    RequirementModuleService, ModuleOperationService, RequirementReviewService, get_report_progress
+)
+from .review_jobs import areview_event_stream, format_sse, review_event_stream, review_job_runner
+from .extraction_jobs import document_extraction_runner, needs_background_extraction
 
 logger = logging.getLogger(__name__)
 
 
+class EventStreamRenderer(BaseRenderer):
+    """允许客户端以 Accept: text/event-stream 请求事件流接口；错误响应以单条SSE消息返回"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_sse({'type': 'error', **(data if isinstance(data, dict) else {'detail': data})}).encode('utf-8')
+
+
 class RequirementDocumentViewSet(BaseModelViewSet):
     """需求文档视图集"""
     queryset = RequirementDocument.objects.all()
@@ -74,9 +94,15 @@ class RequirementDocumentViewSet(BaseModelViewSet):
         return RequirementDocumentSerializer
 
     def perform_create(self, serializer):
-        """创建文档时自动设置上传人并提取内容"""
+        """创建文档时自动设置上传人并提取内容；PDF在后台提取，上传请求立即返回提取状态"""
         document = serializer.save(uploader=self.request.user)
 
+        if needs_background_extraction(document):
+            document.extraction_status = 'pending'
+            document.save(update_fields=['extraction_status'])
+            transaction.on_commit(lambda: document_extraction_runner.submit(document.id))
+            return
+
         # 立即提取文档内容
         if document.file and not document.content:
             try:
@@ -129,7 +155,8 @@ class RequirementDocumentViewSet(BaseModelViewSet):
         {
             "split_level": "h2",           // h1, h2, h3 或 auto
             "include_context": true,       // 是否包含上级标题作为上下文
-            "chunk_size": 2000            // 如果选择auto，按字数拆分的大小
+            "chunk_size": 2000,           // 如果选择auto，按字数拆分的大小
+            "numbered_headings": false    // 是否将"3.2 标题"这类编号标题按层级视为h1/h2/h3标题
         }
         """
         document = self.get_object()
@@ -139,13 +166,19 @@ class RequirementDocumentViewSet(BaseModelViewSet):
                 {'error': '文档状态不允许进行模块拆分'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if document.extraction_status in ['pending', 'extracting']:
+            return Response(
+                {'error': f'文档内容正在提取中（{document.extraction_progress}%），请稍后再拆分'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         try:
             # 获取拆分选项
             split_options = {
                 'split_level': request.data.get('split_level', 'auto'),
                 'include_context': request.data.get('include_context', True),
-                'chunk_size': request.data.get('chunk_size', 2000)
+                'chunk_size': request.data.get('chunk_size', 2000),
+                'numbered_headings': request.data.get('numbered_headings', False)
             }
 
             logger.info(f"开始拆分文档 {document.id}，选项: {split_options}")
@@ -315,22 +348,18 @@ class RequirementDocumentViewSet(BaseModelViewSet):
         serializer = ModuleAdjustmentSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                # 删除现有模块
-                document.modules.all().delete()
-
-                # 创建新模块
                 modules_data = serializer.validated_data['modules']
-                modules = []
-                for module_data in modules_data:
-                    module = RequirementModule.objects.create(
-                        document=document,
-                        **module_data
-                    )
-                    modules.append(module)
+                modules = [RequirementModule(document=document, **module_data) for module_data in modules_data]
+                with transaction.atomic():
+                    # 删除现有模块
+                    document.modules.all().delete()
 
-                # 更新文档状态
-                document.status = 'ready_for_review'
-                document.save()
+                    # 批量创建新模块
+                    RequirementModule.objects.bulk_create(modules)
+
+                    # 更新文档状态
+                    document.status = 'ready_for_review'
+                    document.save()
 
                 response_serializer = RequirementModuleSerializer(modules, many=True)
                 return Response({
@@ -415,6 +444,39 @@ class RequirementDocumentViewSet(BaseModelViewSet):
         # 这样可以重用所有的逻辑和参数处理
         return self.start_review(request, pk)
 
+    @action(detail=True, methods=['post'], url_path='extract-content')
+    @permission_required('requirements.change_requirementdocument')
+    def extract_content(self, request, pk=None):
+        """
+        重新在后台提取PDF文档内容（提取失败或因服务重启中断时使用）
+        POST /api/requirements/documents/{id}/extract-content/
+        """
+        document = self.get_object()
+        if not document.file or not document.file.name.lower().endswith('.pdf'):
+            return Response({'error': '只有PDF文档支持后台提取内容'}, status=status.HTTP_400_BAD_REQUEST)
+        if document.status not in ['uploaded', 'processing']:
+            return Response({'error': '文档状态不允许重新提取内容'}, status=status.HTTP_400_BAD_REQUEST)
+        if document_extraction_runner.is_running(document.id):
+            return Response({'error': '文档内容正在提取中'}, status=status.HTTP_400_BAD_REQUEST)
+
+        RequirementDocument.objects.filter(pk=document.pk).update(
+            extraction_status='pending', extraction_progress=0, extraction_error=''
+        )
+        transaction.on_commit(lambda: document_extraction_runner.submit(document.id))
+        return Response({
+            'message': '已开始提取文档内容',
+            'document_id': str(document.id),
+            'extraction_status': 'pending'
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], url_path='review-progress')
+    def review_progress(self, request, pk=None):
+        """
+        获取文档最新一次评审的进度
+        GET /api/requirements/documents/{id}/review-progress/
+        """
+        return Response(RequirementReviewService.get_review_progress(self.get_object()))
+
     @action(detail=True, methods=['post'], url_path='start-review', permission_classes=[CanStartReview])
     def start_review(self, request, pk=None):
         """
@@ -423,6 +485,7 @@ class RequirementDocumentViewSet(BaseModelViewSet):
 
         参数:
         - direct_review: 是否直接评审整个文档 (默认: false)
+        - background: 模块评审是否作为后台任务执行 (默认: true)，后台执行时立即返回评审报告ID
         """
         document = self.get_object()
 
@@ -476,8 +539,19 @@ class RequirementDocumentViewSet(BaseModelViewSet):
                 # 直接评审整个文档
                 review_report = review_service.start_direct_review(document, analysis_options)
                 review_type = "直接评审"
+            elif request.data.get('background', True):
+                # 模块化评审：提交后台任务，通过评审报告的 progress / events 接口查看进度
+                review_report = review_service.submit_comprehensive_review(document, analysis_options)
+                return Response({
+                    'message': '模块评审任务已提交，正在后台执行',
+                    'review_type': '模块评审',
+                    'direct_review': False,
+                    'report_id': str(review_report.id),
+                    'review_status': review_report.status,
+                    'status': document.status
+                }, status=status.HTTP_202_ACCEPTED)
             else:
-                # 模块化评审
+                # 模块化评审（同步执行）
                 review_report = review_service.start_comprehensive_review(document, analysis_options)
                 review_type = "模块评审"
 
@@ -516,80 +590,105 @@ class RequirementDocumentViewSet(BaseModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        from .serializers import ModuleOperationSerializer, ModuleBatchUpdateSerializer
+        from .serializers import ModuleOperationSerializer
 
-        # 检查是单个操作还是批量操作
+        # 批量操作
         if 'operations' in request.data:
-            # 批量操作
-            serializer = ModuleBatchUpdateSerializer(data=request.data)
-            if serializer.is_valid():
-                try:
-                    operation_service = ModuleOperationService(document)
-                    result = operation_service.execute_batch_operations(
-                        serializer.validated_data['operations']
-                    )
-
-                    if result['success']:
-                        # 更新文档状态
-                        document.status = 'ready_for_review'
-                        document.save()
-
-                        # 返回更新后的模块列表
-                        modules = document.modules.order_by('order')
-                        modules_serializer = RequirementModuleSerializer(modules, many=True)
-
-                        return Response({
-                            'message': result['message'],
-                            'operations_count': result['operations_count'],
-                            'modules': modules_serializer.data,
-                            'status': document.status
-                        })
-                    else:
-                        return Response(
-                            {'error': result['error']},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
-
-                except Exception as e:
-                    logger.error(f"批量模块操作失败: {e}")
-                    return Response(
-                        {'error': f'操作失败: {str(e)}'},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-            else:
-                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            return self.batch_module_operations(request, pk)
 
-        else:
-            # 单个操作
-            serializer = ModuleOperationSerializer(data=request.data)
-            if serializer.is_valid():
-                try:
-                    operation_service = ModuleOperationService(document)
-                    result = operation_service.execute_operation(serializer.validated_data)
+        # 单个操作
+        serializer = ModuleOperationSerializer(data=request.data)
+        if serializer.is_valid():
+            try:
+                operation_service = ModuleOperationService(document)
+                result = operation_service.execute_operation(serializer.validated_data)
+
+                # 更新文档状态
+                document.status = 'ready_for_review'
+                document.save()
+
+                # 返回更新后的模块列表
+                modules = document.modules.order_by('order')
+                modules_serializer = RequirementModuleSerializer(modules, many=True)
+
+                return Response({
+                    'message': result['message'],
+                    'operation_result': result,
+                    'modules': modules_serializer.data,
+                    'status': document.status
+                })
 
+            except Exception as e:
+                logger.error(f"模块操作失败: {e}")
+                return Response(
+                    {'error': f'操作失败: {str(e)}'},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['post'], url_path='module-operations/batch')
+    def batch_module_operations(self, request, pk=None):
+        """
+        批量模块操作 - 按顺序执行合并、拆分、重排序、重命名、删除和创建操作
+        POST /api/requirements/documents/{id}/module-operations/batch/
+
+        请求体参数:
+        {
+            "operations": [
+                {"operation": "rename", "target_modules": ["..."], "new_module_data": {"title": "..."}},
+                {"operation": "merge", "target_modules": ["...", "..."], "merge_title": "..."}
+            ]
+        }
+        执行前校验全部操作，全部操作在一个事务中执行，任一操作失败时整体回滚；
+        成功时返回操作结果和最终的模块列表
+        """
+        document = self.get_object()
+
+        if document.status not in ['user_reviewing', 'ready_for_review']:
+            return Response(
+                {'error': '当前文档状态不允许模块操作'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        from .serializers import ModuleBatchUpdateSerializer
+
+        serializer = ModuleBatchUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            operation_service = ModuleOperationService(document)
+            with transaction.atomic():
+                result = operation_service.execute_batch_operations(serializer.validated_data['operations'])
+                if result['success']:
                     # 更新文档状态
                     document.status = 'ready_for_review'
                     document.save()
+        except Exception as e:
+            logger.error(f"批量模块操作失败: {e}")
+            return Response(
+                {'error': f'操作失败: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
 
-                    # 返回更新后的模块列表
-                    modules = document.modules.order_by('order')
-                    modules_serializer = RequirementModuleSerializer(modules, many=True)
-
-                    return Response({
-                        'message': result['message'],
-                        'operation_result': result,
-                        'modules': modules_serializer.data,
-                        'status': document.status
-                    })
-
-                except Exception as e:
-                    logger.error(f"模块操作失败: {e}")
-                    return Response(
-                        {'error': f'操作失败: {str(e)}'},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-            else:
-                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not result['success']:
+            return Response(
+                {key: value for key, value in result.items() if key != 'success'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # 返回更新后的模块列表
+        modules = document.modules.order_by('order')
+        modules_serializer = RequirementModuleSerializer(modules, many=True)
+
+        return Response({
+            'message': result['message'],
+            'operations_count': result['operations_count'],
+            'results': result['results'],
+            'modules': modules_serializer.data,
+            'status': document.status
+        })
 
 
 class RequirementModuleViewSet(BaseModelViewSet):
@@ -649,6 +748,80 @@ class ReviewReportViewSet(BaseModelViewSet):
             document__project__members__user=user
         ).distinct()
 
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """
+        获取评审进度（阶段、已完成模块数、错误信息）
+        GET /api/requirements/reports/{id}/progress/
+        """
+        return Response(get_report_progress(self.get_object()))
+
+    @action(detail=True, methods=['get'], renderer_classes=[UnifiedResponseRenderer, EventStreamRenderer])
+    def events(self, request, pk=None):
+        """
+        评审进度事件流（SSE）
+        GET /api/requirements/reports/{id}/events/
+        事件类型：progress（进度变化）、module（模块完成，含该模块发现的问题）、done（评审结束）
+        ASGI下使用异步生成器，WSGI下使用同步生成器，两者都能逐条推送
+        """
+        review_report = self.get_object()
+        stream = areview_event_stream if isinstance(request._request, ASGIRequest) else review_event_stream
+        response = StreamingHttpResponse(
+            stream(review_report.id),
+            content_type='text/event-stream; charset=utf-8'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @action(detail=True, methods=['post'])
+    @permission_required('requirements.change_reviewreport')
+    def cancel(self, request, pk=None):
+        """
+        取消评审，执行中的评审在当前模块完成后停止
+        POST /api/requirements/reports/{id}/cancel/
+        """
+        review_report = self.get_object()
+        if not RequirementReviewService.cancel_review(review_report):
+            return Response(
+                {'error': f'评审状态 "{review_report.get_status_display()}" 不能取消'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'message': '已请求取消评审', **get_report_progress(review_report)})
+
+    @action(detail=True, methods=['post'])
+    @permission_required('requirements.change_reviewreport')
+    def resume(self, request, pk=None):
+        """
+        从检查点继续执行失败或已取消的模块评审，已完成的模块不再重新分析
+        POST /api/requirements/reports/{id}/resume/
+        """
+        review_report = self.get_object()
+        document = review_report.document
+        if review_report.review_type != 'comprehensive' or review_report.status not in ['failed', 'cancelled']:
+            return Response(
+                {'error': f'评审状态 "{review_report.get_status_display()}" 不能继续'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if document.status not in ['failed', 'ready_for_review']:
+            return Response(
+                {'error': f'文档状态 "{document.get_status_display()}" 不允许继续评审'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        review_report.status = 'pending'
+        review_report.cancel_requested = False
+        review_report.heartbeat_at = None
+        review_report.finished_at = None
+        review_report.error_message = ''
+        review_report.save(update_fields=[
+            'status', 'cancel_requested', 'heartbeat_at', 'finished_at', 'error_message', 'updated_at'
+        ])
+        document.status = 'reviewing'
+        document.save()
+        review_job_runner.submit(review_report.id)
+        return Response(get_report_progress(review_report), status=status.HTTP_202_ACCEPTED)
+
 
 class ReviewIssueViewSet(BaseModelViewSet):
     """评审问题视图集"""
@@ -0,0 +1,139 @@
+"""
+用例导出
+- 模块路径由一次查询加载的项目模块树计算，不再逐级查询父模块
+- 用例按块迭代读取，每块用一次预取查询按步骤编号读取步骤，查询数只与块数有关
+- Excel 使用 openpyxl 的只写模式逐行写入临时文件，生成后分块流式返回；CSV 边生成边返回
+"""
+import csv
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Prefetch
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles import Alignment, Font
+from openpyxl.utils import get_column_letter
+
+from .models import TestCaseModule, TestCaseStep
+
+EXPORT_HEADERS = [
+    '用例名称', '所属模块', '标签', '前置条件',
+    '步骤描述', '预期结果', '编辑模式', '备注', '用例等级'
+]
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def export_chunk_size() -> int:
+    return max(1, getattr(settings, 'TESTCASE_EXPORT_CHUNK_SIZE', 2000))
+
+
+def build_module_paths(project_id) -> Dict[int, str]:
+    """一次查询加载项目的模块树，返回 模块ID -> 完整路径（如 /登录/账号登录）"""
+    modules = {
+        module_id: (name, parent_id)
+        for module_id, name, parent_id in TestCaseModule.objects.filter(project_id=project_id)
+        .values_list('id', 'name', 'parent_id')
+    }
+    paths: Dict[int, str] = {}
+
+    def resolve(module_id) -> str:
+        # 自下而上找到第一个已计算路径的祖先，再自上而下补齐
+        chain = []
+        current = module_id
+        while current in modules and current not in paths and current not in chain:
+            chain.append(current)
+            current = modules[current][1]
+        prefix = paths.get(current, '')
+        for node in reversed(chain):
+            prefix = f"{prefix}/{modules[node][0]}"
+            paths[node] = prefix
+        return paths.get(module_id, '')
+
+    for module_id in modules:
+        resolve(module_id)
+    return paths
+
+
+def format_steps(steps) -> Tuple[str, str]:
+    """格式化步骤描述和预期结果，steps 已按步骤编号排序"""
+    steps_desc = []
+    expected_results = []
+
+    for step in steps:
+        steps_desc.append(f"[{step.step_number}]{step.description}")
+        expected_results.append(f"[{step.step_number}]{step.expected_result}")
+
+    return "\n".join(steps_desc), "\n".join(expected_results)
+
+
+def iter_export_rows(queryset, project_id, chunk_size: Optional[int] = None) -> Iterator[List]:
+    """按导出表头的顺序逐行生成用例数据"""
+    module_paths = build_module_paths(project_id)
+    queryset = queryset.select_related(None).prefetch_related(None).only(
+        'id', 'name', 'module_id', 'precondition', 'notes', 'level'
+    ).prefetch_related(Prefetch(
+        'steps',
+        queryset=TestCaseStep.objects.order_by('step_number').only(
+            'id', 'test_case_id', 'step_number', 'description', 'expected_result'
+        )
+    ))
+
+    for testcase in queryset.iterator(chunk_size=chunk_size or export_chunk_size()):
+        steps_desc, expected_results = format_steps(testcase.steps.all())
+        yield [
+            testcase.name,
+            module_paths.get(testcase.module_id, ''),
+            '',  # 标签字段，当前数据库中没有
+            testcase.precondition or '',
+            steps_desc,
+            expected_results,
+            'STEP',  # 编辑模式，固定为STEP
+            testcase.notes or '',
+            testcase.level,
+        ]
+
+
+def write_xlsx(rows: Iterator[List]):
+    """
+    以只写模式逐行写入工作簿，返回已定位到开头的临时文件
+    只写模式下已写入的行不保留在内存中，内存占用与用例数量无关
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("测试用例")
+    for col in range(1, len(EXPORT_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 20
+
+    header_cells = []
+    for header in EXPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal='center')
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    for row in rows:
+        # 去掉Excel不允许的控制字符
+        ws.append([ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value for value in row])
+
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+class _Echo:
+    """csv.writer 写入时直接返回写入的内容"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows: Iterator[List]) -> Iterator[str]:
+    """逐行生成CSV内容，开头带BOM以便Excel按UTF-8打开"""
+    writer = csv.writer(_Echo())
+    yield '\ufeff' + writer.writerow(EXPORT_HEADERS)
+    for row in rows:
+        yield writer.writerow(row)
@@ -135,6 +135,30 @@ class TestCaseSerializer(serializers.ModelSerializer):
         ).data
 
 
+class TestCaseBatchStepSerializer(serializers.ModelSerializer):
+    """
+    批量创建用例时的步骤序列化器，步骤编号按提交顺序重新分配
+    """
+    step_number = serializers.IntegerField(required=False)
+
+    class Meta:
+        model = TestCaseStep
+        fields = ['step_number', 'description', 'expected_result']
+
+
+class TestCaseBatchItemSerializer(serializers.ModelSerializer):
+    """
+    批量创建用例的单条数据校验，只做字段校验不访问数据库；
+    模块是否属于当前项目由视图一次性查询后校验
+    """
+    module_id = serializers.IntegerField()
+    steps = TestCaseBatchStepSerializer(many=True, allow_empty=False)
+
+    class Meta:
+        model = TestCase
+        fields = ['module_id', 'name', 'precondition', 'level', 'notes', 'steps']
+
+
 class TestCaseModuleSerializer(serializers.ModelSerializer):
     """
     用例模块序列化器
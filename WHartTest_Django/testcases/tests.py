@@ -1,3 +1,147 @@
-from django.test import TestCase
+import csv
+import io
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from openpyxl import load_workbook
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from projects.models import Project, ProjectMember
+from .models import TestCase as CaseModel, TestCaseModule, TestCaseStep
+
+
+class TestCaseBatchCreateTests(TestCase):
+    """批量创建用例接口测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='batchuser', password='testpass123')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_testcase'))
+        self.project = Project.objects.create(name='批量项目', creator=self.user)
+        ProjectMember.objects.create(project=self.project, user=self.user, role='owner')
+        self.module = TestCaseModule.objects.create(project=self.project, name='登录', creator=self.user)
+        other_project = Project.objects.create(name='其他项目', creator=self.user)
+        self.other_module = TestCaseModule.objects.create(project=other_project, name='其他', creator=self.user)
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = f'/api/projects/{self.project.id}/testcases/batch-create/'
+
+    def _case(self, name, module_id=None, step_count=2):
+        return {
+            'module_id': module_id or self.module.id,
+            'name': name,
+            'precondition': '已注册账号',
+            'level': 'P1',
+            'steps': [
+                {'description': f'步骤{i}', 'expected_result': f'结果{i}'} for i in range(1, step_count + 1)
+            ],
+        }
+
+    def test_batch_create_with_per_item_results(self):
+        """校验通过的用例批量写入，失败的用例逐条返回错误"""
+        cases = [self._case(f'用例{i}') for i in range(20)]
+        cases.append(self._case('跨项目模块', module_id=self.other_module.id))
+        cases.append({'module_id': self.module.id, 'name': '缺少步骤', 'steps': []})
+
+        response = self.client.post(self.url, {'cases': cases}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()['data']
+        self.assertEqual(data['created_count'], 20)
+        self.assertEqual(data['failed_count'], 2)
+        self.assertEqual([item['status'] for item in data['results'][:20]], ['created'] * 20)
+        self.assertIn('module_id', data['results'][20]['errors'])
+        self.assertIn('steps', data['results'][21]['errors'])
+
+        created = CaseModel.objects.filter(project=self.project)
+        self.assertEqual(created.count(), 20)
+        self.assertEqual(TestCaseStep.objects.filter(test_case__project=self.project).count(), 40)
+        first = created.get(id=data['results'][0]['id'])
+        self.assertEqual(first.creator, self.user)
+        self.assertEqual(list(first.steps.values_list('step_number', flat=True)), [1, 2])
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        """查询次数与用例数量无关"""
+        self.client.post(self.url, {'cases': [self._case('预热')]}, format='json')  # 预热权限缓存
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.url, {'cases': [self._case(f'小{i}') for i in range(2)]}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post(self.url, {'cases': [self._case(f'大{i}') for i in range(50)]}, format='json')
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_all_invalid_returns_error(self):
+        response = self.client.post(self.url, {'cases': [{'name': '无模块'}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(CaseModel.objects.count(), 0)
+
+
+class TestCaseExportTests(TestCase):
+    """用例导出接口测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='exporter', password='testpass123')
+        self.project = Project.objects.create(name='导出项目', creator=self.user)
+        ProjectMember.objects.create(project=self.project, user=self.user, role='owner')
+        root = TestCaseModule.objects.create(project=self.project, name='用户', creator=self.user)
+        child = TestCaseModule.objects.create(project=self.project, name='登录', parent=root, level=2,
+                                              creator=self.user)
+        self.leaf = TestCaseModule.objects.create(project=self.project, name='密码登录', parent=child, level=3,
+                                                  creator=self.user)
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = f'/api/projects/{self.project.id}/testcases/export-excel/'
+
+    def _create_cases(self, count, prefix='用例'):
+        cases = CaseModel.objects.bulk_create(
+            CaseModel(project=self.project, module=self.leaf, name=f'{prefix}{i}', level='P1', creator=self.user,
+                      precondition='已注册账号')
+            for i in range(count)
+        )
+        # 步骤乱序写入，导出时按步骤编号排列
+        TestCaseStep.objects.bulk_create(
+            TestCaseStep(test_case=case, step_number=number, description=f'步骤{number}',
+                         expected_result=f'结果{number}', creator=self.user)
+            for case in cases for number in (2, 1)
+        )
+        return cases
+
+    def test_export_xlsx_streams_rows(self):
+        self._create_cases(3)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        rows = list(workbook['测试用例'].iter_rows(values_only=True))
+        self.assertEqual(rows[0][:2], ('用例名称', '所属模块'))
+        self.assertEqual(len(rows), 4)
+        name, module_path, _, precondition, steps, expected = rows[1][:6]
+        self.assertEqual(module_path, '/用户/登录/密码登录')
+        self.assertEqual(steps, '[1]步骤1\n[2]步骤2')
+        self.assertEqual(expected, '[1]结果1\n[2]结果2')
+
+    def test_export_csv(self):
+        cases = self._create_cases(2)
+        response = self.client.post(f'{self.url}?export_format=csv', {'ids': [cases[0].id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][:2], ['用例0', '/用户/登录/密码登录'])
+        self.assertEqual(rows[1][4], '[1]步骤1\n[2]步骤2')
+
+    @override_settings(TESTCASE_EXPORT_CHUNK_SIZE=100)
+    def test_query_count_does_not_grow_with_case_count(self):
+        self.client.get(self.url)  # 预热权限缓存
+        counts = []
+        for count in (2, 60):
+            self._create_cases(count, prefix=f'批次{count}-')
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(f'{self.url}?export_format=csv')
+                b''.join(response.streaming_content)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
@@ -3,14 +3,15 @@ from django_filters.rest_framework import DjangoFilterBackend # 导入 DjangoFil
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django.shortcuts import get_object_or_404
+from django.conf import settings
 from django.db import transaction
-from django.http import HttpResponse
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment
-import io
+from django.http import FileResponse, StreamingHttpResponse
 
-from .models import TestCase, TestCaseModule, Project, TestCaseScreenshot
-from .serializers import TestCaseSerializer, TestCaseModuleSerializer, TestCaseScreenshotSerializer
+from .models import TestCase, TestCaseStep, TestCaseModule, Project, TestCaseScreenshot
+from .exporters import XLSX_CONTENT_TYPE, iter_csv, iter_export_rows, write_xlsx
+from .serializers import (
+    TestCaseSerializer, TestCaseModuleSerializer, TestCaseScreenshotSerializer, TestCaseBatchItemSerializer
+)
 from .permissions import IsProjectMemberForTestCase, IsProjectMemberForTestCaseModule
 from .filters import TestCaseFilter # 导入自定义过滤器
 # 确保导入项目自定义的权限类
@@ -107,8 +108,16 @@ class TestCaseViewSet(viewsets.ModelViewSet):
         1. GET请求通过ids参数: /api/projects/1/testcases/export-excel/?ids=1,2,3
         2. POST请求通过请求体: {"ids": [1, 2, 3]}
         如果不提供ids，则导出项目下所有用例
+        export_format 参数（查询参数或请求体）为 csv 时导出CSV，默认导出xlsx
+        用例按块（TESTCASE_EXPORT_CHUNK_SIZE）读取并流式返回，内存占用不随用例数量增长，每块只需两次查询
         """
         testcase_ids = None
+        export_format = request.query_params.get('export_format') or request.data.get('export_format') or 'xlsx'
+        if export_format not in ('xlsx', 'csv'):
+            return Response(
+                {'error': 'export_format参数只支持xlsx或csv'},
+                status=400
+            )
 
         if request.method == 'POST':
             # POST请求，从请求体获取ids
@@ -117,7 +126,6 @@ class TestCaseViewSet(viewsets.ModelViewSet):
                 try:
                     testcase_ids = [int(id) for id in ids_data]
                 except (ValueError, TypeError):
-                    from rest_framework.response import Response
                     return Response(
                         {'error': 'ids参数格式错误，应为数字列表'},
                         status=400
@@ -129,7 +137,6 @@ class TestCaseViewSet(viewsets.ModelViewSet):
                 try:
                     testcase_ids = [int(id.strip()) for id in ids_param.split(',') if id.strip()]
                 except ValueError:
-                    from rest_framework.response import Response
                     return Response(
                         {'error': 'ids参数格式错误，应为逗号分隔的数字列表'},
                         status=400
@@ -141,91 +148,19 @@ class TestCaseViewSet(viewsets.ModelViewSet):
         else:
             queryset = self.get_queryset()
 
-        # 创建Excel工作簿
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "测试用例"
-
-        # 设置表头
-        headers = [
-            '用例名称', '所属模块', '标签', '前置条件',
-            '步骤描述', '预期结果', '编辑模式', '备注', '用例等级'
-        ]
-
-        # 写入表头
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal='center')
-
-        # 写入数据
-        for row, testcase in enumerate(queryset, 2):
-            # 获取模块路径
-            module_path = self._get_module_path(testcase.module) if testcase.module else ""
-
-            # 获取步骤描述和预期结果
-            steps_desc, expected_results = self._format_steps(testcase.steps.all())
-
-            # 写入数据行
-            ws.cell(row=row, column=1, value=testcase.name)
-            ws.cell(row=row, column=2, value=module_path)
-            ws.cell(row=row, column=3, value="")  # 标签字段，当前数据库中没有
-            ws.cell(row=row, column=4, value=testcase.precondition or "")
-            ws.cell(row=row, column=5, value=steps_desc)
-            ws.cell(row=row, column=6, value=expected_results)
-            ws.cell(row=row, column=7, value="STEP")  # 编辑模式，固定为STEP
-            ws.cell(row=row, column=8, value=testcase.notes or "")
-            ws.cell(row=row, column=9, value=testcase.level)
-
-        # 调整列宽
-        for col in range(1, len(headers) + 1):
-            ws.column_dimensions[chr(64 + col)].width = 20
-
-        # 保存到内存
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-
-        # 创建HTTP响应
-        response = HttpResponse(
-            output.getvalue(),
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-
         # 获取项目名称用于文件名
         project = get_object_or_404(Project, pk=project_pk)
-        filename = f"{project.name}_测试用例.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-
-        return response
-
-    def _get_module_path(self, module):
-        """
-        获取模块的完整路径
-        """
-        if not module:
-            return ""
-
-        path_parts = []
-        current = module
-        while current:
-            path_parts.insert(0, current.name)
-            current = current.parent
-
-        return "/" + "/".join(path_parts)
-
-    def _format_steps(self, steps):
-        """
-        格式化步骤描述和预期结果
-        """
-        steps_desc = []
-        expected_results = []
+        rows = iter_export_rows(queryset, project.pk)
 
-        for step in steps.order_by('step_number'):
-            steps_desc.append(f"[{step.step_number}]{step.description}")
-            expected_results.append(f"[{step.step_number}]{step.expected_result}")
+        if export_format == 'csv':
+            response = StreamingHttpResponse(iter_csv(rows), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="{project.name}_测试用例.csv"'
+            return response
 
-        return "\n".join(steps_desc), "\n".join(expected_results)
+        # 只写模式逐行写入临时文件，再分块返回
+        response = FileResponse(write_xlsx(rows), content_type=XLSX_CONTENT_TYPE)
+        response['Content-Disposition'] = f'attachment; filename="{project.name}_测试用例.xlsx"'
+        return response
 
     @action(detail=False, methods=['post'], url_path='batch-delete')
     def batch_delete(self, request, **kwargs):
@@ -304,6 +239,94 @@ class TestCaseViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['post'], url_path='batch-create')
+    @permission_required('testcases.add_testcase')
+    def batch_create(self, request, **kwargs):
+        """
+        批量创建用例（含步骤），供Agent一次提交多条生成的用例
+        POST请求体格式: {"cases": [{"module_id": 1, "name": "...", "precondition": "...", "level": "P1",
+                                   "notes": "...", "steps": [{"description": "...", "expected_result": "..."}]}]}
+        逐条校验，校验通过的用例和步骤在同一事务中通过 bulk_create 写入；
+        返回每条用例的结果（index、status、id 或 errors），步骤编号按提交顺序重新分配
+        """
+        cases_data = request.data.get('cases')
+        if not isinstance(cases_data, list) or not cases_data:
+            return Response(
+                {'error': '请提供要创建的用例列表 cases'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        max_items = getattr(settings, 'TESTCASE_BATCH_CREATE_MAX_ITEMS', 200)
+        if len(cases_data) > max_items:
+            return Response(
+                {'error': f'单次最多创建 {max_items} 个用例，当前提交 {len(cases_data)} 个'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        project = get_object_or_404(Project, pk=self.kwargs.get('project_pk'))
+        # 一次查询当前项目的全部模块，用于校验 module_id
+        module_ids = set(TestCaseModule.objects.filter(project=project).values_list('id', flat=True))
+
+        results = []
+        valid_items = []  # (index, validated_data)
+        for index, case_data in enumerate(cases_data):
+            serializer = TestCaseBatchItemSerializer(data=case_data)
+            if not serializer.is_valid():
+                results.append({'index': index, 'status': 'failed', 'errors': serializer.errors})
+                continue
+            if serializer.validated_data['module_id'] not in module_ids:
+                results.append({'index': index, 'status': 'failed',
+                                'errors': {'module_id': ['模块不存在或不属于当前项目']}})
+                continue
+            results.append(None)
+            valid_items.append((index, serializer.validated_data))
+
+        if valid_items:
+            with transaction.atomic():
+                test_cases = TestCase.objects.bulk_create([
+                    TestCase(
+                        project=project,
+                        creator=request.user,
+                        module_id=data['module_id'],
+                        name=data['name'],
+                        precondition=data.get('precondition'),
+                        level=data.get('level', 'P2'),
+                        notes=data.get('notes'),
+                    )
+                    for _, data in valid_items
+                ])
+                TestCaseStep.objects.bulk_create([
+                    TestCaseStep(
+                        test_case=test_case,
+                        creator=request.user,
+                        step_number=step_index + 1,
+                        description=step['description'],
+                        expected_result=step['expected_result'],
+                    )
+                    for test_case, (_, data) in zip(test_cases, valid_items)
+                    for step_index, step in enumerate(data['steps'])
+                ])
+
+            for test_case, (index, data) in zip(test_cases, valid_items):
+                results[index] = {'index': index, 'status': 'created', 'id': test_case.id, 'name': test_case.name}
+
+        created_count = len(valid_items)
+        failed_count = len(cases_data) - created_count
+        response_data = {
+            'created_count': created_count,
+            'failed_count': failed_count,
+            'results': results,
+        }
+        if not created_count:
+            return Response(response_data, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'status': 'success',
+            'code': status.HTTP_201_CREATED,
+            'message': f'成功创建 {created_count} 个用例，失败 {failed_count} 个',
+            'data': response_data,
+            'errors': None,
+        }, status=status.HTTP_201_CREATED)
+
     @action(detail=True, methods=['post'], url_path='upload-screenshots')
     @permission_required('testcases.add_testcasescreenshot')
     def upload_screenshots(self, request, project_pk=None, pk=None):
@@ -357,3 +357,77 @@ LOGGING = {
         # 可以根据需要添加其他应用的 logger
     },
 }
+
+# LLM对话与知识库配置
+# 异步对话路径中执行向量检索（嵌入计算 + Chroma查询）的线程池大小
+KNOWLEDGE_RETRIEVAL_MAX_WORKERS = int(os.environ.get('KNOWLEDGE_RETRIEVAL_MAX_WORKERS', '4'))
+# 对话上下文摘要：历史token数超过 上下文上限 × 触发比例 时，将最近K轮之前的对话压缩为滚动摘要
+CHAT_CONTEXT_SUMMARY_ENABLED = os.environ.get('CHAT_CONTEXT_SUMMARY_ENABLED', 'True') == 'True'
+CHAT_CONTEXT_MAX_TOKENS = int(os.environ.get('CHAT_CONTEXT_MAX_TOKENS', '0'))  # 0 表示使用模型的上下文上限
+CHAT_CONTEXT_TRIGGER_RATIO = float(os.environ.get('CHAT_CONTEXT_TRIGGER_RATIO', '0.75'))
+CHAT_CONTEXT_KEEP_LAST_TURNS = int(os.environ.get('CHAT_CONTEXT_KEEP_LAST_TURNS', '4'))
+# LLM网关：按LLM配置限制并发与每分钟token数（LLM配置中未单独设置时使用以下默认值）
+LLM_GATEWAY_ENABLED = os.environ.get('LLM_GATEWAY_ENABLED', 'True') == 'True'
+LLM_GATEWAY_DEFAULT_MAX_CONCURRENCY = int(os.environ.get('LLM_GATEWAY_DEFAULT_MAX_CONCURRENCY', '8'))
+LLM_GATEWAY_DEFAULT_TOKENS_PER_MINUTE = int(os.environ.get('LLM_GATEWAY_DEFAULT_TOKENS_PER_MINUTE', '0'))  # 0 表示不限制
+LLM_GATEWAY_QUEUE_TIMEOUT = int(os.environ.get('LLM_GATEWAY_QUEUE_TIMEOUT', '300'))  # 排队超时（秒），0 表示不超时
+# LLM响应缓存（默认关闭）：精确缓存用于需求拆分/评审等确定性调用，语义缓存用于知识库问答
+LLM_RESPONSE_CACHE_ENABLED = os.environ.get('LLM_RESPONSE_CACHE_ENABLED', 'False') == 'True'
+LLM_RESPONSE_CACHE_PATH = os.environ.get('LLM_RESPONSE_CACHE_PATH', str(BASE_DIR / 'llm_response_cache.sqlite'))
+LLM_RESPONSE_CACHE_TTL = int(os.environ.get('LLM_RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))  # 秒，0 表示永不过期
+LLM_SEMANTIC_CACHE_ENABLED = os.environ.get('LLM_SEMANTIC_CACHE_ENABLED', 'False') == 'True'
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('LLM_SEMANTIC_CACHE_THRESHOLD', '0.95'))
+# 对话配置缓存（激活的LLM配置、用户提示词）的有效期（秒），模型变更时通过信号立即失效
+CHAT_CONFIG_CACHE_TTL = int(os.environ.get('CHAT_CONFIG_CACHE_TTL', '300'))
+# 对话检查点（对话历史）存储后端：sqlite（默认，单机）或 postgres（多进程/多主机部署，需安装 langgraph-checkpoint-postgres）
+# postgres 未设置 CHAT_CHECKPOINTER_POSTGRES_URL 时复用Django默认数据库；可用 migrate_chat_checkpoints 命令迁移已有会话
+CHAT_CHECKPOINTER_BACKEND = os.environ.get('CHAT_CHECKPOINTER_BACKEND', 'sqlite')
+CHAT_HISTORY_SQLITE_PATH = os.environ.get('CHAT_HISTORY_SQLITE_PATH', str(BASE_DIR / 'chat_history.sqlite'))
+CHAT_CHECKPOINTER_POSTGRES_URL = os.environ.get('CHAT_CHECKPOINTER_POSTGRES_URL', '')
+CHAT_CHECKPOINTER_POOL_MIN_SIZE = int(os.environ.get('CHAT_CHECKPOINTER_POOL_MIN_SIZE', '1'))
+CHAT_CHECKPOINTER_POOL_MAX_SIZE = int(os.environ.get('CHAT_CHECKPOINTER_POOL_MAX_SIZE', '10'))
+# MCP持久会话：按用户+项目隔离，空闲超过TTL（秒）由后台任务回收，并限制每个用户、每个服务器的会话数
+MCP_SESSION_IDLE_TTL = int(os.environ.get('MCP_SESSION_IDLE_TTL', '1800'))
+MCP_SESSION_REAP_INTERVAL = int(os.environ.get('MCP_SESSION_REAP_INTERVAL', '60'))
+MCP_MAX_SESSIONS_PER_USER = int(os.environ.get('MCP_MAX_SESSIONS_PER_USER', '5'))
+MCP_MAX_SESSIONS_PER_SERVER = int(os.environ.get('MCP_MAX_SESSIONS_PER_SERVER', '50'))
+# 各MCP服务器并发连接并加载工具，单个服务器的超时时间（秒），超时的服务器在本轮对话中跳过
+MCP_CONNECT_TIMEOUT = float(os.environ.get('MCP_CONNECT_TIMEOUT', '15'))
+# MCP工具目录缓存有效期（秒），过期后先使用旧目录并在后台刷新
+MCP_TOOL_CATALOG_TTL = int(os.environ.get('MCP_TOOL_CATALOG_TTL', '300'))
+# MCP服务器熔断：连续失败次数或滚动窗口内错误率超过阈值时熔断，冷却期（秒）后放行探测请求
+MCP_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('MCP_CIRCUIT_FAILURE_THRESHOLD', '5'))
+MCP_CIRCUIT_ERROR_RATE = float(os.environ.get('MCP_CIRCUIT_ERROR_RATE', '0.5'))
+MCP_CIRCUIT_MIN_CALLS = int(os.environ.get('MCP_CIRCUIT_MIN_CALLS', '10'))
+MCP_CIRCUIT_WINDOW_SECONDS = int(os.environ.get('MCP_CIRCUIT_WINDOW_SECONDS', '300'))
+MCP_CIRCUIT_COOLDOWN = int(os.environ.get('MCP_CIRCUIT_COOLDOWN', '60'))
+MCP_TOOL_CALL_TIMEOUT = float(os.environ.get('MCP_TOOL_CALL_TIMEOUT', '120'))  # 单次MCP工具调用超时（秒）
+# 批量创建用例接口单次请求允许的最大用例数
+TESTCASE_BATCH_CREATE_MAX_ITEMS = int(os.environ.get('TESTCASE_BATCH_CREATE_MAX_ITEMS', '200'))
+# 需求模块评审：并行分析的最大并发模块数；遇到LLM限流时的重试次数和指数退避基础间隔（秒）
+REQUIREMENT_REVIEW_MAX_CONCURRENCY = int(os.environ.get('REQUIREMENT_REVIEW_MAX_CONCURRENCY', '4'))
+REQUIREMENT_REVIEW_MAX_RETRIES = int(os.environ.get('REQUIREMENT_REVIEW_MAX_RETRIES', '3'))
+REQUIREMENT_REVIEW_RETRY_BASE_DELAY = float(os.environ.get('REQUIREMENT_REVIEW_RETRY_BASE_DELAY', '2.0'))
+# 需求评审后台任务：并发执行的评审数、心跳间隔与过期时间（秒，心跳过期的未完成评审由看门狗从检查点继续），事件流轮询间隔（秒）
+REQUIREMENT_REVIEW_JOB_WORKERS = int(os.environ.get('REQUIREMENT_REVIEW_JOB_WORKERS', '2'))
+REQUIREMENT_REVIEW_JOB_HEARTBEAT = int(os.environ.get('REQUIREMENT_REVIEW_JOB_HEARTBEAT', '30'))
+REQUIREMENT_REVIEW_JOB_STALE_SECONDS = int(os.environ.get('REQUIREMENT_REVIEW_JOB_STALE_SECONDS', '120'))
+REQUIREMENT_REVIEW_JOB_WATCHDOG = os.environ.get('REQUIREMENT_REVIEW_JOB_WATCHDOG', 'True') == 'True'
+REQUIREMENT_REVIEW_EVENT_POLL_INTERVAL = float(os.environ.get('REQUIREMENT_REVIEW_EVENT_POLL_INTERVAL', '1.0'))
+# 需求评审结果缓存：按内容哈希、提示词版本和模型复用未变化部分的分析结果，超过有效期（天，0为不过期）未使用的缓存不再命中
+REQUIREMENT_REVIEW_CACHE_ENABLED = os.environ.get('REQUIREMENT_REVIEW_CACHE_ENABLED', 'True') == 'True'
+REQUIREMENT_REVIEW_CACHE_TTL_DAYS = int(os.environ.get('REQUIREMENT_REVIEW_CACHE_TTL_DAYS', '30'))
+# 需求文档PDF后台提取：同时提取的文档数、提取进程数（0为在任务线程中提取）、每个子任务的页数，以及单个PDF最多提取的页数（0为不限制）
+REQUIREMENT_EXTRACTION_JOB_WORKERS = int(os.environ.get('REQUIREMENT_EXTRACTION_JOB_WORKERS', '2'))
+REQUIREMENT_PDF_EXTRACT_PROCESSES = int(os.environ.get('REQUIREMENT_PDF_EXTRACT_PROCESSES', '2'))
+REQUIREMENT_PDF_PAGES_PER_TASK = int(os.environ.get('REQUIREMENT_PDF_PAGES_PER_TASK', '10'))
+REQUIREMENT_PDF_MAX_PAGES = int(os.environ.get('REQUIREMENT_PDF_MAX_PAGES', '300'))
+# 需求评审提示词的token预算：上下文token数（0为按模型的上下文限制）和为模型输出预留的token数
+REQUIREMENT_REVIEW_CONTEXT_TOKENS = int(os.environ.get('REQUIREMENT_REVIEW_CONTEXT_TOKENS', '0'))
+REQUIREMENT_REVIEW_OUTPUT_TOKENS = int(os.environ.get('REQUIREMENT_REVIEW_OUTPUT_TOKENS', '2048'))
+# tiktoken编码器不可用时token快速估算的相对误差上限，可用 calibrate_token_estimator 命令在实际文档上测量
+REQUIREMENT_TOKEN_ESTIMATE_ERROR = float(os.environ.get('REQUIREMENT_TOKEN_ESTIMATE_ERROR', '0.25'))
+# 用例导出：每次从数据库读取的用例数（每块一次用例查询和一次步骤预取查询）
+TESTCASE_EXPORT_CHUNK_SIZE = int(os.environ.get('TESTCASE_EXPORT_CHUNK_SIZE', '2000'))
+# 流式对话检查停止标记的间隔（秒），停止请求可由任意工作进程处理
+CHAT_STOP_POLL_INTERVAL = float(os.environ.get('CHAT_STOP_POLL_INTERVAL', '1.0'))
@@ -4,28 +4,96 @@
 # @Time   : 2025/4/28 14:46
 
 from fastmcp import FastMCP
+import asyncio
 import json
-import requests
+import logging
+import os
+import httpx
 from typing import Any, Dict, List, Optional
-import json
-import ast  # ast 模块用于安全地解析 Python 字符串文字，因为您的输入使用了单引号而不是标准的 JSON 双引号
-import doctest
 import time
 from pydantic import Field
-from pydantic.v1.networks import host_regex
+
+logger = logging.getLogger(__name__)
 
 # mcp 初始化
 mcp = FastMCP(
     name="WHartTest_tools"
 )
 
-base_url = "http://127.0.0.1:8000"
+base_url = os.environ.get("WHARTTEST_BASE_URL", "http://127.0.0.1:8000")
 
 headers = {
     "accept": "application/json, text/plain,*/*",
-    "X-API-Key": "EWKVLxe5zyBG3g5g9c2fygTiotoKAxxCR5zAxcSEh7s"
+    "X-API-Key": os.environ.get("WHARTTEST_API_KEY", "EWKVLxe5zyBG3g5g9c2fygTiotoKAxxCR5zAxcSEh7s")
 }
 
+# HTTP客户端：所有工具共享一个异步连接池，工具并发调用时互不阻塞
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+# 用例列表分页大小和单次返回的用例数上限
+CASE_PAGE_SIZE = 100
+MAX_CASE_RESULTS = 500
+# 项目、模块列表缓存时间（秒）
+LOOKUP_CACHE_TTL = 60
+
+_http_client: Optional[httpx.AsyncClient] = None
+_lookup_cache: Dict[str, tuple] = {}  # path -> (缓存时间, 数据)
+_lookup_inflight: Dict[str, asyncio.Task] = {}  # 正在请求的path，并发请求复用同一次结果
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的异步HTTP客户端（keep-alive连接池）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(base_url=base_url, headers=headers, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+    return _http_client
+
+
+async def get_json(path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    response = await get_http_client().get(path, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+async def get_json_cached(path: str) -> Dict[str, Any]:
+    """带短时缓存的GET请求，用于项目、模块等变化不频繁的数据"""
+    cached = _lookup_cache.get(path)
+    if cached and time.monotonic() - cached[0] < LOOKUP_CACHE_TTL:
+        return cached[1]
+
+    task = _lookup_inflight.get(path)
+    if task is None:
+        task = asyncio.ensure_future(get_json(path))
+        _lookup_inflight[path] = task
+        task.add_done_callback(lambda _: _lookup_inflight.pop(path, None))
+    data = await asyncio.shield(task)
+    _lookup_cache[path] = (time.monotonic(), data)
+    return data
+
+
+def flatten_tree(nodes_list, id_key: str, name_key: str) -> List[Dict[str, Any]]:
+    """递归提取树形节点（含children）的 id 和 name"""
+    extracted_data = []
+
+    def extract_info(nodes):
+        if not isinstance(nodes, list):
+            print("警告: 期望输入列表，但收到了非列表类型。")
+            return
+        for node in nodes:
+            if not isinstance(node, dict):
+                print("警告: 期望列表元素是字典，但收到了非字典类型。")
+                continue
+            extracted_data.append({id_key: node.get("id"), name_key: node.get("name")})
+            children = node.get("children")
+            if isinstance(children, list):
+                extract_info(children)
+
+    if isinstance(nodes_list, list):
+        extract_info(nodes_list)
+    else:
+        print("获取到的数据结构不符合预期，未找到 'data' 列表。")
+    return extracted_data
+
 
 def generate_custom_id():
     """
@@ -57,111 +125,25 @@ def generate_custom_id():
 
 
 @mcp.tool(description="获取WHartTest平台项目的名称和对应id")
-def get_project_name_and_id() -> str:
+async def get_project_name_and_id() -> str:
     """获取WHartTest平台项目的名称和对应id"""
-    url = base_url + "/api/projects/"
+    data_dict = await get_json_cached("/api/projects/")
 
-    data_dict = requests.get(url, headers=headers).json()
-
-    # 用于存储提取出的 id 和 name 的列表
-    extracted_data = []
-
-    # 定义一个递归函数来处理嵌套的 children 列表
-    def extract_info(nodes_list):
-        if not isinstance(nodes_list, list):
-            # 如果输入的不是列表，则停止或报错，取决于期望
-            # 在您的结构中，data 和 children 应该是列表
-            print("警告: 期望输入列表，但收到了非列表类型。")
-            return
-
-        for node in nodes_list:
-            # 确保当前元素是字典
-            if not isinstance(node, dict):
-                print("警告: 期望列表元素是字典，但收到了非字典类型。")
-                continue
-
-            # 提取当前节点的 id 和 name
-            # 使用 .get() 是安全的，即使键不存在也不会报错
-            node_info = {
-                "project_id": node.get("id"),
-                "project_name": node.get("name")
-            }
-            extracted_data.append(node_info)
-
-            # 如果当前节点有 children 且 children 是一个列表，则递归处理 children
-            children = node.get("children")
-            if isinstance(children, list):
-                extract_info(children)  # 递归调用
-
-    # 获取顶层 data 列表
-    # 使用 .get('data') 是安全的，如果 'data' 键不存在，返回 None
-    initial_nodes = data_dict.get('data')
-
-    # 如果 initial_nodes 存在且是一个列表，则开始处理
-    if isinstance(initial_nodes, list):
-        extract_info(initial_nodes)
-    else:
-        print("获取到的数据结构不符合预期，未找到 'data' 列表。")
+    extracted_data = flatten_tree(data_dict.get('data'), "project_id", "project_name")
 
     # 将提取出的列表转换为 JSON 字符串
     # indent 参数用于格式化输出，ensure_ascii=False 保留中文字符和特殊字符
-    output_json_string = json.dumps(extracted_data, indent=4, ensure_ascii=False)
-
-    return output_json_string
+    return json.dumps(extracted_data, indent=4, ensure_ascii=False)
 
 
 @mcp.tool(description="根据WHartTest平台项目id去获取模块及id")
-def module_to_which_it_belongs(project_id: int) -> str:
+async def module_to_which_it_belongs(project_id: int) -> str:
     """根据WHartTest平台项目id去获取模块及id"""
-    url = base_url + f"/api/projects/{project_id}/testcase-modules/"
-
-    data_dict = requests.get(url, headers=headers).json()
-
-    # 用于存储提取出的 id 和 name 的列表
-    extracted_data = []
-
-    # 定义一个递归函数来处理嵌套的 children 列表
-    def extract_info(nodes_list):
-        if not isinstance(nodes_list, list):
-            # 如果输入的不是列表，则停止或报错，取决于期望
-            # 在您的结构中，data 和 children 应该是列表
-            print("警告: 期望输入列表，但收到了非列表类型。")
-            return
-
-        for node in nodes_list:
-            # 确保当前元素是字典
-            if not isinstance(node, dict):
-                print("警告: 期望列表元素是字典，但收到了非字典类型。")
-                continue
+    data_dict = await get_json_cached(f"/api/projects/{project_id}/testcase-modules/")
 
-            # 提取当前节点的 id 和 name
-            # 使用 .get() 是安全的，即使键不存在也不会报错
-            node_info = {
-                "module_id": node.get("id"),
-                "module_name": node.get("name")
-            }
-            extracted_data.append(node_info)
-
-            # 如果当前节点有 children 且 children 是一个列表，则递归处理 children
-            children = node.get("children")
-            if isinstance(children, list):
-                extract_info(children)  # 递归调用
-
-    # 获取顶层 data 列表
-    # 使用 .get('data') 是安全的，如果 'data' 键不存在，返回 None
-    initial_nodes = data_dict.get('data')
-
-    # 如果 initial_nodes 存在且是一个列表，则开始处理
-    if isinstance(initial_nodes, list):
-        extract_info(initial_nodes)
-    else:
-        print("获取到的数据结构不符合预期，未找到 'data' 列表。")
-
-    # 将提取出的列表转换为 JSON 字符串
-    # indent 参数用于格式化输出，ensure_ascii=False 保留中文字符和特殊字符
-    output_json_string = json.dumps(extracted_data, indent=4, ensure_ascii=False)
+    extracted_data = flatten_tree(data_dict.get('data'), "module_id", "module_name")
 
-    return output_json_string
+    return json.dumps(extracted_data, indent=4, ensure_ascii=False)
 
 @mcp.tool(description="获取WHartTest平台用例等级")
 def obtain_use_case_level() -> list:
@@ -171,38 +153,54 @@ def obtain_use_case_level() -> list:
     return ["P0","P1","P2","P3"]
 
 @mcp.tool(description="获取WHartTest平台用例名称和对应id")
-def get_the_list_of_use_cases(
+async def get_the_list_of_use_cases(
         project_id: int = Field(description='项目id'),
         module_id: int= Field(description='模块id')):
-    """获取WHartTest平台用例"""
-    url = base_url + f"/api/projects/{project_id}/testcases/?page=1&page_size=1000&search=&module_id={module_id}"
-
-    data_dict = requests.get(url, headers=headers).json()
-
-    # 用于存储提取出的 id 和 name 的列表
+    """
+    获取WHartTest平台用例
+    按页获取，最多返回 MAX_CASE_RESULTS 条；接口未分页（data为列表）时取第一次返回的结果
+    """
     extracted_data = []
-
-    for i in data_dict.get("data"):
-        extracted_data.append({"case_id": i.get("id"), "case_name": i.get("name")})
-    return  json.dumps(extracted_data, indent=4, ensure_ascii=False)
+    truncated = False
+    page = 1
+    while True:
+        data_dict = await get_json(
+            f"/api/projects/{project_id}/testcases/",
+            params={"page": page, "page_size": CASE_PAGE_SIZE, "search": "", "module_id": module_id},
+        )
+        data = data_dict.get("data") or []
+        # 分页格式：{"count":..., "next":..., "results":[...]}
+        cases = data.get("results", []) if isinstance(data, dict) else data
+
+        for i in cases:
+            if len(extracted_data) >= MAX_CASE_RESULTS:
+                truncated = True
+                break
+            extracted_data.append({"case_id": i.get("id"), "case_name": i.get("name")})
+
+        if truncated or not isinstance(data, dict) or not data.get("next"):
+            break
+        page += 1
+
+    result = json.dumps(extracted_data, indent=4, ensure_ascii=False)
+    if truncated:
+        result += f"\n(仅返回前 {MAX_CASE_RESULTS} 条用例，请缩小模块范围)"
+    return result
 
 
 @mcp.tool(description="获取WHartTest平台用例详情")
-def get_case_details(
+async def get_case_details(
         project_id: int = Field(description='项目id'),
         case_id: int= Field(description='用例id')):
     """获取WHartTest平台用例详情"""
-    url = base_url + f"/api/projects/{project_id}/testcases/{case_id}/"
+    data_dict = await get_json(f"/api/projects/{project_id}/testcases/{case_id}/")
 
-    data_dict = requests.get(url, headers=headers).json()
-
-    # 用于存储提取出的 id 和 name 的列表
     extracted_data = data_dict.get("data")
     return json.dumps(extracted_data, indent=4, ensure_ascii=False)
 
 
 @mcp.tool(description="WHartTest平台保存操作截图到对应用例中")
-def save_operation_screenshots_to_the_application_case(
+async def save_operation_screenshots_to_the_application_case(
         project_id: int = Field(description='项目id'),
         case_id: int= Field(description='用例id'),
         file_path: str= Field(description='文件路径'),
@@ -213,6 +211,7 @@ def save_operation_screenshots_to_the_application_case(
     """
     WHartTest平台保存操作截图到对应用例中
     """
+    response = None
     try:
         # 参数验证
         if not project_id:
@@ -225,11 +224,10 @@ def save_operation_screenshots_to_the_application_case(
             return "截图标题不能为空"
 
         # 检查文件是否存在
-        import os
         if not os.path.exists(file_path):
             return f"文件不存在: {file_path}"
 
-        url = base_url + f"/api/projects/{project_id}/testcases/{case_id}/upload-screenshots/"
+        url = f"/api/projects/{project_id}/testcases/{case_id}/upload-screenshots/"
 
         # 根据文件扩展名确定 MIME 类型
         file_ext = os.path.splitext(file_path)[1].lower()
@@ -241,41 +239,44 @@ def save_operation_screenshots_to_the_application_case(
         }
         content_type = mime_types.get(file_ext, 'image/png')  # 默认为 png
 
-        # 准备文件和表单数据
-        with open(file_path, 'rb') as file:
-            files = {'screenshots': (os.path.basename(file_path), file, content_type)}
+        # 在线程中读取文件，避免阻塞事件循环
+        def read_file():
+            with open(file_path, 'rb') as file:
+                return file.read()
+        file_content = await asyncio.to_thread(read_file)
+        files = {'screenshots': (os.path.basename(file_path), file_content, content_type)}
 
-            # 只添加有值的字段
-            data = {'title': title}  # title 是必填的
+        # 只添加有值的字段
+        data = {'title': title}  # title 是必填的
 
-            if description and description.strip():
-                data['description'] = description
-            if step_number is not None:
-                data['step_number'] = str(step_number)
-            if page_url and page_url.strip():
-                data['page_url'] = page_url
+        if description and description.strip():
+            data['description'] = description
+        if step_number is not None:
+            data['step_number'] = str(step_number)
+        if page_url and page_url.strip():
+            data['page_url'] = page_url
 
-            # 发起请求 - 注意这里不使用json参数，而是用data参数
-            response = requests.post(url, headers=headers, files=files, data=data)
+        # 发起请求 - 注意这里不使用json参数，而是用data参数
+        response = await get_http_client().post(url, files=files, data=data)
 
-            # 检查响应状态
-            response.raise_for_status()
+        # 检查响应状态
+        response.raise_for_status()
 
-            # 处理响应
-            if response.status_code in [200, 201]:
-                return f"截图 '{title}' 上传成功"
-            else:
-                return f"上传失败，状态码: {response.status_code}, 响应: {response.text}"
+        # 处理响应
+        if response.status_code in [200, 201]:
+            return f"截图 '{title}' 上传成功"
+        else:
+            return f"上传失败，状态码: {response.status_code}, 响应: {response.text}"
 
     except FileNotFoundError:
         return f"文件未找到: {file_path}"
-    except requests.exceptions.HTTPError as e:
-        return f"HTTP错误: {e}, 响应内容: {response.text if 'response' in locals() else '无响应内容'}"
+    except httpx.HTTPStatusError as e:
+        return f"HTTP错误: {e}, 响应内容: {response.text if response is not None else '无响应内容'}"
     except Exception as e:
         return f"上传截图时发生错误: {str(e)}"
 
 @mcp.tool(description='保存WHartTest平台功能测试用例')
-def add_functional_case(
+async def add_functional_case(
         project_id: int = Field(description='项目id'),
         name: str = Field(description='用例名称'),
         precondition: str = Field(description='前置条件'),
@@ -300,7 +301,7 @@ def add_functional_case(
         if not steps:
             return "用例步骤不能为空"
 
-        url = base_url + f"/api/projects/{project_id}/testcases/"
+        url = f"/api/projects/{project_id}/testcases/"
         data = {
             "name": name,
             "precondition": precondition,
@@ -311,10 +312,7 @@ def add_functional_case(
         }
 
         # 发起请求
-        response = requests.post(url, headers=headers, json=data)
-        print("status =", response.status_code)
-        print("content-type =", response.headers.get("Content-Type"))
-        print("body-preview =", response.text[:200])
+        response = await get_http_client().post(url, json=data)
         # 如有非 2xx 状态码直接抛异常
         response.raise_for_status()
         # 201，代表成功保存
@@ -322,9 +320,49 @@ def add_functional_case(
             return f"用例：{name}保存成功"
         else:
             return "保存失败，请重试"
-    except requests.exceptions.HTTPError as e:
-        print("HTTPError =", e)
-        return e
+    except httpx.HTTPStatusError as e:
+        logger.warning(f"保存用例失败: {e}")
+        return f"HTTP错误: {e}, 响应内容: {e.response.text[:200]}"
+    except httpx.RequestError as e:
+        return f"请求失败: {e}"
+
+@mcp.tool(description='批量保存WHartTest平台功能测试用例，一次提交多条用例，返回每条用例的保存结果')
+async def add_functional_cases_batch(
+        project_id: int = Field(description='项目id'),
+        cases: list = Field(description='用例列表，每条用例包含 module_id、name、precondition、level、notes、steps，示例：'
+                                        '[{"module_id": 1,"name": "用例名称","precondition": "前置条件","level": "P1","notes": "备注",'
+                                        '"steps": [{"description": "步骤描述1","expected_result": "预期结果1"}]}]')):
+    """
+    批量保存WHartTest平台功能测试用例
+    """
+    try:
+        if not project_id:
+            return "项目id不能为空"
+        if not cases:
+            return "用例列表不能为空"
+
+        url = f"/api/projects/{project_id}/testcases/batch-create/"
+        response = await get_http_client().post(url, json={"cases": cases})
+        body = response.json()
+        # 全部用例校验失败时接口返回400，逐条结果在 errors 中
+        data = body.get("data") if response.status_code < 400 else body.get("errors")
+        if not isinstance(data, dict) or not isinstance(data.get("results"), list):
+            response.raise_for_status()
+            return "保存失败，请重试"
+
+        lines = [f"成功保存 {data.get('created_count', 0)} 个用例，失败 {data.get('failed_count', 0)} 个"]
+        for item in data.get("results", []):
+            if item.get("status") == "created":
+                lines.append(f"[{item['index']}] 用例：{item.get('name')} 保存成功，id={item.get('id')}")
+            else:
+                lines.append(f"[{item['index']}] 保存失败：{item.get('errors')}")
+        return "\n".join(lines)
+    except httpx.HTTPStatusError as e:
+        return f"HTTP错误: {e}, 响应内容: {e.response.text[:200]}"
+    except httpx.RequestError as e:
+        return f"请求失败: {e}"
+    except ValueError as e:
+        return f"响应解析失败: {e}"
 
 if __name__ == "__main__":  # 3️⃣ 用 stdio 启动
-    mcp.run(transport="streamable-http", port=8006)
\ No newline at end of file
+    mcp.run(transport="streamable-http", port=8006)